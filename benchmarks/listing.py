@@ -0,0 +1,99 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Lists and summarizes a destination with a catalog of synthetic snapshots,
+as done by the "list" and "stats" commands, and compares this with listing
+the destination directory. The snapshot folders are created empty.
+
+Usage: listing.py [COUNT]
+"""
+
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                ".."))
+import rbackupd.catalog as catalog
+import rbackupd.constants as const
+import rbackupd.listing as listing
+import rbackupd.repository as repository
+
+INTERVALS = ("hourly", "daily", "weekly", "monthly")
+
+
+def create_destination(count):
+    destination = tempfile.mkdtemp()
+    start = datetime.datetime(2000, 1, 1)
+    names = []
+    for i in range(count):
+        date = start + datetime.timedelta(hours=i)
+        names.append("task_%s_%s.snapshot" % (
+            date.strftime("%Y-%m-%dT%H:%M:%S"), INTERVALS[i % 4]))
+    for name in names:
+        os.mkdir(os.path.join(destination, name))
+    os.mkdir(os.path.join(destination, const.STATE_DIR_NAME))
+    # a compacted catalog, as written after a scan of the destination
+    path = os.path.join(destination, const.STATE_DIR_NAME,
+                        const.CATALOG_NAME)
+    with open(path, "w") as journal:
+        journal.write(json.dumps({"op": "header", "mtime": os.stat(
+            destination).st_mtime_ns}) + "\n")
+        for name in names:
+            journal.write(json.dumps({
+                "op": "add", "name": name,
+                "stats": {"bytes": 12345678, "files": 1234,
+                          "seconds": 12.3}}) + "\n")
+    return destination
+
+
+def measure(description, function):
+    start = time.perf_counter()
+    result = function()
+    print("%-30s %8.3f s" % (description, time.perf_counter() - start))
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    destination = create_destination(count)
+    try:
+        print("%s snapshots" % count)
+        measure("listdir()", lambda: [
+            name for name in os.listdir(destination)
+            if repository.is_backup_folder(name)])
+        measure("catalog: load", lambda: catalog.Catalog(
+            destination, repository.is_backup_folder).get_names())
+        snapshots = measure("list_snapshots()", lambda: listing.list_snapshots(
+            "task", destination))
+        encoder = json.JSONEncoder(check_circular=False)
+        measure("to_json()", lambda: [
+            encoder.encode(snapshot.to_json()) for snapshot in snapshots])
+        measure("summarize()", lambda: listing.summarize(snapshots))
+        assert len(snapshots) == count
+    finally:
+        shutil.rmtree(destination)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Creates a snapshot of a synthetic tree in which some files changed by a
+single byte, once like the "hardlink" snapshot backend and once like the
+"reflink" backend, and compares the time and the space both take.
+
+The hardlink backend hardlinks unchanged files and stores changed files again
+in full, like rsync with --link-dest. The reflink backend clones the previous
+snapshot and rewrites the changed block in place, like rsync with --inplace
+--no-whole-file. The directory should be on the filesystem of the
+destination, e.g. btrfs or XFS, as the space is measured with statvfs().
+
+Usage: snapshot_backends.py DIRECTORY [FILES] [FILE_SIZE_KB] [CHANGED_PERCENT]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                ".."))
+import rbackupd.files as files
+import rbackupd.restore as restore
+
+
+def create_tree(root, count, size):
+    for index in range(count):
+        directory = os.path.join(root, "%03d" % (index % 100))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, "%06d" % index), "wb") as f:
+            f.write(os.urandom(size))
+
+
+def get_used_bytes(path):
+    os.sync()
+    st = os.statvfs(path)
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+
+def change_byte(path):
+    with open(path, "r+b") as f:
+        f.seek(os.fstat(f.fileno()).st_size // 2)
+        f.write(b"\xff")
+
+
+def hardlink_snapshot(previous, snapshot, changed):
+    for (directory, _, names) in os.walk(previous):
+        target = os.path.join(snapshot, os.path.relpath(directory, previous))
+        os.makedirs(target, exist_ok=True)
+        for name in names:
+            path = os.path.join(directory, name)
+            if path in changed:
+                shutil.copyfile(path, os.path.join(target, name))
+                change_byte(os.path.join(target, name))
+            else:
+                os.link(path, os.path.join(target, name))
+
+
+def reflink_snapshot(previous, snapshot, changed):
+    restore.copy_tree(previous, snapshot)
+    for path in changed:
+        change_byte(os.path.join(snapshot, os.path.relpath(path, previous)))
+
+
+def measure(description, root, function):
+    used = get_used_bytes(root)
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    print("%-10s %8.3f s %10.1f MB" % (
+        description, seconds, (get_used_bytes(root) - used) / 1e6))
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    size = (int(sys.argv[3]) if len(sys.argv) > 3 else 256) * 1024
+    percent = float(sys.argv[4]) if len(sys.argv) > 4 else 5
+    root = tempfile.mkdtemp(dir=sys.argv[1])
+    try:
+        previous = os.path.join(root, "previous")
+        create_tree(previous, count, size)
+        paths = sorted(os.path.join(directory, name)
+                       for (directory, _, names) in os.walk(previous)
+                       for name in names)
+        random.seed(0)
+        changed = set(random.sample(paths, int(count * percent / 100)))
+        print("%s files of %s KB, %s changed, reflinks %ssupported" % (
+            count, size // 1024, len(changed),
+            "" if files.supports_reflink(root) else "not "))
+        measure("hardlink", root,
+                lambda: hardlink_snapshot(
+                    previous, os.path.join(root, "hardlink"), changed))
+        measure("reflink", root,
+                lambda: reflink_snapshot(
+                    previous, os.path.join(root, "reflink"), changed))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
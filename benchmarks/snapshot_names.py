@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Parses and sorts synthetic snapshot names, comparing the snapshot records of
+the repository module with the datetime.strptime() based parsing they
+replaced.
+
+Usage: snapshot_names.py [COUNT]
+"""
+
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                ".."))
+import rbackupd.repository as repository
+
+INTERVALS = ("hourly", "daily", "weekly", "monthly")
+
+
+def get_names(count):
+    start = datetime.datetime(2000, 1, 1)
+    names = []
+    for _ in range(count):
+        date = start + datetime.timedelta(
+            seconds=random.randrange(20 * 365 * 86400))
+        names.append("task_%s_%s.snapshot" % (
+            date.strftime("%Y-%m-%dT%H:%M:%S"), random.choice(INTERVALS)))
+    return names
+
+
+def parse_strptime(name):
+    date = datetime.datetime.strptime(name.split("_")[1],
+                                      "%Y-%m-%dT%H:%M:%S")
+    interval = name.split("_")[2]
+    return (date, interval[:interval.find(repository.BACKUP_SUFFIX)])
+
+
+def measure(description, function):
+    start = time.perf_counter()
+    result = function()
+    print("%-30s %8.3f s" % (description, time.perf_counter() - start))
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    random.seed(0)
+    names = get_names(count)
+    print("%s snapshot names" % count)
+
+    old = measure("strptime: parse",
+                  lambda: [parse_strptime(name) for name in names])
+    measure("strptime: sort", lambda: sorted(old, key=lambda item: item[0]))
+    measure("parse_folder_name()",
+            lambda: [repository.parse_folder_name(name) for name in names])
+    new = measure("records: parse",
+                  lambda: [repository.BackupFolder(name) for name in names])
+    measure("records: sort",
+            lambda: sorted(new, key=lambda backup: backup.epoch))
+
+    for (item, backup) in zip(old[:1000], new[:1000]):
+        assert (item[0], item[1]) == (backup.date, backup.interval_name)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,24 +17,42 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+import contextlib
 import datetime
 import logging
 import logging.handlers
 import os
 import re
+import signal
 import subprocess
 import sys
 import time
 
+from . import archive
+from . import catchup
+from . import commands
+from . import catalog
 from . import config
+from . import control
 from . import constants as const
-from . import cron
+from . import estimate
 from . import files
-from . import filesystem
-from . import interval
+from . import filters
+from . import history
+from . import lease
 from . import levelhandler
+from . import mounts
+from . import profiling
+from . import progress
+from . import replicate
 from . import repository
+from . import restore
 from . import rsync
+from . import rsynclog
+from . import schedule
+from . import settings
+from . import ssh
+from . import verify
 
 
 def set_up_logging(console_loglevel, logfile_loglevel):
@@ -110,7 +128,7 @@ def change_to_logfile_logging(logfile_path, loglevel):
     if logging_memory_handler is None:
         pass
 
-    logfile_handler = logging.handlers.RotatingFileHandler(
+    logfile_handler = profiling.SpanningFileHandler(
         logfile_path,
         mode='a',
         maxBytes=1000000,
@@ -132,10 +150,14 @@ def change_to_logfile_logging(logfile_path, loglevel):
     logging_memory_handler = None
 
 
-def main(config_file, console_loglevel):
+def main(config_file, console_loglevel, command=None, command_args=None):
     try:
         change_console_logging_level(console_loglevel)
-        run(config_file)
+        if command is None:
+            run(config_file)
+        else:
+            sys.exit(commands.run(load_settings(config_file), command,
+                                  command_args))
     except KeyboardInterrupt:
         logger.info("Keyboard interrupt.")
         sys.exit(const.EXIT_KEYBOARD_INTERRUPT)
@@ -144,354 +166,475 @@ def main(config_file, console_loglevel):
         sys.exit(err.code)
 
 
-def run(config_file):
-    if not os.path.isfile(config_file):
-        if not os.path.exists(config_file):
-            logger.critical("Config file not found. Aborting.")
-            sys.exit(const.EXIT_CONFIG_FILE_NOT_FOUND)
-        else:
-            logger.critical("Invalid config file. Aborting.")
-            sys.exit(const.EXIT_INVALID_CONFIG_FILE)
-
+def load_settings(config_file):
+    """
+    Loads the settings from the configuration file, exits if it is invalid.
+    :param config_file: The path of the configuration file.
+    :type config_file: string
+    :rtype: settings.Settings instance
+    """
     try:
-        conf = config.Config(config_file)
+        return settings.load(config_file)
+    except settings.SettingsError as err:
+        logger.critical("%s Aborting.", err.message)
+        sys.exit(err.exit_code)
     except config.ParseError as err:
-        logger.critical("Invalid config file:\nerror line %s (\"s\"): %s",
+        logger.critical("Invalid config file:\nerror line %s (\"%s\"): %s. "
+                        "Aborting.",
                         err.lineno,
                         err.line,
                         err.message)
-
-    # this is the [logging] section
-    conf_section_logging = conf.get_section(const.CONF_SECTION_LOGGING)
-    conf_logfile_path = conf_section_logging[const.CONF_KEY_LOGFILE_PATH][0]
-    conf_loglevel = conf_section_logging[const.CONF_KEY_LOGLEVEL][0]
-
-    if conf_loglevel not in const.CONF_VALUES_LOGLEVEL:
-        logger.critical("Invalid value for key \"%s\": \"%s\". Valid values: "
-                        "%s. Aborting.",
-                        const.CONF_KEY_LOGLEVEL,
-                        conf_loglevel,
-                        ",".join(const.CONF_VALUES_LOGLEVEL))
         sys.exit(const.EXIT_INVALID_CONFIG_FILE)
-    if conf_loglevel == "quiet":
-        conf_loglevel = logging.WARNING
-    elif conf_loglevel == "default":
-        conf_loglevel = logging.INFO
-    elif conf_loglevel == "verbose":
-        conf_loglevel = logging.VERBOSE
-    elif conf_loglevel == "debug":
-        conf_loglevel = logging.DEBUG
-    else:
-        assert(False)
 
-    logfile_dir = os.path.dirname(conf_logfile_path)
+
+def run(config_file):
+    global _reload_requested, _profile_requested
+    conf = load_settings(config_file)
+
+    logfile_dir = os.path.dirname(conf.logfile)
     if not os.path.exists(logfile_dir):
         os.mkdir(logfile_dir)
 
     # now we can change from logging into memory to logging to the logfile
-    change_to_logfile_logging(logfile_path=conf_logfile_path,
-                              loglevel=conf_loglevel)
-
-    # this is the [rsync] section
-    conf_section_rsync = conf.get_section(const.CONF_SECTION_RSYNC)
-    conf_rsync_cmd = conf_section_rsync.get(const.CONF_KEY_RSYNC_CMD, "rsync")
-
-    conf_sections_mounts = conf.get_sections(const.CONF_SECTION_MOUNT)
-
-    # these are the [default] options that can be overwritten in the specific
-    # [task] section
-    conf_section_default = conf.get_section(const.CONF_SECTION_DEFAULT)
-    conf_default_rsync_logfile = conf_section_default.get(
-        const.CONF_KEY_RSYNC_LOGFILE, None)
-    conf_default_rsync_logfile_name = conf_section_default.get(
-        const.CONF_KEY_RSYNC_LOGFILE_NAME, None)
-    conf_default_rsync_logfile_format = conf_section_default.get(
-        const.CONF_KEY_RSYNC_LOGFILE_FORMAT, None)
-
-    conf_default_filter_patterns = conf_section_default.get(
-        const.CONF_KEY_FILTER_PATTERNS, None)
-
-    conf_default_include_patterns = conf_section_default.get(
-        const.CONF_KEY_INCLUDE_PATTERNS, None)
-    conf_default_exclude_patterns = conf_section_default.get(
-        const.CONF_KEY_EXCLUDE_PATTERNS, None)
-
-    conf_default_include_files = conf_section_default.get(
-        const.CONF_KEY_INCLUDE_FILE, None)
-    conf_default_exclude_files = conf_section_default.get(
-        const.CONF_KEY_EXCLUDE_FILE, None)
-
-    conf_default_create_destination = conf_section_default.get(
-        const.CONF_KEY_CREATE_DESTINATION, None)
-
-    conf_default_one_filesystem = conf_section_default.get(
-        const.CONF_KEY_ONE_FILESYSTEM, None)
-
-    conf_default_rsync_args = conf_section_default.get(
-        const.CONF_KEY_RSYNC_ARGS, None)
-
-    conf_default_ssh_args = conf_section_default.get(
-        const.CONF_KEY_SSH_ARGS, None)
-
-    conf_default_overlapping = conf_section_default.get(
-        const.CONF_KEY_OVERLAPPING, None)
-
-    conf_sections_tasks = conf.get_sections(const.CONF_SECTION_TASK)
-
-    if conf_sections_mounts is None:
-        conf_sections_mounts = []
-
-    for mount in conf_sections_mounts:
-        if len(mount) == 0:
+    change_to_logfile_logging(logfile_path=conf.logfile,
+                              loglevel=conf.loglevel)
+    progress.set_log_interval(conf.progress_interval)
+
+    for mount in conf.mounts:
+        mounts.prepare_mountpoints(mount)
+    mount_tracker = mounts.MountTracker(conf.mounts)
+    mount_tracker.update()
+
+    repositories = collections.OrderedDict()
+    # tasks whose repository will be created when their destination becomes
+    # available
+    deferred = set()
+    # tasks that have to catch up with missed snapshots, as rbackupd was not
+    # running or their destination was not available, and their plans
+    catchup_needed = set(conf.tasks.keys())
+    catchup_plans = {}
+    for task in conf.tasks.values():
+        if not mount_tracker.is_available(task.destination):
+            deferred.add(task.name)
             continue
+        try:
+            repo = create_repository(task)
+        except settings.SettingsError as err:
+            logger.critical("%s Aborting.", err.message)
+            sys.exit(err.exit_code)
+        if repo is not None:
+            repositories[task.name] = repo
+
+    if conf.ssh.multiplex:
+        try:
+            ssh_pool = ssh.ConnectionPool(const.SSH_CMD,
+                                          control_dir=conf.ssh.control_dir,
+                                          max_sessions=conf.ssh.max_sessions,
+                                          max_age=conf.ssh.max_age)
+        except ssh.ControlDirError as err:
+            logger.critical("%s Aborting.", err.message)
+            sys.exit(const.EXIT_INVALID_CONFIG_FILE)
+    else:
+        ssh_pool = None
+
+    replicator = replicate.Replicator(
+        conf.rsync_cmd,
+        lambda repo: handle_expired_backups(repo, datetime.datetime.now()))
+    # the latest snapshot of every task that was submitted for replication
+    replicated = {}
+    archiver = archive.Archiver()
+    indexer = history.Indexer()
+    controller = control.Controller()
+    try:
+        control_server = control.ControlServer(conf.control_socket,
+                                               controller)
+    except OSError as err:
+        logger.error("Could not create control socket \"%s\": %s",
+                     conf.control_socket, err)
+        control_server = None
+    if conf.cluster is not None:
+        cluster = lease.Cluster(conf.cluster.directory,
+                                conf.cluster.instance,
+                                conf.cluster.lease_time)
+        cluster.start()
+        logger.verbose("Joined cluster \"%s\" as \"%s\".",
+                       conf.cluster.directory, conf.cluster.instance)
+    else:
+        cluster = None
 
-        conf_partition = mount[const.CONF_KEY_PARTITION][0]
-        conf_mountpoint = mount[const.CONF_KEY_MOUNTPOINT][0]
-        conf_mountpoint_ro = mount.get(const.CONF_KEY_MOUNTPOINT_RO, [None])[0]
-        conf_mountpoint_options = mount.get(
-            const.CONF_KEY_MOUNTPOINT_OPTIONS, [None])[0]
-        conf_mountpoint_ro_options = mount.get(
-            const.CONF_KEY_MOUNTPOINT_RO_OPTIONS, [None])[0]
-
-        if conf_mountpoint_options is None:
-            conf_mountpoint_options = ['rw']
-        else:
-            conf_mountpoint_options = conf_mountpoint_options.split(',')
-            conf_mountpoint_options.append('rw')
+    signal.signal(signal.SIGHUP, _request_reload)
+    signal.signal(signal.SIGUSR1, _request_profile)
 
-        if conf_mountpoint_ro_options is None:
-            conf_mountpoint_ro_options = ['ro']
-        else:
-            conf_mountpoint_ro_options = conf_mountpoint_ro_options.split(',')
-            conf_mountpoint_ro_options.append('ro')
-
-        conf_mountpoint_create = mount[const.CONF_KEY_MOUNTPOINT_CREATE][0]
-
-        conf_mountpoint_ro_create = mount.get(
-            const.CONF_KEY_MOUNTPOINT_RO_CREATE, [None])[0]
-        if (conf_mountpoint_ro is not None and
-                conf_mountpoint_ro_create is None):
-            logger.critical("Key \"mountpoint_ro_create\" needed if key "
-                            "\"mountpoint_ro\" is present. Aborting.")
-            sys.exit(const.EXIT_NO_MOUNTPOINT_CREATE)
-
-        if (conf_mountpoint_ro is not None and conf_mountpoint_ro_create and
-                not os.path.exists(conf_mountpoint_ro)):
-            os.mkdir(conf_mountpoint_ro)
-        if not os.path.exists(conf_mountpoint_ro):
-            logger.critical("Path of \"mountpoint_ro\" does not exist. "
-                            "Aborting.")
-            sys.exit()
-        if conf_mountpoint_create and not os.path.exists(conf_mountpoint):
-            os.mkdir(conf_mountpoint)
-        if not os.path.exists(conf_mountpoint):
-            logger.critical("Path of \"mountpoint\" does not exist. Aborting")
-            sys.exit()
-
-        if conf_partition.startswith('UUID'):
-            uuid = conf_partition.split('=')[1]
-            partition_identifier = filesystem.PartitionIdentifier(uuid=uuid)
-        elif conf_partition.startswith('LABEL'):
-            label = conf_partition.split('=')[1]
-            partition_identifier = filesystem.PartitionIdentifier(label=label)
-        else:
-            partition_identifier = filesystem.PartitionIdentifier(
-                path=conf_device)
-
-        partition = filesystem.Partition(partition_identifier,
-                                         filesystem="auto")
-
-        mountpoint = filesystem.Mountpoint(
-            path=conf_mountpoint,
-            options=conf_mountpoint_options)
-        # How to get two mounts of the same device with different rw/ro:
-        # mount readonly
-        # bind readonly to the writeable mountpoint without altering rw/ro
-        # remount writeable mountpoint with rw
-        if conf_mountpoint_ro is not None:
-            mountpoint_ro = filesystem.Mountpoint(
-                path=conf_mountpoint_ro,
-                options=conf_mountpoint_ro_options)
-            try:
-                partition.mount(mountpoint_ro)
-            except filesystem.MountpointInUseError as err:
-                logger.warning("Mountpoint \"%s\" already in use. "
-                               "Skipping mounting." % err.path)
-
-            try:
-                mountpoint_ro.bind(mountpoint)
-            except filesystem.MountpointInUseError as err:
-                logger.warning("Mountpoint \"%s\" already in use. "
-                               "Skipping mounting." % err.path)
-            mountpoint.remount(("rw", "relatime", "noexec", "nosuid"))
-        else:
-            try:
-                partition.mount(mountpoint)
-            except filesystem.MountpointInUseError as err:
-                logger.warning("Mountpoint \"%s\" already in use. "
-                               "Skipping mounting.", err.path)
-
-    repositories = []
-    for task in conf_sections_tasks:
-        # these are the options given in the specific tasks. if none are given,
-        # the default values from the [default] sections will be used.
-        conf_rsync_logfile = task.get(
-            const.CONF_KEY_RSYNC_LOGFILE, conf_default_rsync_logfile)
-        conf_rsync_logfile_name = task.get(const.CONF_KEY_RSYNC_LOGFILE_NAME,
-                                           conf_default_rsync_logfile_name)[0]
-        conf_rsync_logfile_format = task.get(
-            const.CONF_KEY_RSYNC_LOGFILE_FORMAT,
-            conf_default_rsync_logfile_format)[0]
-
-        conf_filter_patterns = task.get(
-            const.CONF_KEY_FILTER_PATTERNS, conf_default_filter_patterns)
-
-        conf_include_patterns = task.get(
-            const.CONF_KEY_INCLUDE_PATTERNS, conf_default_include_patterns)
-        conf_exclude_patterns = task.get(
-            const.CONF_KEY_EXCLUDE_PATTERNS, conf_default_exclude_patterns)
-
-        conf_include_files = task.get(
-            const.CONF_KEY_INCLUDE_FILE, conf_default_include_files)
-        conf_exclude_files = task.get(
-            const.CONF_KEY_EXCLUDE_FILE, conf_default_exclude_files)
-
-        conf_create_destination = task.get(
-            const.CONF_KEY_CREATE_DESTINATION, conf_default_create_destination)
-
-        conf_one_filesystem = task.get(
-            const.CONF_KEY_ONE_FILESYSTEM, conf_default_one_filesystem)[0]
-
-        conf_rsync_args = task.get(
-            const.CONF_KEY_RSYNC_ARGS, conf_default_rsync_args)
-
-        conf_ssh_args = task.get(
-            const.CONF_KEY_SSH_ARGS, conf_default_ssh_args)
-        conf_ssh_args = const.SSH_CMD + " " + " ".join(conf_ssh_args)
-
-        conf_overlapping = task.get(
-            const.CONF_KEY_OVERLAPPING, conf_default_overlapping)[0]
-
-        # these are the options that are not given in the [default] section.
-        conf_destination = task[const.CONF_KEY_DESTINATION][0]
-        conf_sources = task[const.CONF_KEY_SOURCE]
-
-        if conf_overlapping not in ["single", "hardlink", "symlink"]:
-            logger.critical("Invalid value for key \"overlapping\": %s"
-                            "Valid values: \"single\", \"hardlink\", "
-                            "\"symlink\". Aborting.", conf_overlapping)
-            sys.exit(EXIT_INVALID_CONFIG_FILE)
-
-        # now we can check the values
-        if not os.path.exists(conf_destination):
-            if not conf_create_destination:
-                logger.error("Destination \"%s\" does not exists, will no be "
-                             "created. Repository will be skipped.",
-                             conf_destination)
-                continue
-        if not os.path.isdir(conf_destination):
-            logger.critical("Destination \"%s\" not a directory. Aborting.",
-                            conf_destination)
-            sys.exit(const.EXIT_INVALID_DESTINATION)
-
-        if conf_include_files is not None:
-            for include_file in conf_include_files:
-                if include_file is None:
+    try:
+        while True:
+            if _profile_requested:
+                _profile_requested = False
+                if not profiling.request():
+                    logger.info("Profiling is already running.")
+            profiling.begin_cycle()
+            with profiling.span("config"):
+                if _reload_requested:
+                    _reload_requested = False
+                    conf = reload_settings(config_file, conf, repositories,
+                                           deferred, mount_tracker)
+
+                mount_tracker.update()
+                create_deferred_repositories(conf, repositories, deferred,
+                                             mount_tracker)
+                controller.set_tasks(list(conf.tasks.keys()))
+                for name in deferred:
+                    controller.set_unavailable(name)
+
+            start = datetime.datetime.now()
+            with profiling.span("schedule"):
+                # the urgency of unavailable tasks cannot be determined,
+                # they are deferred after all others
+                available = [repo for repo in repositories.values()
+                             if mount_tracker.is_available(repo.destination)]
+                due = (catchup_needed | controller.get_triggered() |
+                       set(name for (name, plan) in catchup_plans.items()
+                           if plan.is_due(start)))
+                ordered = schedule.order(
+                    available,
+                    dict((name, task.priority)
+                         for (name, task) in conf.tasks.items()),
+                    start, due)
+                ordered.extend(repo for repo in repositories.values()
+                               if repo not in available)
+            for repo in ordered:
+                if not mount_tracker.is_available(repo.destination):
+                    logger.verbose("Destination of task \"%s\" not "
+                                   "available, deferring.", repo.name)
+                    catchup_needed.add(repo.name)
+                    controller.set_unavailable(repo.name)
                     continue
-                if not os.path.exists(include_file):
-                    logger.critical("Include file \"%s\" not found. "
-                                    "Aborting.", include_file)
-                    sys.exit(const.EXIT_INCLUDE_FILE_NOT_FOUND)
-                elif not os.path.isfile(include_file):
-                    logger.critical("Include file \"%s\" is not a file. "
-                                    "Aborting.", include_file)
-                    sys.exit(const.EXIT_INCLUDE_FILE_INVALID)
-
-        if conf_exclude_files is not None:
-            for exclude_file in conf_exclude_files:
-                if exclude_file is None:
+                if cluster is not None and not cluster.claim(
+                        repo.name, repo.destination,
+                        busy=bool(replicator.get_in_use(repo.destination) |
+                                  archiver.get_in_use(repo.destination) |
+                                  indexer.get_in_use(repo.destination))):
+                    logger.verbose("Task \"%s\" is run by another "
+                                   "instance.", repo.name)
+                    # the other instance may have missed snapshots when
+                    # the task comes back
+                    catchup_needed.add(repo.name)
+                    controller.set_unavailable(repo.name)
                     continue
-                if not os.path.exists(exclude_file):
-                    logger.critical("Exclude file \"%s\" not found. "
-                                    "Aborting.", exclude_file)
-                    sys.exit(const.EXIT_EXCULDE_FILE_NOT_FOUND)
-                elif not os.path.isfile(exclude_file):
-                    logger.critical("Exclude file \"%s\" is not a file. "
-                                    "Aborting.", exclude_file)
-                    sys.exit(const.EXIT_EXCLUDE_FILE_INVALID)
-
-        if conf_rsync_logfile:
-            conf_rsync_logfile_options = rsync.LogfileOptions(
-                conf_rsync_logfile_name, conf_rsync_logfile_format)
-        else:
-            conf_rsync_logfile_options = None
-
-        conf_rsyncfilter = rsync.Filter(conf_include_patterns,
-                                        conf_exclude_patterns,
-                                        conf_include_files,
-                                        conf_exclude_files,
-                                        conf_filter_patterns)
-
-        rsync_args = []
-        for arg in conf_rsync_args:
-            rsync_args.extend(arg.split())
-        conf_rsync_args = rsync_args
-
-        if conf_one_filesystem:
-            conf_rsync_args.append("-x")
-
-        ssh_args = []
-        if conf_ssh_args is not None:
-            ssh_args = ["--rsh", conf_ssh_args]
-        conf_rsync_args.extend(ssh_args)
-
-        conf_taskname = task[const.CONF_KEY_TASKNAME][0]
-        conf_task_intervals = task[const.CONF_KEY_INTERVAL]
-        conf_task_keeps = task[const.CONF_KEY_KEEP]
-        conf_task_keep_age = task[const.CONF_KEY_KEEP_AGE]
-
-        task_keep_age = collections.OrderedDict()
-        for (backup_interval, max_age) in conf_task_keep_age.items():
-            task_keep_age[backup_interval] = \
-                interval.interval_to_oldest_datetime(max_age)
-
-        repositories.append(
-            repository.Repository(conf_sources,
-                                  conf_destination,
-                                  conf_taskname,
-                                  conf_task_intervals,
-                                  conf_task_keeps,
-                                  task_keep_age,
-                                  conf_rsyncfilter,
-                                  conf_rsync_logfile_options,
-                                  conf_rsync_args))
-
-    while True:
-        start = datetime.datetime.now()
-        for repo in repositories:
-
-            for (backup_interval, max_age) in conf_task_keep_age.items():
-                task_keep_age[backup_interval] = \
-                    interval.interval_to_oldest_datetime(max_age)
-            repo.keep_age = task_keep_age
-
-            create_backups_if_necessary(repo, conf_overlapping,
-                                        conf_rsync_cmd)
-            handle_expired_backups(repo, start)
-
-        # we have to get the current time again, as the above might take a lot
-        # of time
-        now = datetime.datetime.now()
-        if now.minute == 59:
-            wait_seconds = 60 - now.second
+                task = conf.tasks[repo.name]
+                repo.keep_age = task.get_keep_age()
+
+                if repo.name in catchup_needed:
+                    catchup_needed.remove(repo.name)
+                    catchup_plans[repo.name] = plan_catchup(repo, task,
+                                                            start)
+                if controller.is_paused(repo.name):
+                    logger.verbose("Task \"%s\" is paused.", repo.name)
+                else:
+                    with profiling.span("snapshots", task=repo.name):
+                        create_snapshots(repo, task, catchup_plans,
+                                         controller, conf.rsync_cmd,
+                                         ssh_pool)
+                with profiling.span("expiry", task=repo.name):
+                    handle_expired_backups(
+                        repo, start,
+                        replicator.get_in_use(repo.destination) |
+                        archiver.get_in_use(repo.destination) |
+                        indexer.get_in_use(repo.destination))
+                indexer.submit(task)
+                if len(task.replicate_to) != 0:
+                    latest = repo.get_latest_backup()
+                    if (latest is not None and
+                            latest.name != replicated.get(repo.name)):
+                        replicator.submit(task)
+                        replicated[repo.name] = latest.name
+                if (task.archive_after is not None and
+                        len(archive.get_candidates(
+                            repo.backups, repo.packs.get_names(),
+                            start - task.archive_after)) != 0):
+                    archiver.submit(task)
+                controller.update(repo, get_next_time(
+                    repo, catchup_plans.get(repo.name),
+                    datetime.datetime.now()))
+            profiling.end_cycle(os.path.dirname(conf.logfile))
+
+            # we have to get the current time again, as the above might take a
+            # lot of time
+            now = datetime.datetime.now()
+            if now.minute == 59:
+                wait_seconds = 60 - now.second
+            else:
+                nextmin = now.replace(minute=now.minute+1, second=0,
+                                      microsecond=0)
+                wait_seconds = (nextmin - now).seconds + 1
+            # triggered snapshots end the wait early
+            controller.wait(wait_seconds)
+    finally:
+        if control_server is not None:
+            control_server.close()
+        indexer.close()
+        archiver.close()
+        replicator.close()
+        if cluster is not None:
+            cluster.close()
+        mount_tracker.close()
+        if ssh_pool is not None:
+            logger.verbose("Closing ssh master connections.")
+            ssh_pool.close()
+
+
+def _request_reload(signum, frame):
+    # we must not reload in the signal handler, as that might interrupt a
+    # running snapshot. the main loop picks the request up before its next
+    # cycle.
+    global _reload_requested
+    _reload_requested = True
+
+
+def _request_profile(signum, frame):
+    # like reloading, profiling starts with the next cycle
+    global _profile_requested
+    _profile_requested = True
+
+
+def reload_settings(config_file, old_conf, repositories, deferred,
+                    mount_tracker):
+    """
+    Loads the configuration file again and updates all repositories whose
+    task changed. Repositories of unchanged tasks are kept as they are.
+    :param config_file: The path of the configuration file.
+    :type config_file: string
+    :param old_conf: The currently active settings.
+    :type old_conf: settings.Settings instance
+    :param repositories: The repositories of all active tasks by task name,
+    will be updated in place.
+    :type repositories: collections.OrderedDict
+    :param deferred: The names of the tasks whose destination is not
+    available, will be updated in place.
+    :type deferred: set
+    :param mount_tracker: The state of the [mount] sections.
+    :type mount_tracker: mounts.MountTracker instance
+    :returns: The new settings, or the old ones if the new configuration is
+    invalid.
+    :rtype: settings.Settings instance
+    """
+    logger.info("Reloading configuration.")
+    try:
+        new_conf = settings.load(config_file)
+    except settings.SettingsError as err:
+        logger.error("%s Keeping old configuration.", err.message)
+        return old_conf
+    except config.ParseError as err:
+        logger.error("Invalid config file:\nerror line %s (\"%s\"): %s. "
+                     "Keeping old configuration.",
+                     err.lineno,
+                     err.line,
+                     err.message)
+        return old_conf
+
+    if new_conf.logfile != old_conf.logfile:
+        logger.warning("Changes of the logfile take effect after a restart.")
+    if new_conf.loglevel != old_conf.loglevel:
+        change_file_logging_level(new_conf.loglevel)
+    progress.set_log_interval(new_conf.progress_interval)
+    if new_conf.mounts != old_conf.mounts:
+        logger.warning("Changes of [mount] sections take effect after a "
+                       "restart.")
+    if new_conf.ssh != old_conf.ssh:
+        logger.warning("Changes of the [ssh] section take effect after a "
+                       "restart.")
+    if new_conf.control_socket != old_conf.control_socket:
+        logger.warning("Changes of the control socket take effect after a "
+                       "restart.")
+    if new_conf.cluster != old_conf.cluster:
+        logger.warning("Changes of the [cluster] section take effect after a "
+                       "restart.")
+
+    for name in list(repositories.keys()):
+        if name not in new_conf.tasks:
+            logger.info("Task \"%s\" removed.", name)
+            del repositories[name]
+    deferred.intersection_update(new_conf.tasks.keys())
+
+    updated = collections.OrderedDict()
+    for (name, task) in new_conf.tasks.items():
+        if (name in repositories and name in old_conf.tasks and
+                task == old_conf.tasks[name]):
+            updated[name] = repositories[name]
+            continue
+        if (name in deferred and name in old_conf.tasks and
+                task == old_conf.tasks[name]):
+            continue
+        if name in old_conf.tasks:
+            logger.info("Task \"%s\" changed.", name)
         else:
-            nextmin = now.replace(minute=now.minute+1, second=0, microsecond=0)
-            wait_seconds = (nextmin - now).seconds + 1
-        time.sleep(wait_seconds)
-
-
-def create_backups_if_necessary(repository, conf_overlapping, conf_rsync_cmd):
-    necessary_backups = repository.get_necessary_backups()
+            logger.info("Task \"%s\" added.", name)
+        if not mount_tracker.is_available(task.destination):
+            deferred.add(name)
+            continue
+        deferred.discard(name)
+        try:
+            repo = create_repository(task)
+        except settings.SettingsError as err:
+            logger.error("%s Task \"%s\" will be skipped.", err.message, name)
+            continue
+        if repo is not None:
+            updated[name] = repo
+    repositories.clear()
+    repositories.update(updated)
+    return new_conf
+
+
+def create_deferred_repositories(conf, repositories, deferred,
+                                 mount_tracker):
+    """
+    Creates the repositories of all deferred tasks whose destination became
+    available.
+    :param conf: The settings.
+    :type conf: settings.Settings instance
+    :param repositories: The repositories of all active tasks by task name,
+    will be updated in place.
+    :type repositories: collections.OrderedDict
+    :param deferred: The names of the deferred tasks, will be updated in
+    place.
+    :type deferred: set
+    :param mount_tracker: The state of the [mount] sections.
+    :type mount_tracker: mounts.MountTracker instance
+    """
+    for name in list(deferred):
+        task = conf.tasks[name]
+        if not mount_tracker.is_available(task.destination):
+            continue
+        deferred.remove(name)
+        try:
+            repo = create_repository(task)
+        except settings.SettingsError as err:
+            logger.error("%s Task \"%s\" will be skipped.", err.message, name)
+            continue
+        if repo is not None:
+            repositories[name] = repo
+
+
+def create_repository(task):
+    """
+    Creates the repository of a task.
+    :param task: The settings of the task.
+    :type task: settings.TaskSettings instance
+    :returns: The repository, or None if the destination does not exist and
+    should not be created.
+    :rtype: repository.Repository instance
+    :raises settings.SettingsError: if the destination is not a directory.
+    """
+    if not os.path.exists(task.destination):
+        if not task.create_destination:
+            logger.error("Destination \"%s\" does not exists, will no be "
+                         "created. Repository will be skipped.",
+                         task.destination)
+            return None
+        os.makedirs(task.destination)
+    if not os.path.isdir(task.destination):
+        raise settings.SettingsError("Destination \"%s\" not a directory." %
+                                     task.destination,
+                                     const.EXIT_INVALID_DESTINATION)
+
+    return repository.create(task)
+
+
+def plan_catchup(repo, task, now):
+    """
+    Plans how a repository catches up with missed snapshots.
+    :rtype: catchup.CatchupPlan instance
+    """
+    plan = catchup.plan_catchup(repo, now, task.catchup, task.catchup_window)
+    for (interval_name, count) in plan.missed.items():
+        logger.info("Task \"%s\" missed %s snapshot(s) of interval \"%s\".",
+                    repo.name, count, interval_name)
+    if len(plan.skipped) != 0:
+        logger.info("Task \"%s\" skips the missed snapshots of interval(s) "
+                    "%s.", repo.name, ", ".join(plan.skipped))
+    if len(plan.missed) != 0 and plan.due > now:
+        logger.info("Task \"%s\" catches up at %s.", repo.name,
+                    plan.due.strftime("%H:%M:%S"))
+    return plan
+
+
+def create_snapshots(repo, task, catchup_plans, controller, rsync_cmd,
+                     ssh_pool):
+    """
+    Creates the snapshots of a task that are due: a triggered snapshot, the
+    missed snapshots of a catch-up plan or the regular ones, and records the
+    result in the controller.
+    :param catchup_plans: The pending catch-up plans by task name, will be
+    updated in place.
+    :type catchup_plans: dict
+    :param controller: The state shared with the control socket.
+    :type controller: control.Controller instance
+    """
+    latest = repo.get_latest_backup()
+    result = None
+    controller.start(repo.name)
+    try:
+        interval_name = controller.pop_trigger(repo.name)
+        if interval_name is not None:
+            create_backup(repo.get_backup_params(interval_name), rsync_cmd,
+                          ssh_pool)
+        plan = catchup_plans.get(repo.name)
+        if plan is None:
+            create_backups_if_necessary(repo, task.overlapping, rsync_cmd,
+                                        ssh_pool)
+        elif plan.is_due(datetime.datetime.now()):
+            del catchup_plans[repo.name]
+            run_catchup(repo, plan, task.overlapping, rsync_cmd, ssh_pool)
+    except rsync.Cancelled:
+        logger.warning("Snapshot of task \"%s\" cancelled.", repo.name)
+        result = "cancelled"
+    finally:
+        new_latest = repo.get_latest_backup()
+        snapshot = None
+        if (result is None and new_latest is not None and
+                (latest is None or new_latest.name != latest.name)):
+            result = "created"
+            snapshot = new_latest.name
+        controller.finish(repo.name, result, snapshot)
+
+
+def get_next_time(repo, plan, now):
+    """
+    Determines the next time a snapshot of a repository is scheduled.
+    :param plan: The pending catch-up plan of the repository, or None.
+    :type plan: catchup.CatchupPlan instance
+    :returns: The time, or None if no snapshot will ever be created.
+    :rtype: datetime.datetime instance
+    """
+    times = [cronjob.get_next_occurence(now)
+             for (_, cronjob) in repo.intervals]
+    if plan is not None and len(plan.missed) != 0:
+        times.append(plan.due)
+    times = [next_time for next_time in times if next_time is not None]
+    return min(times) if len(times) != 0 else None
+
+
+def run_catchup(repository, plan, conf_overlapping, conf_rsync_cmd,
+                ssh_pool):
+    """
+    Catches up with missed snapshots by creating a single snapshot for all
+    missed intervals.
+    """
+    for interval_name in plan.skipped:
+        repository.skip_occurences(interval_name, plan.created)
+    if len(plan.missed) == 0:
+        return
+    # a single snapshot per interval would take one cycle and one transfer
+    # per interval, linking is equivalent and much faster
+    if conf_overlapping == "single":
+        conf_overlapping = "hardlink"
+    create_linked_backups(repository, list(plan.missed.keys()),
+                          conf_overlapping, conf_rsync_cmd, ssh_pool)
+
+
+def create_backups_if_necessary(repository, conf_overlapping, conf_rsync_cmd,
+                                ssh_pool):
+    with profiling.span("get_necessary_backups", task=repository.name):
+        necessary_backups = repository.get_necessary_backups()
     if len(necessary_backups) != 0:
         if conf_overlapping == "single":
             new_backup_interval_name = None
@@ -505,72 +648,385 @@ def create_backups_if_necessary(repository, conf_overlapping, conf_rsync_cmd):
                 if exitloop:
                     break
             new_backup = repository.get_backup_params(new_backup_interval_name)
-            create_backup(new_backup, conf_rsync_cmd)
+            create_backup(new_backup, conf_rsync_cmd, ssh_pool)
 
         else:
-            # Make one "real" backup and just hard/symlink all others to this
-            # one
-            timestamp = datetime.datetime.now()
-            real_backup = repository.get_backup_params(necessary_backups[0][0],
-                                                       timestamp=timestamp)
-            create_backup(real_backup, conf_rsync_cmd)
-            for backup in necessary_backups[1:]:
-                backup = repository.get_backup_params(backup[0], timestamp)
-                # real_backup.destination and backup.destination are guaranteed
-                # to be identical as they are from the same repository
-                source = os.path.join(real_backup.destination,
-                                      real_backup.folder)
-                destination = os.path.join(real_backup.destination,
-                                           backup.folder)
-                if conf_overlapping == "hardlink":
-                    logger.info("Hardlinking snapshot \"%s\" into \"%s\"",
-                                os.path.basename(source),
-                                os.path.basename(destination))
-                    files.copy_hardlinks(source, destination)
-                elif conf_overlapping == "symlink":
-                    # We should create RELATIVE symlinks with "-r", as the
-                    # repository might move, but the relative location of all
-                    # backups will stay the same
-                    logger.info("Symlinking \"%s\" to \"%s\"",
-                                os.path.basename(source),
-                                os.path.basename(destination))
-                    files.create_symlink(source, destination)
+            create_linked_backups(repository,
+                                  [name for (name, _) in necessary_backups],
+                                  conf_overlapping, conf_rsync_cmd, ssh_pool)
     else:
         logger.info("No backup necessary.")
 
 
-def create_backup(new_backup, rsync_cmd):
+def create_linked_backups(repo, interval_names, conf_overlapping,
+                          conf_rsync_cmd, ssh_pool):
+    """
+    Creates a snapshot for the first of several intervals and links it into
+    the other intervals.
+    :param interval_names: The names of the intervals.
+    :type interval_names: list
+    :param conf_overlapping: Either "hardlink", "symlink" or "alias".
+    :type conf_overlapping: string
+    """
+    # Make one "real" backup and just hard/symlink all others to this
+    # one
+    timestamp = datetime.datetime.now()
+    real_backup = repo.get_backup_params(interval_names[0],
+                                         timestamp=timestamp)
+    if not create_backup(real_backup, conf_rsync_cmd, ssh_pool):
+        return
+    aliases = []
+    for backup in interval_names[1:]:
+        backup = repo.get_backup_params(backup, timestamp)
+        # real_backup.destination and backup.destination are guaranteed
+        # to be identical as they are from the same repository
+        source = os.path.join(real_backup.destination,
+                              real_backup.folder)
+        destination = os.path.join(real_backup.destination,
+                                   backup.folder)
+        if conf_overlapping == "hardlink":
+            logger.info("Hardlinking snapshot \"%s\" into \"%s\"",
+                        os.path.basename(source),
+                        os.path.basename(destination))
+            # an interrupted copy must not be taken for a snapshot
+            incomplete_path = destination + repository.INCOMPLETE_SUFFIX
+            with profiling.span("hardlink clone", snapshot=backup.folder):
+                files.copy_hardlinks(source, incomplete_path)
+            os.rename(incomplete_path, destination)
+        elif conf_overlapping == "symlink":
+            # We should create RELATIVE symlinks with "-r", as the
+            # repository might move, but the relative location of all
+            # backups will stay the same
+            logger.info("Symlinking \"%s\" to \"%s\"",
+                        os.path.basename(source),
+                        os.path.basename(destination))
+            files.create_symlink(source, destination)
+        elif conf_overlapping == "alias":
+            # the snapshot only exists in the catalog until the real one
+            # expires
+            logger.info("Recording \"%s\" as alias of \"%s\"",
+                        backup.folder, real_backup.folder)
+            repo.catalog.add(backup.folder, alias=real_backup.folder)
+            aliases.append(backup.folder)
+    if len(aliases) != 0:
+        repo.catalog.add(real_backup.folder, aliases=aliases)
+
+
+def create_backup(new_backup, rsync_cmd, ssh_pool):
+    """
+    Creates a new snapshot.
+    :returns: True if the snapshot was created, False if it was skipped.
+    :rtype: bool
+    """
     destination = os.path.join(new_backup.destination,
                                new_backup.folder)
+    # rsync writes into a folder that is not taken for a snapshot, which is
+    # renamed once all transfers succeeded
+    incomplete_path = destination + repository.INCOMPLETE_SUFFIX
     symlink_latest = os.path.join(new_backup.destination,
                                   const.SYMLINK_LATEST_NAME)
-    for source in new_backup.sources:
-        if new_backup.link_ref is None:
-            link_dest = None
-        else:
-            link_dest = os.path.join(new_backup.destination,
-                                     new_backup.link_ref)
-        logger.info("Creating backup \"%s\".", os.path.basename(destination))
-        (returncode, stdoutdata, stderrdata) = rsync.rsync(
-            rsync_cmd,
-            source,
-            destination,
-            link_dest,
-            new_backup.rsync_args,
-            new_backup.rsyncfilter,
-            new_backup.rsync_logfile_options)
-        if returncode != 0:
-            logger.critical("Rsync failed. Aborting. Stderr:\n%s", stderrdata)
-            sys.exit(const.EXIT_RSYNC_FAILED)
+    groups = rsync.group_sources(new_backup.sources)
+
+    daemon_args = []
+    if new_backup.password_file is not None:
+        daemon_args.append("--password-file=%s" % new_backup.password_file)
+
+    # check all rsync daemon modules before the snapshot folder is created,
+    # so a missing module does not leave an incomplete snapshot behind
+    for (location, sources) in groups:
+        if location.transport != rsync.Transports.DAEMON:
+            continue
+        (exists, stderrdata) = rsync.module_exists(rsync_cmd, location,
+                                                   daemon_args)
+        if not exists:
+            logger.error("Module \"%s\" not accessible on \"%s\". Skipping "
+                         "backup \"%s\". Stderr:\n%s",
+                         location.module,
+                         location.host,
+                         os.path.basename(destination),
+                         stderrdata)
+            return False
+
+    if new_backup.link_ref is None:
+        link_dest = None
+    else:
+        link_dest = os.path.join(new_backup.destination, new_backup.link_ref)
+    logfile_options = new_backup.rsync_logfile_options
+    if logfile_options is not None and logfile_options.is_in_snapshot():
+        snapshot_logfile_options = logfile_options
+    else:
+        snapshot_logfile_options = None
+    # partially transferred files are kept, so an interrupted snapshot is
+    # resumed where it stopped
+    backend_args = ["--partial"]
+    group_args = [[] for _ in groups]
+    resumed = resume_snapshot(new_backup.destination, incomplete_path)
+    if resumed:
+        # files removed from the sources since the interruption
+        delete_args = get_delete_args(groups, new_backup.rsync_args,
+                                      snapshot_logfile_options)
+        if delete_args is None:
+            logger.info("Removing incomplete snapshot \"%s\", as files "
+                        "removed from its sources cannot be deleted.",
+                        os.path.basename(destination))
+            files.remove_recursive(incomplete_path)
+            resumed = False
         else:
-            logger.info("Backup finished successfully.")
+            group_args = delete_args
+    snapshots = catalog.Catalog(new_backup.destination,
+                                repository.is_backup_folder)
+    previous_stats = snapshots.get_latest("stats")
+    # a clone of the previous snapshot only writes the changed blocks
+    full_copy = new_backup.link_ref is None and not resumed
+    if full_copy:
+        # every file is copied, which may not fit
+        (admitted, expected_bytes) = admit_snapshot(new_backup)
+        if not admitted:
+            return False
+        if previous_stats is None and expected_bytes is not None:
+            previous_stats = {"bytes": expected_bytes, "seconds": None}
+    if (new_backup.backend == "reflink" and link_dest is not None and
+            not resumed):
+        if len(groups) > 1:
+            # every rsync run would delete the files of the other groups
+            logger.warning("Snapshot backend \"reflink\" does not support "
+                           "sources on several hosts, using \"hardlink\".")
+        elif clone_snapshot(link_dest, incomplete_path,
+                            snapshot_logfile_options):
+            link_dest = None
+            backend_args = ["--inplace", "--no-whole-file", "--delete"]
+            if snapshot_logfile_options is not None:
+                backend_args.append(
+                    "--filter=P /%s" % snapshot_logfile_options.log_name)
+
+    log_writer = None
+    if logfile_options is not None and not logfile_options.is_in_snapshot():
+        # the logs of interrupted snapshots are not resumed
+        rsynclog.remove_incomplete(new_backup.destination)
+        log_writer = rsynclog.LogWriter(new_backup.destination,
+                                        new_backup.folder,
+                                        logfile_options.compression,
+                                        logfile_options.log_format)
+    tracker = progress.start(new_backup.destination, new_backup.folder,
+                             previous_stats)
+    try:
+        for ((location, sources), run_args) in zip(groups, group_args):
+            tracker.begin_run()
+            logger.info("Creating backup \"%s\".",
+                        os.path.basename(destination))
+            if (location.transport == rsync.Transports.SSH and
+                    ssh_pool is not None):
+                session = ssh_pool.session(location.host,
+                                           new_backup.ssh_args)
+            else:
+                session = _no_session()
+            start = time.time()
+            with session as control_args:
+                if location.transport == rsync.Transports.DAEMON:
+                    # passing --rsh would make rsync tunnel the daemon
+                    # protocol through ssh
+                    transport_args = daemon_args
+                else:
+                    rsh = [const.SSH_CMD] + new_backup.ssh_args + control_args
+                    transport_args = ["--rsh", " ".join(rsh)]
+                try:
+                    with profiling.span("rsync", sources=sources):
+                        (returncode, stdoutdata, stderrdata) = rsync.rsync(
+                            rsync_cmd,
+                            sources,
+                            incomplete_path,
+                            link_dest,
+                            (new_backup.rsync_args + backend_args +
+                             run_args + transport_args),
+                            new_backup.rsyncfilter,
+                            logfile_options,
+                            progress=tracker.update,
+                            log=(log_writer.write
+                                 if log_writer is not None else None))
+                except rsync.Cancelled:
+                    logger.info("Removing incomplete snapshot \"%s\".",
+                                os.path.basename(destination))
+                    files.remove_recursive(incomplete_path)
+                    if log_writer is not None:
+                        log_writer.discard()
+                    raise
+            if returncode != 0:
+                logger.critical("Rsync failed. Aborting. The incomplete "
+                                "snapshot is resumed on the next start. "
+                                "Stderr:\n%s", stderrdata)
+                sys.exit(const.EXIT_RSYNC_FAILED)
+            else:
+                logger.info("Backup finished successfully.")
+            logger.verbose("Transferred %s source(s) from \"%s\" in %.1f "
+                           "seconds.",
+                           len(sources),
+                           location.host if location.host is not None else
+                           sources[0],
+                           time.time() - start)
+    finally:
+        progress.finish(new_backup.destination)
+        if log_writer is not None:
+            log_writer.close()
+    stats = tracker.get_stats()
+    logger.info("Snapshot \"%s\" transferred %.1f MB in %s.",
+                new_backup.folder, stats["bytes"] / 1e6,
+                progress.format_seconds(stats["seconds"]))
+    os.rename(incomplete_path, destination)
+    if log_writer is not None:
+        log_writer.commit()
+    snapshots.add(new_backup.folder, stats=stats)
     if os.path.islink(symlink_latest):
         files.remove_symlink(symlink_latest)
     files.create_symlink(destination, symlink_latest)
-
-
-def handle_expired_backups(repository, current_time):
-    expired_backups = repository.get_expired_backups()
+    return True
+
+
+def admit_snapshot(new_backup):
+    """
+    Estimates the size of a snapshot that copies all files by scanning its
+    local sources, and checks that it fits into the free space of the
+    destination.
+    :returns: A tuple of a bool stating whether the snapshot may be created
+    as first element, and the estimated bytes or None if they are unknown as
+    second.
+    :rtype: tuple
+    """
+    try:
+        matcher = filters.compile_filter(new_backup.rsyncfilter)
+    except filters.FilterError as err:
+        logger.warning("Cannot estimate the size of snapshot \"%s\": %s",
+                       new_backup.folder, err.message)
+        return (True, None)
+    with profiling.span("estimate"):
+        result = estimate.scan(new_backup.sources, matcher,
+                               new_backup.rsync_args)
+    if len(result.skipped) != 0:
+        # remote sources are not scanned, the estimate is too low
+        return (True, None)
+    logger.verbose("Snapshot \"%s\" will copy about %.1f MB in %s files.",
+                   new_backup.folder, result.bytes / 1e6, result.files)
+    st = os.statvfs(new_backup.destination)
+    free = st.f_bavail * st.f_frsize
+    if result.bytes > free:
+        logger.error("Snapshot \"%s\" needs about %.1f MB, but only %.1f MB "
+                     "are free on the destination. Skipping.",
+                     new_backup.folder, result.bytes / 1e6, free / 1e6)
+        return (False, result.bytes)
+    return (True, result.bytes)
+
+
+def get_delete_args(groups, rsync_args, logfile_options):
+    """
+    Determines the arguments that make every rsync run of a resumed snapshot
+    delete the files removed from its sources, without deleting the files of
+    the other runs.
+    :param groups: The groups of sources, see rsync.group_sources().
+    :type groups: list of tuples
+    :param rsync_args: The arguments passed to rsync.
+    :type rsync_args: list
+    :param logfile_options: The logging options of rsync if the log is
+    written into the snapshot, otherwise None.
+    :type logfile_options: rsync.LogfileOptions instance
+    :returns: The arguments of every group, or None if there are several
+    groups and the contents of a source are transferred into the root of the
+    snapshot, as the other runs could not tell its files from removed ones.
+    :rtype: list of lists
+    """
+    relative = rsync.has_option(rsync_args, "R", "--relative")
+    names = [[rsync.get_destination_name(source, relative)
+              for source in sources]
+             for (_, sources) in groups]
+    if len(groups) > 1 and any(None in group for group in names):
+        return None
+    protected = ([] if logfile_options is None else
+                 [logfile_options.log_name])
+    result = []
+    for group in names:
+        others = [name for other in names if other is not group
+                  for name in other if name not in group]
+        result.append(["--delete"] +
+                      ["--filter=P /%s" % name for name in protected + others])
+    return result
+
+
+def resume_snapshot(destination, incomplete_path):
+    """
+    Takes over the newest snapshot that was interrupted, as the base of a new
+    snapshot, and removes all older ones.
+    :param destination: The destination of the repository.
+    :type destination: string
+    :param incomplete_path: The path the new snapshot is created in.
+    :type incomplete_path: string
+    :returns: True if an interrupted snapshot was taken over.
+    :rtype: bool
+    """
+    folders = repository.get_incomplete_folders(destination)
+    if len(folders) == 0:
+        return False
+    for name in folders[:-1]:
+        logger.info("Removing incomplete snapshot \"%s\".", name)
+        files.remove_recursive(os.path.join(destination, name))
+    path = os.path.join(destination, folders[-1])
+    if path != incomplete_path:
+        os.rename(path, incomplete_path)
+    logger.info("Resuming incomplete snapshot \"%s\" as \"%s\".",
+                folders[-1], os.path.basename(incomplete_path))
+    return True
+
+
+def clone_snapshot(source, destination, rsync_logfile_options):
+    """
+    Clones a snapshot with reflinks as the base of a new snapshot, which rsync
+    then updates in place. Files are copied on filesystems without reflinks.
+    :param source: The path of the snapshot to clone.
+    :type source: string
+    :param destination: The path of the new snapshot.
+    :type destination: string
+    :param rsync_logfile_options: The logging options of rsync, or None.
+    :type rsync_logfile_options: rsync.LogfileOptions instance
+    :returns: True if the snapshot was cloned, False if the new snapshot has
+    to be created from scratch.
+    :rtype: bool
+    """
+    logger.info("Cloning snapshot \"%s\" into \"%s\".",
+                os.path.basename(source), os.path.basename(destination))
+    try:
+        # snapshots of overlapping intervals may be symlinks
+        with profiling.span("reflink clone"):
+            result = restore.copy_tree(os.path.realpath(source),
+                                       destination)
+        if rsync_logfile_options is not None:
+            # rsync appends to an existing log file
+            log_path = os.path.join(destination,
+                                    rsync_logfile_options.log_name)
+            if os.path.lexists(log_path):
+                os.unlink(log_path)
+    except OSError as err:
+        logger.error("Cloning snapshot \"%s\" failed, using hardlinks "
+                     "instead: %s", os.path.basename(source), err)
+        if os.path.lexists(destination):
+            files.remove_recursive(destination)
+        return False
+    logger.verbose("Cloned %s files, %.1f MB in %.1f seconds.",
+                   result.files, result.bytes / 1e6, result.seconds)
+    return True
+
+
+@contextlib.contextmanager
+def _no_session():
+    yield []
+
+
+def handle_expired_backups(repository, current_time, protected=()):
+    """
+    Removes all expired snapshots of a repository.
+    :param protected: The names of snapshots that must not be removed right
+    now, e.g. as they are being replicated. They are removed in a later
+    cycle.
+    :type protected: set
+    """
+    expired_backups = [backup for backup in repository.get_expired_backups()
+                       if backup.name not in protected]
     if len(expired_backups) > 0:
         for expired_backup in expired_backups:
             # as a backup might be a symlink to another backup, we have to
@@ -580,6 +1036,21 @@ def handle_expired_backups(repository, current_time):
             # update all remaining symlinks
             logger.info("Expired backup: \"%s\".",
                         expired_backup.name)
+            if repository.is_archived(expired_backup.name):
+                logger.info("Removing archived snapshot \"%s\".",
+                            expired_backup.name)
+                repository.packs.remove(expired_backup.name)
+                rsynclog.remove(repository.destination, expired_backup.name)
+                verify.remove_verdicts(repository.destination,
+                                       expired_backup.name)
+                continue
+            attributes = repository.catalog.get(expired_backup.name)
+            if attributes is not None and "alias" in attributes:
+                remove_alias(repository, expired_backup.name)
+                continue
+            if attributes is not None and attributes.get("aliases"):
+                materialize_alias(repository, expired_backup.name)
+                continue
             expired_path = os.path.join(repository.destination,
                                         expired_backup.name)
             if os.path.islink(expired_path):
@@ -591,9 +1062,10 @@ def handle_expired_backups(repository, current_time):
                 for backup in repository.backups:
                     backup_path = os.path.join(repository.destination,
                                                backup.name)
-                    if (os.path.samefile(expired_path,
-                                         os.path.realpath(backup_path))
-                            and os.path.islink(backup_path)):
+                    # archived snapshots do not exist in the destination
+                    if (os.path.islink(backup_path) and
+                            os.path.samefile(expired_path,
+                                             os.path.realpath(backup_path))):
                         symlinks.append(backup)
 
                 if len(symlinks) == 0:
@@ -602,6 +1074,10 @@ def handle_expired_backups(repository, current_time):
                                 expired_backup.name)
                     files.remove_recursive(os.path.join(
                         repository.destination, expired_backup.name))
+                    rsynclog.remove(repository.destination,
+                                    expired_backup.name)
+                    verify.remove_verdicts(repository.destination,
+                                           expired_backup.name)
                 else:
                     # replace the first symlink with the backup
                     symlink_path = os.path.join(repository.destination,
@@ -616,6 +1092,11 @@ def handle_expired_backups(repository, current_time):
                                 os.path.basename(expired_path),
                                 os.path.basename(symlink_path))
                     files.move(expired_path, symlink_path)
+                    rsynclog.rename(repository.destination,
+                                    expired_backup.name, symlinks[0].name)
+                    verify.rename_verdicts(repository.destination,
+                                           expired_backup.name,
+                                           symlinks[0].name)
 
                     # now update all symlinks to the directory
                     for remaining_symlink in symlinks[1:]:
@@ -635,7 +1116,67 @@ def handle_expired_backups(repository, current_time):
         logger.info("No expired backups.")
 
 
+def remove_alias(repo, name):
+    """
+    Removes an alias from the catalog and from the snapshot it points to.
+    :param repo: The repository.
+    :type repo: repository.Repository instance
+    :param name: The name of the alias.
+    :type name: string
+    """
+    with repo.catalog.lock():
+        target = repo.resolve(name)
+        logger.info("Removing alias \"%s\" of \"%s\".", name, target)
+        repo.catalog.remove(name)
+        attributes = repo.catalog.get(target)
+        if attributes is not None and name in attributes.get("aliases", []):
+            repo.catalog.add(target, aliases=[alias for alias in
+                                              attributes["aliases"]
+                                              if alias != name])
+
+
+def materialize_alias(repo, name):
+    """
+    Hands the folder of an expired snapshot over to the first of its aliases,
+    which becomes a real snapshot and the target of the remaining aliases.
+    The folder is renamed, so this takes the same time for any snapshot.
+    :param repo: The repository.
+    :type repo: repository.Repository instance
+    :param name: The name of the expired snapshot.
+    :type name: string
+    """
+    # nobody else must change the catalog or compare it with the destination
+    # while the aliases point to a folder that does not exist yet
+    with repo.catalog.lock():
+        repo.catalog.refresh()
+        attributes = dict(repo.catalog.get(name))
+        (first, remaining) = (attributes["aliases"][0],
+                              attributes["aliases"][1:])
+        for alias in remaining:
+            repo.catalog.add(alias, alias=first)
+        attributes["aliases"] = remaining
+        repo.catalog.replace(first, **attributes)
+
+        expired_path = os.path.join(repo.destination, name)
+        path = os.path.join(repo.destination, first)
+        symlink_latest = os.path.join(repo.destination,
+                                      const.SYMLINK_LATEST_NAME)
+        latest = (os.path.islink(symlink_latest) and
+                  os.path.realpath(symlink_latest) ==
+                  os.path.realpath(expired_path))
+        logger.info("Moving \"%s\" to its alias \"%s\".", name, first)
+        os.rename(expired_path, path)
+        rsynclog.rename(repo.destination, name, first)
+        verify.rename_verdicts(repo.destination, name, first)
+        repo.catalog.remove(name)
+    if latest:
+        files.remove_symlink(symlink_latest)
+        files.create_symlink(path, symlink_latest)
+
+
 logger = logging.getLogger(__name__)
+_reload_requested = False
+_profile_requested = False
 logging_memory_handler = None
 logging_console_handlers = []
 logging_file_handlers = []
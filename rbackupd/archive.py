@@ -0,0 +1,260 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module moves old snapshots into packs (see the packs module), which frees
+the inodes of their directory trees on the destination.
+
+Snapshots are archived oldest first by a background thread, so archiving
+never delays the next snapshot. The snapshots of the latest time are never
+archived, as the next snapshot is hardlinked against them. A snapshot that is
+a symlink to another snapshot or an alias of it is archived together with it.
+"""
+
+import datetime
+import logging
+import os
+import queue
+import subprocess
+import threading
+
+from . import catalog
+from . import files
+from . import packs
+from . import repository
+from . import verify
+
+logger = logging.getLogger(__name__)
+
+
+class Archiver(object):
+    """
+    Archives the old snapshots of tasks in a background thread. Every task is
+    queued at most once, no matter how often it is submitted before archiving
+    starts.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # the latest settings of every queued task by name
+        self._pending = {}
+        # the (destination, snapshot) tuples of the snapshots being archived
+        self._in_use = set()
+        self._thread = threading.Thread(target=self._run, name="archiver")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, task):
+        """
+        Queues archiving the old snapshots of a task.
+        :param task: The settings of the task.
+        :type task: settings.TaskSettings instance
+        """
+        with self._lock:
+            queued = task.name in self._pending
+            self._pending[task.name] = task
+        if not queued:
+            self._queue.put(task.name)
+
+    def get_in_use(self, destination):
+        """
+        :returns: The names of the snapshots of a destination that are being
+        archived right now and must not be removed.
+        :rtype: set
+        """
+        with self._lock:
+            return set(name for (path, name) in self._in_use
+                       if path == destination)
+
+    def close(self):
+        """
+        Stops the background thread after the running snapshot is archived.
+        Queued tasks are dropped.
+        """
+        with self._lock:
+            self._pending.clear()
+        self._queue.put(None)
+        if self._thread.is_alive():
+            logger.info("Waiting for archiving to finish.")
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            name = self._queue.get()
+            if name is None:
+                return
+            with self._lock:
+                task = self._pending.pop(name, None)
+            if task is None:
+                continue
+            try:
+                archive_snapshots(task, self._claim)
+            except (OSError, ValueError,
+                    subprocess.CalledProcessError) as err:
+                logger.error("Archiving snapshots of task \"%s\" failed: %s",
+                             task.name, err)
+
+    def _claim(self, destination, names):
+        claimed = set((destination, name) for name in names)
+
+        def release():
+            with self._lock:
+                self._in_use.difference_update(claimed)
+
+        with self._lock:
+            self._in_use.update(claimed)
+        return release
+
+
+def get_candidates(backups, packed, before):
+    """
+    Determines the snapshots that have to be archived.
+    :param backups: All snapshots of the repository.
+    :type backups: list of repository.BackupFolder instances
+    :param packed: The names of the snapshots that are archived already.
+    :type packed: list
+    :param before: Snapshots created before that time are archived.
+    :type before: datetime.datetime instance
+    :returns: The names of the snapshots, oldest first.
+    :rtype: list
+    """
+    if len(backups) == 0:
+        return []
+    latest = max(backup.epoch for backup in backups)
+    packed = set(packed)
+    candidates = [backup for backup in backups
+                  if backup.date < before and backup.epoch != latest and
+                  backup.name not in packed]
+    candidates.sort(key=lambda backup: (backup.epoch, backup.name))
+    return [backup.name for backup in candidates]
+
+
+def archive_snapshots(task, claim=None):
+    """
+    Archives all snapshots of a task that are older than "archive_after".
+    :param task: The settings of the task.
+    :type task: settings.TaskSettings instance
+    :param claim: A function that is called with the destination and the
+    names of the snapshots before they are archived, and returns a function
+    to call afterwards.
+    :type claim: function
+    """
+    store = packs.PackStore(task.destination)
+    packed = store.get_names()
+    backups = []
+    for name in os.listdir(task.destination):
+        if not repository.is_backup_folder(name):
+            continue
+        if name in packed:
+            # archiving was interrupted before the snapshot was removed
+            _remove_snapshot(task.destination, name)
+            continue
+        backups.append(repository.BackupFolder(name))
+    before = datetime.datetime.now() - task.archive_after
+    names = get_candidates(backups, packed, before)
+    # symlinks are archived together with their targets
+    aliases = {}
+    for name in list(names):
+        path = os.path.join(task.destination, name)
+        if os.path.islink(path):
+            names.remove(name)
+            aliases.setdefault(os.path.basename(os.readlink(path)),
+                               []).append(name)
+    snapshots = catalog.Catalog(task.destination, repository.is_backup_folder)
+    for (name, attributes) in snapshots.get_entries().items():
+        if attributes.get("alias") in names:
+            aliases.setdefault(attributes["alias"], []).append(name)
+    if len(names) == 0:
+        return
+
+    # reflink snapshots share no inodes
+    by_path = repository.get_backend(task) == "reflink"
+    previous = _get_previous(store)
+    try:
+        for name in names:
+            group = [name] + aliases.get(name, [])
+            release = (claim(task.destination, group) if claim is not None
+                       else lambda: None)
+            try:
+                reader = _archive_snapshot(
+                    task, store, name, previous, aliases.get(name, []),
+                    by_path, (snapshots.get(name) or {}).get("stats"))
+            finally:
+                release()
+            if reader is not None:
+                if previous is not None:
+                    previous.close()
+                previous = reader
+    finally:
+        if previous is not None:
+            previous.close()
+    store.collect_garbage()
+
+
+def _archive_snapshot(task, store, name, previous, aliases, by_path, stats):
+    """
+    Archives a single snapshot and the symlinks pointing to it, and removes
+    them from the destination.
+    :returns: The reader of the new pack, or None if the snapshot vanished.
+    :rtype: packs.PackReader instance
+    """
+    path = os.path.join(task.destination, name)
+    if not os.path.isdir(path):
+        return None
+    logger.info("Archiving snapshot \"%s\".", name)
+    # the catalog forgets the snapshot once its folder is removed
+    result = store.pack(name, task.archive_compression, previous,
+                        by_path=by_path, stats=stats)
+    logger.info("Archived snapshot \"%s\": %s files, %.1f MB stored in "
+                "%.1f MB, %s files reused from the previous pack.",
+                name, result.files, result.bytes / 1e6,
+                result.stored_bytes / 1e6, result.reused_files)
+    for alias in aliases:
+        logger.info("Archiving snapshot \"%s\" as alias of \"%s\".",
+                    alias, name)
+        store.alias(alias, name)
+        # aliases in the catalog have no folder
+        if os.path.lexists(os.path.join(task.destination, alias)):
+            _remove_snapshot(task.destination, alias)
+    _remove_snapshot(task.destination, name)
+    return store.open(name)
+
+
+def _remove_snapshot(destination, name):
+    path = os.path.join(destination, name)
+    if os.path.islink(path):
+        logger.info("Removing symlink \"%s\".", name)
+        files.remove_symlink(path)
+    else:
+        logger.info("Removing directory \"%s\".", name)
+        files.remove_recursive(path)
+    # the inodes of the verified files are freed
+    verify.remove_verdicts(destination, name)
+
+
+def _get_previous(store):
+    """
+    Returns the reader of the newest packed snapshot, or None if there is
+    none.
+    """
+    packed = [repository.BackupFolder(name) for name in store.get_names()]
+    if len(packed) == 0:
+        return None
+    latest = max(packed, key=lambda backup: (backup.epoch, backup.name))
+    return store.open(latest.name)
@@ -0,0 +1,333 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module implements the catalog of a repository, an index of all snapshots
+kept in the state directory of the destination. It is used to look up
+snapshots without listing the destination, which is slow for destinations with
+many entries and cold caches.
+
+The catalog is a journal of JSON objects, one per line. Every line either adds
+or updates a snapshot ({"op": "add", "name": ..., <attributes>}), replaces
+all attributes of one ({"op": "replace", "name": ..., <attributes>}) or
+removes one ({"op": "remove", "name": ...}). The first line holds the
+modification time of the destination directory at the time the catalog was
+last compared with it. The journal is compacted when it grows much larger
+than the count of snapshots it describes.
+
+A snapshot may be an alias of another one, with the "alias" attribute set to
+the name of the snapshot that holds its files. Aliases have no folder in the
+destination and only exist in the catalog, as long as the snapshot they
+point to exists.
+
+The catalog is written by the daemon, its threads and the commands. Every
+change is made while holding an flock on a lock file next to the journal,
+after reloading the journal if somebody else wrote it, so no change made by
+another writer is lost.
+"""
+
+import collections
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import threading
+
+from . import constants as const
+
+logger = logging.getLogger(__name__)
+
+LOCK_SUFFIX = ".lock"
+
+
+class Catalog(object):
+    """
+    The catalog of the snapshots of a single destination.
+    """
+
+    def __init__(self, destination, is_snapshot, read_only=False):
+        """
+        :param destination: The destination directory of the repository.
+        :type destination: string
+        :param is_snapshot: A function that determines whether an entry of
+        the destination directory is a snapshot.
+        :type is_snapshot: function
+        :param read_only: Whether the catalog is never written, not even to
+        bring it in line with the destination. For commands that only read
+        it.
+        :type read_only: bool
+        """
+        self.destination = destination
+        self.path = os.path.join(destination, const.STATE_DIR_NAME,
+                                 const.CATALOG_NAME)
+        self.read_only = read_only
+        self._is_snapshot = is_snapshot
+        self._entries = None
+        self._mtime = None
+        self._journal_lines = 0
+        self._signature = None
+        # the catalog may be shared by threads, the lock file is only locked
+        # once by the outermost lock()
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_file = None
+
+    def get_names(self):
+        """
+        :returns: The names of all snapshots in the order they were added.
+        :rtype: list
+        """
+        self.refresh()
+        return list(self._entries.keys())
+
+    def get(self, name):
+        """
+        :returns: The attributes of a snapshot, or None if there is no
+        snapshot with that name.
+        :rtype: dict
+        """
+        self.refresh()
+        return self._entries.get(name)
+
+    def get_entries(self):
+        """
+        :returns: The attributes of all snapshots by name.
+        :rtype: collections.OrderedDict
+        """
+        self.refresh()
+        return self._entries
+
+    def get_latest(self, key):
+        """
+        :returns: The value of an attribute of the most recently added
+        snapshot that has it, or None if no snapshot has it.
+        """
+        for attributes in reversed(list(self.get_entries().values())):
+            if key in attributes:
+                return attributes[key]
+        return None
+
+    def resolve(self, name):
+        """
+        :returns: The name of the snapshot whose folder holds the files of a
+        snapshot, which is the snapshot itself unless it is an alias.
+        :rtype: string
+        """
+        attributes = self.get(name)
+        if attributes is None:
+            return name
+        return attributes.get("alias", name)
+
+    def add(self, name, **attributes):
+        """
+        Adds a snapshot to the catalog, or updates its attributes if it is
+        already present.
+        """
+        with self.lock():
+            self.refresh()
+            entry = self._entries.setdefault(name, {})
+            entry.update(attributes)
+            self._append(_make_record("add", name, attributes))
+
+    def replace(self, name, **attributes):
+        """
+        Replaces all attributes of a snapshot. Unlike removing and adding it
+        again, the snapshot keeps its place in the catalog, which
+        get_latest() depends on.
+        """
+        with self.lock():
+            self.refresh()
+            self._entries[name] = attributes
+            self._append(_make_record("replace", name, attributes))
+
+    def remove(self, name):
+        """Removes a snapshot from the catalog."""
+        with self.lock():
+            self.refresh()
+            if name not in self._entries:
+                return
+            del self._entries[name]
+            self._append(_make_record("remove", name, {}))
+
+    @contextlib.contextmanager
+    def lock(self):
+        """
+        Context manager that keeps other threads and processes from writing
+        the catalog, e.g. while several changes have to be made together.
+        It can be nested.
+        """
+        with self._thread_lock:
+            if self._lock_depth == 0:
+                try:
+                    self._ensure_dir()
+                    self._lock_file = open(self.path + LOCK_SUFFIX, "a")
+                except OSError as err:
+                    # nothing can be written anyway, e.g. for read-only
+                    # destinations
+                    logger.debug("Could not lock catalog \"%s\": %s",
+                                 self.path, err)
+                else:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and self._lock_file is not None:
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    def refresh(self):
+        """
+        Loads the catalog if necessary and brings it in line with the
+        destination directory if the directory changed since the catalog was
+        last compared with it.
+        """
+        with self._thread_lock:
+            self._reload()
+            mtime = os.stat(self.destination).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            if self.read_only:
+                self._reconcile(mtime)
+                return
+            with self.lock():
+                # another writer may have changed the catalog in between
+                self._reload()
+                if mtime != self._mtime:
+                    self._reconcile(mtime)
+                    self._compact()
+
+    def _reload(self):
+        # another process, e.g. a command, may have written the catalog
+        if self._entries is None or self._signature != self._get_signature():
+            self._load()
+
+    def _reconcile(self, mtime):
+        names = set(name for name in os.listdir(self.destination)
+                    if self._is_snapshot(name))
+        for (name, attributes) in list(self._entries.items()):
+            if name not in names and attributes.get("alias") not in names:
+                logger.debug("Snapshot \"%s\" vanished from \"%s\".",
+                             name, self.destination)
+                del self._entries[name]
+        for name in sorted(names):
+            if name not in self._entries:
+                self._entries[name] = {}
+        self._mtime = mtime
+
+    def _load(self):
+        self._entries = collections.OrderedDict()
+        self._mtime = None
+        self._journal_lines = 0
+        self._signature = self._get_signature()
+        if self._signature is None:
+            return
+        with open(self.path) as journal:
+            lines = journal.read().splitlines()
+        try:
+            # decoding all lines at once is much faster than line by line
+            records = json.loads("[%s]" % ",".join(lines))
+        except ValueError:
+            records = []
+            for line in lines:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # an interrupted append leaves a truncated line behind,
+                    # everything before it is valid
+                    logger.warning("Ignoring invalid line in catalog \"%s\".",
+                                   self.path)
+        self._journal_lines = len(records)
+        for record in records:
+            op = record.pop("op")
+            if op == "header":
+                self._mtime = record["mtime"]
+            elif op == "add":
+                name = record.pop("name")
+                entry = self._entries.get(name)
+                if entry is None:
+                    self._entries[name] = record
+                else:
+                    entry.update(record)
+            elif op == "replace":
+                # assigning keeps the position of an existing snapshot
+                self._entries[record.pop("name")] = record
+            elif op == "remove":
+                self._entries.pop(record["name"], None)
+
+    def _append(self, record):
+        if self._journal_lines > 2 * len(self._entries) + 100:
+            self._compact()
+            return
+        try:
+            self._ensure_dir()
+            with open(self.path, "a") as journal:
+                journal.write(json.dumps(record) + "\n")
+            self._journal_lines += 1
+            self._signature = self._get_signature()
+        except OSError as err:
+            logger.warning("Could not write catalog \"%s\": %s",
+                           self.path, err)
+
+    def _compact(self):
+        """
+        Rewrites the journal so that it contains exactly one line per
+        snapshot. The new journal is written next to the old one and renamed
+        over it, so the catalog is never incomplete.
+        """
+        # writers that could not take the lock must not share the file
+        tmp_path = "%s.%s-%s.tmp" % (self.path, os.getpid(),
+                                     threading.get_ident())
+        try:
+            self._ensure_dir()
+            with open(tmp_path, "w") as journal:
+                journal.write(json.dumps({"op": "header",
+                                          "mtime": self._mtime}) + "\n")
+                for (name, attributes) in self._entries.items():
+                    journal.write(json.dumps(
+                        _make_record("add", name, attributes)) + "\n")
+            os.rename(tmp_path, self.path)
+            self._journal_lines = len(self._entries) + 1
+            self._signature = self._get_signature()
+        except OSError as err:
+            # the catalog can always be rebuilt from the destination, so this
+            # is not fatal, e.g. for read-only destinations
+            logger.debug("Could not write catalog \"%s\": %s",
+                         self.path, err)
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _get_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _ensure_dir(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+
+def _make_record(op, name, attributes):
+    record = {"op": op, "name": name}
+    record.update(attributes)
+    return record
@@ -0,0 +1,131 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module plans how a repository catches up with the snapshots it missed
+while rbackupd was not running or its destination was not available.
+
+All intervals with missed occurences are coalesced into a single snapshot
+that is linked into all of them, instead of creating one snapshot per
+interval. When that snapshot is taken depends on the catch-up policy of the
+task:
+
+immediate
+    The snapshot is created right away.
+next
+    Missed occurences are skipped, every interval gets its next snapshot at
+    its next regular occurence. Intervals without any snapshot are still
+    caught up right away.
+jitter
+    The snapshot is created at a random point within a time window, so that
+    many tasks do not start at the same time. The point is derived from the
+    name of the task, so it does not change between restarts.
+"""
+
+import collections
+import datetime
+import zlib
+
+# more occurences than that are not counted, as the count only serves to
+# inform the user
+MAX_COUNTED_OCCURENCES = 1000
+
+
+class Policies(object):
+    IMMEDIATE = "immediate"
+    NEXT = "next"
+    JITTER = "jitter"
+
+
+class CatchupPlan(object):
+    """
+    Describes how a repository catches up.
+    """
+
+    def __init__(self, created, missed, skipped, due):
+        """
+        :param created: The time the plan was made.
+        :type created: datetime.datetime instance
+        :param missed: The count of missed occurences by the names of the
+        intervals that will be caught up, in the order of the intervals.
+        :type missed: collections.OrderedDict
+        :param skipped: The names of the intervals whose missed occurences are
+        skipped.
+        :type skipped: list
+        :param due: The time at which the missed snapshot is created.
+        :type due: datetime.datetime instance
+        """
+        self.created = created
+        self.missed = missed
+        self.skipped = skipped
+        self.due = due
+
+    def is_due(self, now):
+        return now >= self.due
+
+
+def plan_catchup(repo, now, policy, window):
+    """
+    Determines the missed occurences of all intervals of a repository and
+    plans how to catch up with them.
+    :param repo: The repository.
+    :type repo: repository.Repository instance
+    :param now: The current time.
+    :type now: datetime.datetime instance
+    :param policy: The catch-up policy, one of the values of Policies.
+    :type policy: string
+    :param window: The time window of the jitter policy.
+    :type window: datetime.timedelta instance
+    :rtype: CatchupPlan instance
+    """
+    missed = collections.OrderedDict()
+    skipped = []
+    for (interval_name, interval) in repo.intervals:
+        latest = repo.get_latest_backup_of_interval(interval_name)
+        if latest is None:
+            missed[interval_name] = 1
+            continue
+        count = len(interval.get_occurences_between(
+            latest.date, now, limit=MAX_COUNTED_OCCURENCES))
+        if count == 0:
+            continue
+        if policy == Policies.NEXT:
+            skipped.append(interval_name)
+        else:
+            missed[interval_name] = count
+    due = now
+    if policy == Policies.JITTER and len(missed) != 0:
+        due += get_jitter(repo.name, window)
+    return CatchupPlan(now, missed, skipped, due)
+
+
+def get_jitter(name, window):
+    """
+    Determines the offset of a task within a time window.
+    :param name: The name of the task.
+    :type name: string
+    :param window: The time window.
+    :type window: datetime.timedelta instance
+    :returns: An offset between zero and the length of the window.
+    :rtype: datetime.timedelta instance
+    """
+    seconds = int(window.total_seconds())
+    if seconds <= 0:
+        return datetime.timedelta(0)
+    return datetime.timedelta(
+        seconds=zlib.crc32(name.encode("utf-8")) % seconds)
@@ -0,0 +1,790 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+This module implements the commands that can be given on the command line
+instead of running the daemon. Every command gets the settings and its own
+arguments and returns the exit code of the program.
+"""
+
+import datetime
+import json
+import logging
+import optparse
+import os
+import sys
+
+from . import constants as const
+from . import control
+from . import diff
+from . import estimate
+from . import export
+from . import filters
+from . import history
+from . import listing
+from . import progress
+from . import repository
+from . import restore
+from . import rsynclog
+from . import verify
+
+logger = logging.getLogger(__name__)
+
+
+def run(conf, name, args):
+    """
+    Runs a command.
+    :param conf: The settings.
+    :type conf: settings.Settings instance
+    :param name: The name of the command, one of the keys of COMMANDS.
+    :type name: string
+    :param args: The command line arguments of the command.
+    :type args: list
+    :returns: The exit code.
+    :rtype: int
+    """
+    return COMMANDS[name](conf, args)
+
+
+def _get_parser(name, usage):
+    return optparse.OptionParser(
+        prog="%s %s" % (os.path.basename(sys.argv[0]), name),
+        usage="%%prog %s" % usage)
+
+
+def _get_repository(conf, name):
+    """
+    Returns the repository of a task, exits if there is no such task.
+    """
+    if name not in conf.tasks:
+        logger.critical("Unknown task \"%s\". Aborting.", name)
+        sys.exit(const.EXIT_UNKNOWN_TASK)
+    task = conf.tasks[name]
+    if not os.path.isdir(task.destination):
+        logger.critical("Destination \"%s\" not a directory. Aborting.",
+                        task.destination)
+        sys.exit(const.EXIT_INVALID_DESTINATION)
+    return repository.create(task)
+
+
+def _get_snapshot(repo, name, archived=False):
+    """
+    Returns the name of a snapshot of a repository, or of the latest snapshot
+    if name is None. Exits if there is no such snapshot, or if it is archived
+    and archived snapshots are not accepted.
+    """
+    if name is None:
+        latest = repo.get_latest_backup()
+        if latest is None:
+            logger.critical("Task \"%s\" has no snapshots. Aborting.",
+                            repo.name)
+            sys.exit(const.EXIT_UNKNOWN_SNAPSHOT)
+        name = latest.name
+    elif name not in [backup.name for backup in repo.backups]:
+        logger.critical("Unknown snapshot \"%s\". Aborting.", name)
+        sys.exit(const.EXIT_UNKNOWN_SNAPSHOT)
+    if not archived and repo.is_archived(name):
+        logger.critical("Snapshot \"%s\" is archived, only \"restore\" and "
+                        "\"export\" can read it. Aborting.", name)
+        sys.exit(const.EXIT_SNAPSHOT_ARCHIVED)
+    return name
+
+
+def verify_command(conf, args):
+    parser = _get_parser("verify", "[options] TASK [SNAPSHOT]")
+    parser.add_option("-w",
+                      "--workers",
+                      dest="workers",
+                      type="int",
+                      default=4,
+                      help="count of checksumming threads [default: %default]"
+                      )
+    parser.add_option("-s",
+                      "--sample",
+                      dest="sample",
+                      type="float",
+                      default=1.0,
+                      help="fraction of new files to check "
+                           "[default: %default]"
+                      )
+    (options, args) = parser.parse_args(args)
+    if len(args) not in (1, 2):
+        parser.error("expected a task and optionally a snapshot")
+    if not 0 < options.sample <= 1:
+        parser.error("sample has to be between 0 and 1")
+
+    repo = _get_repository(conf, args[0])
+    snapshot = _get_snapshot(repo, args[1] if len(args) == 2 else None)
+    logger.info("Verifying snapshot \"%s\".", snapshot)
+    result = verify.verify_snapshot(repo, snapshot,
+                                    workers=options.workers,
+                                    sample=options.sample)
+    (gigabytes, files) = result.get_throughput()
+    print("snapshot:   %s" % snapshot)
+    print("files:      %s" % result.files)
+    print("hashed:     %s (%s bytes)" % (result.hashed_files,
+                                         result.hashed_bytes))
+    print("inherited:  %s" % result.inherited)
+    print("changed:    %s" % result.changed)
+    print("skipped:    %s" % result.skipped)
+    print("mismatches: %s" % len(result.mismatches))
+    print("throughput: %.3f GB/s, %.0f files/s" % (gigabytes, files))
+    for path in result.mismatches:
+        print("MISMATCH %s" % path)
+    if not result.ok:
+        return const.EXIT_VERIFY_FAILED
+    return 0
+
+
+def restore_command(conf, args):
+    parser = _get_parser("restore", "[options] TASK PATH")
+    parser.add_option("-a",
+                      "--at",
+                      dest="at",
+                      metavar="TIME",
+                      help="restore the state at TIME (YYYY-MM-DD, "
+                           "YYYY-MM-DDTHH:MM or YYYY-MM-DDTHH:MM:SS) "
+                           "[default: latest]"
+                      )
+    parser.add_option("-i",
+                      "--interval",
+                      dest="interval",
+                      metavar="NAME",
+                      help="only consider snapshots of interval NAME"
+                      )
+    parser.add_option("-r",
+                      "--root",
+                      dest="root",
+                      metavar="DIR",
+                      help="restore below DIR instead of the original "
+                           "location"
+                      )
+    parser.add_option("-w",
+                      "--workers",
+                      dest="workers",
+                      type="int",
+                      default=4,
+                      help="count of copying threads [default: %default]"
+                      )
+    parser.add_option("-o",
+                      "--overwrite",
+                      dest="overwrite",
+                      default=False,
+                      action="store_true",
+                      help="replace existing files"
+                      )
+    (options, args) = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error("expected a task and a path")
+    if not os.path.isabs(args[1]):
+        parser.error("path has to be absolute")
+    at = None
+    if options.at is not None:
+        at = _parse_time(options.at)
+        if at is None:
+            parser.error("invalid time \"%s\"" % options.at)
+
+    repo = _get_repository(conf, args[0])
+    snapshot = restore.find_snapshot(repo, at, options.interval)
+    if snapshot is None:
+        logger.critical("No matching snapshot of task \"%s\". Aborting.",
+                        repo.name)
+        return const.EXIT_UNKNOWN_SNAPSHOT
+    path = os.path.normpath(args[1])
+    snapshot_path = restore.get_snapshot_path(repo, snapshot, path)
+    reader = None
+    if snapshot_path is not None and repo.is_archived(snapshot):
+        reader = repo.packs.open(snapshot)
+        # the path inside the pack, "" is the root of the snapshot
+        pack_path = os.path.relpath(
+            snapshot_path,
+            os.path.join(repo.destination, repo.resolve(snapshot)))
+        if pack_path == ".":
+            pack_path = ""
+        exists = reader.get(pack_path) is not None
+    else:
+        exists = (snapshot_path is not None and
+                  os.path.lexists(snapshot_path))
+    if not exists:
+        logger.critical("\"%s\" is not part of snapshot \"%s\". Aborting.",
+                        path, snapshot)
+        return const.EXIT_UNKNOWN_PATH
+    if options.root is None:
+        target = path
+    else:
+        target = os.path.join(options.root, path.lstrip("/"))
+        parent = os.path.dirname(target)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+    logger.info("Restoring \"%s\" from snapshot \"%s\" to \"%s\".",
+                path, snapshot, target)
+    try:
+        if reader is None:
+            result = restore.copy_tree(snapshot_path, target,
+                                       workers=options.workers,
+                                       overwrite=options.overwrite)
+        else:
+            result = restore.copy_from_pack(reader, pack_path, target,
+                                            overwrite=options.overwrite)
+    except FileExistsError as err:
+        logger.critical("%s, use --overwrite to replace it. Aborting.", err)
+        return const.EXIT_RESTORE_FAILED
+    except (OSError, ValueError) as err:
+        logger.critical("Restore failed: %s", err)
+        return const.EXIT_RESTORE_FAILED
+    finally:
+        if reader is not None:
+            reader.close()
+    (megabytes, files) = result.get_throughput()
+    print("snapshot:   %s" % snapshot)
+    print("target:     %s" % target)
+    print("files:      %s (%s bytes)" % (result.files, result.bytes))
+    print("time:       %.1f s" % result.seconds)
+    print("throughput: %.1f MB/s, %.0f files/s" % (megabytes, files))
+    return 0
+
+
+def history_command(conf, args):
+    parser = _get_parser("history", "[options] TASK PATH")
+    parser.add_option("-a",
+                      "--all",
+                      dest="all",
+                      default=False,
+                      action="store_true",
+                      help="also show versions of expired snapshots"
+                      )
+    (options, args) = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error("expected a task and a path")
+    if not os.path.isabs(args[1]):
+        parser.error("path has to be absolute")
+
+    repo = _get_repository(conf, args[0])
+    relative_path = history.get_relative_path(repo, os.path.normpath(args[1]))
+    if relative_path is None:
+        logger.critical("\"%s\" is not part of any local source of task "
+                        "\"%s\". Aborting.", args[1], repo.name)
+        return const.EXIT_UNKNOWN_PATH
+    index = history.HistoryIndex(repo.destination)
+    try:
+        index.update(repo)
+        existing = None if options.all else set(backup.name for backup in
+                                                repo.backups)
+        versions = index.get_versions(relative_path, existing)
+    finally:
+        index.close()
+    for version in versions:
+        if version.is_directory:
+            description = "directory"
+        else:
+            description = "%s bytes, modified %s" % (
+                version.size,
+                datetime.datetime.fromtimestamp(version.mtime).isoformat())
+        if len(version.snapshots) == 1:
+            print("%s: %s" % (version.snapshots[0], description))
+        else:
+            print("%s .. %s (%s snapshots): %s" % (
+                version.snapshots[0], version.snapshots[-1],
+                len(version.snapshots), description))
+    return 0
+
+
+def diff_command(conf, args):
+    parser = _get_parser("diff", "[options] TASK OLD_SNAPSHOT [NEW_SNAPSHOT]")
+    parser.add_option("-j",
+                      "--json",
+                      dest="json",
+                      default=False,
+                      action="store_true",
+                      help="print one JSON object per line"
+                      )
+    parser.add_option("-w",
+                      "--workers",
+                      dest="workers",
+                      type="int",
+                      default=4,
+                      help="count of threads listing directories "
+                           "[default: %default]"
+                      )
+    (options, args) = parser.parse_args(args)
+    if len(args) not in (2, 3):
+        parser.error("expected a task and one or two snapshots")
+
+    repo = _get_repository(conf, args[0])
+    old = _get_snapshot(repo, args[1])
+    new = _get_snapshot(repo, args[2] if len(args) == 3 else None)
+    changes = diff.diff_trees(os.path.join(repo.destination,
+                                           repo.resolve(old)),
+                              os.path.join(repo.destination,
+                                           repo.resolve(new)),
+                              workers=options.workers)
+    for change in changes:
+        if options.json:
+            print(json.dumps(change._asdict()))
+        else:
+            suffix = "/" if change.type == "dir" else ""
+            print("%-8s %s%s" % (change.status, change.path, suffix))
+    return 0
+
+
+def export_command(conf, args):
+    parser = _get_parser("export", "[options] TASK [SNAPSHOT]")
+    parser.add_option("-p",
+                      "--path",
+                      dest="path",
+                      metavar="PATH",
+                      help="only export PATH of the sources [default: the "
+                           "whole snapshot]"
+                      )
+    parser.add_option("-o",
+                      "--output",
+                      dest="output",
+                      metavar="FILE",
+                      default="-",
+                      help="write the archive to FILE [default: stdout]"
+                      )
+    parser.add_option("-z",
+                      "--compression",
+                      dest="compression",
+                      metavar="TYPE",
+                      choices=sorted(export.COMPRESSIONS.keys()),
+                      help="compress the archive with TYPE (%s)" %
+                           ", ".join(sorted(export.COMPRESSIONS.keys()))
+                      )
+    (options, args) = parser.parse_args(args)
+    if len(args) not in (1, 2):
+        parser.error("expected a task and optionally a snapshot")
+    if options.path is not None and not os.path.isabs(options.path):
+        parser.error("path has to be absolute")
+    if options.output == "-" and sys.stdout.isatty():
+        parser.error("refusing to write the archive to a terminal")
+
+    repo = _get_repository(conf, args[0])
+    snapshot = _get_snapshot(repo, args[1] if len(args) == 2 else None,
+                             archived=True)
+    root = os.path.join(repo.destination, repo.resolve(snapshot))
+    if options.path is None:
+        (snapshot_path, arcname) = (root, "")
+    else:
+        path = os.path.normpath(options.path)
+        snapshot_path = restore.get_snapshot_path(repo, snapshot, path)
+        # the archive can be extracted with "tar -C /"
+        arcname = path.lstrip("/")
+    reader = None
+    if snapshot_path is not None and repo.is_archived(snapshot):
+        reader = repo.packs.open(snapshot)
+        pack_path = os.path.relpath(snapshot_path, root)
+        if pack_path == ".":
+            pack_path = ""
+        exists = reader.get(pack_path) is not None
+    else:
+        exists = (snapshot_path is not None and
+                  os.path.lexists(snapshot_path))
+    if not exists:
+        logger.critical("\"%s\" is not part of snapshot \"%s\". Aborting.",
+                        options.path, snapshot)
+        return const.EXIT_UNKNOWN_PATH
+
+    if options.output == "-":
+        # the archive goes to stdout, so everything else has to go to stderr
+        _log_to_stderr()
+        output = sys.stdout.buffer
+    else:
+        try:
+            output = open(options.output, "wb")
+        except OSError as err:
+            logger.critical("Cannot write \"%s\": %s. Aborting.",
+                            options.output, err)
+            return const.EXIT_EXPORT_FAILED
+    logger.info("Exporting snapshot \"%s\".", snapshot)
+    try:
+        if reader is None:
+            result = export.export_tree(snapshot_path, output, arcname,
+                                        options.compression)
+        else:
+            result = export.export_pack(reader, pack_path, output, arcname,
+                                        options.compression)
+    except (OSError, ValueError) as err:
+        logger.critical("Export failed: %s", err)
+        return const.EXIT_EXPORT_FAILED
+    finally:
+        if reader is not None:
+            reader.close()
+        if output is not sys.stdout.buffer:
+            output.close()
+    (megabytes, files) = result.get_throughput()
+    print("snapshot:   %s" % snapshot, file=sys.stderr)
+    print("files:      %s (%s bytes)" % (result.files, result.bytes),
+          file=sys.stderr)
+    print("time:       %.1f s" % result.seconds, file=sys.stderr)
+    print("throughput: %.1f MB/s, %.0f files/s" % (megabytes, files),
+          file=sys.stderr)
+    return 0
+
+
+def estimate_command(conf, args):
+    parser = _get_parser("estimate", "[options] TASK")
+    parser.add_option("-w",
+                      "--workers",
+                      dest="workers",
+                      type="int",
+                      default=4,
+                      help="count of scanning threads [default: %default]"
+                      )
+    parser.add_option("-n",
+                      "--count",
+                      dest="count",
+                      type="int",
+                      default=10,
+                      help="count of the biggest subtrees that are listed "
+                           "[default: %default]"
+                      )
+    parser.add_option("-d",
+                      "--depth",
+                      dest="depth",
+                      type="int",
+                      default=2,
+                      help="directory levels below the sources that are "
+                           "considered subtrees [default: %default]"
+                      )
+    (options, args) = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("expected a task")
+    if options.workers < 1:
+        parser.error("workers has to be at least 1")
+
+    repo = _get_repository(conf, args[0])
+    try:
+        matcher = filters.compile_filter(repo.rsyncfilter)
+    except filters.FilterError as err:
+        logger.critical("%s Aborting.", err.message)
+        return const.EXIT_ESTIMATE_FAILED
+    result = estimate.scan(repo.sources, matcher, repo.rsync_args,
+                           workers=options.workers, depth=options.depth)
+    print("files:      %s (%s bytes)" % (result.files, result.bytes))
+    print("excluded:   %s" % result.excluded)
+    print("errors:     %s" % result.errors)
+    print("time:       %.1f s, %.0f files/s" % (result.seconds,
+                                                result.get_throughput()))
+    stats = repo.catalog.get_latest("stats")
+    if stats is not None and stats["bytes"] > 0 and stats["seconds"] > 0:
+        # a full copy at the rate of the previous snapshot
+        print("full copy:  about %s" % progress.format_seconds(
+            result.bytes / (stats["bytes"] / stats["seconds"])))
+    for source in result.skipped:
+        print("SKIPPED %s" % source)
+    for (path, size, files) in result.get_biggest(options.count):
+        print("%10.1f MB %10s files  %s" % (size / 1e6, files, path))
+    return 0
+
+
+def ctl_command(conf, args):
+    parser = _get_parser("ctl", "[options] COMMAND [ARGUMENTS]\n\n"
+                         "Commands:\n"
+                         "  status     show all tasks of the daemon\n"
+                         "  trigger    create a snapshot of TASK now\n"
+                         "  pause      stop creating snapshots of TASK\n"
+                         "  resume     continue creating snapshots of TASK\n"
+                         "  cancel     cancel the running snapshot of TASK\n"
+                         "  snapshots  list the snapshots of TASK\n"
+                         "  profile    profile the next CYCLES cycles of the "
+                         "daemon")
+    parser.add_option("-j",
+                      "--json",
+                      dest="json",
+                      default=False,
+                      action="store_true",
+                      help="print the response of the daemon as JSON"
+                      )
+    parser.add_option("-m",
+                      "--memory",
+                      dest="memory",
+                      default=False,
+                      action="store_true",
+                      help="trace memory allocations while profiling"
+                      )
+    (options, args) = parser.parse_args(args)
+    # the minimum and maximum count of arguments of every command
+    arguments = {"status": (0, 0), "trigger": (1, 2), "pause": (1, 1),
+                 "resume": (1, 1), "cancel": (1, 1), "snapshots": (1, 2),
+                 "profile": (0, 1)}
+    if len(args) == 0 or args[0] not in arguments:
+        parser.error("expected one of the commands %s" %
+                     ", ".join(sorted(arguments.keys())))
+    (command, args) = (args[0], args[1:])
+    (minimum, maximum) = arguments[command]
+    if not minimum <= len(args) <= maximum:
+        parser.error("wrong number of arguments for \"%s\"" % command)
+    if command == "profile":
+        request = {"memory": options.memory}
+        if len(args) != 0:
+            if not args[0].isdigit() or int(args[0]) < 1:
+                parser.error("expected a positive count of cycles")
+            request["cycles"] = int(args[0])
+    else:
+        request = dict(zip(("task", "interval"), args))
+
+    try:
+        result = control.send_request(conf.control_socket, command,
+                                      **request)
+    except control.ControlError as err:
+        logger.critical("%s Aborting.", err.message)
+        return const.EXIT_CONTROL_FAILED
+    except OSError as err:
+        logger.critical("Cannot connect to the daemon at \"%s\": %s. "
+                        "Aborting.", conf.control_socket, err)
+        return const.EXIT_CONTROL_FAILED
+    if options.json:
+        print(json.dumps(result, indent=2))
+    elif command == "status":
+        for task in result:
+            last = "never"
+            if task["last"] is not None:
+                last = "%s at %s" % (task["last"]["result"],
+                                     task["last"]["time"])
+            lag = "none"
+            if task["lag"] is not None:
+                lag = "%s old" % progress.format_seconds(task["lag"])
+            print("%s: %s%s, next %s, last snapshot %s, %s snapshots, "
+                  "newest %s" % (
+                      task["name"], task["status"],
+                      " (triggered)" if task["triggered"] else "",
+                      task["next"] or "never", last, task["snapshots"], lag))
+            state = task["progress"]
+            if state is not None:
+                print("  %s: %.1f MB transferred at %.1f MB/s, %s files "
+                      "checked, %s remaining" % (
+                          state["snapshot"], state["bytes"] / 1e6,
+                          state["rate"] / 1e6, state["files_checked"],
+                          progress.format_seconds(state["eta"])
+                          if state["eta"] is not None else "unknown time"))
+    elif command == "trigger":
+        print("Triggered snapshot of interval \"%s\"." % result)
+    elif command == "profile":
+        print("Profiling the next %s cycle(s)%s." % (
+            result["cycles"],
+            " with memory tracing" if result["memory"] else ""))
+    elif command == "snapshots":
+        for snapshot in result:
+            print("%s%s" % (snapshot["name"],
+                            " (archived)" if snapshot["archived"] else ""))
+    return 0
+
+
+def _log_to_stderr():
+    for handler in logging.getLogger("rbackupd").handlers:
+        if (isinstance(handler, logging.StreamHandler) and
+                handler.stream is sys.stdout):
+            handler.setStream(sys.stderr)
+
+
+def _parse_time(string, end_of_day=True):
+    for timeformat in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            time = datetime.datetime.strptime(string, timeformat)
+        except ValueError:
+            continue
+        if timeformat == "%Y-%m-%d" and end_of_day:
+            # a day means its end, so all snapshots of that day qualify
+            time = time.replace(hour=23, minute=59, second=59)
+        return time
+    return None
+
+
+def _get_listing_parser(name, description):
+    parser = _get_parser(name, "[options] [TASK...]\n\n" + description)
+    parser.add_option("-i",
+                      "--interval",
+                      dest="interval",
+                      metavar="INTERVAL",
+                      help="only consider snapshots of INTERVAL"
+                      )
+    parser.add_option("-s",
+                      "--since",
+                      dest="since",
+                      metavar="TIME",
+                      help="only consider snapshots taken at or after TIME"
+                      )
+    parser.add_option("-u",
+                      "--until",
+                      dest="until",
+                      metavar="TIME",
+                      help="only consider snapshots taken at or before TIME"
+                      )
+    parser.add_option("-j",
+                      "--json",
+                      dest="json",
+                      default=False,
+                      action="store_true",
+                      help="print one JSON object per line"
+                      )
+    return parser
+
+
+def _list_snapshots(conf, parser, options, names):
+    """
+    Lists the snapshots of the given tasks, or of all tasks if none are
+    given, according to the options of a listing parser. Tasks whose
+    destination is not available are skipped.
+    """
+    since = until = None
+    if options.since is not None:
+        since = _parse_time(options.since, end_of_day=False)
+        if since is None:
+            parser.error("invalid time \"%s\"" % options.since)
+    if options.until is not None:
+        until = _parse_time(options.until)
+        if until is None:
+            parser.error("invalid time \"%s\"" % options.until)
+    for name in names:
+        if name not in conf.tasks:
+            logger.critical("Unknown task \"%s\". Aborting.", name)
+            sys.exit(const.EXIT_UNKNOWN_TASK)
+    snapshots = []
+    for name in names or conf.tasks.keys():
+        task = conf.tasks[name]
+        if not os.path.isdir(task.destination):
+            logger.warning("Destination \"%s\" of task \"%s\" not "
+                           "available, skipping.", task.destination, name)
+            continue
+        snapshots.extend(listing.list_snapshots(
+            name, task.destination, options.interval, since, until))
+    return snapshots
+
+
+def list_command(conf, args):
+    parser = _get_listing_parser(
+        "list", "Lists the snapshots of the tasks, oldest first.")
+    (options, args) = parser.parse_args(args)
+    snapshots = _list_snapshots(conf, parser, options, args)
+    if options.json:
+        # the objects are known to be acyclic, which saves the checks
+        encoder = json.JSONEncoder(check_circular=False)
+        lines = [encoder.encode(snapshot.to_json())
+                 for snapshot in snapshots]
+    else:
+        width = max([len(snapshot.name) for snapshot in snapshots] + [8])
+        lines = ["%-*s %11s %8s %9s  %s" % (width, "SNAPSHOT",
+                                            "TRANSFERRED", "FILES", "TIME",
+                                            "STATE")]
+        for snapshot in snapshots:
+            if snapshot.stats is None:
+                size = files = seconds = "-"
+            else:
+                size = _format_size(snapshot.stats["bytes"])
+                files = snapshot.stats["files"]
+                seconds = progress.format_seconds(
+                    snapshot.stats["seconds"])
+            if snapshot.archived:
+                state = "archived"
+            elif snapshot.alias is not None:
+                state = "alias of %s" % snapshot.alias
+            else:
+                state = ""
+            lines.append(("%-*s %11s %8s %9s  %s" % (
+                width, snapshot.name, size, files, seconds, state)).rstrip())
+    # a single write is much faster than one print() per snapshot
+    sys.stdout.write("".join(line + "\n" for line in lines))
+    return 0
+
+
+def stats_command(conf, args):
+    parser = _get_listing_parser(
+        "stats", "Summarizes the snapshots of the tasks per interval.")
+    (options, args) = parser.parse_args(args)
+    summaries = listing.summarize(_list_snapshots(conf, parser, options,
+                                                  args))
+    if options.json:
+        for summary in summaries:
+            print(json.dumps(summary))
+        return 0
+    print("%-12s %-10s %9s %8s %-19s  %-19s %11s %9s" % (
+        "TASK", "INTERVAL", "SNAPSHOTS", "ARCHIVED", "OLDEST", "NEWEST",
+        "TRANSFERRED", "AVG TIME"))
+    for summary in summaries:
+        average = "-"
+        if summary["recorded"] != 0:
+            average = progress.format_seconds(summary["seconds"] /
+                                              summary["recorded"])
+        print("%-12s %-10s %9s %8s %-19s  %-19s %11s %9s" % (
+            summary["task"], summary["interval"], summary["snapshots"],
+            summary["archived"], summary["oldest"], summary["newest"],
+            _format_size(summary["bytes"]), average))
+    return 0
+
+
+def log_command(conf, args):
+    parser = _get_parser("log", "[options] TASK [SNAPSHOT]")
+    parser.add_option("-p",
+                      "--path",
+                      dest="path",
+                      metavar="PATH",
+                      help="only print the lines about PATH and below, "
+                           "relative to the destination like in the log"
+                      )
+    (options, args) = parser.parse_args(args)
+    if len(args) not in (1, 2):
+        parser.error("expected a task and optionally a snapshot")
+
+    repo = _get_repository(conf, args[0])
+    snapshot = _get_snapshot(repo, args[1] if len(args) == 2 else None,
+                             archived=True)
+    # aliases and symlinks share the log of the snapshot holding the files
+    name = os.path.basename(os.path.realpath(
+        os.path.join(repo.destination, repo.resolve(snapshot))))
+    try:
+        reader = rsynclog.LogReader(repo.destination, name)
+        if options.path is None:
+            lines = reader.read()
+        else:
+            lines = reader.search(options.path)
+        for line in lines:
+            sys.stdout.buffer.write(line + b"\n")
+    except rsynclog.LogError as err:
+        logger.critical("%s Aborting.", err.message)
+        return const.EXIT_LOG_NOT_FOUND
+    except OSError as err:
+        logger.critical("Cannot read the rsync log of snapshot \"%s\": %s. "
+                        "Aborting.", name, err)
+        return const.EXIT_LOG_NOT_FOUND
+    sys.stdout.buffer.flush()
+    return 0
+
+
+def _format_size(size):
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if size < 1000 or unit == "TB":
+            break
+        size /= 1000
+    return ("%d %s" if unit == "B" else "%.1f %s") % (size, unit)
+
+
+COMMANDS = {
+    "verify": verify_command,
+    "restore": restore_command,
+    "history": history_command,
+    "diff": diff_command,
+    "export": export_command,
+    "estimate": estimate_command,
+    "list": list_command,
+    "stats": stats_command,
+    "log": log_command,
+    "ctl": ctl_command,
+}
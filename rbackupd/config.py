@@ -49,6 +49,9 @@ int:               <value>
 If a line cannot be parsed, a ParseError will be raised, containing information
 about the line the error occured in and why parsing failed.
 
+Use load() instead of instantiating Config directly to avoid parsing files
+that did not change since they were last loaded.
+
 The file will be parsed into the following datastructure, refered to as the
 structure:
 
@@ -81,6 +84,10 @@ structure:
 import os
 import collections
 
+# maps the path of every file loaded through load() to a tuple of the stat
+# signature of the file at parse time and the resulting Config instance
+_cache = {}
+
 
 class ParseError(Exception):
     """
@@ -108,9 +115,8 @@ class Config(object):
         :type pat: string
         """
         self.path = path
-        self._file = None
-        self._read_file()
         self._structure = []
+        self._index = {}
         self._parse()
 
     def get_structure(self):
@@ -136,20 +142,15 @@ class Config(object):
         :param name: The name of the section.
         :type name: string
         """
-        sections = []
-        for section in self._structure:
-            if section[0] == name:
-                sections.append(section[1])
-        if len(sections) == 0:
+        sections = self._index.get(name)
+        if sections is None:
             return [None]
         return sections
 
     def _read_file(self):
-        if self._file is not None:
-            return
         if not os.path.isfile(self.path):
             raise IOError("file not found")
-        self._file = open(self.path).readlines()
+        return open(self.path)
 
     def _is_section(self, line):
         return line.startswith("[") and line.endswith("]")
@@ -218,33 +219,59 @@ class Config(object):
     def _parse(self):
         current_section = None
         lineno = 0
-        for line in self._file:
-            lineno += 1
-            line = line.strip()
-            if self._is_empty(line) or self._is_comment(line):
-                continue
-            elif self._is_section(line):
-                current_section = [None, None]
-                current_section[0] = self._parse_section(line, lineno)
-                current_section[1] = collections.OrderedDict()
-                self._structure.append(current_section)
-            elif self._is_key_value(line, lineno):
-                if current_section is None:
-                    raise ParseError(
-                        "key-value pair without corresponding section",
-                        line,
-                        lineno)
-                (key, tag, value) = self._parse_key_value(line, lineno)
-                if tag is None:
-                    if not key in current_section[1]:
-                        current_section[1][key] = [value]
+        with self._read_file() as lines:
+            for line in lines:
+                lineno += 1
+                line = line.strip()
+                if self._is_empty(line) or self._is_comment(line):
+                    continue
+                elif self._is_section(line):
+                    current_section = [None, None]
+                    current_section[0] = self._parse_section(line, lineno)
+                    current_section[1] = collections.OrderedDict()
+                    self._structure.append(current_section)
+                    self._index.setdefault(current_section[0], []).append(
+                        current_section[1])
+                elif self._is_key_value(line, lineno):
+                    if current_section is None:
+                        raise ParseError(
+                            "key-value pair without corresponding section",
+                            line,
+                            lineno)
+                    (key, tag, value) = self._parse_key_value(line, lineno)
+                    if tag is None:
+                        if not key in current_section[1]:
+                            current_section[1][key] = [value]
+                        else:
+                            current_section[1][key].append(value)
                     else:
-                        current_section[1][key].append(value)
+                        if not key in current_section[1]:
+                            current_section[1][key] = \
+                                collections.OrderedDict({tag: value})
+                        else:
+                            current_section[1][key][tag] = value
                 else:
-                    if not key in current_section[1]:
-                        current_section[1][key] = collections.OrderedDict(
-                            {tag: value})
-                    else:
-                        current_section[1][key][tag] = value
-            else:
-                raise ParseError("invalid line", line, lineno)
+                    raise ParseError("invalid line", line, lineno)
+
+
+def load(path):
+    """
+    Returns the Config instance for a file. The file is only parsed again if
+    it changed since the last call with the same path.
+    :param path: The path of the file.
+    :type path: string
+    :returns: The parsed file.
+    :rtype: Config instance
+    :raises IOError: if the file does not exist.
+    :raises ParseError: if the file cannot be parsed.
+    """
+    if not os.path.isfile(path):
+        raise IOError("file not found")
+    stat = os.stat(path)
+    signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    conf = Config(path)
+    _cache[path] = (signature, conf)
+    return conf
@@ -17,20 +17,39 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Constants for the configuration file.
+CONF_SECTION_INCLUDE = "include"
+CONF_KEY_INCLUDE_DIR = "directory"
+CONF_INCLUDE_SUFFIX = ".conf"
+
 CONF_SECTION_LOGGING = "logging"
 CONF_KEY_LOGFILE_PATH = "logfile"
 CONF_KEY_LOGLEVEL = "loglevel"
+CONF_KEY_PROGRESS_INTERVAL = "progress_interval"
 CONF_VALUES_LOGLEVEL = ("quiet", "default", "verbose", "debug")
 
 CONF_SECTION_RSYNC = "rsync"
 CONF_KEY_RSYNC_CMD = "cmd"
 
+CONF_SECTION_SSH = "ssh"
+CONF_KEY_SSH_MULTIPLEX = "multiplex"
+CONF_KEY_SSH_CONTROL_DIR = "control_dir"
+CONF_KEY_SSH_MAX_SESSIONS = "max_sessions"
+CONF_KEY_SSH_MAX_AGE = "max_age"
+
+CONF_SECTION_CONTROL = "control"
+CONF_KEY_CONTROL_SOCKET = "socket"
+
+CONF_SECTION_CLUSTER = "cluster"
+CONF_KEY_CLUSTER_DIRECTORY = "directory"
+CONF_KEY_CLUSTER_INSTANCE = "instance"
+CONF_KEY_CLUSTER_LEASE_TIME = "lease_time"
+
 CONF_SECTION_MOUNT = "mount"
 CONF_KEY_PARTITION = "partition"
 CONF_KEY_MOUNTPOINT = "mountpoint"
 CONF_KEY_MOUNTPOINT_RO = "mountpoint_ro"
 CONF_KEY_MOUNTPOINT_OPTIONS = "mountpoint_options"
-CONF_KEY_MOUNTPOINT_RO_OPTIONS = "mountpoint_options"
+CONF_KEY_MOUNTPOINT_RO_OPTIONS = "mountpoint_ro_options"
 CONF_KEY_MOUNTPOINT_CREATE = "mountpoint_create"
 CONF_KEY_MOUNTPOINT_RO_CREATE = "mountpoint_ro_create"
 
@@ -38,6 +57,8 @@ CONF_SECTION_DEFAULT = "default"
 CONF_KEY_RSYNC_LOGFILE = "rsync_logfile"
 CONF_KEY_RSYNC_LOGFILE_NAME = "rsync_logfile_name"
 CONF_KEY_RSYNC_LOGFILE_FORMAT = "rsync_logfile_format"
+CONF_KEY_RSYNC_LOGFILE_COMPRESSION = "rsync_logfile_compression"
+CONF_VALUES_RSYNC_LOGFILE_COMPRESSION = ("xz", "gzip", "zstd")
 CONF_KEY_FILTER_PATTERNS = "filter"
 CONF_KEY_INCLUDE_PATTERNS = "include"
 CONF_KEY_EXCLUDE_PATTERNS = "exclude"
@@ -47,7 +68,19 @@ CONF_KEY_CREATE_DESTINATION = "create_destination"
 CONF_KEY_ONE_FILESYSTEM = "one_fs"
 CONF_KEY_RSYNC_ARGS = "rsync_args"
 CONF_KEY_SSH_ARGS = "ssh_args"
+CONF_KEY_RSYNC_PASSWORD_FILE = "rsync_password_file"
 CONF_KEY_OVERLAPPING = "overlapping"
+CONF_VALUES_OVERLAPPING = ("single", "hardlink", "symlink", "alias")
+CONF_KEY_CATCHUP = "catchup"
+CONF_VALUES_CATCHUP = ("immediate", "next", "jitter")
+CONF_KEY_CATCHUP_WINDOW = "catchup_window"
+CONF_KEY_REPLICATE_TO = "replicate_to"
+CONF_KEY_ARCHIVE_AFTER = "archive_after"
+CONF_KEY_ARCHIVE_COMPRESSION = "archive_compression"
+CONF_VALUES_ARCHIVE_COMPRESSION = ("xz", "gzip", "zstd")
+CONF_KEY_SNAPSHOT_BACKEND = "snapshot_backend"
+CONF_VALUES_SNAPSHOT_BACKEND = ("hardlink", "reflink", "auto")
+CONF_KEY_PRIORITY = "priority"
 
 CONF_SECTION_TASK = "task"
 CONF_KEY_DESTINATION = "destination"
@@ -71,6 +104,17 @@ EXIT_CONFIG_FILE_INVALID = 9
 EXIT_INVALID_DESTINATION = 10
 EXIT_INVALID_CONFIG_FILE = 11
 EXIT_NO_MOUNTPOINT_CREATE = 12
+EXIT_PASSWORD_FILE_INVALID = 14
+EXIT_VERIFY_FAILED = 15
+EXIT_UNKNOWN_TASK = 16
+EXIT_UNKNOWN_SNAPSHOT = 17
+EXIT_UNKNOWN_PATH = 18
+EXIT_RESTORE_FAILED = 19
+EXIT_SNAPSHOT_ARCHIVED = 20
+EXIT_EXPORT_FAILED = 21
+EXIT_CONTROL_FAILED = 22
+EXIT_ESTIMATE_FAILED = 23
+EXIT_LOG_NOT_FOUND = 24
 EXIT_KEYBOARD_INTERRUPT = 130
 
 
@@ -78,9 +122,36 @@ EXIT_KEYBOARD_INTERRUPT = 130
 SYMLINK_LATEST_NAME = "latest"
 
 
+# the directory inside every destination where rbackupd keeps its own data
+STATE_DIR_NAME = ".rbackupd"
+VERIFY_DIR_NAME = "verify"
+CATALOG_NAME = "catalog"
+HISTORY_NAME = "history.db"
+PACKS_DIR_NAME = "packs"
+LEASE_NAME = "lease"
+RSYNC_LOGS_DIR_NAME = "logs"
+
+
 # The default rsync command, can be overwritten in the configuration file.
 DEFAULT_RSYNC_CMD = "rsync"
 
 
 # The ssh command
 SSH_CMD = "ssh"
+SSH_DEFAULT_MAX_SESSIONS = 4
+SSH_DEFAULT_MAX_AGE = 3600
+
+# the unix domain socket of the running daemon
+CONTROL_DEFAULT_SOCKET = "/run/rbackupd.sock"
+
+# the seconds after which the lease of a destination expires
+CLUSTER_DEFAULT_LEASE_TIME = 300
+
+CATCHUP_DEFAULT = "immediate"
+CATCHUP_DEFAULT_WINDOW = "15m"
+
+ARCHIVE_DEFAULT_COMPRESSION = "xz"
+
+SNAPSHOT_DEFAULT_BACKEND = "hardlink"
+
+PRIORITY_DEFAULT = 1
@@ -0,0 +1,448 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module lets other processes control the running daemon through a unix
+domain socket.
+
+The protocol is line based: every request is a JSON object with a "command"
+key and the arguments of the command, every response is a JSON object with
+"ok" set to true and the "result", or "ok" set to false and an "error"
+message. Requests are answered from the state the main loop keeps in memory,
+so they never touch the destinations. Only the owner of the socket, usually
+root, may connect.
+
+Commands:
+    status                     all tasks with their next scheduled time, the
+                               result of their last snapshot, the age of
+                               their newest snapshot and the progress of the
+                               running one
+    trigger TASK [INTERVAL]    create a snapshot as soon as possible
+    pause TASK, resume TASK    stop and restart creating snapshots
+    cancel TASK                terminate the running rsync of a task
+    snapshots TASK [INTERVAL]  the snapshots of a task
+    profile [CYCLES] [MEMORY]  profile the next cycles of the main loop, see
+                               the profiling module
+"""
+
+import collections
+import datetime
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import threading
+
+from . import profiling
+from . import progress
+from . import rsync
+
+logger = logging.getLogger(__name__)
+
+# the maximum length of a request in bytes
+MAX_REQUEST_SIZE = 65536
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+class ControlError(Exception):
+    """
+    This exception is raised when a request cannot be carried out, or when
+    the daemon answers a request with an error.
+    """
+
+    def __init__(self, msg):
+        super(ControlError, self).__init__(msg)
+        self.message = msg
+
+
+class _TaskState(object):
+
+    def __init__(self):
+        self.available = False
+        self.destination = None
+        self.intervals = []
+        self.next_time = None
+        self.snapshots = []
+        self.last_time = None
+        self.last_result = None
+        self.last_snapshot = None
+
+
+class Controller(object):
+    """
+    Holds the state of the daemon that is shared with the control socket.
+    The main loop updates it after every task and asks it for triggered and
+    paused tasks, the requests are handled in the threads of the socket.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._tasks = collections.OrderedDict()
+        # the interval of the triggered snapshot by task name
+        self._triggered = {}
+        self._paused = set()
+        self._running = None
+        self._handlers = {
+            "status": self._handle_status,
+            "trigger": self._handle_trigger,
+            "pause": self._handle_pause,
+            "resume": self._handle_resume,
+            "cancel": self._handle_cancel,
+            "snapshots": self._handle_snapshots,
+            "profile": self._handle_profile,
+        }
+
+    def set_tasks(self, names):
+        """
+        Sets the names of all configured tasks, the state of tasks that were
+        removed is dropped.
+        :param names: The names of the tasks, in the order of the
+        configuration.
+        :type names: list
+        """
+        with self._lock:
+            tasks = collections.OrderedDict()
+            for name in names:
+                tasks[name] = self._tasks.get(name, _TaskState())
+            self._tasks = tasks
+            for name in list(self._triggered):
+                if name not in tasks:
+                    del self._triggered[name]
+            self._paused.intersection_update(tasks)
+
+    def update(self, repo, next_time):
+        """
+        Records the snapshots of a repository, to be answered from memory.
+        :param repo: The repository of a task.
+        :type repo: repository.Repository instance
+        :param next_time: The next time a snapshot of the task is scheduled,
+        or None if there is none.
+        :type next_time: datetime.datetime instance
+        """
+        snapshots = [{"name": backup.name,
+                      "date": backup.date.strftime(TIME_FORMAT),
+                      "interval": backup.interval_name,
+                      "archived": repo.is_archived(backup.name)}
+                     for backup in sorted(repo.backups,
+                                          key=lambda backup: (backup.epoch,
+                                                              backup.name))]
+        with self._lock:
+            state = self._tasks.setdefault(repo.name, _TaskState())
+            state.available = True
+            state.destination = repo.destination
+            state.intervals = [name for (name, _) in repo.intervals]
+            state.next_time = next_time
+            state.snapshots = snapshots
+
+    def set_unavailable(self, name):
+        """Records that the destination of a task is not available."""
+        with self._lock:
+            self._tasks.setdefault(name, _TaskState()).available = False
+
+    def is_paused(self, name):
+        with self._lock:
+            return name in self._paused
+
+    def get_triggered(self):
+        """
+        :returns: The names of all triggered tasks.
+        :rtype: set
+        """
+        with self._lock:
+            return set(self._triggered)
+
+    def pop_trigger(self, name):
+        """
+        :returns: The interval of the snapshot a task was triggered for, or
+        None if it was not triggered.
+        :rtype: string
+        """
+        with self._lock:
+            return self._triggered.pop(name, None)
+
+    def start(self, name):
+        """Records that the snapshots of a task are being created."""
+        with self._lock:
+            self._running = name
+
+    def finish(self, name, result=None, snapshot=None):
+        """
+        Records that the snapshots of a task are done.
+        :param result: "created" or "cancelled", None if no snapshot was
+        created.
+        :type result: string
+        :param snapshot: The name of the created snapshot.
+        :type snapshot: string
+        """
+        with self._lock:
+            self._running = None
+            state = self._tasks.get(name)
+            if state is not None and result is not None:
+                state.last_time = datetime.datetime.now()
+                state.last_result = result
+                state.last_snapshot = snapshot
+
+    def wait(self, seconds):
+        """
+        Waits until the time has passed or a snapshot is triggered.
+        """
+        self._wakeup.wait(seconds)
+        self._wakeup.clear()
+
+    def handle(self, request):
+        """
+        Carries out a request.
+        :param request: The decoded request.
+        :type request: dict
+        :returns: The result, to be encoded as JSON.
+        :raises ControlError: if the request is invalid.
+        """
+        command = request.get("command")
+        if not isinstance(command, str) or command not in self._handlers:
+            raise ControlError("Unknown command \"%s\"." % command)
+        with self._lock:
+            return self._handlers[command](request)
+
+    def _get_task(self, request):
+        name = request.get("task")
+        if not isinstance(name, str) or name not in self._tasks:
+            raise ControlError("Unknown task \"%s\"." % name)
+        return (name, self._tasks[name])
+
+    def _handle_status(self, request):
+        now = datetime.datetime.now()
+        tasks = []
+        for (name, state) in self._tasks.items():
+            if name == self._running:
+                status = "running"
+            elif name in self._paused:
+                status = "paused"
+            elif not state.available:
+                status = "unavailable"
+            else:
+                status = "idle"
+            last = None
+            if state.last_result is not None:
+                last = {"time": state.last_time.strftime(TIME_FORMAT),
+                        "result": state.last_result,
+                        "snapshot": state.last_snapshot}
+            tasks.append({
+                "name": name,
+                "status": status,
+                "next": (state.next_time.strftime(TIME_FORMAT)
+                         if state.next_time is not None else None),
+                "triggered": name in self._triggered,
+                "last": last,
+                "snapshots": len(state.snapshots),
+                "lag": _get_lag(state, now),
+                "progress": (progress.get_state(state.destination)
+                             if status == "running" else None)})
+        return tasks
+
+    def _handle_trigger(self, request):
+        (name, state) = self._get_task(request)
+        if not state.available:
+            raise ControlError("Destination of task \"%s\" is not "
+                               "available." % name)
+        interval_name = request.get("interval")
+        if interval_name is None:
+            interval_name = state.intervals[0]
+        elif interval_name not in state.intervals:
+            raise ControlError("Unknown interval \"%s\"." % interval_name)
+        logger.info("Snapshot of task \"%s\" triggered.", name)
+        self._triggered[name] = interval_name
+        self._wakeup.set()
+        return interval_name
+
+    def _handle_pause(self, request):
+        (name, _) = self._get_task(request)
+        if name not in self._paused:
+            logger.info("Pausing task \"%s\".", name)
+            self._paused.add(name)
+        return None
+
+    def _handle_resume(self, request):
+        (name, _) = self._get_task(request)
+        if name in self._paused:
+            logger.info("Resuming task \"%s\".", name)
+            self._paused.remove(name)
+            self._wakeup.set()
+        return None
+
+    def _handle_cancel(self, request):
+        (name, state) = self._get_task(request)
+        if name != self._running or rsync.terminate(state.destination) == 0:
+            raise ControlError("No snapshot of task \"%s\" is running." %
+                               name)
+        return None
+
+    def _handle_snapshots(self, request):
+        (_, state) = self._get_task(request)
+        interval_name = request.get("interval")
+        return [snapshot for snapshot in state.snapshots
+                if interval_name is None or
+                snapshot["interval"] == interval_name]
+
+    def _handle_profile(self, request):
+        cycles = request.get("cycles", profiling.DEFAULT_CYCLES)
+        if not isinstance(cycles, int) or cycles < 1:
+            raise ControlError("Invalid count of cycles \"%s\"." % cycles)
+        memory = bool(request.get("memory", False))
+        if not profiling.request(cycles, memory):
+            raise ControlError("Profiling is already running.")
+        logger.info("Profiling requested.")
+        # the next cycle starts right away
+        self._wakeup.set()
+        return {"cycles": cycles, "memory": memory}
+
+
+def _get_lag(state, now):
+    """
+    Returns the recovery point lag of a task in seconds, the age of its
+    newest snapshot, or None if it has none.
+    """
+    if len(state.snapshots) == 0:
+        return None
+    latest = datetime.datetime.strptime(state.snapshots[-1]["date"],
+                                        TIME_FORMAT)
+    return max(int((now - latest).total_seconds()), 0)
+
+
+class ControlServer(object):
+    """
+    Answers requests on a unix domain socket in background threads.
+    """
+
+    def __init__(self, path, controller):
+        """
+        :param path: The path of the socket.
+        :type path: string
+        :param controller: The state of the daemon.
+        :type controller: Controller instance
+        :raises OSError: if the socket cannot be created, e.g. because another
+        daemon is listening on it.
+        """
+        self.path = path
+        _remove_stale_socket(path)
+        # the socket must never be accessible by other users, not even
+        # between creating it and changing its permissions
+        umask = os.umask(0o077)
+        try:
+            self._server = _Server(path, _Handler)
+        finally:
+            os.umask(umask)
+        self._server.controller = controller
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="control")
+        self._thread.daemon = True
+        self._thread.start()
+        logger.verbose("Listening for control requests on \"%s\".", path)
+
+    def close(self):
+        """Stops answering requests and removes the socket."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_REQUEST_SIZE + 1)
+            if not line:
+                return
+            if len(line) > MAX_REQUEST_SIZE:
+                self._respond({"ok": False, "error": "Request too long."})
+                return
+            try:
+                request = json.loads(line.decode("utf-8"))
+                if not isinstance(request, dict):
+                    raise ControlError("Request is not an object.")
+                response = {"ok": True,
+                            "result": self.server.controller.handle(request)}
+            except ValueError as err:
+                response = {"ok": False, "error": "Invalid request: %s" % err}
+            except ControlError as err:
+                response = {"ok": False, "error": err.message}
+            self._respond(response)
+
+    def _respond(self, response):
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+
+def _remove_stale_socket(path):
+    """
+    Removes a socket left behind by a daemon that is not running anymore.
+    """
+    if not os.path.lexists(path):
+        return
+    if not stat.S_ISSOCK(os.lstat(path).st_mode):
+        raise OSError("\"%s\" exists and is not a socket." % path)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        client.close()
+    raise OSError("Another daemon is listening on \"%s\"." % path)
+
+
+def send_request(path, command, **arguments):
+    """
+    Sends a request to the daemon and waits for the response.
+    :param path: The path of the socket of the daemon.
+    :type path: string
+    :param command: The command.
+    :type command: string
+    :param arguments: The arguments of the command.
+    :returns: The result of the request.
+    :raises ControlError: if the daemon answered with an error.
+    :raises OSError: if the daemon cannot be reached.
+    """
+    request = dict(arguments, command=command)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        with client.makefile("rwb") as stream:
+            stream.write(json.dumps(request).encode("utf-8") + b"\n")
+            stream.flush()
+            line = stream.readline()
+    finally:
+        client.close()
+    if not line:
+        raise ControlError("The daemon closed the connection.")
+    response = json.loads(line.decode("utf-8"))
+    if not response["ok"]:
+        raise ControlError(response["error"])
+    return response["result"]
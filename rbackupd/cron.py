@@ -172,6 +172,80 @@ class Cronjob(object):
                                         datetime.datetime.now(),
                                         include_start)
 
+    def get_occurences_between(self, date_time_1, date_time_2, limit=None):
+        """
+        Determines all occurences of the cronjob after one datetime up to and
+        including another one.
+        :param date_time_1: The datetime determining the start of the period,
+        which is excluded.
+        :type date_time_1: datetime instance
+        :param date_time_2: The datetime determining the end of the period.
+        :type date_time_2: datetime instance
+        :param limit: The maximum count of occurences to return, the most
+        recent ones are returned if there are more. None means no limit.
+        :type limit: int
+        :returns: The occurences, oldest first.
+        :rtype: list of datetimes
+        """
+        occurences = []
+        min_time = self.get_min_time()
+        if date_time_2 < min_time:
+            return occurences
+        occurence = self.get_most_recent_occurence(
+            min(date_time_2, self.get_max_time()))
+        while occurence > date_time_1:
+            occurences.append(occurence)
+            if limit is not None and len(occurences) >= limit:
+                break
+            previous = occurence - datetime.timedelta(minutes=1)
+            if previous < min_time:
+                break
+            occurence = self.get_most_recent_occurence(previous)
+        occurences.reverse()
+        return occurences
+
+    def get_next_occurence(self, date_time):
+        """
+        Determines the first occurence of the cronjob after a datetime.
+        :param date_time: The datetime after which to search, which is
+        excluded.
+        :type date_time: datetime instance
+        :returns: The occurence, or None if the cronjob does not occur after
+        date_time.
+        :rtype: datetime
+        """
+        start = (date_time.replace(second=0, microsecond=0) +
+                 datetime.timedelta(minutes=1))
+        start_tuple = (start.year, start.month, start.day, start.hour,
+                       start.minute)
+        (minutes, hours, days, months, years) = [sorted(values) for values
+                                                 in self.schedule]
+        # every field is only compared as long as all more significant
+        # fields equal the start, later values of a field match anything
+        for year in years:
+            if year < start_tuple[0]:
+                continue
+            for month in months:
+                if (year, month) < start_tuple[:2]:
+                    continue
+                for day in days:
+                    if (year, month, day) < start_tuple[:3]:
+                        continue
+                    try:
+                        datetime.date(year, month, day)
+                    except ValueError:
+                        # the month is too short
+                        break
+                    for hour in hours:
+                        if (year, month, day, hour) < start_tuple[:4]:
+                            continue
+                        for minute in minutes:
+                            if (year, month, day, hour,
+                                    minute) >= start_tuple:
+                                return datetime.datetime(year, month, day,
+                                                         hour, minute)
+        return None
+
     def get_max_time(self):
         """
         Determines the last possible datetime at which the cronjob occurs.
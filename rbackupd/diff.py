@@ -0,0 +1,168 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module compares two snapshots without reading any file contents.
+
+As unchanged files are hardlinked between snapshots, two entries with the same
+inode on the same device are identical. Only entries with different inodes
+are stat'ed to decide whether their content or only their metadata changed.
+Directories with the same inode, e.g. when one snapshot is a symlink to the
+other, are skipped including everything below them.
+
+Snapshots of the "reflink" backend share no inodes, so there every entry is
+stat'ed. The result is the same, as unchanged files keep their size and
+modification time.
+
+The directories are listed and compared by a pool of threads ahead of the
+output, but the changes are yielded in a stable order (sorted by name,
+every directory before its contents) and only the directories along the
+current path are kept in memory.
+"""
+
+import collections
+import concurrent.futures
+import os
+
+ADDED = "added"
+REMOVED = "removed"
+MODIFIED = "modified"
+METADATA = "metadata"
+
+Change = collections.namedtuple("Change", ["status", "path", "type"])
+
+_Entry = collections.namedtuple("_Entry", ["name", "path", "inode", "type"])
+
+
+def diff_trees(old, new, workers=4):
+    """
+    Yields the differences between two directory trees.
+    :param old: The root of the old tree.
+    :type old: string
+    :param new: The root of the new tree.
+    :type new: string
+    :param workers: The count of threads listing directories.
+    :type workers: int
+    :returns: A generator of Change tuples with the status (ADDED, REMOVED,
+    MODIFIED or METADATA), the path relative to the roots and the type of the
+    entry ("file", "dir", "symlink" or "special").
+    :rtype: generator
+    """
+    old_st = os.stat(old)
+    new_st = os.stat(new)
+    if (old_st.st_dev, old_st.st_ino) == (new_st.st_dev, new_st.st_ino):
+        return
+    # inodes can only be compared on the same device
+    same_device = old_st.st_dev == new_st.st_dev
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        root = pool.submit(_compare, "", old, new, same_device)
+        # a stack of iterators over the futures of the subdirectories, so
+        # the traversal is depth first while the workers run ahead
+        stack = [iter([root])]
+        while stack:
+            future = next(stack[-1], None)
+            if future is None:
+                stack.pop()
+                continue
+            (changes, subdirectories) = future.result()
+            for change in changes:
+                yield change
+            stack.append(iter([
+                pool.submit(_compare, relpath, old_dir, new_dir, same_device)
+                for (relpath, old_dir, new_dir) in subdirectories]))
+
+
+def _compare(relpath, old_dir, new_dir, same_device):
+    """
+    Compares the entries of two directories, either of which may be None.
+    Returns the changes of the entries and the (relative path, old directory,
+    new directory) tuples of the subdirectories that have to be compared.
+    """
+    old_entries = _list(old_dir)
+    new_entries = _list(new_dir)
+    changes = []
+    subdirectories = []
+    for name in sorted(set(old_entries) | set(new_entries)):
+        old = old_entries.get(name)
+        new = new_entries.get(name)
+        path = os.path.join(relpath, name)
+        if old is not None and new is not None and old.type != new.type:
+            # a change of the type is a removal and an addition
+            changes.append(Change(REMOVED, path, old.type))
+            if old.type == "dir":
+                subdirectories.append((path, old.path, None))
+            old = None
+        if old is None:
+            changes.append(Change(ADDED, path, new.type))
+            if new.type == "dir":
+                subdirectories.append((path, None, new.path))
+            continue
+        if new is None:
+            changes.append(Change(REMOVED, path, old.type))
+            if old.type == "dir":
+                subdirectories.append((path, old.path, None))
+            continue
+        if same_device and old.inode == new.inode:
+            continue
+        status = _get_status(old, new)
+        if status is not None:
+            changes.append(Change(status, path, new.type))
+        if new.type == "dir":
+            subdirectories.append((path, old.path, new.path))
+    return (changes, subdirectories)
+
+
+def _get_status(old, new):
+    old_st = os.stat(old.path, follow_symlinks=False)
+    new_st = os.stat(new.path, follow_symlinks=False)
+    if new.type == "file":
+        if (old_st.st_size != new_st.st_size or
+                old_st.st_mtime_ns != new_st.st_mtime_ns):
+            return MODIFIED
+    elif new.type == "symlink":
+        if os.readlink(old.path) != os.readlink(new.path):
+            return MODIFIED
+    elif new.type == "special":
+        if old_st.st_rdev != new_st.st_rdev:
+            return MODIFIED
+    if (old_st.st_mode != new_st.st_mode or
+            old_st.st_uid != new_st.st_uid or
+            old_st.st_gid != new_st.st_gid):
+        return METADATA
+    # every directory gets a new inode in every snapshot, and a file may have
+    # been transferred again without any visible change
+    return None
+
+
+def _list(directory):
+    if directory is None:
+        return {}
+    entries = {}
+    with os.scandir(directory) as iterator:
+        for entry in iterator:
+            if entry.is_symlink():
+                entry_type = "symlink"
+            elif entry.is_dir(follow_symlinks=False):
+                entry_type = "dir"
+            elif entry.is_file(follow_symlinks=False):
+                entry_type = "file"
+            else:
+                entry_type = "special"
+            entries[entry.name] = _Entry(entry.name, entry.path,
+                                         entry.inode(), entry_type)
+    return entries
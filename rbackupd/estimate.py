@@ -0,0 +1,220 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module estimates the size of a snapshot by scanning the local sources of
+a task, applying its filter rules like rsync would. Excluded directories are
+not descended into.
+
+Directories are scanned by a pool of threads, one directory at a time, as
+most of the time is spent waiting for the file system. The sizes are summed
+up per subtree, down to a given depth below every source, so the biggest
+parts of the sources can be listed.
+"""
+
+import concurrent.futures
+import logging
+import os
+import stat
+import time
+
+from . import rsync
+
+logger = logging.getLogger(__name__)
+
+
+class Estimate(object):
+    """Holds the outcome of the scan of the sources of a task."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.directories = 0
+        self.excluded = 0
+        self.errors = 0
+        self.seconds = 0
+        # the sources that cannot be scanned, e.g. remote ones
+        self.skipped = []
+        # (bytes, files) by the path of every subtree
+        self.subtrees = {}
+
+    def get_biggest(self, count):
+        """
+        :param count: The count of subtrees to return.
+        :type count: int
+        :returns: The biggest subtrees as (path, bytes, files) tuples,
+        biggest first.
+        :rtype: list of tuples
+        """
+        biggest = sorted(self.subtrees.items(),
+                         key=lambda item: (-item[1][0], item[0]))[:count]
+        return [(path, size, files) for (path, (size, files)) in biggest]
+
+    def get_throughput(self):
+        """
+        :returns: The scanned files per second.
+        :rtype: float
+        """
+        return self.files / max(self.seconds, 1e-6)
+
+
+def get_transfer_paths(sources, rsync_args):
+    """
+    Determines the path of every local source inside the transfer, which the
+    filter rules are matched against, according to the rules of rsync(1)
+    regarding trailing slashes and --relative.
+    :param sources: The sources.
+    :type sources: list
+    :param rsync_args: The arguments passed to rsync.
+    :type rsync_args: list
+    :returns: A tuple of a list of (source path, path in the transfer)
+    tuples, and a list of the remote sources.
+    :rtype: tuple
+    """
+    relative = rsync.has_option(rsync_args, "R", "--relative")
+    local = []
+    remote = []
+    for source in sources:
+        if rsync.parse_location(source).transport != rsync.Transports.LOCAL:
+            remote.append(source)
+            continue
+        if relative:
+            transfer_path = source.split("/./", 1)[-1].strip("/")
+        elif source.endswith("/"):
+            transfer_path = ""
+        else:
+            transfer_path = os.path.basename(source)
+        local.append((source.rstrip("/") or "/", transfer_path))
+    return (local, remote)
+
+
+def scan(sources, matcher, rsync_args=(), workers=4, depth=2):
+    """
+    Scans the local sources of a task.
+    :param sources: The sources.
+    :type sources: list
+    :param matcher: The compiled filter rules of the task.
+    :type matcher: filters.Matcher instance
+    :param rsync_args: The arguments passed to rsync, "--relative" and
+    "--one-file-system" are obeyed.
+    :type rsync_args: list
+    :param workers: The count of scanning threads.
+    :type workers: int
+    :param depth: The count of directory levels below every source for
+    which the size of the subtrees is determined.
+    :type depth: int
+    :rtype: Estimate instance
+    """
+    result = Estimate()
+    start = time.time()
+    (local, result.skipped) = get_transfer_paths(sources, rsync_args)
+    one_file_system = rsync.has_option(rsync_args, "x", "--one-file-system")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for (source, transfer_path) in local:
+            try:
+                st = os.stat(source, follow_symlinks=False)
+            except OSError as err:
+                logger.warning("Cannot scan \"%s\": %s.", source,
+                               err.strerror)
+                result.errors += 1
+                continue
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if (transfer_path != "" and
+                    not matcher.is_included(transfer_path, is_dir, source)):
+                result.excluded += 1
+                continue
+            if not is_dir:
+                result.files += 1
+                if stat.S_ISREG(st.st_mode):
+                    result.bytes += st.st_size
+                continue
+            device = st.st_dev if one_file_system else None
+            future = pool.submit(_scan_directory, source, transfer_path,
+                                 matcher, device)
+            pending[future] = (source, ())
+        while len(pending) != 0:
+            (done, _) = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                (root, parts) = pending.pop(future)
+                (subdirectories, files, size, excluded, errors) = \
+                    future.result()
+                result.directories += 1
+                result.files += files
+                result.bytes += size
+                result.excluded += excluded
+                result.errors += errors
+                for level in range(1, min(len(parts), depth) + 1):
+                    subtree = os.path.join(root, *parts[:level])
+                    (subtree_bytes, subtree_files) = \
+                        result.subtrees.get(subtree, (0, 0))
+                    result.subtrees[subtree] = (subtree_bytes + size,
+                                                subtree_files + files)
+                for (name, path, transfer_path, device) in subdirectories:
+                    future = pool.submit(_scan_directory, path,
+                                         transfer_path, matcher, device)
+                    pending[future] = (root, parts + (name,))
+
+    result.seconds = time.time() - start
+    return result
+
+
+def _scan_directory(path, transfer_path, matcher, device):
+    """
+    Scans the entries of a single directory.
+    :returns: A tuple of a list of (name, path, path in the transfer,
+    device) tuples of the included subdirectories, and the count of files,
+    their bytes, the count of excluded entries and the count of errors.
+    :rtype: tuple
+    """
+    subdirectories = []
+    files = 0
+    size = 0
+    excluded = 0
+    errors = 0
+    prefix = transfer_path + "/" if transfer_path != "" else ""
+    try:
+        entries = list(os.scandir(path))
+    except OSError as err:
+        logger.warning("Cannot scan \"%s\": %s.", path, err.strerror)
+        return ([], 0, 0, 0, 1)
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            entry_path = prefix + entry.name
+            if not matcher.is_included(entry_path, is_dir, entry.path):
+                excluded += 1
+                continue
+            if is_dir:
+                if (device is not None and
+                        entry.stat(follow_symlinks=False).st_dev != device):
+                    # rsync creates the mount point, but does not descend
+                    continue
+                subdirectories.append((entry.name, entry.path, entry_path,
+                                       device))
+                continue
+            files += 1
+            if entry.is_file(follow_symlinks=False):
+                size += entry.stat(follow_symlinks=False).st_size
+        except OSError as err:
+            logger.warning("Cannot scan \"%s\": %s.", entry.path,
+                           err.strerror)
+            errors += 1
+    return (subdirectories, files, size, excluded, errors)
@@ -0,0 +1,251 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module exports snapshots as tar archives in the pax format, which keeps
+long paths, nanosecond timestamps and extended attributes (including ACLs).
+
+The archive is written as a stream, so it can be piped anywhere without being
+staged on disk. Files with several links are stored once, every other link is
+stored as a hardlink to the first one, so the hardlinks between snapshots do
+not duplicate any data. Archived snapshots are exported from their packs.
+"""
+
+import base64
+import errno
+import grp
+import os
+import pwd
+import stat
+import tarfile
+import time
+
+from . import restore
+
+# the size of the writes to the output and of the reads from files
+BUFFER_SIZE = 1024 * 1024
+
+# the compressions by the suffix of the tarfile mode
+COMPRESSIONS = {"gzip": "gz", "bzip2": "bz2", "xz": "xz"}
+
+
+def export_tree(root, fileobj, arcname="", compression=None):
+    """
+    Writes a directory tree as a tar stream.
+    :param root: The root of the tree, a directory or a single file.
+    :type root: string
+    :param fileobj: The binary file object the archive is written to.
+    :type fileobj: file object
+    :param arcname: The path of the root inside the archive, "" to put the
+    contents of a directory at the top of the archive.
+    :type arcname: string
+    :param compression: "gzip", "bzip2", "xz" or None.
+    :type compression: string
+    :returns: Statistics about the export.
+    :rtype: restore.CopyResult instance
+    """
+    return _write(_iter_tree(root, arcname), fileobj, compression)
+
+
+def export_pack(reader, path, fileobj, arcname="", compression=None):
+    """
+    Writes a subtree of a packed snapshot as a tar stream.
+    :param reader: The reader of the packed snapshot.
+    :type reader: packs.PackReader instance
+    :param path: The path inside the snapshot, "" for the whole snapshot.
+    :type path: string
+    :param fileobj: The binary file object the archive is written to.
+    :type fileobj: file object
+    :param arcname: The path of the subtree inside the archive.
+    :type arcname: string
+    :param compression: "gzip", "bzip2", "xz" or None.
+    :type compression: string
+    :returns: Statistics about the export.
+    :rtype: restore.CopyResult instance
+    """
+    return _write(_iter_pack(reader, path, arcname), fileobj, compression)
+
+
+def _write(members, fileobj, compression):
+    result = restore.CopyResult()
+    start = time.time()
+    mode = "w|"
+    if compression is not None:
+        mode += COMPRESSIONS[compression]
+    with tarfile.open(fileobj=fileobj, mode=mode, format=tarfile.PAX_FORMAT,
+                      bufsize=BUFFER_SIZE, copybufsize=BUFFER_SIZE) as tar:
+        for (info, open_file) in members:
+            if info.isreg():
+                result.files += 1
+                result.bytes += info.size
+                with open_file() as data:
+                    tar.addfile(info, data)
+            else:
+                if not info.isdir():
+                    result.files += 1
+                tar.addfile(info)
+    result.seconds = time.time() - start
+    return result
+
+
+def _iter_tree(root, arcname):
+    """
+    Yields (tarinfo, function opening the file) tuples of a tree, sorted by
+    name and every directory before its contents.
+    """
+    # the archive name of the first link of every inode with several links
+    first_links = {}
+    names = _NameCache()
+    stack = [(root, arcname, os.lstat(root))]
+    while stack:
+        (path, name, st) = stack.pop()
+        info = None if name == "" else _make_tarinfo(name, st, names)
+        if info is not None:
+            _add_xattrs(info, path)
+            if stat.S_ISLNK(st.st_mode):
+                info.linkname = os.readlink(path)
+            elif stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                if key in first_links:
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = first_links[key]
+                    info.size = 0
+                else:
+                    first_links[key] = name
+            yield (info, lambda path=path: open(path, "rb"))
+        if stat.S_ISDIR(st.st_mode):
+            with os.scandir(path) as iterator:
+                entries = sorted(iterator, key=lambda entry: entry.name,
+                                 reverse=True)
+            for entry in entries:
+                stack.append((entry.path,
+                              os.path.join(name, entry.name),
+                              entry.stat(follow_symlinks=False)))
+
+
+def _iter_pack(reader, path, arcname):
+    """
+    Yields (tarinfo, function opening the file) tuples of a subtree of a
+    packed snapshot.
+    """
+    first_links = {}
+    names = _NameCache()
+    for entry in reader.walk(path):
+        relpath = entry["path"][len(path):].lstrip("/")
+        name = os.path.join(arcname, relpath) if relpath else arcname
+        if name == "":
+            continue
+        st = _EntryStat(entry)
+        info = _make_tarinfo(name, st, names)
+        if info is None:
+            continue
+        for (key, value) in entry.get("xattrs", {}).items():
+            info.pax_headers["SCHILY.xattr." + key] = _decode_xattr(
+                base64.b64decode(value))
+        if stat.S_ISLNK(st.st_mode):
+            info.linkname = entry["target"]
+        elif stat.S_ISREG(st.st_mode):
+            key = entry.get("link", entry["path"])
+            if key in first_links:
+                info.type = tarfile.LNKTYPE
+                info.linkname = first_links[key]
+                info.size = 0
+            else:
+                first_links[key] = name
+        yield (info, lambda entry=entry: reader.open_file(entry))
+
+
+class _EntryStat(object):
+    """The fields of an entry of a pack, named like os.stat_result."""
+
+    def __init__(self, entry):
+        self.st_mode = entry["mode"]
+        self.st_uid = entry["uid"]
+        self.st_gid = entry["gid"]
+        self.st_mtime_ns = entry["mtime"]
+        self.st_size = entry.get("size", 0)
+        self.st_rdev = entry.get("rdev", 0)
+
+
+class _NameCache(object):
+    """Looks up user and group names once per id."""
+
+    def __init__(self):
+        self._users = {}
+        self._groups = {}
+
+    def get_user(self, uid):
+        if uid not in self._users:
+            try:
+                self._users[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                self._users[uid] = ""
+        return self._users[uid]
+
+    def get_group(self, gid):
+        if gid not in self._groups:
+            try:
+                self._groups[gid] = grp.getgrgid(gid).gr_name
+            except KeyError:
+                self._groups[gid] = ""
+        return self._groups[gid]
+
+
+def _make_tarinfo(name, st, names):
+    """Returns None for sockets, which cannot be archived."""
+    if stat.S_ISSOCK(st.st_mode):
+        return None
+    info = tarfile.TarInfo(name)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.uname = names.get_user(st.st_uid)
+    info.gname = names.get_group(st.st_gid)
+    # pax headers keep the fractional part
+    info.mtime = st.st_mtime_ns / 1e9
+    mode = st.st_mode
+    if stat.S_ISREG(mode):
+        info.type = tarfile.REGTYPE
+        info.size = st.st_size
+    elif stat.S_ISDIR(mode):
+        info.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(mode):
+        info.type = tarfile.SYMTYPE
+    elif stat.S_ISFIFO(mode):
+        info.type = tarfile.FIFOTYPE
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        info.type = tarfile.CHRTYPE if stat.S_ISCHR(mode) else tarfile.BLKTYPE
+        info.devmajor = os.major(st.st_rdev)
+        info.devminor = os.minor(st.st_rdev)
+    return info
+
+
+def _add_xattrs(info, path):
+    try:
+        for name in os.listxattr(path, follow_symlinks=False):
+            info.pax_headers["SCHILY.xattr." + name] = _decode_xattr(
+                os.getxattr(path, name, follow_symlinks=False))
+    except OSError as err:
+        if err.errno not in (errno.ENOTSUP, errno.EPERM, errno.EACCES):
+            raise
+
+
+def _decode_xattr(value):
+    # values that are not valid UTF-8, e.g. ACLs, make tarfile mark the
+    # header as binary
+    return value.decode("utf-8", "surrogateescape")
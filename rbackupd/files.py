@@ -20,12 +20,24 @@
 This module wraps frequently needed operations on files and directories.
 """
 
+import errno
+import fcntl
 import logging
 import os
+import stat
 import subprocess
+import tempfile
 
 logger = logging.getLogger(__name__)
 
+# the ioctl of linux that makes a file share all extents of another file,
+# _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# the errors of FICLONE if the filesystem cannot clone between the two files
+_CLONE_ERRORS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+                 errno.ENOSYS)
+
 
 def remove_symlink(path):
     """
@@ -108,3 +120,134 @@ def copy_hardlinks(path, target):
     args = ["cp", "-a", "-l", path, target]
     logger.verbose("Executing \"%s\".", " ".join(args))
     subprocess.check_call(args)
+
+
+def copy_file_data(src_fd, dst_fd, size):
+    """
+    Copies the content of a file to another file inside the kernel where
+    possible. Holes in sparse files are skipped, so they stay holes in the
+    copy.
+    :param src_fd: The file descriptor of the file to read.
+    :type src_fd: int
+    :param dst_fd: The file descriptor of the file to write, opened for
+    writing.
+    :type dst_fd: int
+    :param size: The size of the file to copy.
+    :type size: int
+    """
+    offset = 0
+    while offset < size:
+        try:
+            data_start = os.lseek(src_fd, offset, os.SEEK_DATA)
+            data_end = os.lseek(src_fd, data_start, os.SEEK_HOLE)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                # there is only a hole until the end of the file
+                break
+            if err.errno != errno.EINVAL:
+                raise
+            # the filesystem does not know about holes
+            (data_start, data_end) = (offset, size)
+        _copy_range(src_fd, dst_fd, data_start, min(data_end, size) -
+                    data_start)
+        offset = data_end
+    # a trailing hole is created by extending the file
+    os.ftruncate(dst_fd, size)
+
+
+def clone_file_data(src_fd, dst_fd, size):
+    """
+    Makes a file share the contents of another file by cloning its extents
+    (a "reflink"), which takes no time and no space until one of the files
+    is changed. Falls back to copy_file_data() on filesystems that cannot
+    clone.
+    :param src_fd: The file descriptor of the file to read.
+    :type src_fd: int
+    :param dst_fd: The file descriptor of the empty file to write, opened for
+    writing.
+    :type dst_fd: int
+    :param size: The size of the file to copy.
+    :type size: int
+    :returns: True if the file was cloned, False if it was copied.
+    :rtype: bool
+    """
+    if size > 0:
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return True
+        except OSError as err:
+            if err.errno not in _CLONE_ERRORS:
+                raise
+    copy_file_data(src_fd, dst_fd, size)
+    return False
+
+
+def supports_reflink(directory):
+    """
+    Determines whether files in a directory can be cloned with reflinks.
+    :param directory: The directory to check.
+    :type directory: string
+    :rtype: bool
+    """
+    try:
+        with tempfile.TemporaryFile(dir=directory) as source, \
+                tempfile.TemporaryFile(dir=directory) as target:
+            source.write(b"\0")
+            source.flush()
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+    except OSError as err:
+        logger.debug("Reflinks are not supported in \"%s\": %s",
+                     directory, err)
+        return False
+    return True
+
+
+def _copy_range(src_fd, dst_fd, offset, count):
+    while count > 0:
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+        except (AttributeError, OSError) as err:
+            # copy_file_range() is not available before python 3.8 and linux
+            # 4.5 and does not work across filesystems on older kernels
+            if (isinstance(err, OSError) and err.errno not in (
+                    errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                    errno.EOPNOTSUPP)):
+                raise
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            copied = os.sendfile(dst_fd, src_fd, offset, count)
+        if copied == 0:
+            break
+        offset += copied
+        count -= copied
+
+
+def copy_metadata(path, target, st):
+    """
+    Copies ownership, permissions, extended attributes (including ACLs) and
+    timestamps of a file, directory or symlink to another one. Ownership is
+    only copied if permitted.
+    :param path: The path of the original.
+    :type path: string
+    :param target: The path of the copy.
+    :type target: string
+    :param st: The result of os.lstat() of the original.
+    :type st: os.stat_result instance
+    """
+    is_link = stat.S_ISLNK(st.st_mode)
+    try:
+        os.chown(target, st.st_uid, st.st_gid, follow_symlinks=False)
+    except PermissionError:
+        pass
+    try:
+        for name in os.listxattr(path, follow_symlinks=False):
+            os.setxattr(target, name,
+                        os.getxattr(path, name, follow_symlinks=False),
+                        follow_symlinks=False)
+    except OSError as err:
+        if err.errno not in (errno.ENOTSUP, errno.EPERM, errno.EACCES):
+            raise
+    # linux does not support changing the permissions of symlinks
+    if not is_link:
+        os.chmod(target, stat.S_IMODE(st.st_mode))
+    os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns),
+             follow_symlinks=False)
@@ -20,12 +20,24 @@
 Module to handle partitions and mountpoints.
 """
 
+import collections
 import logging
 import os
+import re
+import select
 import subprocess
 
 logger = logging.getLogger(__name__)
 
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+
+# one line of /proc/<pid>/mountinfo, see proc(5)
+MountInfo = collections.namedtuple("MountInfo", [
+    "mount_id", "parent_id", "device", "root", "mountpoint", "options",
+    "fstype", "source", "super_options"])
+
+_ESCAPE_REGEX = re.compile(r"\\([0-7]{3})")
+
 
 class PartitionIdentifiers(object):
     UUID = 0
@@ -80,6 +92,24 @@ class Partition(object):
         self.partition_identifier = partition_identifier
         self.filesystem = filesystem
 
+    def is_present(self):
+        """
+        Determines whether the partition is currently attached, using the
+        symlinks udev creates in /dev/disk. If these are not available, the
+        partition is assumed to be present.
+        :rtype: bool
+        """
+        (kind, value) = self.partition_identifier.identifier
+        if kind == PartitionIdentifiers.PATH:
+            return os.path.exists(value)
+        if kind == PartitionIdentifiers.UUID:
+            directory = "/dev/disk/by-uuid"
+        else:
+            directory = "/dev/disk/by-label"
+        if not os.path.isdir(directory):
+            return True
+        return os.path.exists(os.path.join(directory, value))
+
     def mount(self, mountpoint):
         """
         Mounts the partition on a mountpoint.
@@ -144,6 +174,21 @@ class Mountpoint(object):
         except subprocess.CalledProcessError as err:
             raise
 
+    def unmount(self, lazy=False):
+        """
+        Unmounts the partition mounted on this mountpoint.
+        :param lazy: Whether the mount is detached at once and cleaned up as
+        soon as it is not busy anymore, which also works for partitions whose
+        device is gone.
+        :type lazy: bool
+        """
+        args = ["umount"]
+        if lazy:
+            args.append("-l")
+        args.append(self.path)
+        logger.verbose("Executing \"%s\".", " ".join(args))
+        subprocess.check_output(args)
+
     def bind(self, target):
         """
         Binds this mountpoint to another mountpoint.
@@ -163,3 +208,90 @@ class Mountpoint(object):
             subprocess.check_output(args)
         except subprocess.CalledProcessError as err:
             raise
+
+
+class MountTable(object):
+    """
+    The mounts of the current process, as listed in /proc/self/mountinfo. The
+    file is only parsed again after the kernel signalled a change of the
+    mount table, which is done with POLLPRI on the open file.
+    """
+    def __init__(self, path=MOUNTINFO_PATH):
+        """
+        :param path: The path of the mountinfo file.
+        :type path: string
+        """
+        self.path = path
+        self._file = open(path)
+        self._poller = select.poll()
+        self._poller.register(self._file, select.POLLPRI | select.POLLERR)
+        self._mounts = {}
+        self._read()
+
+    def close(self):
+        self._file.close()
+
+    def refresh(self):
+        """
+        Parses the mountinfo file again if the mount table changed.
+        :returns: True if the mount table changed.
+        :rtype: bool
+        """
+        if not self._poller.poll(0):
+            return False
+        self._read()
+        return True
+
+    def _read(self):
+        self._file.seek(0)
+        mounts = parse_mountinfo(self._file.read().splitlines())
+        # later mounts hide earlier ones on the same mountpoint
+        self._mounts = dict((mount.mountpoint, mount) for mount in mounts)
+
+    def is_mountpoint(self, path):
+        """
+        :returns: Whether something is mounted on a path.
+        :rtype: bool
+        """
+        return os.path.realpath(path) in self._mounts
+
+    def get_mount(self, path):
+        """
+        :returns: The mount a path is located on.
+        :rtype: MountInfo instance
+        """
+        path = os.path.realpath(path)
+        while path not in self._mounts and path != "/":
+            path = os.path.dirname(path)
+        return self._mounts.get(path)
+
+
+def parse_mountinfo(lines):
+    """
+    Parses the lines of a mountinfo file.
+    :param lines: The lines of the file.
+    :type lines: iterable of strings
+    :returns: The mounts in the order they are listed.
+    :rtype: list of MountInfo instances
+    """
+    mounts = []
+    for line in lines:
+        fields = line.split()
+        # the optional fields are terminated by a single hyphen
+        separator = fields.index("-", 6)
+        mounts.append(MountInfo(
+            mount_id=int(fields[0]),
+            parent_id=int(fields[1]),
+            device=fields[2],
+            root=_unescape(fields[3]),
+            mountpoint=_unescape(fields[4]),
+            options=fields[5].split(","),
+            fstype=fields[separator + 1],
+            source=_unescape(fields[separator + 2]),
+            super_options=fields[separator + 3].split(",")))
+    return mounts
+
+
+def _unescape(field):
+    # spaces, tabs, newlines and backslashes are escaped as octal numbers
+    return _ESCAPE_REGEX.sub(lambda match: chr(int(match.group(1), 8)), field)
@@ -0,0 +1,360 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module evaluates the filter rules of rsync(1) in Python, so the files a
+snapshot will contain can be determined without running rsync.
+
+The subset of the rules described in the "FILTER RULES" section of rsync(1)
+that can be given in the configuration file is supported: include and exclude
+rules (also as "show" and "hide"), the "!" and "/" modifiers, clearing the
+list with "!", and merge files. Rules that only affect the receiving side are
+ignored. Per-directory merge files are not supported, as they depend on the
+content of the sources.
+
+The rules are compiled once into a Matcher. Patterns without wildcards that
+only match the name of a file, by far the most common ones, are looked up in
+a dictionary, all others are translated into regular expressions.
+"""
+
+import re
+
+# e.g. "- *.o", "+/ /home", "exclude,! tmp", "-_*.bak"
+_RULE_REGEX = re.compile(r"^(?:(?P<long>[a-z-]+)(?:,(?P<long_modifiers>\S*))?"
+                         r"|(?P<short>[-+.:HSPR])(?P<short_modifiers>"
+                         r",?[!/sprxenwC]*))[ _](?P<pattern>.*)$")
+
+_INCLUDE_RULES = {"include": True, "+": True, "show": True, "S": True,
+                  "exclude": False, "-": False, "hide": False, "H": False}
+_RECEIVER_RULES = ("protect", "P", "risk", "R")
+_MERGE_RULES = ("merge", ".")
+_DIR_MERGE_RULES = ("dir-merge", ":")
+
+_PATTERN_OPTIONS = {"--include": True, "--exclude": False}
+_FILE_OPTIONS = {"--include-from": True, "--exclude-from": False}
+
+# the depth up to which merge files may include other merge files
+_MAX_MERGE_DEPTH = 16
+
+
+class FilterError(Exception):
+    """
+    This exception is raised when a filter rule is invalid or not supported.
+    """
+
+    def __init__(self, msg):
+        super(FilterError, self).__init__(msg)
+        self.message = msg
+
+
+class Rule(object):
+    """A single include or exclude rule."""
+
+    def __init__(self, include, pattern, negate=False, absolute=False):
+        """
+        :param include: Whether matching files are included or excluded.
+        :type include: bool
+        :param pattern: The pattern of the rule.
+        :type pattern: string
+        :param negate: Whether the rule applies to the files that do not
+        match the pattern.
+        :type negate: bool
+        :param absolute: Whether the pattern is matched against the absolute
+        path of a file instead of its path in the transfer.
+        :type absolute: bool
+        """
+        if pattern == "":
+            raise FilterError("Empty pattern in filter rule.")
+        self.include = include
+        self.pattern = pattern
+        self.negate = negate
+        self.absolute = absolute
+        self.dir_only = False
+        # matches the directory of a "dir/***" pattern
+        self._dir_regex = None
+        if pattern.endswith("/***"):
+            pattern = pattern[:-4]
+            self._dir_regex = re.compile(_translate(pattern.lstrip("/")) +
+                                         r"\Z")
+            pattern += "/**"
+        elif pattern.endswith("/") and pattern != "/":
+            self.dir_only = True
+            pattern = pattern.rstrip("/")
+        anchored = pattern.startswith("/") or absolute
+        pattern = pattern.lstrip("/")
+        # patterns without a slash or "**" are only matched against the
+        # name of a file
+        self.name_only = not (anchored or "/" in pattern or "**" in pattern)
+        self.literal = (self.name_only and not negate and
+                        not _has_wildcards(pattern))
+        self.name = pattern if self.literal else None
+        regex = _translate(pattern)
+        if not (anchored or self.name_only):
+            # an unanchored pattern matches the end of the path
+            regex = r"(?:.*/)?" + regex
+        self._regex = re.compile(regex + r"\Z")
+        if self._dir_regex is not None and not anchored:
+            self._dir_regex = re.compile(r"(?:.*/)?" +
+                                         self._dir_regex.pattern)
+
+    def matches(self, path, is_dir, abs_path=None):
+        """
+        Determines whether the rule applies to a file.
+        :param path: The path of the file in the transfer, without a leading
+        slash.
+        :type path: string
+        :param is_dir: Whether the file is a directory.
+        :type is_dir: bool
+        :param abs_path: The absolute path of the file, or None if unknown.
+        Rules with the "/" modifier never apply without it.
+        :type abs_path: string
+        :rtype: bool
+        """
+        if self.absolute:
+            if abs_path is None:
+                return False
+            subject = abs_path.lstrip("/")
+        elif self.name_only:
+            subject = path.rpartition("/")[2]
+        else:
+            subject = path
+        if self.dir_only and not is_dir:
+            matched = False
+        else:
+            matched = self._regex.match(subject) is not None
+            if not matched and is_dir and self._dir_regex is not None:
+                matched = self._dir_regex.match(subject) is not None
+        return matched != self.negate
+
+
+class Matcher(object):
+    """
+    Decides which files are transferred, from a list of rules of which the
+    first matching one wins. Files that no rule matches are included.
+    """
+
+    def __init__(self, rules):
+        """
+        :param rules: The rules, in the order rsync gets them.
+        :type rules: list of Rule instances
+        """
+        self.rules = list(rules)
+        # the first literal rules by name, one for every value of dir_only
+        self._literals = {}
+        # all other rules with their position
+        self._others = []
+        for (index, rule) in enumerate(self.rules):
+            if rule.literal:
+                candidates = self._literals.setdefault(rule.name, [])
+                if not any(dir_only == rule.dir_only
+                           for (_, dir_only, _) in candidates):
+                    candidates.append((index, rule.dir_only, rule.include))
+            else:
+                self._others.append((index, rule))
+
+    def is_included(self, path, is_dir, abs_path=None):
+        """
+        Determines whether a file is transferred. An excluded directory is
+        not descended into, so its content is excluded as well.
+        :param path: The path of the file in the transfer, without a leading
+        slash.
+        :type path: string
+        :param is_dir: Whether the file is a directory.
+        :type is_dir: bool
+        :param abs_path: The absolute path of the file, or None if unknown.
+        :type abs_path: string
+        :rtype: bool
+        """
+        (first, include) = (len(self.rules), True)
+        for (index, dir_only, literal_include) in self._literals.get(
+                path.rpartition("/")[2], ()):
+            if index < first and (is_dir or not dir_only):
+                (first, include) = (index, literal_include)
+        for (index, rule) in self._others:
+            if index >= first:
+                break
+            if rule.matches(path, is_dir, abs_path):
+                return rule.include
+        return include
+
+
+def compile_filter(rsyncfilter):
+    """
+    Compiles the filters of a task.
+    :param rsyncfilter: The filters, or None if there are none.
+    :type rsyncfilter: rsync.Filter instance
+    :rtype: Matcher instance
+    :raises: FilterError if a rule is invalid or not supported, or if a file
+    of rules cannot be read.
+    """
+    if rsyncfilter is None:
+        return Matcher([])
+    return compile_args(rsyncfilter.get_args())
+
+
+def compile_args(args):
+    """
+    Compiles the filter options among the arguments of rsync, as returned
+    by rsync.Filter.get_args(). Other arguments are ignored.
+    :param args: The arguments.
+    :type args: list
+    :rtype: Matcher instance
+    :raises: FilterError if a rule is invalid or not supported, or if a file
+    of rules cannot be read.
+    """
+    rules = []
+    args = list(args)
+    while len(args) != 0:
+        option = args.pop(0)
+        if option.startswith("--") and "=" in option:
+            (option, _, value) = option.partition("=")
+        elif (option in _PATTERN_OPTIONS or option in _FILE_OPTIONS or
+                option == "--filter") and len(args) != 0:
+            value = args.pop(0)
+        else:
+            continue
+        if option == "--filter":
+            parse_rule(value, rules)
+        elif option in _PATTERN_OPTIONS:
+            _parse_pattern(value, _PATTERN_OPTIONS[option], rules)
+        elif option in _FILE_OPTIONS:
+            for line in _read_lines(value):
+                _parse_pattern(line, _FILE_OPTIONS[option], rules)
+    return Matcher(rules)
+
+
+def parse_rule(rule, rules, depth=0):
+    """
+    Parses a filter rule as given to "--filter" and appends the resulting
+    rules to a list.
+    :param rule: The rule.
+    :type rule: string
+    :param rules: The list of rules so far, a "!" rule clears it.
+    :type rules: list
+    :raises: FilterError if the rule is invalid or not supported.
+    """
+    if rule in ("!", "clear"):
+        del rules[:]
+        return
+    match = _RULE_REGEX.match(rule)
+    if match is None:
+        raise FilterError("Invalid filter rule \"%s\"." % rule)
+    name = match.group("long") or match.group("short")
+    modifiers = (match.group("long_modifiers") or
+                 match.group("short_modifiers") or "").lstrip(",")
+    pattern = match.group("pattern")
+    if name in _MERGE_RULES and modifiers == "":
+        if depth >= _MAX_MERGE_DEPTH:
+            raise FilterError("Merge files nested too deeply at \"%s\"." %
+                              pattern)
+        for line in _read_lines(pattern):
+            parse_rule(line, rules, depth + 1)
+        return
+    if name in _DIR_MERGE_RULES or name in _MERGE_RULES:
+        raise FilterError("Filter rule \"%s\" is not supported." % rule)
+    if name in _RECEIVER_RULES or "r" in modifiers:
+        # only affects the files deleted on the receiving side
+        return
+    if name not in _INCLUDE_RULES:
+        raise FilterError("Unknown filter rule \"%s\"." % rule)
+    unsupported = set(modifiers) - set("!/sp")
+    if len(unsupported) != 0:
+        raise FilterError("Modifier \"%s\" of filter rule \"%s\" is not "
+                          "supported." % ("".join(sorted(unsupported)), rule))
+    rules.append(Rule(_INCLUDE_RULES[name], pattern, negate="!" in modifiers,
+                      absolute="/" in modifiers))
+
+
+def _parse_pattern(pattern, include, rules):
+    """
+    Parses a pattern as given to "--include" or "--exclude", which may
+    override the type of the rule with a "+ " or "- " prefix.
+    """
+    if pattern == "!":
+        del rules[:]
+    elif pattern.startswith("+ ") or pattern.startswith("- "):
+        rules.append(Rule(pattern[0] == "+", pattern[2:]))
+    else:
+        rules.append(Rule(include, pattern))
+
+
+def _read_lines(path):
+    """
+    Reads the rules of a file, without blank lines and comments.
+    """
+    try:
+        with open(path, "r") as f:
+            lines = f.read().splitlines()
+    except OSError as err:
+        raise FilterError("Cannot read filter file \"%s\": %s." %
+                          (path, err.strerror))
+    return [line for line in lines
+            if line.strip() != "" and line[0] not in "#;"]
+
+
+def _has_wildcards(pattern):
+    return "*" in pattern or "?" in pattern or "[" in pattern
+
+
+def _translate(pattern):
+    """
+    Translates a pattern into a regular expression. "*" does not match
+    slashes, "**" does. Backslashes only escape characters in patterns with
+    wildcards.
+    """
+    if not _has_wildcards(pattern):
+        return re.escape(pattern)
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern):
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+        elif char == "*":
+            if pattern.startswith("**", i):
+                regex.append(".*")
+                while i < len(pattern) and pattern[i] == "*":
+                    i += 1
+            else:
+                regex.append("[^/]*")
+                i += 1
+        elif char == "?":
+            regex.append("[^/]")
+            i += 1
+        elif char == "[":
+            end = i + 1
+            if end < len(pattern) and pattern[end] in "!^":
+                end += 1
+            if end < len(pattern) and pattern[end] == "]":
+                end += 1
+            while end < len(pattern) and pattern[end] != "]":
+                end += 1
+            if end >= len(pattern):
+                regex.append(re.escape(char))
+                i += 1
+                continue
+            body = pattern[i + 1:end].replace("\\", "\\\\")
+            if body[0] in "!^":
+                body = "^" + body[1:]
+            regex.append("[%s]" % body)
+            i = end + 1
+        else:
+            regex.append(re.escape(char))
+            i += 1
+    return "".join(regex)
@@ -0,0 +1,446 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module maintains the history index of a repository, which records for
+every path in the snapshots in which snapshots it changed.
+
+As unchanged files are hardlinked between snapshots, a file changed exactly
+when its inode changed. The index is a sqlite database in the state directory
+of the destination with three tables:
+
+snapshots
+    The indexed snapshots, numbered in the order they were indexed.
+nodes
+    A tree of all paths that ever existed in a snapshot. Every node stores its
+    name and its parent only, so common prefixes are not repeated. The inode
+    of the path in the latest indexed snapshot is kept to detect changes, it
+    is 0 for directories and NULL if the path does not exist anymore.
+versions
+    One row for every change of a path: the snapshot in which it changed and
+    the inode, size and modification time it got. Rows of removed paths have
+    no inode.
+
+Snapshots are indexed incrementally: the tree of a new snapshot is compared
+with the nodes directory by directory, and only paths whose inode differs are
+stat'ed and written.
+
+Snapshots of the "reflink" backend give every file a new inode, so there a
+path with a new inode only changed if its size or modification time differs
+from its latest version, like rsync's quick check.
+
+The daemon indexes new snapshots in a background thread, so walking the trees
+of large snapshots never delays the snapshots of other tasks.
+"""
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+
+from . import constants as const
+from . import repository
+from . import restore
+
+logger = logging.getLogger(__name__)
+
+ROOT_NODE = 1
+DIRECTORY_INODE = 0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    seq INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY,
+    parent INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    ino INTEGER,
+    UNIQUE (parent, name)
+);
+CREATE TABLE IF NOT EXISTS versions (
+    node INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    ino INTEGER,
+    size INTEGER,
+    mtime INTEGER,
+    PRIMARY KEY (node, seq)
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO nodes (id, parent, name, ino) VALUES (1, 0, '', 0);
+"""
+
+
+class Version(object):
+    """
+    A version of a path, which is contained in one or more consecutive
+    snapshots.
+    """
+
+    def __init__(self, snapshots, inode, size, mtime):
+        """
+        :param snapshots: The names of the existing snapshots containing this
+        version, oldest first.
+        :type snapshots: list
+        :param inode: The inode of the version, 0 for directories.
+        :type inode: int
+        :param size: The size in bytes.
+        :type size: int
+        :param mtime: The modification time in seconds since the epoch.
+        :type mtime: int
+        """
+        self.snapshots = snapshots
+        self.inode = inode
+        self.size = size
+        self.mtime = mtime
+
+    @property
+    def is_directory(self):
+        return self.inode == DIRECTORY_INODE
+
+
+class HistoryIndex(object):
+    """The history index of a single repository."""
+
+    def __init__(self, destination):
+        """
+        :param destination: The destination directory of the repository.
+        :type destination: string
+        """
+        self.destination = destination
+        self.path = os.path.join(destination, const.STATE_DIR_NAME,
+                                 const.HISTORY_NAME)
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # the daemon and commands may access the index at the same time
+        self._db = sqlite3.connect(self.path, timeout=60)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def get_indexed_snapshots(self):
+        """
+        :returns: The names of all indexed snapshots in the order they were
+        indexed.
+        :rtype: list
+        """
+        return [name for (name,) in self._db.execute(
+            "SELECT name FROM snapshots ORDER BY seq")]
+
+    def update(self, repo, claim=None):
+        """
+        Indexes all snapshots of a repository that are newer than the latest
+        indexed snapshot, oldest first.
+        :param repo: The repository.
+        :type repo: repository.Repository instance
+        :param claim: A function that is called with the destination and the
+        names of a snapshot and its folder before it is indexed, and returns
+        a function to call afterwards.
+        :type claim: function
+        :returns: The names of the newly indexed snapshots.
+        :rtype: list
+        """
+        indexed = set(self.get_indexed_snapshots())
+        backups = sorted(repo.backups, key=lambda backup: backup.date)
+        latest = None
+        for backup in backups:
+            if backup.name in indexed:
+                latest = backup.date
+        # archived snapshots cannot be indexed anymore
+        new = [backup.name for backup in backups
+               if backup.name not in indexed and
+               (latest is None or backup.date >= latest) and
+               not repo.is_archived(backup.name)]
+        indexed = []
+        for name in new:
+            folder = repo.resolve(name)
+            release = (claim(repo.destination, [name, folder])
+                       if claim is not None else lambda: None)
+            try:
+                # a snapshot that expired in the meantime would be recorded
+                # as the removal of all its paths
+                if not os.path.isdir(os.path.join(repo.destination, folder)):
+                    continue
+                self.add_snapshot(name, folder,
+                                  quick_check=repo.backend == "reflink")
+                indexed.append(name)
+            finally:
+                release()
+        return indexed
+
+    def add_snapshot(self, name, folder=None, quick_check=False):
+        """
+        Indexes a snapshot. Everything is written in a single transaction, so
+        an interrupted run leaves the index as it was before.
+        :param name: The name of the snapshot.
+        :type name: string
+        :param folder: The folder holding the files of the snapshot, if it is
+        an alias of another snapshot.
+        :type folder: string
+        :param quick_check: Whether paths with a new inode but the size and
+        modification time of their latest version are unchanged.
+        :type quick_check: bool
+        """
+        logger.verbose("Indexing history of snapshot \"%s\".", name)
+        root = os.path.realpath(os.path.join(self.destination,
+                                             folder or name))
+        with self._db:
+            seq = self._db.execute("INSERT INTO snapshots (name) VALUES (?)",
+                                   (name,)).lastrowid
+            changes = 0
+            stack = [(ROOT_NODE, root)]
+            while stack:
+                (node, path) = stack.pop()
+                changes += self._index_directory(seq, node, path, stack,
+                                                 quick_check)
+        logger.verbose("Recorded %s change(s) in snapshot \"%s\".",
+                       changes, name)
+
+    def _index_directory(self, seq, node, path, stack, quick_check):
+        known = {}
+        for (child, child_name, ino) in self._db.execute(
+                "SELECT id, name, ino FROM nodes WHERE parent = ? AND "
+                "ino IS NOT NULL", (node,)):
+            known[child_name] = (child, ino)
+        changes = 0
+        try:
+            entries = list(os.scandir(path))
+        except OSError as err:
+            logger.warning("Cannot read \"%s\": %s", path, err)
+            return 0
+        for entry in entries:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            ino = DIRECTORY_INODE if is_dir else entry.inode()
+            if entry.name in known:
+                (child, old_ino) = known.pop(entry.name)
+            else:
+                (child, old_ino) = (self._get_node(node, entry.name), None)
+            if ino != old_ino:
+                if old_ino == DIRECTORY_INODE:
+                    # a directory was replaced by something else
+                    changes += self._remove_children(seq, child)
+                st = entry.stat(follow_symlinks=False)
+                self._db.execute("UPDATE nodes SET ino = ? WHERE id = ?",
+                                 (ino, child))
+                if (quick_check and old_ino not in (None, DIRECTORY_INODE) and
+                        not is_dir and self._is_unchanged(child, st)):
+                    continue
+                self._db.execute(
+                    "INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?, ?)",
+                    (child, seq, ino, 0 if is_dir else st.st_size,
+                     int(st.st_mtime)))
+                changes += 1
+            if is_dir:
+                stack.append((child, entry.path))
+        for (child, old_ino) in known.values():
+            changes += self._remove(seq, child, old_ino)
+        return changes
+
+    def _is_unchanged(self, node, st):
+        row = self._db.execute(
+            "SELECT size, mtime FROM versions WHERE node = ? ORDER BY seq "
+            "DESC LIMIT 1", (node,)).fetchone()
+        return row == (st.st_size, int(st.st_mtime))
+
+    def _get_node(self, parent, name):
+        row = self._db.execute(
+            "SELECT id FROM nodes WHERE parent = ? AND name = ?",
+            (parent, name)).fetchone()
+        if row is not None:
+            return row[0]
+        return self._db.execute(
+            "INSERT INTO nodes (parent, name) VALUES (?, ?)",
+            (parent, name)).lastrowid
+
+    def _remove(self, seq, node, ino):
+        changes = 0
+        if ino == DIRECTORY_INODE:
+            changes += self._remove_children(seq, node)
+        self._db.execute("UPDATE nodes SET ino = NULL WHERE id = ?", (node,))
+        self._db.execute(
+            "INSERT OR REPLACE INTO versions VALUES (?, ?, NULL, NULL, NULL)",
+            (node, seq))
+        return changes + 1
+
+    def _remove_children(self, seq, node):
+        children = self._db.execute(
+            "SELECT id, ino FROM nodes WHERE parent = ? AND ino IS NOT NULL",
+            (node,)).fetchall()
+        return sum(self._remove(seq, child, ino) for (child, ino) in children)
+
+    def get_versions(self, relative_path, existing=None):
+        """
+        Returns all versions of a path.
+        :param relative_path: The path relative to the root of the snapshots.
+        :type relative_path: string
+        :param existing: The names of the snapshots that still exist. Versions
+        that are not contained in any of them are omitted. None means all
+        indexed snapshots.
+        :type existing: collection
+        :returns: The versions, oldest first.
+        :rtype: list of Version instances
+        """
+        node = ROOT_NODE
+        for name in relative_path.strip("/").split("/"):
+            if name in ("", "."):
+                continue
+            row = self._db.execute(
+                "SELECT id FROM nodes WHERE parent = ? AND name = ?",
+                (node, name)).fetchone()
+            if row is None:
+                return []
+            node = row[0]
+        snapshots = self._db.execute(
+            "SELECT seq, name FROM snapshots ORDER BY seq").fetchall()
+        rows = self._db.execute(
+            "SELECT seq, ino, size, mtime FROM versions WHERE node = ? "
+            "ORDER BY seq", (node,)).fetchall()
+        versions = []
+        for (i, (seq, ino, size, mtime)) in enumerate(rows):
+            if ino is None:
+                continue
+            end = rows[i + 1][0] if i + 1 < len(rows) else None
+            names = [name for (snapshot_seq, name) in snapshots
+                     if snapshot_seq >= seq and
+                     (end is None or snapshot_seq < end) and
+                     (existing is None or name in existing)]
+            if len(names) != 0:
+                versions.append(Version(names, ino, size, mtime))
+        return versions
+
+
+def get_relative_path(repo, path):
+    """
+    Determines the path of a source path relative to the root of the
+    snapshots of a repository.
+    :param repo: The repository.
+    :type repo: repository.Repository instance
+    :param path: The absolute path on the source machine.
+    :type path: string
+    :returns: The relative path, or None if the path is not part of any local
+    source.
+    :rtype: string
+    """
+    # any name works, as the layout of all snapshots is the same
+    placeholder = "snapshot"
+    snapshot_path = restore.get_snapshot_path(repo, placeholder, path)
+    if snapshot_path is None:
+        return None
+    return os.path.relpath(snapshot_path,
+                           os.path.join(repo.destination, placeholder))
+
+
+def update(repo, claim=None):
+    """
+    Brings the history index of a repository up to date.
+    :param repo: The repository.
+    :type repo: repository.Repository instance
+    :param claim: See HistoryIndex.update().
+    :type claim: function
+    """
+    index = HistoryIndex(repo.destination)
+    try:
+        index.update(repo, claim)
+    finally:
+        index.close()
+
+
+class Indexer(object):
+    """
+    Updates the history indexes of tasks in a background thread. Every task is
+    queued at most once, no matter how often it is submitted before indexing
+    starts.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # the latest settings of every queued task by name
+        self._pending = {}
+        # the (destination, snapshot) tuples of the snapshots being indexed
+        self._in_use = set()
+        self._thread = threading.Thread(target=self._run, name="indexer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, task):
+        """
+        Queues indexing the new snapshots of a task.
+        :param task: The settings of the task.
+        :type task: settings.TaskSettings instance
+        """
+        with self._lock:
+            queued = task.name in self._pending
+            self._pending[task.name] = task
+        if not queued:
+            self._queue.put(task.name)
+
+    def get_in_use(self, destination):
+        """
+        :returns: The names of the snapshots of a destination that are being
+        indexed right now and must not be removed.
+        :rtype: set
+        """
+        with self._lock:
+            return set(name for (path, name) in self._in_use
+                       if path == destination)
+
+    def close(self):
+        """
+        Stops the background thread after the running snapshot is indexed.
+        Queued tasks are dropped.
+        """
+        with self._lock:
+            self._pending.clear()
+        self._queue.put(None)
+        if self._thread.is_alive():
+            logger.info("Waiting for history indexing to finish.")
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            name = self._queue.get()
+            if name is None:
+                return
+            with self._lock:
+                task = self._pending.pop(name, None)
+            if task is None:
+                continue
+            # the repositories of the main thread are not thread-safe
+            try:
+                update(repository.create(task), self._claim)
+            except (OSError, sqlite3.Error) as err:
+                # the snapshots are indexed the next time or by the
+                # "history" command
+                logger.error("Could not update history index of task "
+                             "\"%s\": %s", task.name, err)
+
+    def _claim(self, destination, names):
+        claimed = set((destination, name) for name in names)
+
+        def release():
+            with self._lock:
+                self._in_use.difference_update(claimed)
+
+        with self._lock:
+            self._in_use.update(claimed)
+        return release
@@ -53,3 +53,19 @@ def interval_to_oldest_datetime(interval):
         logger.critical("Invalid interval: \"%s\". Aborting.", interval)
         sys.exit(13)
     return result
+
+
+def interval_to_timedelta(interval):
+    """
+    Converts an interval with a fixed length, which means in minutes ("m"),
+    hours ("h"), days ("d") or weeks ("w"), to a timedelta.
+    :param interval: The interval, e.g. "15m".
+    :type interval: string
+    :rtype: datetime.timedelta instance
+    :raises ValueError: if the interval is invalid.
+    """
+    units = {"m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+    suffix = interval[-1:]
+    if suffix not in units:
+        raise ValueError("Invalid interval: \"%s\"" % interval)
+    return datetime.timedelta(**{units[suffix]: int(interval[:-1])})
@@ -0,0 +1,293 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module lets several daemons, on one host or on several hosts with
+shared storage, split the tasks of a configuration between them.
+
+Every daemon is a member of a cluster: it keeps a heartbeat file in a shared
+directory, and members whose heartbeat expired are considered dead. Every
+task is assigned to one of the live members by rendezvous hashing, so the
+assignment only changes for the tasks of members that join or leave.
+
+A daemon only runs a task while it holds the lease of its destination, a
+file in the ".rbackupd" directory of the destination that names the owner
+and expires unless it is renewed. Leases are renewed in a background thread,
+so they do not expire during long snapshots. A daemon hands a lease over by
+releasing it once the task is assigned to another member, and takes over the
+tasks of a dead member once its leases expired. The clocks of all hosts have
+to be synchronized.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from . import constants as const
+from . import rsync
+
+logger = logging.getLogger(__name__)
+
+MEMBER_SUFFIX = ".member"
+
+
+class Cluster(object):
+    """
+    The membership of a daemon in a cluster, and the leases it holds.
+    """
+
+    def __init__(self, directory, instance, lease_time):
+        """
+        :param directory: The shared directory of the heartbeat files.
+        :type directory: string
+        :param instance: The name of the daemon, unique in the cluster.
+        :type instance: string
+        :param lease_time: The seconds after which heartbeats and leases
+        expire.
+        :type lease_time: int
+        """
+        self.directory = directory
+        self.instance = instance
+        self.lease_time = lease_time
+        self._lock = threading.Lock()
+        # the held leases by destination
+        self._leases = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Joins the cluster and starts renewing the heartbeat and the leases in
+        a background thread.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.heartbeat()
+        self._thread = threading.Thread(target=self._run, name="lease")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Releases all leases and leaves the cluster."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            for lease in self._leases.values():
+                lease.release()
+            self._leases.clear()
+        try:
+            os.unlink(self._get_member_path(self.instance))
+        except FileNotFoundError:
+            pass
+
+    def heartbeat(self):
+        """Announces that the daemon is alive."""
+        path = self._get_member_path(self.instance)
+        _write_json(path, {"instance": self.instance,
+                           "pid": os.getpid(),
+                           "expires": time.time() + self.lease_time})
+
+    def get_members(self):
+        """
+        :returns: The names of all live members, including this daemon.
+        :rtype: list
+        """
+        members = set([self.instance])
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith(MEMBER_SUFFIX):
+                continue
+            record = _read_json(os.path.join(self.directory, name))
+            if record is not None and record["expires"] > now:
+                members.add(record["instance"])
+        return sorted(members)
+
+    def claim(self, name, destination, busy=False):
+        """
+        Determines whether the daemon runs a task now, acquiring or releasing
+        the lease of its destination as necessary.
+        :param name: The name of the task.
+        :type name: string
+        :param destination: The destination of the task.
+        :type destination: string
+        :param busy: Whether the destination is still in use, e.g. by
+        replication. A busy lease is not handed over.
+        :type busy: bool
+        :returns: True if the daemon holds the lease.
+        :rtype: bool
+        """
+        owner = get_owner(name, self.get_members())
+        with self._lock:
+            lease = self._leases.get(destination)
+            if lease is not None:
+                if owner != self.instance and not busy:
+                    logger.info("Handing task \"%s\" over to \"%s\".",
+                                name, owner)
+                    lease.release()
+                    del self._leases[destination]
+                    return False
+                if lease.renew():
+                    return True
+                logger.error("Lost the lease of task \"%s\".", name)
+                del self._leases[destination]
+                return False
+            if owner != self.instance:
+                return False
+            lease = Lease(destination, self.instance, self.lease_time)
+            if not lease.acquire():
+                return False
+            logger.info("Acquired the lease of task \"%s\".", name)
+            self._leases[destination] = lease
+            return True
+
+    def _run(self):
+        while not self._stop.wait(self.lease_time / 3):
+            try:
+                self.heartbeat()
+            except OSError as err:
+                logger.error("Could not write heartbeat: %s", err)
+            with self._lock:
+                for (destination, lease) in list(self._leases.items()):
+                    try:
+                        renewed = lease.renew()
+                    except OSError as err:
+                        logger.error("Could not renew lease of \"%s\": %s",
+                                     destination, err)
+                        continue
+                    if not renewed:
+                        # another daemon runs the task now, the running
+                        # snapshot must not go on
+                        logger.error("Lost the lease of \"%s\".",
+                                     destination)
+                        del self._leases[destination]
+                        rsync.terminate(destination)
+
+    def _get_member_path(self, instance):
+        return os.path.join(self.directory, instance + MEMBER_SUFFIX)
+
+
+class Lease(object):
+    """
+    The lease of a destination, stored in the destination itself.
+    """
+
+    def __init__(self, destination, owner, lease_time):
+        self.path = os.path.join(destination, const.STATE_DIR_NAME,
+                                 const.LEASE_NAME)
+        self.owner = owner
+        self.lease_time = lease_time
+
+    def acquire(self):
+        """
+        Acquires the lease if it is free, expired or held by the owner
+        already.
+        :returns: True if the lease was acquired.
+        :rtype: bool
+        """
+        with self._lock():
+            record = _read_json(self.path)
+            if (record is not None and record["owner"] != self.owner and
+                    record["expires"] > time.time()):
+                return False
+            self._write()
+            return True
+
+    def renew(self):
+        """
+        Extends the lease.
+        :returns: False if the lease was taken over by another owner.
+        :rtype: bool
+        """
+        with self._lock():
+            record = _read_json(self.path)
+            if record is not None and record["owner"] != self.owner:
+                return False
+            self._write()
+            return True
+
+    def release(self):
+        """Releases the lease, unless it was taken over already."""
+        with self._lock():
+            record = _read_json(self.path)
+            if record is not None and record["owner"] == self.owner:
+                os.unlink(self.path)
+
+    def get_owner(self):
+        """
+        :returns: The owner of the lease, or None if it is free or expired.
+        :rtype: string
+        """
+        record = _read_json(self.path)
+        if record is None or record["expires"] <= time.time():
+            return None
+        return record["owner"]
+
+    def _write(self):
+        _write_json(self.path, {"owner": self.owner,
+                                "expires": time.time() + self.lease_time})
+
+    @contextlib.contextmanager
+    def _lock(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # POSIX locks, unlike flock(), work on NFS
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+
+
+def get_owner(name, members):
+    """
+    Assigns a task to a member by rendezvous hashing: the member with the
+    highest hash of its name and the name of the task wins.
+    :param name: The name of the task.
+    :type name: string
+    :param members: The names of the live members.
+    :type members: list
+    :rtype: string
+    """
+    return max(members, key=lambda member: hashlib.sha256(
+        ("%s\0%s" % (member, name)).encode("utf-8")).digest())
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        # a file that is being written by a crashed writer
+        return None
+
+
+def _write_json(path, record):
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(record, f)
+    os.rename(tmp_path, path)
@@ -0,0 +1,178 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module lists the snapshots of a destination and summarizes them, for the
+"list" and "stats" commands.
+
+Everything is read from the catalog and the index of the packs, neither the
+destination nor any snapshot is listed unless the catalog is out of date.
+The statistics of a snapshot are those recorded in the catalog when it was
+created: the transferred bytes and files and the time it took. Archived
+snapshots keep them in the header of their pack index.
+"""
+
+import collections
+
+from . import catalog
+from . import packs
+from . import repository
+
+# the format of the time in snapshot names, which sorts like the times
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+class SnapshotInfo(object):
+    """A snapshot as listed by the "list" command."""
+
+    __slots__ = ("task", "name", "time", "interval_name", "archived",
+                 "alias", "stats")
+
+    def __init__(self, task, name, time, interval_name, archived=False,
+                 alias=None, stats=None):
+        """
+        :param task: The name of the task.
+        :type task: string
+        :param name: The name of the snapshot.
+        :type name: string
+        :param time: The time of the snapshot, formatted like in its name.
+        :type time: string
+        :param interval_name: The name of the interval.
+        :type interval_name: string
+        :param archived: Whether the snapshot was moved into a pack.
+        :type archived: bool
+        :param alias: The snapshot holding the files if this one is an
+        alias, otherwise None.
+        :type alias: string
+        :param stats: The statistics recorded when the snapshot was created,
+        or None.
+        :type stats: dict
+        """
+        self.task = task
+        self.name = name
+        self.time = time
+        self.interval_name = interval_name
+        self.archived = archived
+        self.alias = alias
+        self.stats = stats
+
+    def to_json(self):
+        """
+        :returns: The snapshot, to be encoded as JSON.
+        :rtype: dict
+        """
+        stats = self.stats or {}
+        return {"task": self.task,
+                "name": self.name,
+                "interval": self.interval_name,
+                "time": self.time,
+                "archived": self.archived,
+                "alias": self.alias,
+                "bytes": stats.get("bytes"),
+                "files": stats.get("files"),
+                "seconds": stats.get("seconds")}
+
+
+def list_snapshots(task, destination, interval_name=None, since=None,
+                   until=None):
+    """
+    Lists the snapshots of a task, including archived ones and aliases.
+    :param task: The name of the task.
+    :type task: string
+    :param destination: The destination of the task.
+    :type destination: string
+    :param interval_name: Only list snapshots of this interval if not None.
+    :type interval_name: string
+    :param since: Only list snapshots taken at or after this time if not
+    None.
+    :type since: datetime.datetime instance
+    :param until: Only list snapshots taken at or before this time if not
+    None.
+    :type until: datetime.datetime instance
+    :returns: The snapshots, oldest first.
+    :rtype: list of SnapshotInfo instances
+    """
+    entries = catalog.Catalog(destination, repository.is_backup_folder,
+                              read_only=True).get_entries()
+    store = packs.PackStore(destination)
+    names = [(name, False) for name in entries]
+    names.extend((name, True) for name in store.get_names()
+                 if name not in entries)
+    since = since.strftime(TIME_FORMAT) if since is not None else None
+    until = until.strftime(TIME_FORMAT) if until is not None else None
+    suffix_length = len(repository.BACKUP_SUFFIX)
+    snapshots = []
+    for (name, archived) in names:
+        # all names in the catalog and the packs are valid snapshot names,
+        # so the times are compared as strings instead of being parsed
+        start = name.find("_") + 1
+        time = name[start:start + 19]
+        snapshot_interval = name[start + 20:-suffix_length]
+        if ((interval_name is not None and
+                snapshot_interval != interval_name) or
+                (since is not None and time < since) or
+                (until is not None and time > until)):
+            continue
+        if archived:
+            attributes = {"stats": store.get_stats(name)}
+        else:
+            attributes = entries[name]
+        snapshots.append(SnapshotInfo(task, name, time, snapshot_interval,
+                                      archived, attributes.get("alias"),
+                                      attributes.get("stats")))
+    snapshots.sort(key=lambda snapshot: (snapshot.time, snapshot.name))
+    return snapshots
+
+
+def summarize(snapshots):
+    """
+    Summarizes snapshots per task and interval.
+    :param snapshots: The snapshots, oldest first.
+    :type snapshots: list of SnapshotInfo instances
+    :returns: The summaries in the order the tasks and intervals first
+    appear, each one a dict with the keys "task", "interval", "snapshots",
+    "archived", "aliases", "oldest", "newest", "bytes", "files" and
+    "seconds". The last three are the totals of the snapshots with recorded
+    statistics, counted in "recorded".
+    :rtype: list of dicts
+    """
+    summaries = collections.OrderedDict()
+    for snapshot in snapshots:
+        key = (snapshot.task, snapshot.interval_name)
+        summary = summaries.get(key)
+        if summary is None:
+            summary = summaries[key] = {
+                "task": snapshot.task, "interval": snapshot.interval_name,
+                "snapshots": 0, "archived": 0, "aliases": 0,
+                "oldest": snapshot.time, "newest": None, "recorded": 0,
+                "bytes": 0, "files": 0, "seconds": 0}
+        summary["snapshots"] += 1
+        summary["newest"] = snapshot.time
+        if snapshot.archived:
+            summary["archived"] += 1
+        if snapshot.alias is not None:
+            summary["aliases"] += 1
+        if snapshot.stats is not None:
+            summary["recorded"] += 1
+            summary["bytes"] += snapshot.stats["bytes"]
+            summary["files"] += snapshot.stats["files"]
+            summary["seconds"] += snapshot.stats["seconds"]
+    for summary in summaries.values():
+        # the sum of many recorded durations is not exact anyway
+        summary["seconds"] = round(summary["seconds"], 1)
+    return list(summaries.values())
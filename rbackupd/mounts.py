@@ -0,0 +1,225 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module handles the partitions of the [mount] sections. The partitions
+may be attached and detached at any time, e.g. external disks, so their state
+is tracked: a partition is mounted as soon as it appears, and tasks whose
+destination is on a partition that is not mounted are deferred instead of
+writing into the empty mountpoint on the root filesystem.
+
+A partition that is detached without being unmounted, e.g. an unplugged USB
+disk, stays listed in the mount table. Such a stale mount is not available,
+and it is unmounted lazily, so the partition can be mounted again once it is
+attached again.
+"""
+
+import logging
+import os
+import subprocess
+import sys
+
+from . import filesystem
+
+logger = logging.getLogger(__name__)
+
+
+class MountTracker(object):
+    """
+    Tracks the state of the partitions of all [mount] sections.
+    """
+
+    def __init__(self, mounts, table=None):
+        """
+        :param mounts: The settings of all [mount] sections.
+        :type mounts: list of settings.MountSettings instances
+        :param table: The mount table, mainly for testing.
+        :type table: filesystem.MountTable instance
+        """
+        self.mounts = mounts
+        if table is None and len(mounts) != 0:
+            table = filesystem.MountTable()
+        self.table = table
+        # the state of every mount during the last update, so only changes
+        # are logged
+        self._available = {}
+
+    def close(self):
+        if self.table is not None:
+            self.table.close()
+
+    def update(self):
+        """
+        Mounts every partition that is present but not mounted. Has to be
+        called before the availability of destinations is checked.
+        """
+        if self.table is None:
+            return
+        self.table.refresh()
+        for mount in self.mounts:
+            available = self._update_mount(mount)
+            if available != self._available.get(mount.mountpoint):
+                if available:
+                    logger.info("Partition \"%s\" is available on \"%s\".",
+                                mount.partition, mount.mountpoint)
+                else:
+                    logger.warning("Partition \"%s\" is not available, "
+                                   "tasks on \"%s\" are deferred.",
+                                   mount.partition, mount.mountpoint)
+            self._available[mount.mountpoint] = available
+
+    def _update_mount(self, mount):
+        present = get_partition(mount).is_present()
+        if self.table.is_mountpoint(mount.mountpoint):
+            if present:
+                return True
+            logger.warning("Partition \"%s\" is gone but still mounted on "
+                           "\"%s\", unmounting it.", mount.partition,
+                           mount.mountpoint)
+            try:
+                self._unmount(mount)
+            except (subprocess.CalledProcessError, OSError) as err:
+                logger.error("Unmounting partition \"%s\" failed: %s",
+                             mount.partition, err)
+            self.table.refresh()
+            return False
+        if not present:
+            return False
+        try:
+            mount_partition(mount)
+        except (subprocess.CalledProcessError, OSError) as err:
+            logger.error("Mounting partition \"%s\" failed: %s",
+                         mount.partition, err)
+            return False
+        self.table.refresh()
+        return self.table.is_mountpoint(mount.mountpoint)
+
+    def _unmount(self, mount):
+        # unmounted lazily, as the device is gone, and the writable
+        # mountpoint first, as it is bound to the read-only one
+        for path in (mount.mountpoint, mount.mountpoint_ro):
+            if path is not None and self.table.is_mountpoint(path):
+                filesystem.Mountpoint(path, None).unmount(lazy=True)
+
+    def get_mount(self, path):
+        """
+        :returns: The [mount] section whose mountpoint contains a path, or
+        None if the path is not located on any of them.
+        :rtype: settings.MountSettings instance
+        """
+        path = os.path.realpath(path)
+        candidates = [mount for mount in self.mounts
+                      if path == os.path.realpath(mount.mountpoint) or
+                      path.startswith(
+                          os.path.realpath(mount.mountpoint) + os.sep)]
+        if len(candidates) == 0:
+            return None
+        return max(candidates, key=lambda mount: len(mount.mountpoint))
+
+    def is_available(self, path):
+        """
+        Determines whether a path can be written to, which is the case if it
+        is not located on a [mount] section or if the partition of that
+        section is attached and mounted.
+        :rtype: bool
+        """
+        mount = self.get_mount(path)
+        if mount is None:
+            return True
+        return (self.table.is_mountpoint(mount.mountpoint) and
+                get_partition(mount).is_present())
+
+
+def prepare_mountpoints(mount):
+    """
+    Creates the mountpoints of a [mount] section if requested. Exits if a
+    mountpoint does not exist.
+    :param mount: The settings of the [mount] section.
+    :type mount: settings.MountSettings instance
+    """
+    if (mount.mountpoint_ro is not None and mount.ro_create and
+            not os.path.exists(mount.mountpoint_ro)):
+        os.mkdir(mount.mountpoint_ro)
+    if (mount.mountpoint_ro is not None and
+            not os.path.exists(mount.mountpoint_ro)):
+        logger.critical("Path of \"mountpoint_ro\" does not exist. "
+                        "Aborting.")
+        sys.exit()
+    if mount.create and not os.path.exists(mount.mountpoint):
+        os.mkdir(mount.mountpoint)
+    if not os.path.exists(mount.mountpoint):
+        logger.critical("Path of \"mountpoint\" does not exist. Aborting")
+        sys.exit()
+
+
+def get_partition(mount):
+    """
+    :returns: The partition of a [mount] section.
+    :rtype: filesystem.Partition instance
+    """
+    if mount.partition.startswith('UUID'):
+        uuid = mount.partition.split('=')[1]
+        partition_identifier = filesystem.PartitionIdentifier(uuid=uuid)
+    elif mount.partition.startswith('LABEL'):
+        label = mount.partition.split('=')[1]
+        partition_identifier = filesystem.PartitionIdentifier(label=label)
+    else:
+        partition_identifier = filesystem.PartitionIdentifier(
+            path=mount.partition)
+
+    return filesystem.Partition(partition_identifier, filesystem="auto")
+
+
+def mount_partition(mount):
+    """
+    Mounts the partition of a [mount] section on its mountpoints.
+    :param mount: The settings of the [mount] section.
+    :type mount: settings.MountSettings instance
+    :raises subprocess.CalledProcessError: if mount(8) fails.
+    """
+    partition = get_partition(mount)
+
+    mountpoint = filesystem.Mountpoint(
+        path=mount.mountpoint,
+        options=mount.options)
+    # How to get two mounts of the same device with different rw/ro:
+    # mount readonly
+    # bind readonly to the writeable mountpoint without altering rw/ro
+    # remount writeable mountpoint with rw
+    if mount.mountpoint_ro is not None:
+        mountpoint_ro = filesystem.Mountpoint(
+            path=mount.mountpoint_ro,
+            options=mount.ro_options)
+        try:
+            partition.mount(mountpoint_ro)
+        except filesystem.MountpointInUseError as err:
+            logger.warning("Mountpoint \"%s\" already in use. "
+                           "Skipping mounting." % err.path)
+
+        try:
+            mountpoint_ro.bind(mountpoint)
+        except filesystem.MountpointInUseError as err:
+            logger.warning("Mountpoint \"%s\" already in use. "
+                           "Skipping mounting." % err.path)
+        mountpoint.remount(("rw", "relatime", "noexec", "nosuid"))
+    else:
+        try:
+            partition.mount(mountpoint)
+        except filesystem.MountpointInUseError as err:
+            logger.warning("Mountpoint \"%s\" already in use. "
+                           "Skipping mounting.", err.path)
@@ -0,0 +1,591 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module implements packs, the compressed form of archived snapshots.
+
+A packed snapshot consists of two files in the "packs" directory of the state
+directory of the destination:
+
+<snapshot>.pack
+    The contents of the files, as a header line followed by frames. Every
+    frame holds up to FRAME_SIZE bytes of file contents and is compressed on
+    its own, so any part of a file can be read by decompressing only the
+    frames it is stored in. Small files share frames.
+<snapshot>.idx
+    The index, one JSON object per line. The first line is a header with the
+    names of all packs the snapshot refers to and the statistics recorded
+    when the snapshot was created, every other line describes an entry of
+    the snapshot with its metadata and, for files, the segments of the
+    frames holding its contents.
+
+Files are deduplicated by inode: a file that is hardlinked to a file of the
+previous pack, which is how unchanged files are stored in consecutive
+snapshots, refers to the frames of that pack instead of being stored again.
+Like rsync's quick check, an inode with the same size and modification time
+is taken to have the same contents. Snapshots of the "reflink" backend give
+every file a new inode, so there files are matched with the file at the same
+path in the previous pack instead. A pack is removed once no index refers to
+it anymore.
+"""
+
+import base64
+import collections
+import contextlib
+import errno
+import fcntl
+import gzip
+import io
+import json
+import logging
+import lzma
+import os
+import stat
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import constants as const
+
+MAGIC = b"rbackupd-pack"
+VERSION = 1
+
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".idx"
+TMP_SUFFIX = ".tmp"
+LOCK_NAME = ".lock"
+
+# the uncompressed size of a frame
+FRAME_SIZE = 4 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class PackResult(object):
+    """Holds statistics about a packed snapshot."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.stored_bytes = 0
+        self.reused_files = 0
+
+
+def is_available(compression):
+    """
+    :returns: Whether a compression can be used, "zstd" needs the optional
+    zstandard module.
+    :rtype: bool
+    """
+    return compression != "zstd" or zstandard is not None
+
+
+def get_codec(compression):
+    """Returns the compression and decompression functions."""
+    if compression == "xz":
+        return (lzma.compress, lzma.decompress)
+    if compression == "gzip":
+        return (gzip.compress, gzip.decompress)
+    if compression == "zstd" and zstandard is not None:
+        return (zstandard.ZstdCompressor().compress,
+                zstandard.ZstdDecompressor().decompress)
+    raise ValueError("compression \"%s\" not available" % compression)
+
+
+class PackStore(object):
+    """
+    The packs of a single destination.
+    """
+
+    def __init__(self, destination):
+        """
+        :param destination: The destination directory of the repository.
+        :type destination: string
+        """
+        self.destination = destination
+        self.path = os.path.join(destination, const.STATE_DIR_NAME,
+                                 const.PACKS_DIR_NAME)
+        self._names = []
+        self._mtime = None
+
+    def get_names(self):
+        """
+        :returns: The names of all packed snapshots, sorted.
+        :rtype: list
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        if mtime != self._mtime:
+            self._names = sorted(name[:-len(INDEX_SUFFIX)]
+                                 for name in os.listdir(self.path)
+                                 if name.endswith(INDEX_SUFFIX))
+            self._mtime = mtime
+        return list(self._names)
+
+    def contains(self, name):
+        return os.path.exists(self._get_index_path(name))
+
+    def get_stats(self, name):
+        """
+        :returns: The statistics recorded when a packed snapshot was created,
+        or None if there are none.
+        :rtype: dict
+        """
+        with open(self._get_index_path(name)) as index:
+            return json.loads(index.readline()).get("stats")
+
+    def open(self, name):
+        """
+        :returns: A reader of a packed snapshot.
+        :rtype: PackReader instance
+        """
+        return PackReader(self, name)
+
+    def remove(self, name):
+        """
+        Removes a packed snapshot. Packs that are not referred to anymore are
+        removed as well.
+        """
+        os.unlink(self._get_index_path(name))
+        self.collect_garbage()
+
+    def collect_garbage(self):
+        """
+        Removes all packs no index refers to.
+        :returns: The names of the removed packs.
+        :rtype: list
+        """
+        removed = []
+        with self._lock():
+            referenced = set()
+            entries = os.listdir(self.path)
+            for entry in entries:
+                if entry.endswith(INDEX_SUFFIX):
+                    with open(os.path.join(self.path, entry)) as index:
+                        referenced.update(json.loads(index.readline())
+                                          ["packs"])
+            for entry in entries:
+                if (entry.endswith(PACK_SUFFIX) and
+                        entry[:-len(PACK_SUFFIX)] not in referenced):
+                    logger.verbose("Removing unreferenced pack \"%s\".",
+                                   entry)
+                    os.unlink(os.path.join(self.path, entry))
+                    removed.append(entry[:-len(PACK_SUFFIX)])
+        return removed
+
+    def pack(self, name, compression, previous=None, frame_size=FRAME_SIZE,
+             by_path=False, stats=None):
+        """
+        Packs a snapshot. The snapshot itself is left untouched.
+        :param name: The name of the snapshot.
+        :type name: string
+        :param compression: The compression of the frames, "xz", "gzip" or
+        "zstd".
+        :type compression: string
+        :param previous: The reader of the previous packed snapshot, whose
+        frames are reused for files that are hardlinked to it.
+        :type previous: PackReader instance
+        :param frame_size: The uncompressed size of the frames.
+        :type frame_size: int
+        :param by_path: Whether files are matched with the previous packed
+        snapshot by path instead of by inode.
+        :type by_path: bool
+        :param stats: The statistics recorded when the snapshot was created,
+        see catalog, or None.
+        :type stats: dict
+        :rtype: PackResult instance
+        """
+        root = os.path.join(self.destination, name)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        pack_tmp = self._get_pack_path(name) + TMP_SUFFIX
+        entries_tmp = self._get_index_path(name) + ".entries" + TMP_SUFFIX
+        if previous is None:
+            known = {}
+        elif by_path:
+            known = previous.get_files()
+        else:
+            known = previous.get_inodes()
+        result = PackResult()
+        referenced = set()
+        # the first path of every inode with several links
+        first_links = {}
+        writer = _FrameWriter(pack_tmp, name, compression, frame_size)
+        try:
+            with open(entries_tmp, "w") as entries:
+                # entries are written in the order of the walk once the
+                # frames holding their contents are complete
+                waiting = collections.deque()
+                for (relpath, path, st) in _walk(root):
+                    entry = _make_entry(relpath, path, st)
+                    if stat.S_ISREG(st.st_mode):
+                        result.files += 1
+                        entry["size"] = st.st_size
+                        entry["ino"] = st.st_ino
+                        if st.st_nlink > 1 and st.st_ino in first_links:
+                            entry["link"] = first_links[st.st_ino]
+                        else:
+                            if st.st_nlink > 1:
+                                first_links[st.st_ino] = relpath
+                            result.bytes += st.st_size
+                            old = known.get(relpath if by_path else
+                                            st.st_ino)
+                            if (old is not None and
+                                    old["size"] == st.st_size and
+                                    old["mtime"] == st.st_mtime_ns):
+                                entry["data"] = old["data"]
+                                result.reused_files += 1
+                            else:
+                                entry["data"] = _write_file(writer, path)
+                    waiting.append(entry)
+                    while waiting and _is_complete(waiting[0]):
+                        entry = _resolve(waiting.popleft())
+                        referenced.update(segment[0] for segment in
+                                          entry.get("data", []))
+                        entries.write(json.dumps(entry) + "\n")
+                writer.close()
+                for entry in waiting:
+                    entry = _resolve(entry)
+                    referenced.update(segment[0] for segment in
+                                      entry.get("data", []))
+                    entries.write(json.dumps(entry) + "\n")
+            result.stored_bytes = writer.stored_bytes
+            self._write_index(name, entries_tmp, referenced, stats)
+            with self._lock():
+                os.rename(pack_tmp, self._get_pack_path(name))
+                os.rename(self._get_index_path(name) + TMP_SUFFIX,
+                          self._get_index_path(name))
+        finally:
+            writer.close()
+            for path in (pack_tmp, entries_tmp,
+                         self._get_index_path(name) + TMP_SUFFIX):
+                if os.path.exists(path):
+                    os.unlink(path)
+        return result
+
+    def alias(self, name, target):
+        """
+        Packs a snapshot that is a symlink to another, packed snapshot. The
+        index of the target is copied, so both snapshots can be removed
+        independently.
+        """
+        with open(self._get_index_path(target)) as index:
+            header = json.loads(index.readline())
+            header["snapshot"] = name
+            # like in the catalog, the statistics belong to the target only
+            header.pop("stats", None)
+            index_tmp = self._get_index_path(name) + TMP_SUFFIX
+            with open(index_tmp, "w") as alias:
+                alias.write(json.dumps(header) + "\n")
+                for line in index:
+                    alias.write(line)
+                alias.flush()
+                os.fsync(alias.fileno())
+        os.rename(index_tmp, self._get_index_path(name))
+
+    def _write_index(self, name, entries_tmp, referenced, stats):
+        header = {"op": "header", "version": VERSION, "snapshot": name,
+                  "packs": sorted(referenced)}
+        if stats is not None:
+            header["stats"] = stats
+        with open(self._get_index_path(name) + TMP_SUFFIX, "w") as index:
+            index.write(json.dumps(header) + "\n")
+            with open(entries_tmp) as entries:
+                for line in entries:
+                    index.write(line)
+            index.flush()
+            os.fsync(index.fileno())
+
+    @contextlib.contextmanager
+    def _lock(self):
+        # packs are written by the daemon and removed by the daemon and the
+        # commands, a pack must not be removed between being written and
+        # being referred to by its index
+        with open(os.path.join(self.path, LOCK_NAME), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _get_pack_path(self, name):
+        return os.path.join(self.path, name + PACK_SUFFIX)
+
+    def _get_index_path(self, name):
+        return os.path.join(self.path, name + INDEX_SUFFIX)
+
+
+class PackReader(object):
+    """
+    Reads a packed snapshot. The whole index is loaded, frames are read on
+    demand.
+    """
+
+    def __init__(self, store, name):
+        """
+        :param store: The packs of the destination.
+        :type store: PackStore instance
+        :param name: The name of the snapshot.
+        :type name: string
+        """
+        self.store = store
+        self.name = name
+        self.entries = collections.OrderedDict()
+        with open(store._get_index_path(name)) as index:
+            header = json.loads(index.readline())
+            if header.get("version") != VERSION:
+                raise ValueError("unsupported version of pack \"%s\"" % name)
+            for line in index:
+                entry = json.loads(line)
+                self.entries[entry["path"]] = entry
+        # the open packs by name, with their decompression functions
+        self._packs = {}
+        self._cached_frame = (None, None)
+
+    def close(self):
+        for (pack, _) in self._packs.values():
+            pack.close()
+        self._packs.clear()
+
+    def get(self, path):
+        """
+        :param path: The path relative to the root of the snapshot, "" for
+        the root itself.
+        :type path: string
+        :returns: The entry of a path, or None if there is no such entry.
+        :rtype: dict
+        """
+        return self.entries.get(path)
+
+    def walk(self, path=""):
+        """
+        Yields the entries of a path and everything below it, every directory
+        before its contents.
+        """
+        prefix = path + "/" if path != "" else ""
+        for (entry_path, entry) in self.entries.items():
+            if entry_path == path or entry_path.startswith(prefix):
+                yield entry
+
+    def read(self, entry):
+        """
+        Yields the contents of a file in chunks.
+        """
+        if "link" in entry:
+            entry = self.entries[entry["link"]]
+        for (pack, offset, length, start, count) in entry["data"]:
+            frame = self._read_frame(pack, offset, length)
+            yield frame[start:start + count]
+
+    def open_file(self, entry):
+        """
+        :returns: A binary file object reading the contents of a file.
+        :rtype: io.BufferedReader instance
+        """
+        return io.BufferedReader(_ChunkStream(self.read(entry)), READ_SIZE)
+
+    def get_inodes(self):
+        """
+        :returns: The entries of all stored files by inode.
+        :rtype: dict
+        """
+        return dict((entry["ino"], entry) for entry in self.entries.values()
+                    if "data" in entry)
+
+    def get_files(self):
+        """
+        :returns: The entries holding the contents of all stored files by
+        path, hardlinks included.
+        :rtype: dict
+        """
+        files = {}
+        for (path, entry) in self.entries.items():
+            if "link" in entry:
+                entry = self.entries.get(entry["link"], {})
+            if "data" in entry:
+                files[path] = entry
+        return files
+
+    def _read_frame(self, pack, offset, length):
+        if self._cached_frame[0] == (pack, offset):
+            return self._cached_frame[1]
+        if pack not in self._packs:
+            packfile = open(self.store._get_pack_path(pack), "rb")
+            header = packfile.readline().split()
+            if len(header) != 3 or header[0] != MAGIC:
+                packfile.close()
+                raise ValueError("\"%s\" is not a pack" % pack)
+            (_, decompress) = get_codec(header[2].decode("ascii"))
+            self._packs[pack] = (packfile, decompress)
+        (packfile, decompress) = self._packs[pack]
+        packfile.seek(offset)
+        frame = memoryview(decompress(packfile.read(length)))
+        self._cached_frame = ((pack, offset), frame)
+        return frame
+
+
+class _ChunkStream(io.RawIOBase):
+    """A raw stream reading from an iterator of chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self._chunk) == 0:
+            self._chunk = next(self._chunks, None)
+            if self._chunk is None:
+                self._chunk = memoryview(b"")
+                return 0
+        count = min(len(buffer), len(self._chunk))
+        buffer[:count] = self._chunk[:count]
+        self._chunk = self._chunk[count:]
+        return count
+
+
+class _FrameWriter(object):
+    """
+    Writes data into compressed frames. A segment of a frame is described by
+    a list of the pack, the offset and the compressed length of the frame,
+    which are only known once the frame is complete, and the start and
+    length of the data in the uncompressed frame.
+    """
+
+    def __init__(self, path, pack, compression, frame_size):
+        (self._compress, _) = get_codec(compression)
+        self._file = open(path, "wb")
+        self._file.write(b" ".join([MAGIC, str(VERSION).encode("ascii"),
+                                    compression.encode("ascii")]) + b"\n")
+        self.pack = pack
+        self.frame_size = frame_size
+        self.stored_bytes = 0
+        self._buffer = bytearray()
+        self._frame = None
+
+    def write(self, data):
+        """
+        :returns: The segments the data was stored in.
+        :rtype: list
+        """
+        segments = []
+        view = memoryview(data)
+        while len(view) != 0:
+            if self._frame is None:
+                self._frame = [self.pack, None, None]
+            count = min(len(view), self.frame_size - len(self._buffer))
+            segments.append([self._frame, len(self._buffer), count])
+            self._buffer += view[:count]
+            view = view[count:]
+            if len(self._buffer) >= self.frame_size:
+                self.flush()
+        return segments
+
+    def flush(self):
+        if self._frame is None:
+            return
+        compressed = self._compress(bytes(self._buffer))
+        self._frame[1] = self._file.tell()
+        self._frame[2] = len(compressed)
+        self._file.write(compressed)
+        self.stored_bytes += len(compressed)
+        self._buffer = bytearray()
+        self._frame = None
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+
+def _write_file(writer, path):
+    segments = []
+    with open(path, "rb") as source:
+        while True:
+            data = source.read(READ_SIZE)
+            if not data:
+                break
+            segments.extend(writer.write(data))
+    return segments
+
+
+def _is_complete(entry):
+    return all(segment[0][1] is not None
+               for segment in entry.get("data", [])
+               if isinstance(segment[0], list))
+
+
+def _resolve(entry):
+    """Replaces the frames of the segments of an entry by their position."""
+    if "data" in entry:
+        entry["data"] = [segment if not isinstance(segment[0], list) else
+                         segment[0] + segment[1:]
+                         for segment in entry["data"]]
+    return entry
+
+
+def _make_entry(relpath, path, st):
+    entry = {"path": relpath,
+             "mode": st.st_mode,
+             "uid": st.st_uid,
+             "gid": st.st_gid,
+             "mtime": st.st_mtime_ns}
+    if stat.S_ISLNK(st.st_mode):
+        entry["target"] = os.readlink(path)
+    elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+        entry["rdev"] = st.st_rdev
+    xattrs = _get_xattrs(path)
+    if len(xattrs) != 0:
+        entry["xattrs"] = xattrs
+    return entry
+
+
+def _get_xattrs(path):
+    try:
+        return dict((name, base64.b64encode(os.getxattr(
+            path, name, follow_symlinks=False)).decode("ascii"))
+            for name in os.listxattr(path, follow_symlinks=False))
+    except OSError as err:
+        if err.errno not in (errno.ENOTSUP, errno.EPERM, errno.EACCES):
+            raise
+        return {}
+
+
+def _walk(root):
+    """
+    Yields (relative path, path, stat result) tuples of a tree, sorted by
+    name and every directory before its contents.
+    """
+    stack = [("", root, os.stat(root))]
+    while stack:
+        (relpath, path, st) = stack.pop()
+        yield (relpath, path, st)
+        if stat.S_ISDIR(st.st_mode):
+            with os.scandir(path) as iterator:
+                entries = sorted(iterator, key=lambda entry: entry.name,
+                                 reverse=True)
+            for entry in entries:
+                stack.append((os.path.join(relpath, entry.name), entry.path,
+                              entry.stat(follow_symlinks=False)))
@@ -0,0 +1,275 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module profiles the running daemon on request, without restarting it.
+
+Profiling is requested with SIGUSR1 or "rbackupd ctl profile" and covers the
+next cycles of the main loop. While it is active, the main thread runs under
+cProfile, and the phases of every cycle (loading the configuration, ordering
+the tasks, running rsync, cloning snapshots, expiring snapshots, writing the
+log, ...) are recorded as spans of all threads. Optionally, the memory
+allocations are traced and compared between the start and the end.
+
+Afterwards, three files are written:
+
+    <base>.prof         the cProfile statistics, readable with pstats
+    <base>.trace.json   the spans in the trace event format of Chrome, to be
+                        loaded into chrome://tracing or Perfetto
+    <base>.memory.txt   the lines that allocated the most memory in between
+
+Spans cost a single check when profiling is not active.
+"""
+
+import contextlib
+import cProfile
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# the count of cycles profiled when profiling is requested with a signal
+DEFAULT_CYCLES = 1
+
+# the count of frames stored with every traced memory allocation
+MEMORY_FRAMES = 10
+
+# the count of lines listed in the memory report
+MEMORY_TOP_LINES = 30
+
+_lock = threading.Lock()
+# the pending request as a (cycles, memory) tuple
+_requested = None
+_session = None
+
+
+class Session(object):
+    """The state of profiling while it is active."""
+
+    def __init__(self, cycles, memory):
+        """
+        :param cycles: The count of cycles to profile.
+        :type cycles: int
+        :param memory: Whether memory allocations are traced.
+        :type memory: bool
+        """
+        self.cycles = cycles
+        self.memory = memory
+        self.finished_cycles = 0
+        self.started = time.time()
+        self.profile = cProfile.Profile()
+        self.events = []
+        self._threads = {}
+        self._cycle_start = None
+        self._snapshot = None
+        self._started_tracing = False
+
+    def start_memory(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(MEMORY_FRAMES)
+            self._started_tracing = True
+        self._snapshot = tracemalloc.take_snapshot()
+
+    def begin_cycle(self):
+        self._cycle_start = time.time()
+        self.profile.enable()
+
+    def end_cycle(self):
+        self.profile.disable()
+        self.add_span("cycle", self._cycle_start, time.time(),
+                      {"cycle": self.finished_cycles + 1})
+        self.finished_cycles += 1
+
+    def add_span(self, name, start, end, args=None):
+        """
+        Records a span of the current thread.
+        :param name: The name of the span.
+        :type name: string
+        :param start: The start of the span, in seconds since the epoch.
+        :type start: float
+        :param end: The end of the span.
+        :type end: float
+        :param args: Details shown with the span.
+        :type args: dict
+        """
+        thread = threading.current_thread()
+        event = {"name": name,
+                 "cat": "rbackupd",
+                 "ph": "X",
+                 "ts": round((start - self.started) * 1e6),
+                 "dur": round((end - start) * 1e6),
+                 "pid": os.getpid(),
+                 "tid": thread.ident}
+        if args:
+            event["args"] = args
+        with _lock:
+            self.events.append(event)
+            self._threads[thread.ident] = thread.name
+
+    def get_trace(self):
+        """
+        :returns: The spans in the trace event format, to be encoded as
+        JSON.
+        :rtype: dict
+        """
+        with _lock:
+            events = list(self.events)
+            threads = dict(self._threads)
+        for (ident, name) in sorted(threads.items()):
+            events.append({"name": "thread_name", "ph": "M",
+                           "pid": os.getpid(), "tid": ident,
+                           "args": {"name": name}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, directory):
+        """
+        Writes the collected data.
+        :param directory: The directory the files are written to.
+        :type directory: string
+        :returns: The paths of the written files.
+        :rtype: list
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        base = os.path.join(directory, "rbackupd-profile-%s" %
+                            time.strftime("%Y-%m-%dT%H:%M:%S",
+                                          time.localtime(self.started)))
+        paths = [base + ".prof", base + ".trace.json"]
+        self.profile.dump_stats(paths[0])
+        with open(paths[1], "w") as f:
+            json.dump(self.get_trace(), f)
+        if self._snapshot is not None:
+            snapshot = tracemalloc.take_snapshot()
+            if self._started_tracing:
+                tracemalloc.stop()
+            paths.append(base + ".memory.txt")
+            with open(paths[2], "w") as f:
+                f.write("Memory allocated in %s cycle(s), by line:\n\n" %
+                        self.finished_cycles)
+                for stat in snapshot.compare_to(
+                        self._snapshot, "lineno")[:MEMORY_TOP_LINES]:
+                    f.write("%s\n" % stat)
+        return paths
+
+
+def request(cycles=DEFAULT_CYCLES, memory=False):
+    """
+    Requests profiling of the next cycles of the main loop.
+    :param cycles: The count of cycles to profile.
+    :type cycles: int
+    :param memory: Whether memory allocations are traced.
+    :type memory: bool
+    :returns: False if profiling is already requested or active.
+    :rtype: bool
+    """
+    global _requested
+    with _lock:
+        if _requested is not None or _session is not None:
+            return False
+        _requested = (cycles, memory)
+    return True
+
+
+def is_active():
+    """
+    :returns: Whether profiling is requested or active.
+    :rtype: bool
+    """
+    with _lock:
+        return _requested is not None or _session is not None
+
+
+def begin_cycle():
+    """
+    Called by the main loop before every cycle, starts profiling if it was
+    requested.
+    """
+    global _requested, _session
+    with _lock:
+        if _session is None and _requested is not None:
+            (cycles, memory) = _requested
+            _requested = None
+            _session = Session(cycles, memory)
+            logger.info("Profiling the next %s cycle(s)%s.", cycles,
+                        " and tracing memory allocations" if memory else "")
+        session = _session
+    if session is None:
+        return
+    if session.memory and session.finished_cycles == 0:
+        session.start_memory()
+    session.begin_cycle()
+
+
+def end_cycle(directory):
+    """
+    Called by the main loop after every cycle, writes the collected data once
+    all requested cycles are profiled.
+    :param directory: The directory the files are written to.
+    :type directory: string
+    """
+    global _session
+    session = _session
+    if session is None:
+        return
+    session.end_cycle()
+    if session.finished_cycles < session.cycles:
+        return
+    with _lock:
+        _session = None
+    try:
+        paths = session.write(directory)
+    except OSError as err:
+        logger.error("Could not write the profile: %s", err)
+        return
+    logger.info("Profile written to %s.",
+                ", ".join("\"%s\"" % path for path in paths))
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """
+    Records the time spent in a block as a span while profiling is active.
+    :param name: The name of the span.
+    :type name: string
+    :param args: Details shown with the span.
+    """
+    session = _session
+    if session is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        session.add_span(name, start, time.time(), args)
+
+
+class SpanningFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    A RotatingFileHandler that records the time spent writing the log as
+    spans.
+    """
+
+    def emit(self, record):
+        with span("logging"):
+            super(SpanningFileHandler, self).emit(record)
@@ -0,0 +1,264 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module follows the progress of running snapshots. rsync reports its
+progress with "--info=progress2", the lines are parsed while rsync runs.
+
+The time a snapshot will take is estimated from the bytes the previous
+snapshot of the task transferred, which are kept in the catalog. The state
+of all running snapshots can be queried from other threads, and is logged
+periodically.
+"""
+
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# the default count of seconds between two log messages about the progress
+DEFAULT_LOG_INTERVAL = 300
+
+# e.g. "  1,234,567  45%   12.34MB/s    0:00:12 (xfr#12, to-chk=100/200)"
+_PROGRESS_REGEX = re.compile(
+    r"^\s*(?P<bytes>[\d,.]+)(?P<bytes_unit>[KMGTP]?)\s+(?P<percent>\d+)%\s+"
+    r"(?P<rate>[\d,.]+)(?P<rate_unit>[kKMGTP]?)B/s\s+\d+:\d\d:\d\d"
+    r"(?:\s+\((?:xfr#(?P<transferred>\d+), )?(?:to|ir)-chk="
+    r"(?P<remaining>\d+)/(?P<total>\d+)\))?")
+
+_UNITS = {"": 1, "k": 1024, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3,
+          "T": 1024 ** 4, "P": 1024 ** 5}
+
+_lock = threading.Lock()
+# the progress of all running snapshots by destination
+_running = {}
+_log_interval = DEFAULT_LOG_INTERVAL
+
+
+class ProgressLine(object):
+    """A parsed progress line of rsync."""
+
+    def __init__(self, transferred_bytes, rate, transferred_files=None,
+                 checked_files=None, total_files=None):
+        self.transferred_bytes = transferred_bytes
+        self.rate = rate
+        self.transferred_files = transferred_files
+        self.checked_files = checked_files
+        self.total_files = total_files
+
+
+def parse_line(line):
+    """
+    Parses a line printed by rsync with "--info=progress2".
+    :param line: The line.
+    :type line: string
+    :returns: The parsed line, or None if it is not a progress line.
+    :rtype: ProgressLine instance
+    """
+    match = _PROGRESS_REGEX.match(line)
+    if match is None:
+        return None
+    # the rate always has two decimal places
+    rate = float(match.group("rate").replace(",", ""))
+    progress = ProgressLine(
+        _parse_bytes(match.group("bytes"), match.group("bytes_unit")),
+        rate * _UNITS[match.group("rate_unit")])
+    if match.group("transferred") is not None:
+        progress.transferred_files = int(match.group("transferred"))
+    if match.group("total") is not None:
+        progress.total_files = int(match.group("total"))
+        progress.checked_files = (progress.total_files -
+                                  int(match.group("remaining")))
+    return progress
+
+
+def _parse_bytes(number, unit):
+    if unit == "":
+        # without units, rsync separates thousands
+        return int(number.replace(",", "").replace(".", ""))
+    return int(float(number.replace(",", ".")) * _UNITS[unit])
+
+
+class Progress(object):
+    """
+    The live state of a running snapshot, which may consist of several rsync
+    runs.
+    """
+
+    def __init__(self, name, expected_bytes=None, expected_seconds=None):
+        """
+        :param name: The name of the snapshot.
+        :type name: string
+        :param expected_bytes: The bytes the previous snapshot transferred,
+        or None if unknown.
+        :type expected_bytes: int
+        :param expected_seconds: The time the previous snapshot took.
+        :type expected_seconds: float
+        """
+        self.name = name
+        self.expected_bytes = expected_bytes
+        self.expected_seconds = expected_seconds
+        self.started = time.time()
+        self.transferred_bytes = 0
+        self.transferred_files = 0
+        self.checked_files = 0
+        self.rate = 0
+        # the totals of the finished rsync runs
+        self._base = (0, 0, 0)
+        self._last_log = self.started
+
+    def begin_run(self):
+        """Starts counting the next rsync run on top of the previous ones."""
+        self._base = (self.transferred_bytes, self.transferred_files,
+                      self.checked_files)
+
+    def update(self, line):
+        """
+        Updates the state from a line printed by rsync. Lines that are not
+        progress lines are ignored.
+        :param line: The line.
+        :type line: string
+        """
+        progress = parse_line(line)
+        if progress is None:
+            return
+        (base_bytes, base_transferred, base_checked) = self._base
+        with _lock:
+            self.transferred_bytes = base_bytes + progress.transferred_bytes
+            self.rate = progress.rate
+            if progress.transferred_files is not None:
+                self.transferred_files = (base_transferred +
+                                          progress.transferred_files)
+            if progress.checked_files is not None:
+                self.checked_files = base_checked + progress.checked_files
+        now = time.time()
+        if _log_interval > 0 and now - self._last_log >= _log_interval:
+            self._last_log = now
+            self.log()
+
+    def get_eta(self):
+        """
+        Estimates the remaining time of the snapshot, assuming it transfers
+        as much as the previous one.
+        :returns: The remaining seconds, or None if they cannot be
+        estimated.
+        :rtype: float
+        """
+        if self.expected_bytes is not None and self.rate > 0:
+            remaining = self.expected_bytes - self.transferred_bytes
+            if remaining > 0:
+                return remaining / self.rate
+        if self.expected_seconds is not None:
+            remaining = self.expected_seconds - (time.time() - self.started)
+            if remaining > 0:
+                return remaining
+        return None
+
+    def get_state(self):
+        """
+        :returns: The state, to be encoded as JSON.
+        :rtype: dict
+        """
+        eta = self.get_eta()
+        with _lock:
+            return {"snapshot": self.name,
+                    "seconds": round(time.time() - self.started, 1),
+                    "bytes": self.transferred_bytes,
+                    "files_transferred": self.transferred_files,
+                    "files_checked": self.checked_files,
+                    "rate": self.rate,
+                    "eta": round(eta) if eta is not None else None}
+
+    def log(self):
+        eta = self.get_eta()
+        logger.info("Snapshot \"%s\": %.1f MB transferred at %.1f MB/s, %s "
+                    "files checked, %s.",
+                    self.name, self.transferred_bytes / 1e6, self.rate / 1e6,
+                    self.checked_files,
+                    "about %s remaining" % format_seconds(eta)
+                    if eta is not None else "remaining time unknown")
+
+    def get_stats(self):
+        """
+        :returns: The statistics of the finished snapshot, to be kept in the
+        catalog.
+        :rtype: dict
+        """
+        return {"bytes": self.transferred_bytes,
+                "files": self.transferred_files,
+                "seconds": round(time.time() - self.started, 1)}
+
+
+def set_log_interval(seconds):
+    """
+    Sets the count of seconds between two log messages about the progress of
+    a snapshot, 0 disables them.
+    """
+    global _log_interval
+    _log_interval = seconds
+
+
+def start(destination, name, previous_stats=None):
+    """
+    Starts following a snapshot.
+    :param destination: The destination of the task.
+    :type destination: string
+    :param name: The name of the snapshot.
+    :type name: string
+    :param previous_stats: The statistics of the previous snapshot, as
+    returned by Progress.get_stats(), or None.
+    :type previous_stats: dict
+    :rtype: Progress instance
+    """
+    if previous_stats is None:
+        progress = Progress(name)
+    else:
+        progress = Progress(name, previous_stats["bytes"],
+                            previous_stats["seconds"])
+    with _lock:
+        _running[destination] = progress
+    return progress
+
+
+def finish(destination):
+    """Stops following the snapshot of a destination."""
+    with _lock:
+        _running.pop(destination, None)
+
+
+def get_state(destination):
+    """
+    :returns: The state of the running snapshot of a destination, or None if
+    no snapshot is running.
+    :rtype: dict
+    """
+    with _lock:
+        progress = _running.get(destination)
+    return progress.get_state() if progress is not None else None
+
+
+def format_seconds(seconds):
+    """
+    Formats a duration like "1:02:03".
+    :rtype: string
+    """
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60,
+                             seconds % 60)
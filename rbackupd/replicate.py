@@ -0,0 +1,372 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module replicates the snapshots of a repository to secondary
+destinations ("replicas").
+
+Every snapshot that is newer than the latest snapshot of a replica is copied
+with rsync, using the latest snapshot of the replica as --link-dest, so the
+replica has the same hardlink structure as the repository. Snapshots that are
+symlinks to other snapshots or aliases of them are recreated as symlinks.
+A new snapshot is
+copied into a temporary directory and only renamed to its final name after it
+was verified, so an interrupted copy is never mistaken for a snapshot and is
+resumed on the next attempt.
+
+The copy is verified by comparing Merkle hashes of both trees: the hash of a
+directory covers the names, types, modes, sizes and modification times of its
+entries and the hashes of its subdirectories. No file contents are read, and
+ownership is ignored as the replica may be written by a different user.
+
+Replication runs in a background thread, so it never delays the next snapshot
+of the repository.
+"""
+
+import hashlib
+import logging
+import os
+import queue
+import subprocess
+import threading
+
+from . import catalog
+from . import constants as const
+from . import files
+from . import repository
+from . import rsync
+
+# the suffix of a snapshot that is still being copied
+REPLICATING_SUFFIX = ".replicating"
+
+# only that many differing directories are logged
+MAX_LOGGED_MISMATCHES = 10
+
+logger = logging.getLogger(__name__)
+
+
+class Replicator(object):
+    """
+    Replicates the snapshots of tasks in a background thread. Every task is
+    queued at most once, no matter how often it is submitted before its
+    replication starts.
+    """
+
+    def __init__(self, rsync_cmd, expire):
+        """
+        :param rsync_cmd: The rsync command.
+        :type rsync_cmd: string
+        :param expire: The function that removes the expired snapshots of a
+        repository, called with the repository.
+        :type expire: function
+        """
+        self.rsync_cmd = rsync_cmd
+        self._expire = expire
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # the latest settings of every queued task by name
+        self._pending = {}
+        # the (destination, snapshot) tuples of the snapshots being copied
+        self._in_use = set()
+        self._thread = threading.Thread(target=self._run,
+                                        name="replicator")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, task):
+        """
+        Queues the replication of a task to all its replicas.
+        :param task: The settings of the task.
+        :type task: settings.TaskSettings instance
+        """
+        with self._lock:
+            queued = task.name in self._pending
+            self._pending[task.name] = task
+        if not queued:
+            self._queue.put(task.name)
+
+    def get_in_use(self, destination):
+        """
+        :returns: The names of the snapshots of a destination that are being
+        copied right now and must not be removed.
+        :rtype: set
+        """
+        with self._lock:
+            return set(name for (path, name) in self._in_use
+                       if path == destination)
+
+    def close(self):
+        """
+        Stops the background thread after the running replication finished.
+        Queued replications are dropped.
+        """
+        with self._lock:
+            self._pending.clear()
+        self._queue.put(None)
+        if self._thread.is_alive():
+            logger.info("Waiting for replication to finish.")
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            name = self._queue.get()
+            if name is None:
+                return
+            with self._lock:
+                task = self._pending.pop(name, None)
+            if task is None:
+                continue
+            for replica in task.replicate_to:
+                try:
+                    self._replicate(task, replica)
+                except (OSError, ValueError,
+                        subprocess.CalledProcessError) as err:
+                    logger.error("Replication of task \"%s\" to \"%s\" "
+                                 "failed: %s", task.name, replica, err)
+
+    def _replicate(self, task, replica):
+        if not os.path.isdir(replica):
+            logger.warning("Replica \"%s\" of task \"%s\" not available, "
+                           "skipping.", replica, task.name)
+            return
+        missing = get_missing_snapshots(task.destination, replica)
+        if len(missing) == 0:
+            logger.verbose("Replica \"%s\" of task \"%s\" is up to date.",
+                           replica, task.name)
+            return
+        aliases = _list_aliases(task.destination)
+        for name in missing:
+            source = os.path.join(task.destination, aliases.get(name, name))
+            claimed = self._claim(task.destination, source)
+            try:
+                # the snapshot might have expired in the meantime
+                if not os.path.exists(source):
+                    continue
+                if not copy_snapshot(self.rsync_cmd, task, replica, name,
+                                     aliases.get(name)):
+                    return
+            finally:
+                with self._lock:
+                    self._in_use.difference_update(claimed)
+
+        # the replica keeps its snapshots according to the same rules as the
+        # repository, but independently of it
+        replica_repo = repository.Repository(
+            [], replica, task.name, task.intervals, task.keep,
+            task.get_keep_age(), None, None, [], [], None)
+        self._expire(replica_repo)
+
+    def _claim(self, destination, path):
+        # a snapshot that is a symlink depends on the snapshot it points to
+        names = (os.path.basename(path),
+                 os.path.basename(os.path.realpath(path)))
+        claimed = set((destination, name) for name in names)
+        with self._lock:
+            self._in_use.update(claimed)
+        return claimed
+
+
+def get_missing_snapshots(destination, replica):
+    """
+    Determines the snapshots that have to be copied to a replica, which are
+    all snapshots newer than the latest snapshot of the replica. If the
+    replica is empty, only the latest snapshots are copied.
+    :param destination: The destination of the repository.
+    :type destination: string
+    :param replica: The destination of the replica.
+    :type replica: string
+    :returns: The names of the snapshots, oldest first.
+    :rtype: list
+    """
+    aliases = _list_aliases(destination)
+    snapshots = _list_snapshots(destination)
+    snapshots.extend(repository.BackupFolder(name) for name in aliases)
+    if len(snapshots) == 0:
+        return []
+    # aliases are copied after the snapshots they point to
+    snapshots.sort(key=lambda snapshot: (snapshot.epoch,
+                                         snapshot.name in aliases,
+                                         snapshot.name))
+    replicated = _list_snapshots(replica)
+    if len(replicated) == 0:
+        # snapshots of several intervals may share the latest time
+        since = snapshots[-1].epoch - 1
+    else:
+        since = replicated[-1].epoch
+    return [snapshot.name for snapshot in snapshots if snapshot.epoch > since]
+
+
+def copy_snapshot(rsync_cmd, task, replica, name, alias=None):
+    """
+    Copies a single snapshot to a replica.
+    :param rsync_cmd: The rsync command.
+    :type rsync_cmd: string
+    :param task: The settings of the task.
+    :type task: settings.TaskSettings instance
+    :param replica: The destination of the replica.
+    :type replica: string
+    :param name: The name of the snapshot.
+    :type name: string
+    :param alias: The snapshot the snapshot is an alias of, or None.
+    :type alias: string
+    :returns: True if the snapshot was copied, False if copying failed.
+    :rtype: bool
+    """
+    source = os.path.join(task.destination, name)
+    target = os.path.join(replica, name)
+    if alias is not None:
+        source = os.path.join(task.destination, alias)
+        if os.path.isdir(os.path.join(replica, alias)):
+            logger.info("Symlinking replica \"%s\" to \"%s\".",
+                        name, alias)
+            os.symlink(alias, target)
+            return True
+    elif os.path.islink(source):
+        link_target = os.readlink(source)
+        # overlapping snapshots are relative symlinks to their neighbours
+        if (os.sep not in link_target and
+                os.path.isdir(os.path.join(replica, link_target))):
+            logger.info("Symlinking replica \"%s\" to \"%s\".",
+                        name, link_target)
+            os.symlink(link_target, target)
+            return True
+
+    tmp_target = target + REPLICATING_SUFFIX
+    link_ref = _get_latest_directory(replica)
+    arguments = ["-aH", "--numeric-ids", "--delete"]
+    if rsync.has_option(task.rsync_args, "A", "--acls"):
+        arguments.append("-A")
+    if rsync.has_option(task.rsync_args, "X", "--xattrs"):
+        arguments.append("-X")
+    logger.info("Replicating snapshot \"%s\" to \"%s\".", name, replica)
+    (returncode, stdoutdata, stderrdata) = rsync.rsync(
+        rsync_cmd,
+        [source + "/"],
+        tmp_target,
+        None if link_ref is None else os.path.join(replica, link_ref),
+        arguments,
+        rsync.Filter([], [], [], [], []),
+        None)
+    if returncode != 0:
+        logger.error("Rsync failed while replicating \"%s\" to \"%s\". "
+                     "Stderr:\n%s", name, replica, stderrdata)
+        return False
+
+    source_hashes = compute_merkle(source)
+    target_hashes = compute_merkle(tmp_target)
+    if source_hashes[""] != target_hashes[""]:
+        mismatches = find_mismatches(source_hashes, target_hashes)
+        logger.error("Replica of snapshot \"%s\" in \"%s\" differs in %s "
+                     "directories, keeping it as \"%s\": %s",
+                     name, replica, len(mismatches),
+                     os.path.basename(tmp_target),
+                     ", ".join("\"%s\"" % (path or ".") for path in
+                               mismatches[:MAX_LOGGED_MISMATCHES]))
+        return False
+
+    os.rename(tmp_target, target)
+    catalog.Catalog(replica, repository.is_backup_folder).add(
+        name, merkle=source_hashes[""])
+    symlink_latest = os.path.join(replica, const.SYMLINK_LATEST_NAME)
+    if os.path.islink(symlink_latest):
+        files.remove_symlink(symlink_latest)
+    files.create_symlink(target, symlink_latest)
+    logger.info("Replication of snapshot \"%s\" finished successfully.",
+                name)
+    return True
+
+
+def compute_merkle(root):
+    """
+    Computes the Merkle hashes of all directories of a tree.
+    :param root: The root of the tree.
+    :type root: string
+    :returns: The hex digests of all directories by their path relative to
+    the root, the root itself has the path "".
+    :rtype: dict
+    """
+    hashes = {}
+    _hash_directory(root, "", hashes)
+    return hashes
+
+
+def _hash_directory(path, relpath, hashes):
+    digest = hashlib.sha256()
+    with os.scandir(path) as iterator:
+        entries = sorted(iterator, key=lambda entry: entry.name)
+    for entry in entries:
+        st = entry.stat(follow_symlinks=False)
+        if entry.is_symlink():
+            fields = ("l", os.readlink(entry.path))
+        elif entry.is_dir(follow_symlinks=False):
+            fields = ("d", st.st_mode, _hash_directory(
+                entry.path, os.path.join(relpath, entry.name), hashes))
+        elif entry.is_file(follow_symlinks=False):
+            fields = ("f", st.st_mode, st.st_size, int(st.st_mtime))
+        else:
+            fields = ("s", st.st_mode, st.st_rdev)
+        digest.update(os.fsencode(entry.name))
+        digest.update(b"\0")
+        digest.update(os.fsencode("\0".join(str(field) for field in fields)))
+        digest.update(b"\n")
+    hashes[relpath] = digest.hexdigest()
+    return hashes[relpath]
+
+
+def find_mismatches(hashes, other_hashes):
+    """
+    Compares the Merkle hashes of two trees.
+    :returns: The relative paths of the deepest directories that differ,
+    sorted. The parents of a differing directory are omitted, as their hashes
+    differ as well.
+    :rtype: list
+    """
+    mismatches = set(path for path in set(hashes) | set(other_hashes)
+                     if hashes.get(path) != other_hashes.get(path))
+    parents = set()
+    for path in mismatches:
+        while path != "":
+            path = os.path.dirname(path)
+            parents.add(path)
+    return sorted(mismatches - parents)
+
+
+def _list_snapshots(destination):
+    names = [name for name in os.listdir(destination)
+             if repository.is_backup_folder(name)]
+    snapshots = [repository.BackupFolder(name) for name in names]
+    snapshots.sort(key=lambda snapshot: (snapshot.epoch, snapshot.name))
+    return snapshots
+
+
+def _list_aliases(destination):
+    """
+    Returns the targets of all aliases in the catalog of a destination by
+    the names of the aliases.
+    """
+    snapshots = catalog.Catalog(destination, repository.is_backup_folder)
+    return dict((name, attributes["alias"])
+                for (name, attributes) in snapshots.get_entries().items()
+                if "alias" in attributes)
+
+
+def _get_latest_directory(destination):
+    for snapshot in reversed(_list_snapshots(destination)):
+        if not os.path.islink(os.path.join(destination, snapshot.name)):
+            return snapshot.name
+    return None
@@ -16,16 +16,24 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import calendar
 import datetime
 import logging
 import os
 import re
 import sys
 
+from . import catalog
 from . import cron
+from . import files
+from . import packs
+from . import rsync
 
 BACKUP_REGEX = re.compile(r'^.*_.*_.*\.snapshot$')
 BACKUP_SUFFIX = ".snapshot"
+# snapshots are created under their name with this suffix and only renamed
+# once they are complete
+INCOMPLETE_SUFFIX = ".incomplete"
 
 logger = logging.getLogger(__name__)
 
@@ -38,7 +46,8 @@ class Repository(object):
     """
 
     def __init__(self, sources, destination, name, intervals, keep, keep_age,
-                 rsyncfilter, rsync_logfile_options, rsync_args):
+                 rsyncfilter, rsync_logfile_options, rsync_args, ssh_args,
+                 password_file, backend="hardlink"):
         self.sources = sources
         self.destination = destination
         self.name = name
@@ -49,32 +58,102 @@ class Repository(object):
         self.rsyncfilter = rsyncfilter
         self.rsync_logfile_options = rsync_logfile_options
         self.rsync_args = rsync_args
+        self.ssh_args = ssh_args
+        self.password_file = password_file
+        self.backend = backend
+        self.catalog = catalog.Catalog(destination, is_backup_folder)
+        self.packs = packs.PackStore(destination)
+        self._skipped = {}
+        self._backup_names = None
+        self._backups = None
 
     @property
     def backups(self):
-        return [BackupFolder(folder) for folder in os.listdir(self.destination)
-                if is_backup_folder(folder)]
-
-    def get_necessary_backups(self):
+        names = self.catalog.get_names()
+        packed = self.packs.get_names()
+        if len(packed) != 0:
+            # archived snapshots are not part of the destination directory
+            # anymore, but still belong to the repository
+            known = set(names)
+            names.extend(name for name in packed if name not in known)
+        # the records are only built again if the snapshots changed
+        if names != self._backup_names:
+            self._backups = [BackupFolder(folder) for folder in names]
+            self._backup_names = names
+        return list(self._backups)
+
+    def get_source_paths(self, snapshot):
+        """
+        Determines where the local sources of the repository are located
+        inside a snapshot, according to the rules of rsync(1) regarding
+        trailing slashes and --relative.
+        :param snapshot: The name of the snapshot.
+        :type snapshot: string
+        :returns: A list of (source path, path inside the snapshot) tuples.
+        Remote sources are omitted.
+        :rtype: list of tuples
+        """
+        relative = rsync.has_option(self.rsync_args, "R", "--relative")
+        snapshot_path = os.path.join(self.destination, self.resolve(snapshot))
+        paths = []
+        for source in self.sources:
+            location = rsync.parse_location(source)
+            if location.transport != rsync.Transports.LOCAL:
+                continue
+            if relative:
+                # everything before a "/./" is not part of the path in the
+                # destination
+                relative_path = source.split("/./", 1)[-1]
+                target = os.path.join(snapshot_path,
+                                      relative_path.lstrip("/"))
+            elif source.endswith("/"):
+                target = snapshot_path
+            else:
+                target = os.path.join(snapshot_path, os.path.basename(source))
+            paths.append((source.rstrip("/") or "/", target.rstrip("/")))
+        return paths
+
+    def get_necessary_backups(self, now=None):
         """
         Returns all backups deemed necessary.
+        :param now: The time to check against, the current time if omitted.
+        :type now: datetime.datetime instance
         :returns: A list of tuples containing all necessary backups, each tuple
         consisting of the interval name as first and the interval cron object
         as second element.
         :returns: All backups deemed necessary.
         :rtype: list of tuples.
         """
+        if now is None:
+            now = datetime.datetime.now()
         necessary_backups = []
         for (interval_name, interval) in self.intervals:
-            latest_backup = self._get_latest_backup_of_interval(interval_name)
+            latest_backup = self.get_latest_backup_of_interval(interval_name)
             if latest_backup is None:
                 necessary_backups.append((interval_name, interval))
                 continue
-            if interval.has_occured_since(latest_backup.date,
-                                          include_start=False):
+            since = latest_backup.date
+            skipped = self._skipped.get(interval_name)
+            if skipped is not None and skipped > since:
+                since = skipped
+            if (since <= now and
+                    interval.has_occured_between(since, now,
+                                                 include_start=False)):
                 necessary_backups.append((interval_name, interval))
         return necessary_backups
 
+    def skip_occurences(self, interval_name, until):
+        """
+        Makes all occurences of an interval up to a specific time count as if
+        a snapshot had been created for them, so the next snapshot of that
+        interval is created at its next occurence.
+        :param interval_name: The name of the interval.
+        :type interval_name: string
+        :param until: The time up to which occurences are skipped.
+        :type until: datetime.datetime instance
+        """
+        self._skipped[interval_name] = until
+
     def get_backup_params(self, new_backup_interval_name, timestamp=None):
         """
         Gets the parameters for a backup of the specific interval with a given
@@ -90,8 +169,9 @@ class Repository(object):
         """
         if timestamp is None:
             timestamp = datetime.datetime.now()
-        new_link_ref = self._get_latest_backup()
-        new_link_ref = new_link_ref.name if new_link_ref is not None else None
+        new_link_ref = self.get_latest_backup()
+        new_link_ref = (self.resolve(new_link_ref.name)
+                        if new_link_ref is not None else None)
         new_folder = "%s_%s_%s%s" % (self.name,
                                      timestamp.strftime(
                                          "%Y-%m-%dT%H:%M:%S"),
@@ -104,7 +184,10 @@ class Repository(object):
                                          new_link_ref,
                                          self.rsyncfilter,
                                          self.rsync_logfile_options,
-                                         self.rsync_args)
+                                         self.rsync_args,
+                                         self.ssh_args,
+                                         self.password_file,
+                                         self.backend)
         return backup_params
 
     def get_expired_backups(self):
@@ -152,7 +235,7 @@ class Repository(object):
         """
         expired_backups = []
         count = len(backups) - max_count
-        backups.sort(key=lambda backup: backup.date, reverse=False)
+        backups.sort(key=lambda backup: backup.epoch, reverse=False)
         for i in range(0, count):
             expired_backups.append(backups[i])
         return expired_backups
@@ -169,44 +252,94 @@ class Repository(object):
                 expired_backups.append(backup)
         return expired_backups
 
-    def _get_latest_backup(self):
+    def resolve(self, name):
+        """
+        Determines the folder holding the files of a snapshot, which is
+        another snapshot if it is an alias.
+        :param name: The name of the snapshot.
+        :type name: string
+        :returns: The name of the folder.
+        :rtype: string
+        """
+        return self.catalog.resolve(name)
+
+    def is_archived(self, name):
+        """
+        Determines whether a snapshot was moved into a pack.
+        :param name: The name of the snapshot.
+        :type name: string
+        :rtype: bool
+        """
+        return (not os.path.lexists(os.path.join(self.destination, name)) and
+                self.packs.contains(name))
+
+    def get_latest_backup(self):
         """
         Returns the latest/youngest backup, or None if there is none.
         """
-        if len(self.backups) == 0:
+        backups = self.backups
+        if len(backups) == 0:
             return None
-        if len(self.backups) == 1:
-            return self.backups[0]
-        latest = self.backups[0]
-        for backup in self.backups:
-            if backup.date > latest.date:
-                latest = backup
-        return latest
+        return max(backups, key=lambda backup: backup.epoch)
 
-    def _get_latest_backup_of_interval(self, interval):
+    def get_latest_backup_of_interval(self, interval):
         """
         Returns the latest/youngest backup of the given interval, or None if
         there is none.
         :param interval: The name of the interval to search for.
         :type interval: string
         """
-        if len(self.backups) == 0:
+        backups = [backup for backup in self.backups
+                   if backup.interval_name == interval]
+        if len(backups) == 0:
             return None
-        latest = None
-        for backup in self.backups:
-            if latest is None and backup.interval_name == interval:
-                latest = backup
-            elif latest is not None:
-                if (backup.interval_name == interval and
-                        backup.date > latest.date):
-                    latest = backup
-        return latest
+        return max(backups, key=lambda backup: backup.epoch)
+
+
+def create(task):
+    """
+    Creates the repository of a task.
+    :param task: The settings of the task.
+    :type task: settings.TaskSettings instance
+    :rtype: Repository instance
+    """
+    return Repository(task.sources,
+                      task.destination,
+                      task.name,
+                      task.intervals,
+                      task.keep,
+                      task.get_keep_age(),
+                      task.get_rsync_filter(),
+                      task.get_rsync_logfile_options(),
+                      task.rsync_args,
+                      task.ssh_args,
+                      task.password_file,
+                      get_backend(task))
+
+
+def get_backend(task):
+    """
+    Determines the snapshot backend of a task, "auto" is resolved depending
+    on the destination.
+    :param task: The settings of the task.
+    :type task: settings.TaskSettings instance
+    :returns: "hardlink" or "reflink".
+    :rtype: string
+    """
+    backend = task.snapshot_backend
+    if backend == "auto":
+        backend = ("reflink" if os.path.isdir(task.destination) and
+                   files.supports_reflink(task.destination) else "hardlink")
+        logger.verbose("Using snapshot backend \"%s\" for task \"%s\".",
+                       backend, task.name)
+    return backend
 
 
 class BackupParameters(object):
 
     def __init__(self, sources, destination, folder, link_ref,
-                 rsyncfilter, rsync_logfile_options, rsync_args):
+                 rsyncfilter, rsync_logfile_options, rsync_args, ssh_args,
+                 password_file, backend="hardlink"):
         self.sources = sources
         self.destination = destination
         self.folder = folder
@@ -214,31 +347,184 @@ class BackupParameters(object):
         self.rsyncfilter = rsyncfilter
         self.rsync_logfile_options = rsync_logfile_options
         self.rsync_args = rsync_args
+        self.ssh_args = ssh_args
+        self.password_file = password_file
+        self.backend = backend
 
 
 class BackupFolder(object):
+    """
+    A snapshot in a repository, described by the name of its folder. As
+    repositories may contain many thousand snapshots, the instances are kept
+    small: the time is stored as seconds since the epoch and the interval as
+    an index into a table of all interval names.
+    """
+
+    __slots__ = ("_name", "_epoch", "_interval_id")
 
     def __init__(self, name):
         self._name = name
-
-        datestring = self.name.split("_")[1]
-        self._date = datetime.datetime.strptime(datestring,
-                                                "%Y-%m-%dT%H:%M:%S")
-        intervalstring = self.name.split("_")[2]
-        self._interval = intervalstring[:intervalstring.find(BACKUP_SUFFIX)]
+        (self._epoch, interval_name) = parse_folder_name(name)
+        self._interval_id = _get_interval_id(interval_name)
 
     @property
     def date(self):
-        return self._date
+        return _EPOCH + datetime.timedelta(seconds=self._epoch)
+
+    @property
+    def epoch(self):
+        """
+        The time of the snapshot in seconds since the epoch, to be used for
+        comparisons. The time is local time, like in the name.
+        """
+        return self._epoch
 
     @property
     def interval_name(self):
-        return self._interval
+        return _interval_names[self._interval_id]
 
     @property
     def name(self):
         return self._name
 
 
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# all interval names ever seen, so every name is stored only once
+_interval_names = []
+_interval_ids = {}
+
+
+def _get_interval_id(interval_name):
+    interval_id = _interval_ids.get(interval_name)
+    if interval_id is None:
+        interval_id = len(_interval_names)
+        _interval_names.append(interval_name)
+        _interval_ids[interval_name] = interval_id
+    return interval_id
+
+
+def parse_folder_name(name):
+    """
+    Parses the name of a snapshot folder, which has the format
+    "<task>_<%Y-%m-%dT%H:%M:%S>_<interval>.snapshot". This is many times
+    faster than datetime.strptime(), which matters for repositories with many
+    snapshots.
+    :param name: The name of the folder.
+    :type name: string
+    :returns: A tuple of the time in seconds since the epoch and the name of
+    the interval.
+    :rtype: tuple
+    :raises ValueError: if the name does not have the expected format.
+    """
+    start = name.index("_") + 1
+    end = start + 19
+    # checks the "T", both colons and the underscore after the timestamp
+    if (name[start + 10:end + 1:3] != "T::_" or
+            not name.endswith(BACKUP_SUFFIX)):
+        raise ValueError("Invalid snapshot name: \"%s\"" % name)
+    # there are only few distinct days and at most 86400 distinct times of
+    # day, so both are converted only once
+    date_string = name[start:start + 10]
+    days = _days.get(date_string)
+    if days is None:
+        days = _parse_date(date_string, name)
+    time_string = name[start + 11:end]
+    seconds = _seconds.get(time_string)
+    if seconds is None:
+        seconds = _parse_time(time_string, name)
+    return (days * 86400 + seconds, name[end + 1:-len(BACKUP_SUFFIX)])
+
+
+_days = {}
+_seconds = {}
+
+
+def _is_digits(string):
+    # int() also accepts signs, whitespace, underscores and non-ASCII digits
+    return len(string) != 0 and all("0" <= c <= "9" for c in string)
+
+
+def _parse_date(date_string, name):
+    if (date_string[4] != "-" or date_string[7] != "-" or
+            not _is_digits(date_string[0:4]) or
+            not _is_digits(date_string[5:7]) or
+            not _is_digits(date_string[8:10])):
+        raise ValueError("Invalid snapshot name: \"%s\"" % name)
+    year = int(date_string[0:4])
+    month = int(date_string[5:7])
+    day = int(date_string[8:10])
+    # like strptime(), dates that do not exist are rejected
+    if (year < 1 or not 1 <= month <= 12 or
+            not 1 <= day <= calendar.monthrange(year, month)[1]):
+        raise ValueError("Invalid snapshot name: \"%s\"" % name)
+    days = _days_from_civil(year, month, day)
+    if len(_days) < 100000:
+        _days[date_string] = days
+    return days
+
+
+def _parse_time(time_string, name):
+    if (not _is_digits(time_string[0:2]) or
+            not _is_digits(time_string[3:5]) or
+            not _is_digits(time_string[6:8])):
+        raise ValueError("Invalid snapshot name: \"%s\"" % name)
+    hour = int(time_string[0:2])
+    minute = int(time_string[3:5])
+    second = int(time_string[6:8])
+    if hour > 23 or minute > 59 or second > 59:
+        raise ValueError("Invalid snapshot name: \"%s\"" % name)
+    seconds = hour * 3600 + minute * 60 + second
+    _seconds[time_string] = seconds
+    return seconds
+
+
+def _days_from_civil(year, month, day):
+    """
+    Returns the count of days since 1970-01-01 of a date in the proleptic
+    Gregorian calendar, see http://howardhinnant.github.io/date_algorithms.html
+    """
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = (year_of_era * 365 + year_of_era // 4 - year_of_era // 100 +
+                  day_of_year)
+    return era * 146097 + day_of_era - 719468
+
+
 def is_backup_folder(name):
-    return BACKUP_REGEX.match(name)
+    """
+    :returns: Whether a name is the name of a snapshot folder, with a date
+    that exists.
+    :rtype: bool
+    """
+    if not BACKUP_REGEX.match(name):
+        return False
+    try:
+        parse_folder_name(name)
+    except ValueError:
+        return False
+    return True
+
+
+def get_incomplete_folders(destination):
+    """
+    Returns the folders of all snapshots in a destination that were
+    interrupted before they were complete.
+    :param destination: The destination of a repository.
+    :type destination: string
+    :returns: The names of the folders, the newest last.
+    :rtype: list
+    """
+    folders = []
+    for name in os.listdir(destination):
+        if not name.endswith(BACKUP_SUFFIX + INCOMPLETE_SUFFIX):
+            continue
+        try:
+            (epoch, _) = parse_folder_name(name[:-len(INCOMPLETE_SUFFIX)])
+        except ValueError:
+            continue
+        folders.append((epoch, name))
+    return [name for (_, name) in sorted(folders)]
@@ -0,0 +1,316 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module restores files and directories from snapshots. Files are copied
+by several threads in parallel, preserving everything rsync preserves with
+"-aHAX": permissions, ownership, timestamps, hardlinks, ACLs, extended
+attributes, special files and holes in sparse files. On filesystems with
+reflinks, file contents are cloned instead of copied.
+"""
+
+import base64
+import concurrent.futures
+import errno
+import logging
+import os
+import stat
+import time
+
+from . import files
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 10
+
+
+class CopyResult(object):
+    """Holds statistics about a finished copy."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0
+
+    def get_throughput(self):
+        """
+        :returns: A tuple of the copied megabytes per second and the copied
+        files per second.
+        :rtype: tuple
+        """
+        seconds = max(self.seconds, 1e-6)
+        return (self.bytes / seconds / 1e6, self.files / seconds)
+
+
+def find_snapshot(repo, at=None, interval_name=None):
+    """
+    Finds the newest snapshot of a repository that was created at or before a
+    specific time, optionally only considering snapshots of one interval.
+    :param repo: The repository to search.
+    :type repo: repository.Repository instance
+    :param at: The point in time, or None for the latest snapshot.
+    :type at: datetime.datetime instance
+    :param interval_name: The name of the interval, or None for all
+    intervals.
+    :type interval_name: string
+    :returns: The name of the snapshot, or None if there is no such snapshot.
+    :rtype: string
+    """
+    candidates = [backup for backup in repo.backups
+                  if (interval_name is None or
+                      backup.interval_name == interval_name) and
+                  (at is None or backup.date <= at)]
+    if len(candidates) == 0:
+        return None
+    return max(candidates, key=lambda backup: backup.date).name
+
+
+def get_snapshot_path(repo, snapshot, path):
+    """
+    Determines where a path of the sources is located inside a snapshot.
+    :param repo: The repository the snapshot belongs to.
+    :type repo: repository.Repository instance
+    :param snapshot: The name of the snapshot.
+    :type snapshot: string
+    :param path: The absolute path on the source machine.
+    :type path: string
+    :returns: The path inside the snapshot, or None if the path is not part of
+    any source.
+    :rtype: string
+    """
+    path = os.path.normpath(path)
+    for (source, target) in repo.get_source_paths(snapshot):
+        if path == source:
+            return target
+        if path.startswith(source.rstrip("/") + "/"):
+            return os.path.join(target, os.path.relpath(path, source))
+    return None
+
+
+def copy_tree(source, target, workers=4, overwrite=False):
+    """
+    Copies a file or directory tree. Directories are created in the calling
+    thread, file contents are copied by a pool of threads. Existing
+    directories are merged.
+    :param source: The file or directory to copy.
+    :type source: string
+    :param target: The path of the copy.
+    :type target: string
+    :param workers: The count of threads copying file contents.
+    :type workers: int
+    :param overwrite: Whether existing files will be replaced.
+    :type overwrite: bool
+    :returns: Statistics about the copy.
+    :rtype: CopyResult instance
+    :raises FileExistsError: if a file exists and overwrite is False.
+    """
+    result = CopyResult()
+    start = time.time()
+    last_report = start
+    # hardlinks can only be created once the first copy exists, which is
+    # not guaranteed while the copy runs in another thread
+    first_copies = {}
+    links = []
+    directories = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for (path, target_path, st) in _walk(source, target):
+            if stat.S_ISDIR(st.st_mode):
+                if not os.path.isdir(target_path):
+                    _prepare(target_path, overwrite)
+                    os.mkdir(target_path, 0o700)
+                directories.append((path, target_path, st))
+                continue
+            _prepare(target_path, overwrite)
+            result.files += 1
+            if st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                if key in first_copies:
+                    links.append((first_copies[key], target_path))
+                    continue
+                first_copies[key] = target_path
+            if stat.S_ISREG(st.st_mode):
+                result.bytes += st.st_size
+                pending.add(pool.submit(_copy_file, path, target_path, st))
+                if len(pending) >= workers * 16:
+                    (done, pending) = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        # raises the exceptions of the copy, if any
+                        future.result()
+            else:
+                _copy_special(path, target_path, st)
+            now = time.time()
+            if now - last_report >= PROGRESS_INTERVAL:
+                last_report = now
+                logger.info("Copied %s files, %.1f MB (%.1f MB/s).",
+                            result.files, result.bytes / 1e6,
+                            result.bytes / 1e6 / (now - start))
+        for future in concurrent.futures.as_completed(pending):
+            # raises the exceptions of the copy, if any
+            future.result()
+
+    for (first_copy, target_path) in links:
+        os.link(first_copy, target_path)
+    # changing the contents of a directory changes its timestamps, so they
+    # have to be set after everything else, starting with the deepest ones
+    for (path, target_path, st) in reversed(directories):
+        files.copy_metadata(path, target_path, st)
+
+    result.seconds = time.time() - start
+    return result
+
+
+def copy_from_pack(reader, path, target, overwrite=False):
+    """
+    Copies a file or directory tree out of an archived snapshot. Existing
+    directories are merged.
+    :param reader: The reader of the packed snapshot.
+    :type reader: packs.PackReader instance
+    :param path: The path inside the snapshot, "" for the whole snapshot.
+    :type path: string
+    :param target: The path of the copy.
+    :type target: string
+    :param overwrite: Whether existing files will be replaced.
+    :type overwrite: bool
+    :returns: Statistics about the copy.
+    :rtype: CopyResult instance
+    :raises FileExistsError: if a file exists and overwrite is False.
+    """
+    result = CopyResult()
+    start = time.time()
+    # the first copy of every file by the path of its first link in the
+    # snapshot, to recreate hardlinks
+    copies = {}
+    directories = []
+    for entry in reader.walk(path):
+        relpath = entry["path"][len(path):].lstrip("/")
+        target_path = os.path.join(target, relpath) if relpath else target
+        mode = entry["mode"]
+        if stat.S_ISDIR(mode):
+            if not os.path.isdir(target_path):
+                _prepare(target_path, overwrite)
+                os.mkdir(target_path, 0o700)
+            directories.append((target_path, entry))
+            continue
+        _prepare(target_path, overwrite)
+        result.files += 1
+        if stat.S_ISREG(mode):
+            key = entry.get("link", entry["path"])
+            if key in copies:
+                os.link(copies[key], target_path)
+                continue
+            copies[key] = target_path
+            with open(target_path, "xb") as copy:
+                for data in reader.read(entry):
+                    copy.write(data)
+            result.bytes += entry["size"]
+        elif stat.S_ISLNK(mode):
+            os.symlink(entry["target"], target_path)
+        elif stat.S_ISFIFO(mode):
+            os.mkfifo(target_path)
+        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+            os.mknod(target_path, mode, entry["rdev"])
+        else:
+            logger.warning("Skipping \"%s\", unsupported file type.",
+                           entry["path"])
+            continue
+        _set_metadata(target_path, entry)
+    for (target_path, entry) in reversed(directories):
+        _set_metadata(target_path, entry)
+
+    result.seconds = time.time() - start
+    return result
+
+
+def _set_metadata(target, entry):
+    """
+    Applies the metadata of an entry of a pack, like files.copy_metadata().
+    """
+    try:
+        os.chown(target, entry["uid"], entry["gid"], follow_symlinks=False)
+    except PermissionError:
+        pass
+    try:
+        for (name, value) in entry.get("xattrs", {}).items():
+            os.setxattr(target, name, base64.b64decode(value),
+                        follow_symlinks=False)
+    except OSError as err:
+        if err.errno not in (errno.ENOTSUP, errno.EPERM, errno.EACCES):
+            raise
+    if not stat.S_ISLNK(entry["mode"]):
+        os.chmod(target, stat.S_IMODE(entry["mode"]))
+    os.utime(target, ns=(entry["mtime"], entry["mtime"]),
+             follow_symlinks=False)
+
+
+def _walk(source, target):
+    """
+    Yields (path, target path, stat result) tuples of a tree, every directory
+    before its contents.
+    """
+    stack = [(source, target, os.lstat(source))]
+    while stack:
+        (path, target_path, st) = stack.pop()
+        yield (path, target_path, st)
+        if stat.S_ISDIR(st.st_mode):
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    stack.append((entry.path,
+                                  os.path.join(target_path, entry.name),
+                                  entry.stat(follow_symlinks=False)))
+
+
+def _prepare(target_path, overwrite):
+    if not os.path.lexists(target_path):
+        return
+    if not overwrite:
+        raise FileExistsError("\"%s\" already exists" % target_path)
+    if os.path.isdir(target_path) and not os.path.islink(target_path):
+        files.remove_recursive(target_path)
+    else:
+        os.unlink(target_path)
+
+
+def _copy_file(path, target_path, st):
+    src_fd = os.open(path, os.O_RDONLY)
+    try:
+        dst_fd = os.open(target_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o600)
+        try:
+            files.clone_file_data(src_fd, dst_fd, st.st_size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    files.copy_metadata(path, target_path, st)
+
+
+def _copy_special(path, target_path, st):
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(path), target_path)
+    elif stat.S_ISFIFO(st.st_mode):
+        os.mkfifo(target_path)
+    elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+        os.mknod(target_path, st.st_mode, st.st_rdev)
+    else:
+        logger.warning("Skipping \"%s\", unsupported file type.", path)
+        return
+    files.copy_metadata(path, target_path, st)
@@ -23,20 +23,46 @@ arguments of rsync for ease of use.
 
 import logging
 import os
+import select
 import subprocess
+import threading
+
+DAEMON_URL_PREFIX = "rsync://"
+
+# the count of bytes read from the output of rsync at once
+PROGRESS_READ_SIZE = 65536
+
+# the seconds to wait for more of the log once rsync exited, as processes
+# started by rsync, like ssh, may keep the log open
+LOG_DRAIN_TIMEOUT = 0.5
 
 logger = logging.getLogger(__name__)
 
+# the destinations of the running rsync processes, so they can be cancelled
+# from other threads
+_running = {}
+_cancelled = set()
+_running_lock = threading.Lock()
 
-def rsync(cmd, source, destination, link_ref, arguments, rsyncfilter,
-          loggingOptions):
+
+class Cancelled(Exception):
+    """
+    This exception is raised when a running transfer was cancelled with
+    terminate().
+    """
+    pass
+
+
+def rsync(cmd, sources, destination, link_ref, arguments, rsyncfilter,
+          loggingOptions, progress=None, log=None):
     """
     Runs the rsync command with specific parameters.
     :param cmd: The exact command to execute. Just use "rsync" to search for
     the rsync executable in PATH
     :type cmd: string
-    :param source: The path to the source of the transfer.
-    :type source: string
+    :param sources: The paths to the sources of the transfer. All remote
+    sources have to be located on the same host.
+    :type sources: list
     :param destination: The path to the destination of the transfer.
     :type destination: string
     :param link_ref: The path used for the --link-dest paramter of rsync. All
@@ -51,6 +77,13 @@ def rsync(cmd, source, destination, link_ref, arguments, rsyncfilter,
     :type rsyncfilter: Filter instance
     :param loggingOptions: A LogfileOptions instance containing information
     about the logging rsync will do.
+    :param progress: A function that is called with every line rsync prints
+    while it runs. rsync is told to report its overall progress.
+    :type progress: function
+    :param log: A function that is called with the data rsync writes to its
+    log, instead of writing the log into the destination. Only used if
+    loggingOptions is not None.
+    :type log: function
     """
     args = [cmd]
 
@@ -61,25 +94,315 @@ def rsync(cmd, source, destination, link_ref, arguments, rsyncfilter,
     if link_ref is not None:
         args.append("--link-dest=%s" % link_ref)
 
+    if progress is not None:
+        args.append("--info=progress2")
+
+    log_pipe = None
     if loggingOptions is not None:
-        args.append("--log-file=%s" % os.path.join(destination,
-                                                   loggingOptions.log_name))
+        if log is None:
+            log_path = os.path.join(destination, loggingOptions.log_name)
+        else:
+            # rsync writes its log into a pipe that is read while it runs
+            log_pipe = os.pipe()
+            log_path = "/dev/fd/%s" % log_pipe[1]
+        args.append("--log-file=%s" % log_path)
         if loggingOptions.log_format is not None:
             args.append("--log-file-format=%s" % loggingOptions.log_format)
 
-    args.append(source)
+    args.extend(sources)
     args.append(destination)
 
     logger.verbose("Executing \"%s\".", " ".join(args))
 
     # create the directory first, otherwise logging will fail
-    os.mkdir(destination)
+    if not os.path.isdir(destination):
+        os.mkdir(destination)
+
+    try:
+        proc = subprocess.Popen(args,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                pass_fds=log_pipe[1:] if log_pipe else ())
+    finally:
+        if log_pipe is not None:
+            os.close(log_pipe[1])
+    log_reader = None
+    if log_pipe is not None:
+        exited = threading.Event()
+        log_reader = threading.Thread(target=_read_log,
+                                      args=(log_pipe[0], log, exited))
+        log_reader.daemon = True
+        log_reader.start()
+    with _running_lock:
+        _running[proc] = destination
+    try:
+        if progress is None:
+            (stdoutdata, stderrdata) = proc.communicate()
+        else:
+            (stdoutdata, stderrdata) = _communicate(proc, progress)
+    finally:
+        with _running_lock:
+            del _running[proc]
+            cancelled = proc in _cancelled
+            _cancelled.discard(proc)
+        if log_reader is not None:
+            exited.set()
+            log_reader.join()
+    if cancelled:
+        raise Cancelled("Transfer into \"%s\" was cancelled." % destination)
+    return (proc.returncode, stdoutdata, stderrdata)
+
+
+def _communicate(proc, progress):
+    """
+    Like Popen.communicate(), but passes every line of stdout to a function
+    as soon as it is printed. Progress lines end with carriage returns.
+    """
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(proc.stderr.read()))
+    reader.daemon = True
+    reader.start()
+    stdout = []
+    pending = b""
+    while True:
+        data = proc.stdout.read1(PROGRESS_READ_SIZE)
+        if not data:
+            break
+        stdout.append(data)
+        lines = (pending + data).replace(b"\r", b"\n").split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                progress(line.decode("utf-8", "replace"))
+    if pending:
+        progress(pending.decode("utf-8", "replace"))
+    proc.wait()
+    reader.join()
+    proc.stdout.close()
+    proc.stderr.close()
+    return (b"".join(stdout), stderr[0] if stderr else b"")
+
+
+def _read_log(fd, log, exited):
+    """
+    Passes everything written into a pipe to a function, until the pipe is
+    closed or nothing arrives shortly after the writer exited.
+    """
+    try:
+        while True:
+            (readable, _, _) = select.select([fd], [], [], LOG_DRAIN_TIMEOUT)
+            if not readable:
+                if exited.is_set():
+                    break
+                continue
+            data = os.read(fd, PROGRESS_READ_SIZE)
+            if not data:
+                break
+            log(data)
+    finally:
+        os.close(fd)
+
+
+def terminate(destination):
+    """
+    Terminates all running rsync processes transferring into a directory or
+    below it. The calls of rsync() that started them raise Cancelled.
+    :param destination: The directory.
+    :type destination: string
+    :returns: The count of terminated processes.
+    :rtype: int
+    """
+    prefix = os.path.join(destination, "")
+    count = 0
+    with _running_lock:
+        for (proc, path) in _running.items():
+            if path == destination or path.startswith(prefix):
+                logger.info("Terminating rsync process %s.", proc.pid)
+                proc.terminate()
+                _cancelled.add(proc)
+                count += 1
+    return count
+
+
+def has_option(arguments, short_option, long_option):
+    """
+    Determines whether rsync arguments contain an option, either as a long
+    option or as a short one, possibly combined with other short options.
+    :param arguments: The arguments.
+    :type arguments: list
+    :param short_option: The letter of the short option, e.g. "R".
+    :type short_option: string
+    :param long_option: The long option, e.g. "--relative".
+    :type long_option: string
+    :rtype: bool
+    """
+    for arg in arguments:
+        if arg == long_option or (arg.startswith("-") and
+                                  not arg.startswith("--") and
+                                  short_option in arg):
+            return True
+    return False
+
+
+class Transports(object):
+    LOCAL = 0
+    SSH = 1
+    DAEMON = 2
+
 
+class Location(object):
+    """
+    Represents a source or destination of a rsync transfer as described in
+    the "USAGE" section of rsync(1).
+    """
+
+    def __init__(self, transport, path, host=None, module=None, port=None):
+        """
+        :param transport: The transport used to access the location, one of
+        the values in Transports.
+        :type transport: int
+        :param path: The path on the (possibly remote) machine. For rsync
+        daemon locations, this is the path inside the module.
+        :type path: string
+        :param host: The remote host in the form [USER@]HOST, or None for
+        local locations.
+        :type host: string
+        :param module: The module of a rsync daemon location.
+        :type module: string
+        :param port: The TCP port of a rsync daemon location, or None for the
+        default port.
+        :type port: int
+        """
+        self.transport = transport
+        self.path = path
+        self.host = host
+        self.module = module
+        self.port = port
+
+    def get_module_url(self):
+        """
+        Returns the URL of the root of the module of a rsync daemon location.
+        :rtype: string
+        """
+        if self.transport != Transports.DAEMON:
+            raise ValueError("not a rsync daemon location")
+        if self.port is None:
+            return "rsync://%s/%s/" % (self.host, self.module)
+        return "rsync://%s:%s/%s/" % (self.host, self.port, self.module)
+
+
+def parse_location(location):
+    """
+    Determines how a location given to rsync will be accessed. rsync treats
+    every location with a colon before the first slash as remote, a double
+    colon or the "rsync://" prefix denote a rsync daemon.
+    :param location: The location as passed to rsync.
+    :type location: string
+    :returns: A Location instance describing the location.
+    :rtype: Location instance
+    """
+    if location.startswith(DAEMON_URL_PREFIX):
+        (host, _, module_path) = \
+            location[len(DAEMON_URL_PREFIX):].partition("/")
+        (module, _, path) = module_path.partition("/")
+        (user, at, host) = host.rpartition("@")
+        port = None
+        if ":" in host:
+            (host, _, port) = host.partition(":")
+            port = int(port)
+        return Location(Transports.DAEMON, path, host=user + at + host,
+                        module=module, port=port)
+    (host, sep, path) = location.partition(":")
+    if sep == "" or "/" in host or host == "":
+        return Location(Transports.LOCAL, location)
+    if path.startswith(":"):
+        (module, _, path) = path[1:].partition("/")
+        return Location(Transports.DAEMON, path, host=host, module=module)
+    return Location(Transports.SSH, path, host=host)
+
+
+def get_destination_name(source, relative):
+    """
+    Determines the entry in the root of the destination a source is
+    transferred into, according to the rules of rsync(1) regarding trailing
+    slashes and --relative.
+    :param source: The source as passed to rsync.
+    :type source: string
+    :param relative: Whether rsync is run with --relative.
+    :type relative: bool
+    :returns: The name of the entry, or None if the contents of the source
+    are transferred into the root of the destination itself.
+    :rtype: string
+    """
+    path = parse_location(source).path
+    if relative:
+        # everything before a "/./" is not part of the path in the
+        # destination
+        name = path.split("/./", 1)[-1].strip("/").split("/")[0]
+    elif path.endswith("/"):
+        return None
+    else:
+        name = os.path.basename(path)
+    if name in ("", ".", ".."):
+        return None
+    return name
+
+
+def module_exists(cmd, location, arguments):
+    """
+    Checks whether the module of a rsync daemon location exists and is
+    accessible, by listing the top directory of the module. This also works
+    for modules that are not listed by the daemon.
+    :param cmd: The rsync command to execute.
+    :type cmd: string
+    :param location: The rsync daemon location to check.
+    :type location: Location instance
+    :param arguments: Additional arguments passed to rsync, e.g. the
+    password file.
+    :type arguments: list
+    :returns: A tuple with a bool stating whether the module exists as first
+    element and the error output of rsync as second.
+    :rtype: tuple
+    """
+    args = [cmd, "--list-only", "--no-recursive"]
+    args.extend(arguments)
+    args.append(location.get_module_url())
+    logger.verbose("Executing \"%s\".", " ".join(args))
     proc = subprocess.Popen(args,
-                            stdout=subprocess.PIPE,
+                            stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL,
                             stderr=subprocess.PIPE)
-    (stdoutdata, stderrdata) = proc.communicate()
-    return (proc.returncode, stdoutdata, stderrdata)
+    (_, stderrdata) = proc.communicate()
+    return (proc.returncode == 0, stderrdata)
+
+
+def group_sources(sources):
+    """
+    Groups sources that can be transferred with a single rsync invocation,
+    which are all sources located on the same remote host and, for rsync
+    daemon sources, in the same module. Local sources are not grouped. The
+    order of the groups is determined by the first source of each group.
+    :param sources: The sources to group.
+    :type sources: list
+    :returns: A list of (location, sources) tuples, where location is the
+    Location instance of the first source of the group.
+    :rtype: list of tuples
+    """
+    groups = []
+    remote_groups = {}
+    for source in sources:
+        location = parse_location(source)
+        if location.transport == Transports.LOCAL:
+            groups.append((location, [source]))
+            continue
+        key = (location.transport, location.host, location.port,
+               location.module)
+        if key in remote_groups:
+            remote_groups[key].append(source)
+        else:
+            remote_groups[key] = [source]
+            groups.append((location, remote_groups[key]))
+    return groups
 
 
 class LogfileOptions(object):
@@ -87,15 +410,27 @@ class LogfileOptions(object):
     This class holds information about the logfile rsync will create.
     """
 
-    def __init__(self, log_name, log_format):
+    def __init__(self, log_name, log_format, compression=None):
         """
         :param log_name: The name of the logfile.
         :type log_name: string
         :log_format: The format of the log.
         :type log_format: string
+        :param compression: The compression of the log, which is then
+        captured by rbackupd and stored outside of the snapshot, or None if
+        rsync writes the log into the snapshot.
+        :type compression: string
         """
         self.log_name = log_name
         self.log_format = log_format
+        self.compression = compression
+
+    def is_in_snapshot(self):
+        """
+        :returns: Whether rsync writes the log into the snapshot.
+        :rtype: bool
+        """
+        return self.compression is None
 
 
 class Filter(object):
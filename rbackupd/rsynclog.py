@@ -0,0 +1,399 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module stores the logs rsync writes while creating snapshots, compressed
+and outside of the snapshots, so they neither take up the space of an
+uncompressed file in every snapshot nor break the sharing of files between
+snapshots. The log of a snapshot lives as long as the snapshot itself.
+
+The logs are kept in the "logs" directory of the state directory of the
+destination:
+
+    <snapshot>.log.gz    the log, also .log.xz or .log.zst
+    <snapshot>.log.idx   the index of the log
+
+The log is compressed in blocks of about BLOCK_SIZE bytes, each of them a
+complete gzip member, xz stream or zstd frame, so the file can still be read
+with zcat, xzcat or zstdcat. The first line of the index is a JSON header,
+every other line describes one block:
+
+    {"offset": 0, "size": 41234, "lines": 8150, "dirs": ["home", ...]}
+
+"dirs" are the directories of all paths that appear in the lines of the
+block, so searching the log for a path only decompresses the blocks that
+mention the path or anything below it. The paths are only known for the
+default log format of rsync, with another format "dirs" is null and every
+block is searched.
+"""
+
+import json
+import logging
+import os
+
+from . import constants as const
+from . import packs
+
+VERSION = 1
+
+LOG_SUFFIX = ".log"
+INDEX_SUFFIX = ".log.idx"
+TMP_SUFFIX = ".tmp"
+EXTENSIONS = {"gzip": ".gz", "xz": ".xz", "zstd": ".zst"}
+
+# the uncompressed size of a block
+BLOCK_SIZE = 1024 * 1024
+
+# the first letters of the changes itemized by rsync (%i), see
+# "--itemize-changes" in rsync(1)
+ITEMIZE_TYPES = b"<>ch.*"
+ITEMIZE_LENGTH = 11
+
+logger = logging.getLogger(__name__)
+
+
+class LogError(Exception):
+    """
+    This exception is raised when the log of a snapshot does not exist or
+    cannot be read.
+    """
+
+    def __init__(self, message):
+        super(LogError, self).__init__(message)
+        self.message = message
+
+
+def get_directory(destination):
+    """
+    :returns: The directory holding the logs of a destination.
+    :rtype: string
+    """
+    return os.path.join(destination, const.STATE_DIR_NAME,
+                        const.RSYNC_LOGS_DIR_NAME)
+
+
+def _get_names(name):
+    """Returns the names of all files that may belong to a log."""
+    return ([name + LOG_SUFFIX + extension
+             for extension in EXTENSIONS.values()] +
+            [name + INDEX_SUFFIX])
+
+
+def exists(destination, name):
+    """
+    :returns: Whether there is a log of a snapshot.
+    :rtype: bool
+    """
+    return os.path.exists(os.path.join(get_directory(destination),
+                                       name + INDEX_SUFFIX))
+
+
+def remove(destination, name):
+    """
+    Removes the log of a snapshot, if there is one.
+    """
+    directory = get_directory(destination)
+    for filename in _get_names(name):
+        path = os.path.join(directory, filename)
+        if os.path.lexists(path):
+            logger.verbose("Removing rsync log \"%s\".", filename)
+            os.unlink(path)
+
+
+def rename(destination, old_name, new_name):
+    """
+    Moves the log of a snapshot to another snapshot, when the folder of the
+    snapshot is taken over by the other one.
+    """
+    directory = get_directory(destination)
+    for (old, new) in zip(_get_names(old_name), _get_names(new_name)):
+        if os.path.lexists(os.path.join(directory, old)):
+            os.rename(os.path.join(directory, old),
+                      os.path.join(directory, new))
+
+
+def remove_incomplete(destination):
+    """
+    Removes the logs of snapshots that were never finished.
+    """
+    directory = get_directory(destination)
+    if not os.path.isdir(directory):
+        return
+    for filename in os.listdir(directory):
+        if filename.endswith(TMP_SUFFIX):
+            logger.verbose("Removing incomplete rsync log \"%s\".", filename)
+            os.unlink(os.path.join(directory, filename))
+
+
+def parse_path(line):
+    """
+    Extracts the path from a line of a log in the default format of rsync,
+    "%i %n%L" after the time and the process id.
+    :param line: The line, without the line break.
+    :type line: bytes
+    :returns: The path, relative to the destination and without trailing
+    slash, or None if the line does not name a path.
+    :rtype: bytes
+    """
+    (_, sep, message) = line.partition(b"] ")
+    if (not sep or len(message) <= ITEMIZE_LENGTH + 1 or
+            message[ITEMIZE_LENGTH] != 32 or
+            message[0] not in ITEMIZE_TYPES):
+        return None
+    path = message[ITEMIZE_LENGTH + 1:]
+    # %L names the target of symlinks and hardlinks
+    if message[1:2] == b"L":
+        path = path.partition(b" -> ")[0]
+    elif message[0:1] == b"h":
+        path = path.partition(b" => ")[0]
+    return path.rstrip(b"/")
+
+
+def _decode(path):
+    return path.decode("utf-8", "surrogateescape")
+
+
+def _encode(path):
+    return path.encode("utf-8", "surrogateescape")
+
+
+class LogWriter(object):
+    """
+    Compresses and indexes the log of a snapshot while rsync writes it. The
+    log is written to temporary files until it is committed.
+    """
+
+    def __init__(self, destination, name, compression, log_format=None,
+                 block_size=BLOCK_SIZE):
+        """
+        :param destination: The destination of the snapshot.
+        :type destination: string
+        :param name: The name of the snapshot.
+        :type name: string
+        :param compression: "gzip", "xz" or "zstd".
+        :type compression: string
+        :param log_format: The log format given to rsync, None for the
+        default format.
+        :type log_format: string
+        :param block_size: The uncompressed size of the blocks.
+        :type block_size: int
+        """
+        self.destination = destination
+        self.name = name
+        self.block_size = block_size
+        self.failed = False
+        (self._compress, _) = packs.get_codec(compression)
+        self._indexed = log_format is None
+        self._log_name = name + LOG_SUFFIX + EXTENSIONS[compression]
+        directory = get_directory(destination)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._log = open(os.path.join(directory, self._log_name + TMP_SUFFIX),
+                         "wb")
+        self._index = open(os.path.join(directory,
+                                        name + INDEX_SUFFIX + TMP_SUFFIX),
+                           "w")
+        self._index.write(json.dumps({"version": VERSION,
+                                      "compression": compression,
+                                      "format": log_format}) + "\n")
+        self._offset = 0
+        self._pending = b""
+        self._lines = []
+        self._size = 0
+        self._dirs = set()
+
+    def write(self, data):
+        """
+        Adds data written by rsync to the log. Failures are logged once, the
+        log is dropped afterwards.
+        :param data: The data, not necessarily ending with a complete line.
+        :type data: bytes
+        """
+        if self.failed:
+            return
+        lines = (self._pending + data).split(b"\n")
+        self._pending = lines.pop()
+        try:
+            for line in lines:
+                self._add_line(line)
+        except OSError as err:
+            self._fail(err)
+
+    def _add_line(self, line):
+        if self._indexed:
+            path = parse_path(line)
+            if path is not None:
+                self._dirs.add(_decode(os.path.dirname(path)))
+        self._lines.append(line)
+        self._size += len(line) + 1
+        if self._size >= self.block_size:
+            self._write_block()
+
+    def _write_block(self):
+        if len(self._lines) == 0:
+            return
+        data = self._compress(b"\n".join(self._lines) + b"\n")
+        self._log.write(data)
+        self._index.write(json.dumps({
+            "offset": self._offset,
+            "size": len(data),
+            "lines": len(self._lines),
+            "dirs": sorted(self._dirs) if self._indexed else None}) + "\n")
+        self._offset += len(data)
+        self._lines = []
+        self._size = 0
+        self._dirs = set()
+
+    def _fail(self, err):
+        logger.error("Could not write rsync log of snapshot \"%s\", it is "
+                     "dropped: %s", self.name, err)
+        self.failed = True
+
+    def close(self):
+        """
+        Writes the remaining lines and closes the temporary files.
+        """
+        if self._log.closed:
+            return
+        try:
+            if not self.failed:
+                if self._pending:
+                    self._add_line(self._pending)
+                self._write_block()
+        except OSError as err:
+            self._fail(err)
+        finally:
+            self._log.close()
+            self._index.close()
+
+    def commit(self):
+        """
+        Moves the log into place once the snapshot exists.
+        """
+        self.close()
+        if self.failed:
+            self.discard()
+            return
+        directory = get_directory(self.destination)
+        os.rename(self._log.name, os.path.join(directory, self._log_name))
+        os.rename(self._index.name,
+                  os.path.join(directory, self.name + INDEX_SUFFIX))
+
+    def discard(self):
+        """
+        Removes the temporary files.
+        """
+        self.close()
+        for f in (self._log, self._index):
+            if os.path.lexists(f.name):
+                os.unlink(f.name)
+
+
+class LogReader(object):
+    """
+    Reads the log of a snapshot.
+    """
+
+    def __init__(self, destination, name):
+        """
+        :param destination: The destination of the snapshot.
+        :type destination: string
+        :param name: The name of the snapshot, not of an alias.
+        :type name: string
+        :raises LogError: If the snapshot has no log.
+        """
+        directory = get_directory(destination)
+        try:
+            with open(os.path.join(directory, name + INDEX_SUFFIX)) as index:
+                header = json.loads(index.readline())
+                self.blocks = [json.loads(line) for line in index]
+        except FileNotFoundError:
+            raise LogError("Snapshot \"%s\" has no rsync log." % name)
+        except ValueError as err:
+            raise LogError("Index of the rsync log of snapshot \"%s\" is "
+                           "damaged: %s" % (name, err))
+        if header.get("version") != VERSION:
+            raise LogError("Rsync log of snapshot \"%s\" has the unknown "
+                           "version %s." % (name, header.get("version")))
+        self.compression = header["compression"]
+        self.log_format = header["format"]
+        self.path = os.path.join(directory,
+                                 name + LOG_SUFFIX +
+                                 EXTENSIONS[self.compression])
+        try:
+            (_, self._decompress) = packs.get_codec(self.compression)
+        except ValueError as err:
+            raise LogError(str(err))
+
+    def get_blocks(self, path=None):
+        """
+        :param path: Only return the blocks that may mention this path or
+        anything below it, relative to the destination, if not None.
+        :type path: string
+        :returns: The blocks, as described in the index.
+        :rtype: list of dicts
+        """
+        if path is None or path == "":
+            return list(self.blocks)
+        (parent, prefix) = (os.path.dirname(path), path + "/")
+        return [block for block in self.blocks
+                if block["dirs"] is None or
+                any(directory == parent or directory == path or
+                    directory.startswith(prefix)
+                    for directory in block["dirs"])]
+
+    def _read_blocks(self, blocks):
+        with open(self.path, "rb") as f:
+            for block in blocks:
+                f.seek(block["offset"])
+                data = self._decompress(f.read(block["size"]))
+                # every block ends with a line break
+                for line in data[:-1].split(b"\n"):
+                    yield line
+
+    def read(self):
+        """
+        :returns: All lines of the log, without line breaks.
+        :rtype: iterator of bytes
+        """
+        return self._read_blocks(self.blocks)
+
+    def search(self, path):
+        """
+        Finds the lines about a path or anything below it. With the default
+        log format, these are the lines naming the path. Otherwise, they are
+        all lines containing it.
+        :param path: The path, relative to the destination, e.g.
+        "home/user/file" for the source "/home" without trailing slash.
+        :type path: string
+        :returns: The lines, without line breaks.
+        :rtype: iterator of bytes
+        """
+        path = path.strip("/")
+        encoded = _encode(path)
+        prefix = encoded + b"/"
+        for line in self._read_blocks(self.get_blocks(path)):
+            if self.log_format is not None:
+                if encoded in line:
+                    yield line
+                continue
+            line_path = parse_path(line)
+            if line_path is not None and (encoded == b"" or
+                                          line_path == encoded or
+                                          line_path.startswith(prefix)):
+                yield line
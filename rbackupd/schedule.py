@@ -0,0 +1,156 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module decides in which order the daemon works on its tasks when many
+of them are due at the same time.
+
+A due snapshot has to be finished before the next occurence of its interval,
+otherwise that occurence is missed. The slack of a task is the time until
+that deadline minus the time its previous snapshot took. Due tasks are
+processed with the least slack first (earliest deadline first), and the
+"priority" of a task scales its slack: a task with priority 2 is treated as
+if it had half the slack, or twice the delay once its deadline has passed.
+Tasks that are not due keep the order of the configuration.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Urgency(object):
+    """How urgently a task needs its next snapshot."""
+
+    def __init__(self, name, due_since, deadline, expected_seconds,
+                 priority):
+        """
+        :param name: The name of the task.
+        :type name: string
+        :param due_since: The time the oldest due snapshot became due.
+        :type due_since: datetime.datetime instance
+        :param deadline: The time the due snapshots have to be finished, or
+        None if there is no deadline.
+        :type deadline: datetime.datetime instance
+        :param expected_seconds: The time the previous snapshot took, or None
+        if unknown.
+        :type expected_seconds: float
+        :param priority: The priority of the task.
+        :type priority: int
+        """
+        self.name = name
+        self.due_since = due_since
+        self.deadline = deadline
+        self.expected_seconds = expected_seconds
+        self.priority = priority
+
+    def get_slack(self, now):
+        """
+        :returns: The weighted seconds that are left until the snapshot has
+        to be started, negative if it is late.
+        :rtype: float
+        """
+        if self.deadline is None:
+            return float("inf")
+        slack = (self.deadline - now).total_seconds()
+        if self.expected_seconds is not None:
+            slack -= self.expected_seconds
+        if slack >= 0:
+            return slack / self.priority
+        return slack * self.priority
+
+
+def get_urgency(repo, priority, now, due=False):
+    """
+    Determines how urgently a repository needs a snapshot.
+    :param repo: The repository.
+    :type repo: repository.Repository instance
+    :param priority: The priority of the task.
+    :type priority: int
+    :param now: The current time.
+    :type now: datetime.datetime instance
+    :param due: Whether a snapshot is due regardless of the intervals, e.g.
+    as it was triggered or missed snapshots are caught up.
+    :type due: bool
+    :returns: The urgency, or None if no snapshot is due.
+    :rtype: Urgency instance
+    """
+    due_since = now if due else None
+    deadlines = []
+    for (interval_name, cronjob) in repo.get_necessary_backups(now):
+        latest = repo.get_latest_backup_of_interval(interval_name)
+        since = (cronjob.get_next_occurence(latest.date)
+                 if latest is not None else None)
+        if since is None or since > now:
+            since = now
+        if due_since is None or since < due_since:
+            due_since = since
+        deadline = cronjob.get_next_occurence(now)
+        if deadline is not None:
+            deadlines.append(deadline)
+    if due_since is None:
+        return None
+    if len(deadlines) == 0:
+        deadlines = [deadline for deadline in
+                     (cronjob.get_next_occurence(now)
+                      for (_, cronjob) in repo.intervals)
+                     if deadline is not None]
+    stats = repo.catalog.get_latest("stats")
+    return Urgency(repo.name, due_since,
+                   min(deadlines) if len(deadlines) != 0 else None,
+                   stats["seconds"] if stats is not None else None,
+                   priority)
+
+
+def order(repos, priorities, now, due=()):
+    """
+    Orders repositories by the urgency of their snapshots.
+    :param repos: The repositories, in the order of the configuration.
+    :type repos: list
+    :param priorities: The priorities of the tasks by name.
+    :type priorities: dict
+    :param now: The current time.
+    :type now: datetime.datetime instance
+    :param due: The names of the tasks that are due regardless of their
+    intervals.
+    :type due: set
+    :returns: The due repositories, most urgent first, followed by all
+    others in their original order.
+    :rtype: list
+    """
+    urgent = []
+    others = []
+    for (index, repo) in enumerate(repos):
+        urgency = get_urgency(repo, priorities.get(repo.name, 1), now,
+                              repo.name in due)
+        if urgency is None:
+            others.append(repo)
+        else:
+            urgent.append((urgency.get_slack(now), urgency.due_since, index,
+                           repo))
+    urgent.sort(key=lambda entry: entry[:3])
+    if len(urgent) > 1:
+        logger.verbose("Processing due tasks in the order %s.",
+                       ", ".join("\"%s\"" % repo.name
+                                 for (_, _, _, repo) in urgent))
+    for (slack, due_since, _, repo) in urgent:
+        if slack < 0:
+            logger.info("Task \"%s\" is due since %s and will probably miss "
+                        "its next occurence.", repo.name,
+                        due_since.strftime("%H:%M:%S"))
+    return [repo for (_, _, _, repo) in urgent] + others
@@ -0,0 +1,548 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module turns the parsed configuration file into validated settings. All
+values are checked and converted once when the settings are loaded, so the
+rest of the program does not have to deal with the raw structure of the
+configuration file.
+"""
+
+import collections
+import glob
+import logging
+import os
+import socket
+
+from . import config
+from . import constants as const
+from . import interval
+from . import packs
+from . import progress
+from . import rsync
+
+
+class SettingsError(Exception):
+    """
+    This exception is raised when the configuration contains invalid values.
+    It holds the exit code the program should terminate with.
+    """
+
+    def __init__(self, msg, exit_code):
+        super(SettingsError, self).__init__(msg)
+        self.message = msg
+        self.exit_code = exit_code
+
+
+class Settings(object):
+    """
+    Holds all settings of the configuration file and all included files.
+    """
+
+    def __init__(self, logfile, loglevel, progress_interval, rsync_cmd, ssh,
+                 control_socket, cluster, mounts, tasks):
+        self.logfile = logfile
+        self.loglevel = loglevel
+        self.progress_interval = progress_interval
+        self.rsync_cmd = rsync_cmd
+        self.ssh = ssh
+        self.control_socket = control_socket
+        self.cluster = cluster
+        self.mounts = mounts
+        self.tasks = tasks
+
+
+class SshSettings(object):
+    """Holds the settings of the [ssh] section."""
+
+    def __init__(self, multiplex, control_dir, max_sessions, max_age):
+        self.multiplex = multiplex
+        self.control_dir = control_dir
+        self.max_sessions = max_sessions
+        self.max_age = max_age
+
+    def __eq__(self, other):
+        return vars(self) == vars(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class ClusterSettings(object):
+    """Holds the settings of the [cluster] section."""
+
+    def __init__(self, directory, instance, lease_time):
+        self.directory = directory
+        self.instance = instance
+        self.lease_time = lease_time
+
+    def __eq__(self, other):
+        # the section is optional, so the settings are compared with None
+        return (isinstance(other, ClusterSettings) and
+                vars(self) == vars(other))
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class MountSettings(object):
+    """Holds the settings of a single [mount] section."""
+
+    def __init__(self, partition, mountpoint, mountpoint_ro, options,
+                 ro_options, create, ro_create):
+        self.partition = partition
+        self.mountpoint = mountpoint
+        self.mountpoint_ro = mountpoint_ro
+        self.options = options
+        self.ro_options = ro_options
+        self.create = create
+        self.ro_create = ro_create
+
+    def __eq__(self, other):
+        return vars(self) == vars(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class TaskSettings(object):
+    """
+    Holds the settings of a single [task] section, with all values missing in
+    the task taken from the [default] section.
+    """
+
+    def __init__(self, name, sources, destination, intervals, keep, keep_age,
+                 filter_patterns, include_patterns, exclude_patterns,
+                 include_files, exclude_files, rsync_logfile,
+                 rsync_logfile_name, rsync_logfile_format,
+                 rsync_logfile_compression, create_destination, rsync_args,
+                 ssh_args, password_file,
+                 overlapping, catchup, catchup_window, replicate_to,
+                 archive_after, archive_compression, snapshot_backend,
+                 priority):
+        self.name = name
+        self.sources = sources
+        self.destination = destination
+        self.intervals = intervals
+        self.keep = keep
+        self.keep_age = keep_age
+        self.filter_patterns = filter_patterns
+        self.include_patterns = include_patterns
+        self.exclude_patterns = exclude_patterns
+        self.include_files = include_files
+        self.exclude_files = exclude_files
+        self.rsync_logfile = rsync_logfile
+        self.rsync_logfile_name = rsync_logfile_name
+        self.rsync_logfile_format = rsync_logfile_format
+        self.rsync_logfile_compression = rsync_logfile_compression
+        self.create_destination = create_destination
+        self.rsync_args = rsync_args
+        self.ssh_args = ssh_args
+        self.password_file = password_file
+        self.overlapping = overlapping
+        self.catchup = catchup
+        self.catchup_window = catchup_window
+        self.replicate_to = replicate_to
+        self.archive_after = archive_after
+        self.archive_compression = archive_compression
+        self.snapshot_backend = snapshot_backend
+        self.priority = priority
+
+    def __eq__(self, other):
+        return vars(self) == vars(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def get_rsync_filter(self):
+        """
+        :returns: The filters applied to the transfers of this task.
+        :rtype: rsync.Filter instance
+        """
+        return rsync.Filter(self.include_patterns,
+                            self.exclude_patterns,
+                            self.include_files,
+                            self.exclude_files,
+                            self.filter_patterns)
+
+    def get_rsync_logfile_options(self):
+        """
+        :returns: The logfile options of this task, or None if rsync should
+        not write a logfile.
+        :rtype: rsync.LogfileOptions instance
+        """
+        if not self.rsync_logfile:
+            return None
+        return rsync.LogfileOptions(self.rsync_logfile_name,
+                                    self.rsync_logfile_format,
+                                    self.rsync_logfile_compression)
+
+    def get_keep_age(self):
+        """
+        Converts the maximum ages of all intervals into the oldest datetime a
+        snapshot may have, relative to the current time.
+        :rtype: collections.OrderedDict
+        """
+        keep_age = collections.OrderedDict()
+        for (backup_interval, max_age) in self.keep_age.items():
+            keep_age[backup_interval] = \
+                interval.interval_to_oldest_datetime(max_age)
+        return keep_age
+
+
+def load(path):
+    """
+    Loads the settings from a configuration file and all files in the
+    directories given in its [include] sections. Files that did not change
+    since the last call are not parsed again.
+    :param path: The path of the configuration file.
+    :type path: string
+    :returns: The validated settings.
+    :rtype: Settings instance
+    :raises SettingsError: if the configuration is invalid.
+    :raises config.ParseError: if a file cannot be parsed.
+    """
+    if not os.path.isfile(path):
+        if not os.path.exists(path):
+            raise SettingsError("Config file not found.",
+                                const.EXIT_CONFIG_FILE_NOT_FOUND)
+        raise SettingsError("Invalid config file.",
+                            const.EXIT_INVALID_CONFIG_FILE)
+    main_conf = config.load(path)
+    confs = [main_conf]
+    for include in _get_sections([main_conf], const.CONF_SECTION_INCLUDE):
+        for directory in _get_values(include, const.CONF_KEY_INCLUDE_DIR):
+            if not os.path.isdir(directory):
+                raise SettingsError("Include directory \"%s\" not found." %
+                                    directory,
+                                    const.EXIT_CONFIG_FILE_NOT_FOUND)
+            for include_path in sorted(glob.glob(os.path.join(
+                    directory, "*" + const.CONF_INCLUDE_SUFFIX))):
+                confs.append(config.load(include_path))
+
+    section_logging = _get_section(confs, const.CONF_SECTION_LOGGING)
+    logfile = _get_value(section_logging, const.CONF_KEY_LOGFILE_PATH)
+    loglevel = _get_value(section_logging, const.CONF_KEY_LOGLEVEL)
+    if loglevel not in const.CONF_VALUES_LOGLEVEL:
+        raise _invalid_value(const.CONF_KEY_LOGLEVEL, loglevel,
+                             const.CONF_VALUES_LOGLEVEL)
+    loglevel = {"quiet": logging.WARNING,
+                "default": logging.INFO,
+                "verbose": logging.VERBOSE,
+                "debug": logging.DEBUG}[loglevel]
+    progress_interval = _get_value(section_logging,
+                                   const.CONF_KEY_PROGRESS_INTERVAL,
+                                   progress.DEFAULT_LOG_INTERVAL)
+    if not isinstance(progress_interval, int) or progress_interval < 0:
+        raise SettingsError("Invalid value for key \"%s\": \"%s\"." %
+                            (const.CONF_KEY_PROGRESS_INTERVAL,
+                             progress_interval),
+                            const.EXIT_INVALID_CONFIG_FILE)
+
+    section_rsync = _get_section(confs, const.CONF_SECTION_RSYNC)
+    rsync_cmd = _get_value(section_rsync, const.CONF_KEY_RSYNC_CMD,
+                           const.DEFAULT_RSYNC_CMD)
+
+    section_ssh = _get_section(confs, const.CONF_SECTION_SSH)
+    ssh = SshSettings(
+        _get_value(section_ssh, const.CONF_KEY_SSH_MULTIPLEX, True),
+        _get_value(section_ssh, const.CONF_KEY_SSH_CONTROL_DIR),
+        _get_value(section_ssh, const.CONF_KEY_SSH_MAX_SESSIONS,
+                   const.SSH_DEFAULT_MAX_SESSIONS),
+        _get_value(section_ssh, const.CONF_KEY_SSH_MAX_AGE,
+                   const.SSH_DEFAULT_MAX_AGE))
+
+    section_control = _get_section(confs, const.CONF_SECTION_CONTROL)
+    control_socket = _get_value(section_control, const.CONF_KEY_CONTROL_SOCKET,
+                                const.CONTROL_DEFAULT_SOCKET)
+
+    section_cluster = _get_section(confs, const.CONF_SECTION_CLUSTER)
+    cluster = None
+    cluster_directory = _get_value(section_cluster,
+                                   const.CONF_KEY_CLUSTER_DIRECTORY)
+    if cluster_directory is not None:
+        lease_time = _get_value(section_cluster,
+                                const.CONF_KEY_CLUSTER_LEASE_TIME,
+                                const.CLUSTER_DEFAULT_LEASE_TIME)
+        if not isinstance(lease_time, int) or lease_time <= 0:
+            raise SettingsError("Invalid value for key \"%s\": \"%s\"." %
+                                (const.CONF_KEY_CLUSTER_LEASE_TIME,
+                                 lease_time),
+                                const.EXIT_INVALID_CONFIG_FILE)
+        cluster = ClusterSettings(
+            cluster_directory,
+            _get_value(section_cluster, const.CONF_KEY_CLUSTER_INSTANCE,
+                       socket.gethostname()),
+            lease_time)
+
+    mounts = [_load_mount(section) for section in
+              _get_sections(confs, const.CONF_SECTION_MOUNT)
+              if len(section) != 0]
+
+    section_default = _get_section(confs, const.CONF_SECTION_DEFAULT)
+    tasks = collections.OrderedDict()
+    for section in _get_sections(confs, const.CONF_SECTION_TASK):
+        task = _load_task(section, section_default)
+        if task.name in tasks:
+            raise SettingsError("Task \"%s\" defined more than once." %
+                                task.name,
+                                const.EXIT_INVALID_CONFIG_FILE)
+        tasks[task.name] = task
+
+    return Settings(logfile, loglevel, progress_interval, rsync_cmd, ssh,
+                    control_socket, cluster, mounts, tasks)
+
+
+def _load_mount(section):
+    partition = _get_value(section, const.CONF_KEY_PARTITION)
+    mountpoint = _get_value(section, const.CONF_KEY_MOUNTPOINT)
+    mountpoint_ro = _get_value(section, const.CONF_KEY_MOUNTPOINT_RO)
+    options = _get_value(section, const.CONF_KEY_MOUNTPOINT_OPTIONS)
+    ro_options = _get_value(section, const.CONF_KEY_MOUNTPOINT_RO_OPTIONS)
+
+    if options is None:
+        options = ['rw']
+    else:
+        options = options.split(',')
+        options.append('rw')
+
+    if ro_options is None:
+        ro_options = ['ro']
+    else:
+        ro_options = ro_options.split(',')
+        ro_options.append('ro')
+
+    create = _get_value(section, const.CONF_KEY_MOUNTPOINT_CREATE)
+    ro_create = _get_value(section, const.CONF_KEY_MOUNTPOINT_RO_CREATE)
+    if mountpoint_ro is not None and ro_create is None:
+        raise SettingsError("Key \"mountpoint_ro_create\" needed if key "
+                            "\"mountpoint_ro\" is present.",
+                            const.EXIT_NO_MOUNTPOINT_CREATE)
+
+    return MountSettings(partition, mountpoint, mountpoint_ro, options,
+                         ro_options, create, ro_create)
+
+
+def _load_task(section, section_default):
+    # a key that is present but empty in the task section still overrides
+    # the [default] section
+    def get_value(key, default=None):
+        if key in section:
+            return _get_value(section, key, default)
+        return _get_value(section_default, key, default)
+
+    def get_values(key):
+        if key in section:
+            return _get_values(section, key)
+        return _get_values(section_default, key)
+
+    name = _get_value(section, const.CONF_KEY_TASKNAME)
+    overlapping = get_value(const.CONF_KEY_OVERLAPPING)
+    if overlapping not in const.CONF_VALUES_OVERLAPPING:
+        raise _invalid_value(const.CONF_KEY_OVERLAPPING, overlapping,
+                             const.CONF_VALUES_OVERLAPPING)
+
+    catchup = get_value(const.CONF_KEY_CATCHUP, const.CATCHUP_DEFAULT)
+    if catchup not in const.CONF_VALUES_CATCHUP:
+        raise _invalid_value(const.CONF_KEY_CATCHUP, catchup,
+                             const.CONF_VALUES_CATCHUP)
+    catchup_window = get_value(const.CONF_KEY_CATCHUP_WINDOW,
+                               const.CATCHUP_DEFAULT_WINDOW)
+    try:
+        catchup_window = interval.interval_to_timedelta(catchup_window)
+    except ValueError:
+        raise SettingsError("Invalid value for key \"%s\": \"%s\"." %
+                            (const.CONF_KEY_CATCHUP_WINDOW, catchup_window),
+                            const.EXIT_INVALID_CONFIG_FILE)
+
+    archive_after = get_value(const.CONF_KEY_ARCHIVE_AFTER)
+    if archive_after is not None:
+        try:
+            archive_after = interval.interval_to_timedelta(archive_after)
+        except ValueError:
+            raise SettingsError("Invalid value for key \"%s\": \"%s\"." %
+                                (const.CONF_KEY_ARCHIVE_AFTER, archive_after),
+                                const.EXIT_INVALID_CONFIG_FILE)
+    archive_compression = get_value(const.CONF_KEY_ARCHIVE_COMPRESSION,
+                                    const.ARCHIVE_DEFAULT_COMPRESSION)
+    if archive_compression not in const.CONF_VALUES_ARCHIVE_COMPRESSION:
+        raise _invalid_value(const.CONF_KEY_ARCHIVE_COMPRESSION,
+                             archive_compression,
+                             const.CONF_VALUES_ARCHIVE_COMPRESSION)
+    if not packs.is_available(archive_compression):
+        raise SettingsError("Compression \"%s\" needs the zstandard "
+                            "module." % archive_compression,
+                            const.EXIT_INVALID_CONFIG_FILE)
+
+    rsync_logfile_compression = get_value(
+        const.CONF_KEY_RSYNC_LOGFILE_COMPRESSION)
+    if rsync_logfile_compression is not None:
+        if (rsync_logfile_compression not in
+                const.CONF_VALUES_RSYNC_LOGFILE_COMPRESSION):
+            raise _invalid_value(const.CONF_KEY_RSYNC_LOGFILE_COMPRESSION,
+                                 rsync_logfile_compression,
+                                 const.CONF_VALUES_RSYNC_LOGFILE_COMPRESSION)
+        if not packs.is_available(rsync_logfile_compression):
+            raise SettingsError("Compression \"%s\" needs the zstandard "
+                                "module." % rsync_logfile_compression,
+                                const.EXIT_INVALID_CONFIG_FILE)
+
+    snapshot_backend = get_value(const.CONF_KEY_SNAPSHOT_BACKEND,
+                                 const.SNAPSHOT_DEFAULT_BACKEND)
+    if snapshot_backend not in const.CONF_VALUES_SNAPSHOT_BACKEND:
+        raise _invalid_value(const.CONF_KEY_SNAPSHOT_BACKEND,
+                             snapshot_backend,
+                             const.CONF_VALUES_SNAPSHOT_BACKEND)
+
+    priority = get_value(const.CONF_KEY_PRIORITY, const.PRIORITY_DEFAULT)
+    if not isinstance(priority, int) or priority < 1:
+        raise SettingsError("Invalid value for key \"%s\": \"%s\"." %
+                            (const.CONF_KEY_PRIORITY, priority),
+                            const.EXIT_INVALID_CONFIG_FILE)
+
+    destination = _get_value(section, const.CONF_KEY_DESTINATION)
+    replicate_to = get_values(const.CONF_KEY_REPLICATE_TO)
+    for replica in replicate_to:
+        if not os.path.isabs(replica):
+            raise SettingsError("Replica \"%s\" is not an absolute path." %
+                                replica,
+                                const.EXIT_INVALID_CONFIG_FILE)
+        if (destination is not None and
+                os.path.normpath(replica) == os.path.normpath(destination)):
+            raise SettingsError("Replica \"%s\" is the destination of the "
+                                "task." % replica,
+                                const.EXIT_INVALID_CONFIG_FILE)
+
+    include_files = get_values(const.CONF_KEY_INCLUDE_FILE)
+    exclude_files = get_values(const.CONF_KEY_EXCLUDE_FILE)
+    for include_file in include_files:
+        if not os.path.exists(include_file):
+            raise SettingsError("Include file \"%s\" not found." %
+                                include_file,
+                                const.EXIT_INCLUDE_FILE_NOT_FOUND)
+        elif not os.path.isfile(include_file):
+            raise SettingsError("Include file \"%s\" is not a file." %
+                                include_file,
+                                const.EXIT_INCLUDE_FILE_INVALID)
+    for exclude_file in exclude_files:
+        if not os.path.exists(exclude_file):
+            raise SettingsError("Exclude file \"%s\" not found." %
+                                exclude_file,
+                                const.EXIT_EXCULDE_FILE_NOT_FOUND)
+        elif not os.path.isfile(exclude_file):
+            raise SettingsError("Exclude file \"%s\" is not a file." %
+                                exclude_file,
+                                const.EXIT_EXCLUDE_FILE_INVALID)
+
+    password_file = get_value(const.CONF_KEY_RSYNC_PASSWORD_FILE)
+    if password_file is not None:
+        if not os.path.isfile(password_file):
+            raise SettingsError("Password file \"%s\" not found." %
+                                password_file,
+                                const.EXIT_PASSWORD_FILE_INVALID)
+        if os.stat(password_file).st_mode & 0o077:
+            # rsync refuses to use a password file that is accessible by
+            # other users, we should fail early
+            raise SettingsError("Password file \"%s\" must only be "
+                                "accessible by its owner." % password_file,
+                                const.EXIT_PASSWORD_FILE_INVALID)
+
+    rsync_args = []
+    for arg in get_values(const.CONF_KEY_RSYNC_ARGS):
+        rsync_args.extend(arg.split())
+    if get_value(const.CONF_KEY_ONE_FILESYSTEM):
+        rsync_args.append("-x")
+
+    ssh_args = []
+    for arg in get_values(const.CONF_KEY_SSH_ARGS):
+        ssh_args.extend(arg.split())
+
+    return TaskSettings(
+        name=name,
+        sources=_get_values(section, const.CONF_KEY_SOURCE),
+        destination=destination,
+        intervals=section[const.CONF_KEY_INTERVAL],
+        keep=section[const.CONF_KEY_KEEP],
+        keep_age=section[const.CONF_KEY_KEEP_AGE],
+        filter_patterns=get_values(const.CONF_KEY_FILTER_PATTERNS),
+        include_patterns=get_values(const.CONF_KEY_INCLUDE_PATTERNS),
+        exclude_patterns=get_values(const.CONF_KEY_EXCLUDE_PATTERNS),
+        include_files=include_files,
+        exclude_files=exclude_files,
+        rsync_logfile=get_value(const.CONF_KEY_RSYNC_LOGFILE, False),
+        rsync_logfile_name=get_value(const.CONF_KEY_RSYNC_LOGFILE_NAME),
+        rsync_logfile_format=get_value(const.CONF_KEY_RSYNC_LOGFILE_FORMAT),
+        rsync_logfile_compression=rsync_logfile_compression,
+        create_destination=get_value(const.CONF_KEY_CREATE_DESTINATION,
+                                     False),
+        rsync_args=rsync_args,
+        ssh_args=ssh_args,
+        password_file=password_file,
+        overlapping=overlapping,
+        catchup=catchup,
+        catchup_window=catchup_window,
+        replicate_to=replicate_to,
+        archive_after=archive_after,
+        archive_compression=archive_compression,
+        snapshot_backend=snapshot_backend,
+        priority=priority)
+
+
+def _invalid_value(key, value, valid_values):
+    return SettingsError("Invalid value for key \"%s\": \"%s\". Valid "
+                         "values: %s." % (key, value, ", ".join(valid_values)),
+                         const.EXIT_INVALID_CONFIG_FILE)
+
+
+def _get_sections(confs, name):
+    """
+    Returns all sections with the given name from several configuration
+    files, in the order of the files.
+    """
+    sections = []
+    for conf in confs:
+        sections.extend(section for section in conf.get_sections(name)
+                        if section is not None)
+    return sections
+
+
+def _get_section(confs, name):
+    """
+    Returns the first section with the given name, or an empty section if
+    there is none.
+    """
+    sections = _get_sections(confs, name)
+    if len(sections) == 0:
+        return {}
+    return sections[0]
+
+
+def _get_value(section, key, default=None):
+    """
+    Returns the first value of a key in a section. Empty values are treated
+    like missing keys.
+    """
+    values = section.get(key)
+    if values is None or values[0] is None:
+        return default
+    return values[0]
+
+
+def _get_values(section, key):
+    """Returns all non-empty values of a key in a section."""
+    return [value for value in section.get(key, []) if value is not None]
@@ -0,0 +1,262 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module manages persistent ssh(1) master connections ("ControlMaster"),
+so that all rsync transfers to the same host share one connection instead of
+doing a full ssh handshake for every source.
+"""
+
+import contextlib
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ControlDirError(Exception):
+    """
+    This exception is raised when the directory for the control sockets may
+    be accessible by other users.
+    """
+
+    def __init__(self, message):
+        super(ControlDirError, self).__init__(message)
+        self.message = message
+
+
+class ConnectionPool(object):
+    """
+    Keeps one ssh master connection per host and set of ssh arguments. The
+    control sockets are kept in a private directory that is only accessible
+    by the current user.
+    """
+
+    def __init__(self, ssh_cmd, control_dir=None, max_sessions=4,
+                 max_age=3600, check_interval=60):
+        """
+        :param ssh_cmd: The ssh command to execute.
+        :type ssh_cmd: string
+        :param control_dir: The directory the control sockets will be
+        created in. If None, a temporary directory will be used. An existing
+        directory has to be owned by the current user and must not be
+        writable by anybody else.
+        :type control_dir: string
+        :param max_sessions: The maximum count of concurrent sessions per
+        host.
+        :type max_sessions: int
+        :param max_age: The time in seconds after which a master connection
+        will be recycled when it is not in use.
+        :type max_age: int
+        :param check_interval: The minimum time in seconds between two health
+        checks of the same master connection.
+        :type check_interval: int
+        :raises ControlDirError: if control_dir is not private.
+        """
+        self.ssh_cmd = ssh_cmd
+        self.max_sessions = max_sessions
+        self.max_age = max_age
+        self.check_interval = check_interval
+
+        if control_dir is None:
+            self.control_dir = tempfile.mkdtemp(prefix="rbackupd-ssh-")
+            self._remove_control_dir = True
+        else:
+            if not os.path.exists(control_dir):
+                os.makedirs(control_dir, mode=0o700)
+                # other users must not be able to use our connections,
+                # whatever the umask is
+                os.chmod(control_dir, 0o700)
+            # an existing directory is never changed, it may be shared like
+            # /tmp
+            _check_control_dir(control_dir)
+            self.control_dir = control_dir
+            self._remove_control_dir = False
+
+        self._masters = {}
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def session(self, host, ssh_args):
+        """
+        Context manager that reserves a session to a host and yields the ssh
+        arguments needed to use the shared master connection. If the master
+        connection cannot be established, no arguments are yielded and ssh
+        will connect on its own.
+        :param host: The host to connect to, in the form [USER@]HOST.
+        :type host: string
+        :param ssh_args: Additional arguments passed to ssh.
+        :type ssh_args: list
+        """
+        semaphore = self._get_semaphore(host)
+        semaphore.acquire()
+        try:
+            master = self._get_master(host, ssh_args)
+            try:
+                if master.alive:
+                    yield ["-o", "ControlPath=%s" % master.path,
+                           "-o", "ControlMaster=no"]
+                else:
+                    yield []
+            finally:
+                with master.lock:
+                    master.users -= 1
+        finally:
+            semaphore.release()
+
+    def close(self):
+        """Shuts down all master connections and removes the sockets."""
+        with self._lock:
+            masters = list(self._masters.values())
+            self._masters = {}
+        for master in masters:
+            with master.lock:
+                self._stop_master(master)
+        if self._remove_control_dir:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+
+    def _get_semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(
+                    self.max_sessions)
+            return self._semaphores[host]
+
+    def _get_master(self, host, ssh_args):
+        key = (host, tuple(ssh_args))
+        with self._lock:
+            master = self._masters.get(key)
+            if master is None:
+                master = _Master(host, ssh_args, self._get_path(key))
+                self._masters[key] = master
+        # connecting may block for a long time, so only sessions using the
+        # same master wait for it
+        with master.lock:
+            now = time.time()
+            if (master.alive and master.users == 0 and
+                    now - master.started > self.max_age):
+                logger.verbose("Recycling ssh master connection to \"%s\".",
+                               host)
+                self._stop_master(master)
+            elif (master.alive and
+                    now - master.checked > self.check_interval):
+                if not self._check_master(master):
+                    logger.warning("ssh master connection to \"%s\" is "
+                                   "dead, reconnecting.", host)
+                    self._stop_master(master)
+            if not master.alive:
+                self._start_master(master)
+            master.users += 1
+            return master
+
+    def _get_path(self, key):
+        # the path of unix sockets is limited to about 100 characters, so we
+        # cannot use the host name directly
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.control_dir, digest[:16])
+
+    def _start_master(self, master):
+        args = [self.ssh_cmd]
+        args.extend(master.ssh_args)
+        args.extend(["-M", "-N", "-f",
+                     "-o", "ControlMaster=yes",
+                     "-o", "ControlPersist=yes",
+                     "-o", "ControlPath=%s" % master.path,
+                     master.host])
+        logger.verbose("Executing \"%s\".", " ".join(args))
+        try:
+            subprocess.check_call(args, stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError) as err:
+            logger.warning("Could not start ssh master connection to \"%s\": "
+                           "%s. Connecting without multiplexing.",
+                           master.host, err)
+            master.alive = False
+            return
+        master.alive = True
+        master.started = time.time()
+        master.checked = master.started
+
+    def _check_master(self, master):
+        master.checked = time.time()
+        return self._control(master, "check") == 0
+
+    def _stop_master(self, master):
+        if master.alive:
+            self._control(master, "exit")
+        master.alive = False
+        if os.path.exists(master.path):
+            os.remove(master.path)
+
+    def _control(self, master, command):
+        args = [self.ssh_cmd,
+                "-o", "ControlPath=%s" % master.path,
+                "-O", command,
+                master.host]
+        logger.debug("Executing \"%s\".", " ".join(args))
+        try:
+            return subprocess.call(args, stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+        except OSError:
+            return -1
+
+
+def _check_control_dir(path):
+    """
+    Raises ControlDirError if other users could access or replace the
+    control sockets in a directory.
+    """
+    try:
+        st = os.stat(path)
+    except OSError as err:
+        raise ControlDirError("Cannot access ssh control directory \"%s\": "
+                              "%s." % (path, err.strerror))
+    if not stat.S_ISDIR(st.st_mode):
+        raise ControlDirError("ssh control directory \"%s\" is not a "
+                              "directory." % path)
+    if st.st_uid != os.geteuid():
+        raise ControlDirError("ssh control directory \"%s\" is owned by "
+                              "another user." % path)
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise ControlDirError("ssh control directory \"%s\" is writable by "
+                              "other users." % path)
+
+
+class _Master(object):
+    """Holds the state of a single ssh master connection."""
+
+    def __init__(self, host, ssh_args, path):
+        self.host = host
+        self.ssh_args = list(ssh_args)
+        self.path = path
+        self.alive = False
+        self.started = 0
+        self.checked = 0
+        self.users = 0
+        # held while the connection is started, checked or stopped
+        self.lock = threading.Lock()
@@ -0,0 +1,307 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module verifies snapshots against their sources by comparing checksums.
+
+As unchanged files are hardlinked between snapshots, a file only has to be
+checked once: every inode that was already verified in an earlier snapshot
+inherits the earlier verdict. The verdicts are recorded in the state directory
+of the repository, one file per snapshot, containing a line
+"<inode> <size> <mtime_ns> <verdict>" for every verified inode. Inode numbers
+are reused once files are removed, so verdicts are only inherited from
+snapshots that still exist, and only by inodes with the same size and
+modification time. The verdicts of a snapshot are removed with it.
+
+Snapshots of the "reflink" backend give every file a new inode, so there a
+file inherits the verdict of the file at the same path in the earlier
+snapshot, again only if its size and modification time are the same.
+"""
+
+import concurrent.futures
+import hashlib
+import logging
+import os
+import random
+import stat
+import time
+
+from . import constants as const
+from . import repository
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+
+
+class Verdicts(object):
+    OK = "ok"
+    MISMATCH = "mismatch"
+    # the source changed after the snapshot was taken or is gone, so nothing
+    # can be said about the snapshot
+    CHANGED = "changed"
+
+
+class VerifyResult(object):
+    """Holds the outcome of the verification of a snapshot."""
+
+    def __init__(self):
+        self.files = 0
+        self.hashed_files = 0
+        self.hashed_bytes = 0
+        self.inherited = 0
+        self.skipped = 0
+        self.changed = 0
+        self.mismatches = []
+        self.seconds = 0
+
+    @property
+    def ok(self):
+        return len(self.mismatches) == 0
+
+    def get_throughput(self):
+        """
+        :returns: A tuple of the hashed gigabytes per second and the checked
+        files per second.
+        :rtype: tuple
+        """
+        seconds = max(self.seconds, 1e-6)
+        return (self.hashed_bytes / seconds / 1e9, self.files / seconds)
+
+
+def verify_snapshot(repo, snapshot, workers=4, sample=1.0):
+    """
+    Verifies a snapshot against the local sources of its repository.
+    :param repo: The repository the snapshot belongs to.
+    :type repo: repository.Repository instance
+    :param snapshot: The name of the snapshot.
+    :type snapshot: string
+    :param workers: The count of threads used for checksumming.
+    :type workers: int
+    :param sample: The fraction of new inodes that will be checked, between 0
+    and 1. Inodes that are not checked get no verdict and will be candidates
+    again in the next verification.
+    :type sample: float
+    :returns: The result of the verification.
+    :rtype: VerifyResult instance
+    """
+    result = VerifyResult()
+    start = time.time()
+    (previous, known) = _load_previous_verdicts(repo.destination, snapshot)
+    by_path = repo.backend == "reflink" and previous is not None
+    folder = os.path.join(repo.destination, repo.resolve(snapshot))
+    verdicts = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for (source_root, snapshot_root) in \
+                repo.get_source_paths(snapshot):
+            for (path, st) in _walk_files(snapshot_root):
+                result.files += 1
+                if st.st_ino in verdicts:
+                    continue
+                if by_path:
+                    record = known.get(_get_inode(os.path.join(
+                        repo.destination, previous,
+                        os.path.relpath(path, folder))))
+                else:
+                    record = known.get(st.st_ino)
+                if (record is not None and record[0] == st.st_size and
+                        record[1] == st.st_mtime_ns):
+                    verdicts[st.st_ino] = record
+                    result.inherited += 1
+                    if record[2] == Verdicts.MISMATCH:
+                        result.mismatches.append(path)
+                    continue
+                if sample < 1 and random.random() >= sample:
+                    result.skipped += 1
+                    continue
+                if path == snapshot_root:
+                    source = source_root
+                else:
+                    source = os.path.join(
+                        source_root, os.path.relpath(path, snapshot_root))
+                # a placeholder, so hardlinks within this snapshot are not
+                # checked twice
+                verdicts[st.st_ino] = None
+                future = pool.submit(_check_file, path, st, source)
+                pending[future] = (path, st)
+                if len(pending) >= workers * 64:
+                    _collect(pending, verdicts, result, wait_all=False)
+        _collect(pending, verdicts, result, wait_all=True)
+
+    result.seconds = time.time() - start
+    _save_verdicts(repo.destination, snapshot, verdicts)
+    return result
+
+
+def _collect(pending, verdicts, result, wait_all):
+    if wait_all:
+        done = list(pending.keys())
+    else:
+        (done, _) = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+    for future in done:
+        (path, st) = pending.pop(future)
+        verdict = future.result()
+        if verdict == Verdicts.CHANGED:
+            # no verdict is recorded, so the inode will be checked again the
+            # next time
+            result.changed += 1
+            continue
+        verdicts[st.st_ino] = (st.st_size, st.st_mtime_ns, verdict)
+        result.hashed_files += 1
+        result.hashed_bytes += st.st_size
+        if verdict == Verdicts.MISMATCH:
+            logger.warning("Checksum mismatch: \"%s\".", path)
+            result.mismatches.append(path)
+
+
+def _check_file(path, st, source):
+    try:
+        source_st = os.stat(source, follow_symlinks=False)
+    except FileNotFoundError:
+        return Verdicts.CHANGED
+    # rsync preserves the modification time, so a different one means the
+    # source changed after the snapshot
+    if (source_st.st_size != st.st_size or
+            int(source_st.st_mtime) != int(st.st_mtime)):
+        return Verdicts.CHANGED
+    if _hash_file(path) == _hash_file(source):
+        return Verdicts.OK
+    return Verdicts.MISMATCH
+
+
+def _get_inode(path):
+    try:
+        return os.stat(path, follow_symlinks=False).st_ino
+    except OSError:
+        return None
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb", buffering=0) as fileobj:
+        while True:
+            data = fileobj.read(READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.digest()
+
+
+def _walk_files(top):
+    """
+    Yields (path, stat result) tuples of all regular files below top, without
+    following symlinks.
+    """
+    if not os.path.lexists(top):
+        return
+    st = os.stat(top, follow_symlinks=False)
+    if stat.S_ISREG(st.st_mode):
+        yield (top, st)
+        return
+    stack = [top]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as err:
+            logger.warning("Cannot read \"%s\": %s", directory, err)
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield (entry.path, entry.stat(follow_symlinks=False))
+
+
+def get_verdicts_dir(destination):
+    return os.path.join(destination, const.STATE_DIR_NAME,
+                        const.VERIFY_DIR_NAME)
+
+
+def _load_previous_verdicts(destination, snapshot):
+    """
+    Loads the verdicts of the newest snapshot verified before the given one
+    that still exists. Snapshot names sort by time within a repository, as
+    they start with the repository name followed by the timestamp.
+    :returns: The name of the snapshot, or None if there is none, and its
+    (size, mtime_ns, verdict) tuples by inode.
+    :rtype: tuple
+    """
+    directory = get_verdicts_dir(destination)
+    if not os.path.isdir(directory):
+        return (None, {})
+    # the inodes of removed or archived snapshots may belong to other files
+    # by now
+    older = [name for name in os.listdir(directory)
+             if name.endswith(repository.BACKUP_SUFFIX) and
+             _snapshot_key(name) < _snapshot_key(snapshot) and
+             os.path.isdir(os.path.join(destination, name))]
+    if len(older) == 0:
+        return (None, {})
+    previous = max(older, key=_snapshot_key)
+    verdicts = {}
+    with open(os.path.join(directory, previous)) as records:
+        for line in records:
+            fields = line.split()
+            if len(fields) != 4:
+                # recorded without size and modification time
+                continue
+            verdicts[int(fields[0])] = (int(fields[1]), int(fields[2]),
+                                        fields[3])
+    return (previous, verdicts)
+
+
+def _snapshot_key(name):
+    return name.split("_")[1]
+
+
+def _save_verdicts(destination, snapshot, verdicts):
+    directory = get_verdicts_dir(destination)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, snapshot)
+    # write to a temporary file first, so an interrupted run never leaves a
+    # truncated record behind
+    with open(path + ".tmp", "w") as records:
+        for (inode, record) in verdicts.items():
+            if record is not None:
+                records.write("%s %s %s %s\n" % ((inode,) + record))
+    os.rename(path + ".tmp", path)
+
+
+def remove_verdicts(destination, name):
+    """
+    Removes the verdicts of a snapshot, if there are any.
+    """
+    path = os.path.join(get_verdicts_dir(destination), name)
+    if os.path.lexists(path):
+        os.unlink(path)
+
+
+def rename_verdicts(destination, old_name, new_name):
+    """
+    Moves the verdicts of a snapshot to another snapshot, when the folder of
+    the snapshot is taken over by the other one.
+    """
+    path = os.path.join(get_verdicts_dir(destination), old_name)
+    if os.path.lexists(path):
+        os.rename(path, os.path.join(get_verdicts_dir(destination),
+                                     new_name))
@@ -0,0 +1,138 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import rbackupd.catalog as catalog
+import rbackupd.repository as repository
+
+FIRST = "task_2013-01-01T00:00:00_daily.snapshot"
+SECOND = "task_2013-01-02T00:00:00_daily.snapshot"
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.destination = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.destination, FIRST))
+        os.mkdir(os.path.join(self.destination, "unrelated"))
+        self.catalog = self._open()
+
+    def tearDown(self):
+        shutil.rmtree(self.destination)
+
+    def _open(self):
+        return catalog.Catalog(self.destination,
+                               repository.is_backup_folder)
+
+    def test_scan(self):
+        self.assertEqual(self.catalog.get_names(), [FIRST])
+        self.assertTrue(os.path.exists(self.catalog.path))
+
+    def test_new_snapshot_is_found(self):
+        self.catalog.get_names()
+        os.mkdir(os.path.join(self.destination, SECOND))
+        self.assertEqual(self.catalog.get_names(), [FIRST, SECOND])
+
+    def test_vanished_snapshot_is_removed(self):
+        self.catalog.get_names()
+        os.rmdir(os.path.join(self.destination, FIRST))
+        self.assertEqual(self.catalog.get_names(), [])
+
+    def test_attributes_are_persistent(self):
+        self.catalog.add(FIRST, size=42)
+        self.catalog.remove("unknown")
+        self.assertEqual(self._open().get(FIRST), {"size": 42})
+
+    def test_truncated_line_is_ignored(self):
+        self.catalog.add(FIRST, size=42)
+        with open(self.catalog.path, "a") as journal:
+            journal.write('{"op": "add", "na')
+        self.assertEqual(self._open().get(FIRST), {"size": 42})
+
+    def test_aliases(self):
+        alias = "task_2013-01-01T00:00:00_weekly.snapshot"
+        self.catalog.add(alias, alias=FIRST)
+        os.mkdir(os.path.join(self.destination, SECOND))
+        self.assertEqual(self._open().get_names(), [FIRST, alias, SECOND])
+        self.assertEqual(self.catalog.resolve(alias), FIRST)
+        self.assertEqual(self.catalog.resolve(SECOND), SECOND)
+        # aliases vanish with the snapshot they point to
+        os.rmdir(os.path.join(self.destination, FIRST))
+        self.assertEqual(self.catalog.get_names(), [SECOND])
+
+    def test_replace_keeps_position(self):
+        alias = "task_2013-01-01T00:00:00_weekly.snapshot"
+        self.catalog.add(FIRST, stats={"bytes": 1})
+        self.catalog.add(alias, alias=FIRST)
+        os.mkdir(os.path.join(self.destination, SECOND))
+        self.catalog.add(SECOND, stats={"bytes": 2})
+        # what materializing the alias does
+        os.rename(os.path.join(self.destination, FIRST),
+                  os.path.join(self.destination, alias))
+        self.catalog.replace(alias, stats={"bytes": 1})
+        self.catalog.remove(FIRST)
+        for snapshots in (self.catalog, self._open()):
+            self.assertEqual(snapshots.get_names(), [alias, SECOND])
+            self.assertEqual(snapshots.get(alias), {"stats": {"bytes": 1}})
+            self.assertEqual(snapshots.get_latest("stats"), {"bytes": 2})
+
+    def test_concurrent_writers(self):
+        self.catalog.add(FIRST, stats={"bytes": 1})
+
+        def write(i):
+            # every writer has its own catalog, like another thread or a
+            # command, and changes the destination, which makes the others
+            # compact the journal
+            snapshots = self._open()
+            for j in range(20):
+                name = "task_2013-02-%02dT00:%02d:00_daily.snapshot" % (
+                    i + 1, j)
+                os.mkdir(os.path.join(self.destination, name))
+                snapshots.add(name, alias=FIRST)
+                snapshots.get_names()
+
+        threads = [threading.Thread(target=write, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        entries = self._open().get_entries()
+        self.assertEqual(len(entries), 81)
+        self.assertEqual(entries[FIRST], {"stats": {"bytes": 1}})
+        self.assertTrue(all(attributes.get("alias") == FIRST
+                            for (name, attributes) in entries.items()
+                            if name != FIRST))
+        self.assertEqual([name for name in os.listdir(
+            os.path.dirname(self.catalog.path)) if name.endswith(".tmp")],
+            [])
+
+    def test_read_only(self):
+        self.catalog.get_names()
+        os.mkdir(os.path.join(self.destination, SECOND))
+        signature = self.catalog._get_signature()
+        snapshots = catalog.Catalog(self.destination,
+                                    repository.is_backup_folder,
+                                    read_only=True)
+        self.assertEqual(snapshots.get_names(), [FIRST, SECOND])
+        self.assertEqual(self.catalog._get_signature(), signature)
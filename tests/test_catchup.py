@@ -0,0 +1,84 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import rbackupd.catchup as catchup
+import rbackupd.repository as repository
+
+NOW = datetime.datetime(2013, 1, 10, 12, 30)
+WINDOW = datetime.timedelta(minutes=15)
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.destination = tempfile.mkdtemp()
+        for name in ("task_2013-01-10T10:00:00_hourly.snapshot",
+                     "task_2013-01-09T00:00:00_daily.snapshot",
+                     "task_2013-01-07T00:00:00_weekly.snapshot"):
+            os.mkdir(os.path.join(self.destination, name))
+        intervals = collections.OrderedDict()
+        intervals["hourly"] = "0 * * * * *"
+        intervals["daily"] = "0 0 * * * *"
+        intervals["weekly"] = "0 0 * * * MON"
+        intervals["monthly"] = "0 0 1 * * *"
+        self.repo = repository.Repository(
+            ["/source"], self.destination, "task", intervals, {}, {}, None,
+            None, ["-a"], [], None)
+
+    def tearDown(self):
+        shutil.rmtree(self.destination)
+
+    def test_immediate(self):
+        plan = catchup.plan_catchup(self.repo, NOW,
+                                    catchup.Policies.IMMEDIATE, WINDOW)
+        # the weekday field is ignored by the cron engine, so "weekly" runs
+        # daily here
+        self.assertEqual(list(plan.missed.items()),
+                         [("hourly", 2), ("daily", 1), ("weekly", 3),
+                          ("monthly", 1)])
+        self.assertEqual(plan.skipped, [])
+        self.assertTrue(plan.is_due(NOW))
+
+    def test_next(self):
+        plan = catchup.plan_catchup(self.repo, NOW, catchup.Policies.NEXT,
+                                    WINDOW)
+        # intervals without any snapshot are caught up anyway
+        self.assertEqual(list(plan.missed.keys()), ["monthly"])
+        self.assertEqual(plan.skipped, ["hourly", "daily", "weekly"])
+        for interval_name in plan.skipped:
+            self.repo.skip_occurences(interval_name,
+                                      datetime.datetime.now())
+        necessary = [name for (name, _) in
+                     self.repo.get_necessary_backups()]
+        self.assertEqual(necessary, ["monthly"])
+
+    def test_jitter(self):
+        plan = catchup.plan_catchup(self.repo, NOW, catchup.Policies.JITTER,
+                                    WINDOW)
+        self.assertTrue(NOW <= plan.due < NOW + WINDOW)
+        self.assertEqual(catchup.get_jitter("task", WINDOW),
+                         catchup.get_jitter("task", WINDOW))
+        self.assertEqual(catchup.get_jitter("task", datetime.timedelta(0)),
+                         datetime.timedelta(0))
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 
 import config
@@ -6,7 +9,35 @@ import config
 class Tests(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "test.conf")
+        with open(self.path, "w") as conf:
+            conf.write("[task]\n"
+                       "name = \"a\"\n"
+                       "[other]\n"
+                       "[task]\n"
+                       "name = \"b\"\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
 
     def test_nonexistent_file(self):
         self.assertRaises(IOError, config.Config, "/does/not/exist")
+        self.assertRaises(IOError, config.load, "/does/not/exist")
+
+    def test_get_sections(self):
+        conf = config.Config(self.path)
+        self.assertEqual([section["name"] for section in
+                          conf.get_sections("task")], [["a"], ["b"]])
+        self.assertEqual(conf.get_sections("missing"), [None])
+
+    def test_load_is_cached(self):
+        self.assertIs(config.load(self.path), config.load(self.path))
+
+    def test_load_parses_changed_file(self):
+        old = config.load(self.path)
+        with open(self.path, "a") as conf:
+            conf.write("[task]\nname = \"c\"\n")
+        new = config.load(self.path)
+        self.assertIsNot(old, new)
+        self.assertEqual(len(new.get_sections("task")), 3)
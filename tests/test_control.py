@@ -0,0 +1,115 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import datetime
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import rbackupd.control as control
+import rbackupd.repository as repository
+
+SNAPSHOT = "task_2013-01-01T00:00:00_daily.snapshot"
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.destination = os.path.join(self.tmpdir, "destination")
+        os.makedirs(os.path.join(self.destination, SNAPSHOT))
+        self.repo = repository.Repository(
+            ["/source"], self.destination, "task",
+            collections.OrderedDict(daily="0 0 * * * *",
+                                    weekly="0 0 * * * 1"),
+            {}, {}, None, None, ["-a"], [], None)
+        self.controller = control.Controller()
+        self.controller.set_tasks(["task", "other"])
+        self.controller.update(self.repo, datetime.datetime(2013, 1, 2))
+        self.path = os.path.join(self.tmpdir, "control.sock")
+        self.server = control.ControlServer(self.path, self.controller)
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _request(self, command, **arguments):
+        return control.send_request(self.path, command, **arguments)
+
+    def test_status(self):
+        self.assertEqual(os.stat(self.path).st_mode & 0o077, 0)
+        self.controller.start("task")
+        self.controller.finish("task", "created", SNAPSHOT)
+        (task, other) = self._request("status")
+        self.assertEqual(task["name"], "task")
+        self.assertEqual(task["status"], "idle")
+        self.assertEqual(task["next"], "2013-01-02T00:00:00")
+        self.assertEqual(task["last"]["result"], "created")
+        self.assertEqual(task["last"]["snapshot"], SNAPSHOT)
+        self.assertEqual(task["snapshots"], 1)
+        self.assertGreater(task["lag"], 0)
+        self.assertEqual(other["status"], "unavailable")
+        self.assertIsNone(other["last"])
+        self.assertIsNone(other["lag"])
+
+    def test_trigger_and_pause(self):
+        self.assertEqual(self._request("trigger", task="task"), "daily")
+        self.assertEqual(self._request("trigger", task="task",
+                                       interval="weekly"), "weekly")
+        self.assertTrue(self._request("status")[0]["triggered"])
+        self.assertEqual(self.controller.pop_trigger("task"), "weekly")
+        self.assertIsNone(self.controller.pop_trigger("task"))
+        with self.assertRaises(control.ControlError):
+            self._request("trigger", task="other")
+
+        self._request("pause", task="task")
+        self.assertTrue(self.controller.is_paused("task"))
+        self.assertEqual(self._request("status")[0]["status"], "paused")
+        self._request("resume", task="task")
+        self.assertFalse(self.controller.is_paused("task"))
+
+    def test_snapshots(self):
+        snapshots = self._request("snapshots", task="task")
+        self.assertEqual(snapshots, [{"name": SNAPSHOT,
+                                      "date": "2013-01-01T00:00:00",
+                                      "interval": "daily",
+                                      "archived": False}])
+        self.assertEqual(self._request("snapshots", task="task",
+                                       interval="weekly"), [])
+
+    def test_errors(self):
+        with self.assertRaises(control.ControlError):
+            self._request("unknown")
+        with self.assertRaises(control.ControlError):
+            self._request("pause", task="unknown")
+        with self.assertRaises(control.ControlError):
+            self._request("cancel", task="task")
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.path)
+            client.sendall(b"not json\n[]\n")
+            with client.makefile("rb") as stream:
+                self.assertIn(b"Invalid request", stream.readline())
+                self.assertIn(b"not an object", stream.readline())
+        finally:
+            client.close()
+        # the server keeps running
+        self.assertEqual(len(self._request("status")), 2)
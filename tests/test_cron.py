@@ -120,3 +120,46 @@ class Tests(unittest.TestCase):
         for d in self.d_all:
             self.assertEqual(self.c1.has_occured_between(d, d),
                              self.c1.matches(d))
+
+    def test_occurences_between(self):
+        occurences = self.c1.get_occurences_between(
+            datetime.datetime(2012, 6, 5, 10, 1),
+            datetime.datetime(2012, 6, 5, 12, 30))
+        self.assertEqual(occurences,
+                         [datetime.datetime(2012, 6, 5, 11, 1),
+                          datetime.datetime(2012, 6, 5, 12, 1)])
+
+    def test_occurences_between_match_all(self):
+        for (d1, d2) in zip(self.d_out_lo, self.d_in_any):
+            for occurence in self.c1.get_occurences_between(d1, d2):
+                self.assertTrue(self.c1.matches(occurence))
+                self.assertTrue(d1 < occurence <= d2)
+
+    def test_occurences_between_limit(self):
+        occurences = self.c1.get_occurences_between(self.d_out_lo[0],
+                                                    self.d_in_hi, limit=3)
+        self.assertEqual(len(occurences), 3)
+        self.assertEqual(occurences[-1], self.d_in_hi)
+
+    def test_occurences_between_outside(self):
+        self.assertEqual(
+            self.c1.get_occurences_between(self.d_out_lo[0],
+                                           self.d_out_lo[1]), [])
+
+    def test_next_occurence(self):
+        self.assertEqual(
+            self.c1.get_next_occurence(datetime.datetime(2012, 6, 5, 10, 1)),
+            datetime.datetime(2012, 6, 5, 11, 1))
+        self.assertEqual(
+            self.c1.get_next_occurence(datetime.datetime(2012, 8, 20)),
+            datetime.datetime(2012, 11, 5, 10, 1))
+        for d in self.d_out_lo:
+            self.assertEqual(self.c1.get_next_occurence(d), self.d_in_lo)
+        for d in self.d_out_hi:
+            self.assertIsNone(self.c1.get_next_occurence(d))
+
+    def test_next_occurence_skips_short_months(self):
+        cronjob = cron.Cronjob("0 0 31 * * *")
+        self.assertEqual(
+            cronjob.get_next_occurence(datetime.datetime(2013, 1, 31)),
+            datetime.datetime(2013, 3, 31))
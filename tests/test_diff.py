@@ -0,0 +1,88 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rbackupd
+import rbackupd.diff as diff
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.old = os.path.join(self.tmpdir, "old")
+        self.new = os.path.join(self.tmpdir, "new")
+        os.makedirs(os.path.join(self.old, "dir", "sub"))
+        for name in ("same", "changed", "removed", "chmod", "dir/sub/file"):
+            with open(os.path.join(self.old, name), "w") as old_file:
+                old_file.write(name)
+        shutil.copytree(self.old, self.new, copy_function=os.link)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _diff(self):
+        return [(change.status, change.path) for change in
+                diff.diff_trees(self.old, self.new, workers=2)]
+
+    def test_identical(self):
+        self.assertEqual(self._diff(), [])
+
+    def test_changes(self):
+        os.remove(os.path.join(self.new, "changed"))
+        with open(os.path.join(self.new, "changed"), "w") as changed:
+            changed.write("new content")
+        os.remove(os.path.join(self.new, "removed"))
+        os.remove(os.path.join(self.new, "chmod"))
+        shutil.copy2(os.path.join(self.old, "chmod"),
+                     os.path.join(self.new, "chmod"))
+        os.chmod(os.path.join(self.new, "chmod"), 0o600)
+        os.makedirs(os.path.join(self.new, "added", "deeper"))
+        self.assertEqual(self._diff(), [
+            (diff.ADDED, "added"),
+            (diff.MODIFIED, "changed"),
+            (diff.METADATA, "chmod"),
+            (diff.REMOVED, "removed"),
+            (diff.ADDED, "added/deeper"),
+        ])
+
+    def test_removed_directory(self):
+        shutil.rmtree(os.path.join(self.new, "dir"))
+        self.assertEqual(self._diff(), [
+            (diff.REMOVED, "dir"),
+            (diff.REMOVED, "dir/sub"),
+            (diff.REMOVED, "dir/sub/file"),
+        ])
+
+    def test_same_directory_is_skipped(self):
+        shutil.rmtree(self.new)
+        os.symlink(self.old, self.new)
+        self.assertEqual(self._diff(), [])
+
+    def test_reflink_snapshot(self):
+        # the "reflink" backend gives every file a new inode
+        shutil.rmtree(self.new)
+        rbackupd.clone_snapshot(self.old, self.new, None)
+        self.assertEqual(self._diff(), [])
+        with open(os.path.join(self.new, "changed"), "w") as changed:
+            changed.write("new content")
+        self.assertEqual(self._diff(), [(diff.MODIFIED, "changed")])
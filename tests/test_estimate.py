@@ -0,0 +1,76 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rbackupd.estimate as estimate
+import rbackupd.filters as filters
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, "home")
+        for (path, size) in [("user/docs/a.txt", 100),
+                             ("user/docs/b.txt", 200),
+                             ("user/music/c.mp3", 5000),
+                             ("user/.cache/d", 9000),
+                             ("user/e.o", 50),
+                             ("top", 7)]:
+            path = os.path.join(self.source, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write(b"x" * size)
+        os.symlink("docs", os.path.join(self.source, "user", "link"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_scan(self):
+        matcher = filters.compile_args(["--exclude", "/home/user/.cache",
+                                        "--exclude", "*.o"])
+        result = estimate.scan([self.source, "host:/remote"], matcher,
+                               workers=2)
+        self.assertEqual(result.files, 5)
+        self.assertEqual(result.bytes, 5307)
+        self.assertEqual(result.excluded, 2)
+        self.assertEqual(result.errors, 0)
+        self.assertEqual(result.directories, 4)
+        self.assertEqual(result.skipped, ["host:/remote"])
+        user = os.path.join(self.source, "user")
+        self.assertEqual(result.get_biggest(2),
+                         [(user, 5300, 4),
+                          (os.path.join(user, "music"), 5000, 1)])
+
+    def test_transfer_paths(self):
+        # with a trailing slash, the content of the source is transferred,
+        # so "/home" refers to a directory inside it
+        matcher = filters.compile_args(["--exclude", "/home"])
+        self.assertEqual(estimate.scan([self.source], matcher).files, 0)
+        self.assertEqual(estimate.scan([self.source + "/"],
+                                       matcher).files, 7)
+        (local, remote) = estimate.get_transfer_paths(
+            ["/srv/./data/", "/var/log"], ["-aR"])
+        self.assertEqual(local, [("/srv/./data", "data"),
+                                 ("/var/log", "var/log")])
+        self.assertEqual(remote, [])
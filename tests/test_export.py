@@ -0,0 +1,97 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import rbackupd.export as export
+import rbackupd.packs as packs
+
+SNAPSHOT = "task_2013-01-01T00:00:00_daily.snapshot"
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.destination = tempfile.mkdtemp()
+        self.root = os.path.join(self.destination, SNAPSHOT)
+        os.makedirs(os.path.join(self.root, "home", "user"))
+        with open(os.path.join(self.root, "home", "user", "file"),
+                  "wb") as f:
+            f.write(b"content" * 1000)
+        os.link(os.path.join(self.root, "home", "user", "file"),
+                os.path.join(self.root, "home", "link"))
+        os.symlink("user/file", os.path.join(self.root, "home", "symlink"))
+        os.utime(os.path.join(self.root, "home", "user", "file"),
+                 ns=(0, 1234567890123456789))
+
+    def tearDown(self):
+        shutil.rmtree(self.destination)
+
+    def _read_archive(self, data, mode="r|"):
+        members = {}
+        with tarfile.open(fileobj=io.BytesIO(data), mode=mode) as tar:
+            for info in tar:
+                content = None
+                if info.isreg():
+                    content = tar.extractfile(info).read()
+                members[info.name] = (info, content)
+        return members
+
+    def _check_archive(self, members):
+        self.assertEqual(sorted(members.keys()),
+                         ["home", "home/link", "home/symlink", "home/user",
+                          "home/user/file"])
+        # the first link in the order of the archive holds the contents
+        (link, _) = members["home/user/file"]
+        self.assertTrue(link.islnk())
+        self.assertEqual(link.linkname, "home/link")
+        (info, content) = members["home/link"]
+        self.assertEqual(content, b"content" * 1000)
+        self.assertAlmostEqual(info.mtime, 1234567890.123456789, places=5)
+        self.assertEqual(members["home/symlink"][0].linkname, "user/file")
+
+    def test_export_tree(self):
+        output = io.BytesIO()
+        result = export.export_tree(self.root, output)
+        self.assertEqual(result.files, 3)
+        self.assertEqual(result.bytes, 7000)
+        self._check_archive(self._read_archive(output.getvalue()))
+
+    def test_export_subtree_compressed(self):
+        output = io.BytesIO()
+        export.export_tree(os.path.join(self.root, "home", "user"), output,
+                           "home/user", compression="xz")
+        members = self._read_archive(output.getvalue(), mode="r|xz")
+        self.assertEqual(sorted(members.keys()),
+                         ["home/user", "home/user/file"])
+
+    def test_export_pack(self):
+        store = packs.PackStore(self.destination)
+        store.pack(SNAPSHOT, "gzip")
+        reader = store.open(SNAPSHOT)
+        output = io.BytesIO()
+        try:
+            export.export_pack(reader, "", output)
+        finally:
+            reader.close()
+        self._check_archive(self._read_archive(output.getvalue()))
@@ -0,0 +1,118 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rbackupd.filters as filters
+import rbackupd.rsync as rsync
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, lines):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+    def test_patterns(self):
+        cases = [
+            # (pattern, path, is_dir, matches)
+            ("*.o", "src/main.o", False, True),
+            ("*.o", "src/main.c", False, False),
+            ("cache", "home/user/cache", True, True),
+            ("cache", "home/user/cache", False, True),
+            ("cache/", "home/user/cache", False, False),
+            ("cache/", "home/user/cache", True, True),
+            ("/home", "home", True, True),
+            ("/home", "srv/home", True, False),
+            ("user/cache", "home/user/cache", True, True),
+            ("user/cache", "home/otheruser/cache", True, False),
+            ("home/*", "home/user/cache", True, False),
+            ("home/**", "home/user/cache", True, True),
+            ("/home/*/.cache", "home/user/.cache", True, True),
+            ("file?.txt", "file1.txt", False, True),
+            ("file?.txt", "file10.txt", False, False),
+            ("[ab]*", "dir/bfile", False, True),
+            ("[!ab]*", "dir/bfile", False, False),
+            ("\\*.txt", "*.txt", False, True),
+            ("\\*.txt", "a.txt", False, False),
+            ("/srv/***", "srv", True, True),
+            ("/srv/***", "srv/a/b", False, True),
+            ("/srv/***", "srvx", True, False),
+        ]
+        for (pattern, path, is_dir, matches) in cases:
+            rule = filters.Rule(False, pattern)
+            self.assertEqual(rule.matches(path, is_dir), matches,
+                             (pattern, path, is_dir))
+
+    def test_first_match_wins(self):
+        matcher = filters.compile_args(
+            ["--filter", "+ keep.log", "--filter", "- *.log",
+             "--include", "important", "--exclude", "important",
+             "--exclude", "*"])
+        self.assertTrue(matcher.is_included("a/keep.log", False))
+        self.assertFalse(matcher.is_included("a/other.log", False))
+        self.assertTrue(matcher.is_included("a/important", True))
+        self.assertFalse(matcher.is_included("a/file", False))
+        self.assertTrue(filters.Matcher([]).is_included("file", False))
+
+    def test_rule_syntax(self):
+        matcher = filters.compile_args(
+            ["--filter", "exclude tmp", "--filter", "-! */",
+             "--filter", "-/ /etc/shadow", "--filter", "P *.keep",
+             "--filter", "hide,s _old", "--filter", "-_*.bak"])
+        self.assertFalse(matcher.is_included("a/tmp", True))
+        # the negated rule excludes everything but directories
+        self.assertTrue(matcher.is_included("a/b", True))
+        self.assertFalse(matcher.is_included("a/b", False))
+        self.assertFalse(matcher.is_included("shadow", True, "/etc/shadow"))
+        self.assertTrue(matcher.is_included("shadow", True, "/srv/shadow"))
+        self.assertFalse(matcher.is_included("x/_old", True))
+        self.assertFalse(matcher.is_included("x.bak", True))
+        for rule in [": .rsync-filter", "-C", "foo bar", "-e *.o"]:
+            with self.assertRaises(filters.FilterError):
+                filters.compile_args(["--filter", rule])
+
+    def test_clear_and_files(self):
+        include_file = self._write("include", ["# comment", "", "*.txt",
+                                               "- *.tmp"])
+        exclude_file = self._write("exclude", ["; comment", "*"])
+        merge_file = self._write("merge", ["+ *.c", "!", "- *.h"])
+        rsyncfilter = rsync.Filter(["*.md"], ["*.o"], [include_file],
+                                   [exclude_file], ["- *.txt", "!",
+                                                    ". " + merge_file])
+        matcher = filters.compile_filter(rsyncfilter)
+        self.assertEqual(len(matcher.rules), 6)
+        self.assertFalse(matcher.is_included("main.h", False))
+        self.assertTrue(matcher.is_included("readme.md", False))
+        self.assertTrue(matcher.is_included("notes.txt", False))
+        self.assertFalse(matcher.is_included("notes.tmp", False))
+        self.assertFalse(matcher.is_included("main.c", False))
+        with self.assertRaises(filters.FilterError):
+            filters.compile_args(["--exclude-from",
+                                  os.path.join(self.tmpdir, "missing")])
@@ -0,0 +1,159 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import rbackupd
+import rbackupd.history as history
+import rbackupd.repository as repository
+
+FIRST = "task_2013-01-01T00:00:00_daily.snapshot"
+SECOND = "task_2013-01-02T00:00:00_daily.snapshot"
+THIRD = "task_2013-01-03T00:00:00_daily.snapshot"
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.destination = os.path.join(self.tmpdir, "destination")
+        first = os.path.join(self.destination, FIRST, "source")
+        os.makedirs(os.path.join(first, "dir"))
+        for name in ("same", "changed", "removed", "dir/file"):
+            with open(os.path.join(first, name), "w") as snapshot_file:
+                snapshot_file.write(name)
+        self.repo = repository.Repository(
+            [os.path.join(self.tmpdir, "source")], self.destination, "task",
+            collections.OrderedDict(daily="0 0 * * * *"), {}, {}, None, None,
+            ["-a"], [], None)
+        self.index = history.HistoryIndex(self.destination)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _link_snapshot(self, old, new):
+        # what rsync --link-dest does with unchanged files
+        shutil.copytree(os.path.join(self.destination, old),
+                        os.path.join(self.destination, new),
+                        copy_function=os.link)
+        source = os.path.join(self.destination, new, "source")
+        os.remove(os.path.join(source, "changed"))
+        with open(os.path.join(source, "changed"), "w") as changed:
+            changed.write("new content")
+        if os.path.exists(os.path.join(source, "removed")):
+            os.remove(os.path.join(source, "removed"))
+
+    def _clone_snapshot(self, old, new):
+        # what the "reflink" backend does: unchanged files get new inodes
+        rbackupd.clone_snapshot(os.path.join(self.destination, old),
+                                os.path.join(self.destination, new), None)
+        with open(os.path.join(self.destination, new, "source", "changed"),
+                  "w") as changed:
+            changed.write("new content")
+
+    def _versions(self, path):
+        return self.index.get_versions(
+            history.get_relative_path(self.repo, path))
+
+    def test_history(self):
+        self._link_snapshot(FIRST, SECOND)
+        self._link_snapshot(SECOND, THIRD)
+        self.assertEqual(self.index.update(self.repo), [FIRST, SECOND, THIRD])
+
+        source = os.path.join(self.tmpdir, "source")
+        same = self._versions(os.path.join(source, "same"))
+        self.assertEqual(len(same), 1)
+        self.assertEqual(same[0].snapshots, [FIRST, SECOND, THIRD])
+        changed = self._versions(os.path.join(source, "changed"))
+        self.assertEqual([version.snapshots for version in changed],
+                         [[FIRST], [SECOND], [THIRD]])
+        self.assertEqual(changed[1].size, len("new content"))
+        removed = self._versions(os.path.join(source, "removed"))
+        self.assertEqual(removed[0].snapshots, [FIRST])
+        directory = self._versions(os.path.join(source, "dir"))
+        self.assertTrue(directory[0].is_directory)
+        self.assertEqual(self._versions(os.path.join(source, "unknown")), [])
+
+    def test_incremental_update(self):
+        self.index.update(self.repo)
+        self._link_snapshot(FIRST, SECOND)
+        self.assertEqual(self.index.update(self.repo), [SECOND])
+        self.assertEqual(self.index.update(self.repo), [])
+
+    def test_expired_snapshots_are_omitted(self):
+        self._link_snapshot(FIRST, SECOND)
+        self.index.update(self.repo)
+        versions = self.index.get_versions("source/same", existing=[SECOND])
+        self.assertEqual(versions[0].snapshots, [SECOND])
+        self.assertEqual(self.index.get_versions("source/removed",
+                                                 existing=[SECOND]), [])
+
+    def test_reflink_snapshots(self):
+        self.repo.backend = "reflink"
+        self._clone_snapshot(FIRST, SECOND)
+        self._clone_snapshot(SECOND, THIRD)
+        self.index.update(self.repo)
+        same = self.index.get_versions("source/same")
+        self.assertEqual([version.snapshots for version in same],
+                         [[FIRST, SECOND, THIRD]])
+        changed = self.index.get_versions("source/changed")
+        self.assertEqual([version.snapshots for version in changed],
+                         [[FIRST], [SECOND, THIRD]])
+
+    def test_claimed_snapshots(self):
+        self._link_snapshot(FIRST, SECOND)
+        self._link_snapshot(SECOND, THIRD)
+        claimed = []
+
+        def claim(destination, names):
+            claimed.append(names)
+            if SECOND in names:
+                # the snapshot expires before it is claimed
+                shutil.rmtree(os.path.join(self.destination, SECOND))
+            return lambda: None
+
+        self.assertEqual(self.index.update(self.repo, claim), [FIRST, THIRD])
+        self.assertEqual(claimed, [[FIRST, FIRST], [SECOND, SECOND],
+                                   [THIRD, THIRD]])
+        same = self.index.get_versions("source/same")
+        self.assertEqual(same[0].snapshots, [FIRST, THIRD])
+
+    def test_indexer(self):
+        self._link_snapshot(FIRST, SECOND)
+        task = unittest.mock.Mock()
+        task.name = "task"
+        with unittest.mock.patch.object(repository, "create",
+                                        return_value=self.repo):
+            indexer = history.Indexer()
+            try:
+                indexer.submit(task)
+                deadline = time.time() + 10
+                while (len(self.index.get_indexed_snapshots()) != 2 and
+                       time.time() < deadline):
+                    time.sleep(0.01)
+            finally:
+                indexer.close()
+        self.assertEqual(self.index.get_indexed_snapshots(), [FIRST, SECOND])
+        self.assertEqual(indexer.get_in_use(self.destination), set())
@@ -0,0 +1,134 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import rbackupd.lease as lease
+
+TASKS = ["task%d" % i for i in range(12)]
+
+
+def _claim_tasks(directory, destinations, instance, barrier, results):
+    cluster = lease.Cluster(directory, instance, 60)
+    cluster.start()
+    try:
+        # all instances have to be members before the tasks are assigned
+        barrier.wait()
+        owned = [name for name in TASKS
+                 if cluster.claim(name, destinations[name])]
+        results.put((instance, owned))
+        # the leases are held until every instance claimed its tasks
+        barrier.wait()
+    finally:
+        cluster.close()
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmpdir, "cluster")
+        self.destinations = dict((name, os.path.join(self.tmpdir, name))
+                                 for name in TASKS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _claim_all(self, cluster, busy=False):
+        return [name for name in TASKS
+                if cluster.claim(name, self.destinations[name], busy)]
+
+    def test_tasks_are_split(self):
+        first = lease.Cluster(self.directory, "first", 60)
+        first.start()
+        self.assertEqual(self._claim_all(first), TASKS)
+        second = lease.Cluster(self.directory, "second", 60)
+        second.start()
+        try:
+            self.assertEqual(first.get_members(), ["first", "second"])
+            # the leases of the first instance are still valid
+            self.assertEqual(self._claim_all(second), [])
+            kept = self._claim_all(first)
+            moved = self._claim_all(second)
+            self.assertNotEqual(kept, [])
+            self.assertNotEqual(moved, [])
+            self.assertEqual(sorted(kept + moved), sorted(TASKS))
+            for name in moved:
+                self.assertEqual(lease.get_owner(name, ["first", "second"]),
+                                 "second")
+        finally:
+            second.close()
+        # the tasks of an instance that left are taken over
+        self.assertEqual(self._claim_all(first), TASKS)
+        first.close()
+        owner = lease.Lease(self.destinations[TASKS[0]], "other", 60)
+        self.assertIsNone(owner.get_owner())
+
+    def test_expired_lease_is_taken_over(self):
+        destination = self.destinations[TASKS[0]]
+        stale = lease.Lease(destination, "crashed", 1)
+        self.assertTrue(stale.acquire())
+        cluster = lease.Cluster(self.directory, "instance", 60)
+        cluster.start()
+        try:
+            self.assertFalse(cluster.claim(TASKS[0], destination))
+            time.sleep(1.1)
+            self.assertTrue(cluster.claim(TASKS[0], destination))
+            self.assertEqual(stale.get_owner(), "instance")
+            self.assertFalse(stale.renew())
+        finally:
+            cluster.close()
+
+    def test_busy_lease_is_kept(self):
+        first = lease.Cluster(self.directory, "first", 60)
+        first.start()
+        self.assertEqual(self._claim_all(first), TASKS)
+        second = lease.Cluster(self.directory, "second", 60)
+        second.start()
+        try:
+            self.assertEqual(self._claim_all(first, busy=True), TASKS)
+            self.assertEqual(self._claim_all(second), [])
+        finally:
+            second.close()
+            first.close()
+
+    def test_processes(self):
+        count = 4
+        # forking a process with running threads may deadlock the children
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(count)
+        results = context.Queue()
+        processes = [context.Process(
+            target=_claim_tasks,
+            args=(self.directory, self.destinations, "instance%d" % i,
+                  barrier, results))
+            for i in range(count)]
+        for process in processes:
+            process.start()
+        owned = dict(results.get(timeout=30) for _ in processes)
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        claimed = [name for names in owned.values() for name in names]
+        self.assertEqual(sorted(claimed), sorted(TASKS))
+        self.assertEqual(os.listdir(self.directory), [])
@@ -0,0 +1,89 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import rbackupd.catalog as catalog
+import rbackupd.files as files
+import rbackupd.listing as listing
+import rbackupd.packs as packs
+import rbackupd.repository as repository
+
+ARCHIVED = "task_2013-01-01T00:00:00_daily.snapshot"
+FIRST = "task_2013-01-02T00:00:00_daily.snapshot"
+ALIAS = "task_2013-01-02T00:00:00_weekly.snapshot"
+SECOND = "task_2013-01-03T12:00:00_daily.snapshot"
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.destination = tempfile.mkdtemp()
+        for name in [ARCHIVED, SECOND, FIRST]:
+            os.mkdir(os.path.join(self.destination, name))
+        packs.PackStore(self.destination).pack(
+            ARCHIVED, "gzip", stats={"bytes": 500, "files": 5,
+                                     "seconds": 5})
+        files.remove_recursive(os.path.join(self.destination, ARCHIVED))
+        snapshots = catalog.Catalog(self.destination,
+                                    repository.is_backup_folder)
+        snapshots.add(SECOND, stats={"bytes": 3000, "files": 3,
+                                     "seconds": 30})
+        snapshots.add(FIRST, stats={"bytes": 1000, "files": 1,
+                                    "seconds": 10})
+        snapshots.add(ALIAS, alias=FIRST)
+
+    def tearDown(self):
+        shutil.rmtree(self.destination)
+
+    def test_list(self):
+        snapshots = listing.list_snapshots("task", self.destination)
+        self.assertEqual([snapshot.name for snapshot in snapshots],
+                         [ARCHIVED, FIRST, ALIAS, SECOND])
+        self.assertTrue(snapshots[0].archived)
+        self.assertEqual(snapshots[0].stats["bytes"], 500)
+        self.assertEqual(snapshots[2].alias, FIRST)
+        self.assertEqual(snapshots[3].to_json(), {
+            "task": "task", "name": SECOND, "interval": "daily",
+            "time": "2013-01-03T12:00:00", "archived": False,
+            "alias": None, "bytes": 3000, "files": 3, "seconds": 30})
+
+    def test_filters(self):
+        snapshots = listing.list_snapshots(
+            "task", self.destination, interval_name="daily",
+            since=datetime.datetime(2013, 1, 2),
+            until=datetime.datetime(2013, 1, 3, 12))
+        self.assertEqual([snapshot.name for snapshot in snapshots],
+                         [FIRST, SECOND])
+
+    def test_summarize(self):
+        summaries = listing.summarize(
+            listing.list_snapshots("task", self.destination))
+        self.assertEqual(summaries, [
+            {"task": "task", "interval": "daily", "snapshots": 3,
+             "archived": 1, "aliases": 0, "oldest": "2013-01-01T00:00:00",
+             "newest": "2013-01-03T12:00:00", "recorded": 3, "bytes": 4500,
+             "files": 9, "seconds": 45},
+            {"task": "task", "interval": "weekly", "snapshots": 1,
+             "archived": 0, "aliases": 1, "oldest": "2013-01-02T00:00:00",
+             "newest": "2013-01-02T00:00:00", "recorded": 0, "bytes": 0,
+             "files": 0, "seconds": 0}])
@@ -0,0 +1,100 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import rbackupd.filesystem as filesystem
+import rbackupd.mounts as mounts
+import rbackupd.settings as settings
+
+MOUNTINFO = """\
+22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw
+40 22 8:17 / /mnt/back\\040up rw,noexec master:2 - ext4 /dev/sdb1 rw,errors
+"""
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mountinfo = os.path.join(self.tmpdir, "mountinfo")
+        with open(self.mountinfo, "w") as mountinfo:
+            mountinfo.write(MOUNTINFO)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_mountinfo(self):
+        (root, backup) = filesystem.parse_mountinfo(MOUNTINFO.splitlines())
+        self.assertEqual(root.mountpoint, "/")
+        self.assertEqual(backup.mountpoint, "/mnt/back up")
+        self.assertEqual(backup.fstype, "ext4")
+        self.assertEqual(backup.source, "/dev/sdb1")
+        self.assertEqual(backup.options, ["rw", "noexec"])
+
+    def test_mount_table(self):
+        table = filesystem.MountTable(self.mountinfo)
+        try:
+            self.assertTrue(table.is_mountpoint("/mnt/back up"))
+            self.assertFalse(table.is_mountpoint("/mnt"))
+            self.assertEqual(table.get_mount("/mnt/back up/x").source,
+                             "/dev/sdb1")
+            self.assertEqual(table.get_mount("/usr").mountpoint, "/")
+        finally:
+            table.close()
+
+    def test_destination_availability(self):
+        table = filesystem.MountTable(self.mountinfo)
+        # the device of the partition, as the mount table is not real
+        device = os.path.join(self.tmpdir, "sdb1")
+        open(device, "w").close()
+        mounted = settings.MountSettings(
+            device, "/mnt/back up", None, ["rw"], ["ro"], False, None)
+        # a partition that is not attached will not be mounted
+        absent = settings.MountSettings(
+            os.path.join(self.tmpdir, "absent"), "/mnt/other", None, ["rw"],
+            ["ro"], False, None)
+        tracker = mounts.MountTracker([mounted, absent], table)
+        try:
+            tracker.update()
+            self.assertTrue(tracker.is_available("/mnt/back up/task"))
+            self.assertFalse(tracker.is_available("/mnt/other/task"))
+            self.assertTrue(tracker.is_available("/srv/task"))
+        finally:
+            tracker.close()
+
+    def test_stale_mount(self):
+        # a disk that was unplugged without unmounting it
+        stale = settings.MountSettings(
+            os.path.join(self.tmpdir, "sdb1"), "/mnt/back up", None, ["rw"],
+            ["ro"], False, None)
+        tracker = mounts.MountTracker(
+            [stale], filesystem.MountTable(self.mountinfo))
+        try:
+            self.assertFalse(tracker.is_available("/mnt/back up/task"))
+            with unittest.mock.patch.object(filesystem.Mountpoint,
+                                            "unmount") as unmount:
+                tracker.update()
+            unmount.assert_called_once_with(lazy=True)
+            self.assertFalse(tracker.is_available("/mnt/back up/task"))
+        finally:
+            tracker.close()
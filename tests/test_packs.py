@@ -0,0 +1,202 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import rbackupd
+import rbackupd.archive as archive
+import rbackupd.catalog as catalog
+import rbackupd.packs as packs
+import rbackupd.replicate as replicate
+import rbackupd.repository as repository
+import rbackupd.restore as restore
+
+OLD = "task_2013-01-01T00:00:00_daily.snapshot"
+NEW = "task_2013-01-02T00:00:00_daily.snapshot"
+LATEST = "task_2013-01-03T00:00:00_daily.snapshot"
+
+# small frames, so files span several frames and frames several files
+FRAME_SIZE = 1000
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.destination = tempfile.mkdtemp()
+        self.store = packs.PackStore(self.destination)
+        old = os.path.join(self.destination, OLD)
+        os.makedirs(os.path.join(old, "dir", "sub"))
+        os.mkdir(os.path.join(old, "empty"))
+        self._write(os.path.join(old, "dir", "big"),
+                    bytes(range(256)) * 20)
+        self._write(os.path.join(old, "dir", "sub", "small"), b"small")
+        self._write(os.path.join(old, "zero"), b"")
+        os.link(os.path.join(old, "dir", "big"), os.path.join(old, "link"))
+        os.symlink("dir/big", os.path.join(old, "symlink"))
+        os.chmod(os.path.join(old, "dir", "sub", "small"), 0o640)
+        os.utime(os.path.join(old, "zero"), (1000, 1000))
+
+    def tearDown(self):
+        shutil.rmtree(self.destination)
+
+    def _write(self, path, data):
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def _read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_pack_and_restore(self):
+        result = self.store.pack(OLD, "xz", frame_size=FRAME_SIZE)
+        self.assertEqual(result.files, 4)
+        self.assertEqual(result.bytes, 5125)
+        self.assertEqual(self.store.get_names(), [OLD])
+
+        target = os.path.join(self.destination, "restored")
+        reader = self.store.open(OLD)
+        try:
+            result = restore.copy_from_pack(reader, "", target)
+        finally:
+            reader.close()
+        self.assertEqual(result.files, 5)
+        old = os.path.join(self.destination, OLD)
+        self.assertEqual(replicate.compute_merkle(old),
+                         replicate.compute_merkle(target))
+        self.assertEqual(self._read(os.path.join(target, "dir", "big")),
+                         self._read(os.path.join(old, "dir", "big")))
+        self.assertEqual(os.stat(os.path.join(target, "link")).st_ino,
+                         os.stat(os.path.join(target, "dir", "big")).st_ino)
+        self.assertEqual(os.readlink(os.path.join(target, "symlink")),
+                         "dir/big")
+
+    def test_restore_subtree(self):
+        self.store.pack(OLD, "gzip", frame_size=FRAME_SIZE)
+        target = os.path.join(self.destination, "restored")
+        reader = self.store.open(OLD)
+        try:
+            restore.copy_from_pack(reader, "dir/sub", target)
+            with self.assertRaises(FileExistsError):
+                restore.copy_from_pack(reader, "dir/sub", target)
+        finally:
+            reader.close()
+        self.assertEqual(os.listdir(target), ["small"])
+        self.assertEqual(self._read(os.path.join(target, "small")), b"small")
+
+    def test_reuse_and_garbage_collection(self):
+        old = os.path.join(self.destination, OLD)
+        new = os.path.join(self.destination, NEW)
+        os.makedirs(os.path.join(new, "dir", "sub"))
+        os.link(os.path.join(old, "dir", "big"),
+                os.path.join(new, "dir", "big"))
+        self._write(os.path.join(new, "dir", "sub", "small"), b"changed")
+        self.store.pack(OLD, "xz", frame_size=FRAME_SIZE)
+        reader = self.store.open(OLD)
+        try:
+            result = self.store.pack(NEW, "xz", previous=reader,
+                                     frame_size=FRAME_SIZE)
+        finally:
+            reader.close()
+        self.assertEqual(result.reused_files, 1)
+
+        # the contents of "big" are only stored in the pack of OLD
+        self.store.remove(OLD)
+        self.assertEqual(self.store.collect_garbage(), [])
+        shutil.rmtree(old)
+        reader = self.store.open(NEW)
+        try:
+            data = b"".join(reader.read(reader.get("dir/big")))
+        finally:
+            reader.close()
+        self.assertEqual(data, bytes(range(256)) * 20)
+        self.store.remove(NEW)
+        self.assertEqual(os.listdir(self.store.path), [packs.LOCK_NAME])
+
+    def test_reuse_by_path(self):
+        old = os.path.join(self.destination, OLD)
+        new = os.path.join(self.destination, NEW)
+        # the "reflink" backend gives every file a new inode
+        rbackupd.clone_snapshot(old, new, None)
+        self._write(os.path.join(new, "dir", "sub", "small"), b"changed")
+        self.store.pack(OLD, "xz", frame_size=FRAME_SIZE)
+        reader = self.store.open(OLD)
+        try:
+            by_inode = self.store.pack(NEW, "xz", previous=reader,
+                                       frame_size=FRAME_SIZE)
+            self.store.remove(NEW)
+            by_path = self.store.pack(NEW, "xz", previous=reader,
+                                      frame_size=FRAME_SIZE, by_path=True)
+        finally:
+            reader.close()
+        self.assertEqual(by_inode.reused_files, 0)
+        # "dir/big" and "zero", "link" is a hardlink to "dir/big"
+        self.assertEqual(by_path.reused_files, 2)
+        reader = self.store.open(NEW)
+        try:
+            self.assertEqual(b"".join(reader.read(reader.get("dir/big"))),
+                             bytes(range(256)) * 20)
+            self.assertEqual(b"".join(reader.read(
+                reader.get("dir/sub/small"))), b"changed")
+        finally:
+            reader.close()
+
+    def test_archived_snapshots_belong_to_repository(self):
+        os.mkdir(os.path.join(self.destination, LATEST))
+        repo = repository.Repository(
+            ["/source"], self.destination, "task",
+            collections.OrderedDict(daily="0 0 * * * *"), {}, {}, None, None,
+            ["-a"], [], None)
+        backups = repo.backups
+        self.assertEqual(
+            archive.get_candidates(backups, [],
+                                   datetime.datetime(2013, 1, 5)),
+            [OLD])
+        self.assertEqual(
+            archive.get_candidates(backups, [OLD],
+                                   datetime.datetime(2013, 1, 5)),
+            [])
+
+        self.store.pack(OLD, "xz")
+        shutil.rmtree(os.path.join(self.destination, OLD))
+        self.assertEqual(sorted(backup.name for backup in repo.backups),
+                         [OLD, LATEST])
+        self.assertTrue(repo.is_archived(OLD))
+        self.assertFalse(repo.is_archived(LATEST))
+
+    def test_archive_keeps_stats(self):
+        os.mkdir(os.path.join(self.destination, LATEST))
+        stats = {"bytes": 5125, "files": 4, "seconds": 1.5}
+        catalog.Catalog(self.destination, repository.is_backup_folder).add(
+            OLD, stats=stats)
+        task = unittest.mock.Mock(
+            destination=self.destination, snapshot_backend="hardlink",
+            archive_after=datetime.timedelta(days=1),
+            archive_compression="gzip")
+        task.name = "task"
+        archive.archive_snapshots(task)
+        self.assertFalse(os.path.exists(os.path.join(self.destination, OLD)))
+        self.assertEqual(self.store.get_stats(OLD), stats)
+        # the statistics belong to the target of an alias only
+        self.store.alias(NEW, OLD)
+        self.assertIsNone(self.store.get_stats(NEW))
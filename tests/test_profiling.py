@@ -0,0 +1,94 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import unittest
+
+import rbackupd.profiling as profiling
+
+
+def _work():
+    return sum(i * i for i in range(10000))
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _run_cycle(self):
+        profiling.begin_cycle()
+        with profiling.span("phase", task="task"):
+            _work()
+        thread = threading.Thread(target=self._in_thread, name="worker")
+        thread.start()
+        thread.join()
+        profiling.end_cycle(self.tmpdir)
+
+    def _in_thread(self):
+        with profiling.span("background"):
+            _work()
+
+    def test_inactive(self):
+        self.assertFalse(profiling.is_active())
+        with profiling.span("phase"):
+            pass
+        self._run_cycle()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_profile(self):
+        self.assertTrue(profiling.request(cycles=2, memory=True))
+        self.assertFalse(profiling.request())
+        self._run_cycle()
+        self.assertTrue(profiling.is_active())
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+        log_path = os.path.join(self.tmpdir, "log")
+        handler = profiling.SpanningFileHandler(log_path)
+        record = logging.LogRecord("rbackupd", logging.INFO, __file__, 0,
+                                   "message", None, None)
+        profiling.begin_cycle()
+        handler.handle(record)
+        handler.close()
+        profiling.end_cycle(self.tmpdir)
+        self.assertFalse(profiling.is_active())
+
+        names = sorted(os.listdir(self.tmpdir))
+        self.assertEqual(len(names), 4)
+        base = os.path.join(self.tmpdir, names[1][:-len(".memory.txt")])
+        stats = pstats.Stats(base + ".prof")
+        self.assertTrue(any(function == "_work"
+                            for (_, _, function) in stats.stats))
+        with open(base + ".trace.json") as f:
+            events = json.load(f)["traceEvents"]
+        spans = [event["name"] for event in events if event["ph"] == "X"]
+        self.assertEqual(sorted(spans), ["background", "cycle", "cycle",
+                                         "logging", "phase"])
+        threads = [event["args"]["name"] for event in events
+                   if event["ph"] == "M"]
+        self.assertIn("worker", threads)
+        self.assertTrue(os.path.getsize(base + ".memory.txt") > 0)
@@ -0,0 +1,90 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import rbackupd.progress as progress
+import rbackupd.rsync as rsync
+
+# prints what rsync prints with --info=progress2, ignoring all arguments
+FAKE_RSYNC = """#!/bin/sh
+printf '          1,024   0%%    0.00kB/s    0:00:00\\r'
+printf '      2,097,152  50%%    2.00MB/s    0:00:01 (xfr#3, to-chk=6/10)\\r'
+printf '\\nsent 2,097,152 bytes\\n'
+echo error >&2
+"""
+
+
+class Tests(unittest.TestCase):
+
+    def test_parse_line(self):
+        line = progress.parse_line(
+            "  1,234,567  45%   12.50MB/s    0:00:12 (xfr#12, to-chk=100/200)")
+        self.assertEqual(line.transferred_bytes, 1234567)
+        self.assertEqual(line.rate, 12.5 * 1024 ** 2)
+        self.assertEqual(line.transferred_files, 12)
+        self.assertEqual(line.checked_files, 100)
+        self.assertEqual(line.total_files, 200)
+
+        line = progress.parse_line(
+            "        1.23G  10%  512.00kB/s    0:01:00  (ir-chk=10/50)")
+        self.assertEqual(line.transferred_bytes, int(1.23 * 1024 ** 3))
+        self.assertIsNone(line.transferred_files)
+        self.assertEqual(line.checked_files, 40)
+        self.assertIsNone(progress.parse_line("sending incremental file list"))
+
+    def test_runs_and_eta(self):
+        tracker = progress.Progress("snapshot", expected_bytes=3000)
+        self.assertIsNone(tracker.get_eta())
+        tracker.update("  1,000  10%  100.00B/s  0:00:10 (xfr#1, to-chk=0/5)")
+        tracker.begin_run()
+        tracker.update("  1,000  10%  100.00B/s  0:00:10 (xfr#2, to-chk=1/3)")
+        self.assertEqual(tracker.transferred_bytes, 2000)
+        self.assertEqual(tracker.transferred_files, 3)
+        self.assertEqual(tracker.checked_files, 7)
+        self.assertEqual(tracker.get_eta(), 10)
+        self.assertEqual(tracker.get_stats()["bytes"], 2000)
+
+    def test_rsync_reports_progress(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cmd = os.path.join(tmpdir, "rsync")
+            with open(cmd, "w") as script:
+                script.write(FAKE_RSYNC)
+            os.chmod(cmd, stat.S_IRWXU)
+            destination = os.path.join(tmpdir, "destination")
+            tracker = progress.start(destination, "snapshot")
+            (returncode, stdoutdata, stderrdata) = rsync.rsync(
+                cmd, ["/source"], destination, None, [],
+                rsync.Filter([], [], [], [], []), None,
+                progress=tracker.update)
+            self.assertEqual(progress.get_state(destination)["bytes"],
+                             2097152)
+            progress.finish(destination)
+            self.assertIsNone(progress.get_state(destination))
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(returncode, 0)
+        self.assertIn(b"sent 2,097,152 bytes", stdoutdata)
+        self.assertEqual(stderrdata, b"error\n")
+        self.assertEqual(tracker.transferred_files, 3)
+        self.assertEqual(tracker.rate, 2 * 1024 ** 2)
@@ -0,0 +1,103 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rbackupd.replicate as replicate
+
+OLD = "task_2013-01-01T00:00:00_daily.snapshot"
+NEW = "task_2013-01-02T00:00:00_daily.snapshot"
+NEW_HOURLY = "task_2013-01-02T00:00:00_hourly.snapshot"
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.destination = os.path.join(self.tmpdir, "destination")
+        self.replica = os.path.join(self.tmpdir, "replica")
+        os.mkdir(self.destination)
+        os.mkdir(self.replica)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_tree(self, root):
+        os.makedirs(os.path.join(root, "a", "b"))
+        os.mkdir(os.path.join(root, "c"))
+        with open(os.path.join(root, "a", "b", "file"), "w") as f:
+            f.write("content")
+        os.symlink("b/file", os.path.join(root, "a", "link"))
+        os.utime(os.path.join(root, "a", "b", "file"), (1000, 1000))
+
+    def test_missing_snapshots(self):
+        os.mkdir(os.path.join(self.destination, OLD))
+        os.mkdir(os.path.join(self.destination, NEW))
+        os.symlink(NEW, os.path.join(self.destination, NEW_HOURLY))
+        os.mkdir(os.path.join(self.destination, "task_unrelated"))
+        # an empty replica only gets the latest snapshots
+        self.assertEqual(
+            replicate.get_missing_snapshots(self.destination, self.replica),
+            [NEW, NEW_HOURLY])
+        os.mkdir(os.path.join(self.replica, OLD))
+        os.mkdir(os.path.join(self.replica, NEW + ".replicating"))
+        self.assertEqual(
+            replicate.get_missing_snapshots(self.destination, self.replica),
+            [NEW, NEW_HOURLY])
+        os.mkdir(os.path.join(self.replica, NEW))
+        self.assertEqual(
+            replicate.get_missing_snapshots(self.destination, self.replica),
+            [])
+
+    def test_merkle_identical_trees(self):
+        self._make_tree(os.path.join(self.destination, OLD))
+        self._make_tree(os.path.join(self.replica, OLD))
+        hashes = replicate.compute_merkle(os.path.join(self.destination, OLD))
+        self.assertEqual(sorted(hashes), ["", "a", "a/b", "c"])
+        self.assertEqual(
+            hashes,
+            replicate.compute_merkle(os.path.join(self.replica, OLD)))
+
+    def test_merkle_mismatches(self):
+        self._make_tree(os.path.join(self.destination, OLD))
+        self._make_tree(os.path.join(self.replica, OLD))
+        with open(os.path.join(self.replica, OLD, "a", "b", "file"),
+                  "a") as f:
+            f.write("more")
+        os.mkdir(os.path.join(self.replica, OLD, "c", "extra"))
+        hashes = replicate.compute_merkle(os.path.join(self.destination, OLD))
+        other_hashes = replicate.compute_merkle(
+            os.path.join(self.replica, OLD))
+        self.assertNotEqual(hashes[""], other_hashes[""])
+        self.assertEqual(replicate.find_mismatches(hashes, other_hashes),
+                         ["a/b", "c/extra"])
+
+    def test_symlinked_snapshot(self):
+        class Task(object):
+            destination = self.destination
+            rsync_args = []
+        os.mkdir(os.path.join(self.destination, NEW))
+        os.symlink(NEW, os.path.join(self.destination, NEW_HOURLY))
+        os.mkdir(os.path.join(self.replica, NEW))
+        self.assertTrue(replicate.copy_snapshot("rsync", Task(), self.replica,
+                                                NEW_HOURLY))
+        self.assertEqual(os.readlink(os.path.join(self.replica, NEW_HOURLY)),
+                         NEW)
@@ -0,0 +1,276 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import datetime
+import os
+import random
+import shutil
+import stat
+import tempfile
+import unittest
+import unittest.mock
+
+import rbackupd
+import rbackupd.repository as repository
+import rbackupd.rsync as rsync
+
+# writes its arguments into the destination, which is the last one
+FAKE_RSYNC = """#!/bin/sh
+for destination; do :; done
+echo "$@" > "$destination/arguments"
+"""
+
+
+class Tests(unittest.TestCase):
+
+    def test_parse_matches_strptime(self):
+        start = datetime.datetime(1990, 1, 1)
+        for _ in range(1000):
+            date = start + datetime.timedelta(
+                seconds=random.randrange(60 * 365 * 86400))
+            name = "task_%s_daily.snapshot" % date.strftime(
+                "%Y-%m-%dT%H:%M:%S")
+            backup = repository.BackupFolder(name)
+            self.assertEqual(backup.date, date)
+            self.assertEqual(backup.interval_name, "daily")
+
+    def test_epoch_orders_like_date(self):
+        names = ["task_2013-01-01T00:00:00_daily.snapshot",
+                 "task_2012-12-31T23:59:59_weekly.snapshot",
+                 "task_2013-01-01T00:00:01_daily.snapshot"]
+        backups = [repository.BackupFolder(name) for name in names]
+        self.assertEqual(
+            sorted(backups, key=lambda backup: backup.epoch),
+            sorted(backups, key=lambda backup: backup.date))
+
+    def test_interval_names_are_shared(self):
+        first = repository.BackupFolder(
+            "task_2013-01-01T00:00:00_daily.snapshot")
+        second = repository.BackupFolder(
+            "other_2013-01-02T00:00:00_daily.snapshot")
+        self.assertIs(first.interval_name, second.interval_name)
+
+    def test_invalid_names(self):
+        for name in ("task_2013-01-01_daily.snapshot",
+                     "task_2013-13-01T00:00:00_daily.snapshot",
+                     "task_2013-01-01 00:00:00_daily.snapshot",
+                     "task_2013-01-01T00:00:00_daily"):
+            self.assertRaises(ValueError, repository.BackupFolder, name)
+
+    def test_invalid_dates(self):
+        for date in ("2021-02-30", "2021-02-29", "1900-02-29", "2013-04-31",
+                     "2013-01-00", "0000-01-01"):
+            name = "t_%sT00:00:00_daily.snapshot" % date
+            self.assertRaises(ValueError, repository.BackupFolder, name)
+            self.assertFalse(repository.is_backup_folder(name))
+        for timestamp in ("2013-01-01T-1:00:00", "2013-01-01T 1:00:00",
+                          "2013-01-01T01:+0:00", "2013-01-01T01:00:0_",
+                          "+013-01-01T00:00:00", "2013- 1-01T00:00:00",
+                          "2013-01-\u0661\u0661T00:00:00"):
+            name = "t_%s_daily.snapshot" % timestamp
+            self.assertRaises(ValueError, repository.BackupFolder, name)
+            self.assertFalse(repository.is_backup_folder(name))
+        self.assertEqual(repository.BackupFolder(
+            "t_2000-02-29T00:00:00_daily.snapshot").date,
+            datetime.datetime(2000, 2, 29))
+
+    def test_incomplete_snapshots(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cmd = os.path.join(tmpdir, "rsync")
+            with open(cmd, "w") as script:
+                script.write(FAKE_RSYNC)
+            os.chmod(cmd, stat.S_IRWXU)
+            destination = os.path.join(tmpdir, "destination")
+            for name in ("task_2013-01-01T00:00:00_daily.snapshot",
+                         "task_2013-01-03T00:00:00_daily.snapshot.incomplete",
+                         "task_2013-01-02T00:00:00_daily.snapshot.incomplete"):
+                os.makedirs(os.path.join(destination, name))
+            with open(os.path.join(
+                    destination,
+                    "task_2013-01-03T00:00:00_daily.snapshot.incomplete",
+                    "transferred"), "w"):
+                pass
+            self.assertEqual(
+                repository.get_incomplete_folders(destination),
+                ["task_2013-01-02T00:00:00_daily.snapshot.incomplete",
+                 "task_2013-01-03T00:00:00_daily.snapshot.incomplete"])
+            repo = repository.Repository(
+                ["/source"], destination, "task",
+                collections.OrderedDict(daily="0 0 * * * *"), {}, {},
+                rsync.Filter([], [], [], [], []), None, ["-a"], [], None)
+            self.assertEqual([backup.name for backup in repo.backups],
+                             ["task_2013-01-01T00:00:00_daily.snapshot"])
+
+            params = repo.get_backup_params(
+                "daily", datetime.datetime(2013, 1, 4))
+            self.assertTrue(rbackupd.create_backup(params, cmd, None))
+            path = os.path.join(destination, params.folder)
+            # the newest interrupted snapshot was resumed, the older one
+            # removed
+            self.assertTrue(os.path.exists(os.path.join(path, "transferred")))
+            self.assertEqual(repository.get_incomplete_folders(destination),
+                             [])
+            with open(os.path.join(path, "arguments")) as arguments:
+                arguments = arguments.read().split()
+            self.assertIn("--partial", arguments)
+            self.assertIn("--delete", arguments)
+            self.assertIn("--link-dest=%s" % os.path.join(
+                destination, "task_2013-01-01T00:00:00_daily.snapshot"),
+                arguments)
+            self.assertEqual(repo.get_latest_backup().name, params.folder)
+            self.assertEqual(os.path.realpath(
+                os.path.join(destination, "latest")), path)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _resume(self, tmpdir, sources):
+        cmd = os.path.join(tmpdir, "rsync")
+        with open(cmd, "w") as script:
+            script.write(FAKE_RSYNC)
+        os.chmod(cmd, stat.S_IRWXU)
+        destination = os.path.join(tmpdir, "destination")
+        incomplete = os.path.join(
+            destination, "task_2013-01-01T00:00:00_daily.snapshot.incomplete")
+        os.makedirs(incomplete)
+        with open(os.path.join(incomplete, "transferred"), "w"):
+            pass
+        repo = repository.Repository(
+            sources, destination, "task",
+            collections.OrderedDict(daily="0 0 * * * *"), {}, {},
+            rsync.Filter([], [], [], [], []), None, ["-a"], [], None)
+        params = repo.get_backup_params(
+            "daily", datetime.datetime(2013, 1, 2))
+        with unittest.mock.patch.object(rbackupd, "admit_snapshot",
+                                        return_value=(True, None)):
+            self.assertTrue(rbackupd.create_backup(params, cmd, None))
+        path = os.path.join(destination, params.folder)
+        with open(os.path.join(path, "arguments")) as arguments:
+            return (path, arguments.read())
+
+    def test_resume_several_groups(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # every run only deletes within its own sources
+            (path, arguments) = self._resume(
+                tmpdir, ["/srv/one", "/srv/two", "host:/srv/three"])
+            self.assertTrue(os.path.exists(os.path.join(path, "transferred")))
+            self.assertIn(" --delete ", arguments)
+            self.assertIn("--filter=P /one", arguments)
+            self.assertIn("--filter=P /two", arguments)
+            self.assertNotIn("--filter=P /three", arguments)
+        finally:
+            shutil.rmtree(tmpdir)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # the contents of "/srv/one/" cannot be told from removed files
+            (path, arguments) = self._resume(tmpdir,
+                                             ["/srv/one/", "/srv/two"])
+            self.assertFalse(os.path.exists(os.path.join(path,
+                                                         "transferred")))
+            self.assertNotIn(" --delete ", arguments)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_reflink_snapshot_is_not_admitted(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cmd = os.path.join(tmpdir, "rsync")
+            with open(cmd, "w") as script:
+                script.write(FAKE_RSYNC)
+            os.chmod(cmd, stat.S_IRWXU)
+            destination = os.path.join(tmpdir, "destination")
+            first = os.path.join(destination,
+                                 "task_2013-01-01T00:00:00_daily.snapshot")
+            os.makedirs(first)
+            with open(os.path.join(first, "file"), "w"):
+                pass
+            repo = repository.Repository(
+                ["/source"], destination, "task",
+                collections.OrderedDict(daily="0 0 * * * *"), {}, {},
+                rsync.Filter([], [], [], [], []), None, ["-a"], [], None,
+                "reflink")
+            params = repo.get_backup_params(
+                "daily", datetime.datetime(2013, 1, 2))
+            # only snapshots copying every file are admitted
+            with unittest.mock.patch.object(
+                    rbackupd, "admit_snapshot",
+                    return_value=(False, None)) as admit:
+                self.assertTrue(rbackupd.create_backup(params, cmd, None))
+            self.assertFalse(admit.called)
+            path = os.path.join(destination, params.folder)
+            self.assertTrue(os.path.exists(os.path.join(path, "file")))
+            with open(os.path.join(path, "arguments")) as arguments:
+                arguments = arguments.read().split()
+            self.assertIn("--inplace", arguments)
+            self.assertFalse(any(argument.startswith("--link-dest")
+                                 for argument in arguments))
+
+            shutil.rmtree(destination)
+            os.makedirs(destination)
+            params = repo.get_backup_params(
+                "daily", datetime.datetime(2013, 1, 3))
+            with unittest.mock.patch.object(
+                    rbackupd, "admit_snapshot",
+                    return_value=(False, None)) as admit:
+                self.assertFalse(rbackupd.create_backup(params, cmd, None))
+            self.assertTrue(admit.called)
+            self.assertEqual(os.listdir(destination), [".rbackupd"])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_materialize_alias(self):
+        destination = tempfile.mkdtemp()
+        try:
+            real = "task_2013-01-01T00:00:00_daily.snapshot"
+            weekly = "task_2013-01-01T00:00:00_weekly.snapshot"
+            monthly = "task_2013-01-01T00:00:00_monthly.snapshot"
+            os.makedirs(os.path.join(destination, real, "files"))
+            repo = repository.Repository(
+                ["/source"], destination, "task",
+                collections.OrderedDict(daily="0 0 * * * *"), {}, {},
+                rsync.Filter([], [], [], [], []), None, ["-a"], [], None)
+            repo.catalog.add(real, stats={"bytes": 1}, aliases=[weekly,
+                                                                monthly])
+            repo.catalog.add(weekly, alias=real)
+            repo.catalog.add(monthly, alias=real)
+            os.symlink(real, os.path.join(destination, "latest"))
+            self.assertEqual(len(repo.backups), 3)
+            self.assertEqual(repo.get_source_paths(weekly),
+                             [("/source", os.path.join(destination, real,
+                                                       "source"))])
+
+            rbackupd.materialize_alias(repo, real)
+            self.assertEqual(sorted(os.listdir(destination)),
+                             [".rbackupd", "latest", weekly])
+            self.assertEqual(repo.catalog.get(weekly),
+                             {"stats": {"bytes": 1}, "aliases": [monthly]})
+            self.assertEqual(repo.resolve(monthly), weekly)
+            self.assertEqual(os.path.realpath(
+                os.path.join(destination, "latest")),
+                os.path.realpath(os.path.join(destination, weekly)))
+            self.assertEqual(sorted(backup.name for backup in repo.backups),
+                             [monthly, weekly])
+
+            rbackupd.remove_alias(repo, monthly)
+            self.assertEqual(repo.catalog.get(weekly)["aliases"], [])
+            self.assertEqual([backup.name for backup in repo.backups],
+                             [weekly])
+        finally:
+            shutil.rmtree(destination)
@@ -0,0 +1,149 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import datetime
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import rbackupd.files as files
+import rbackupd.repository as repository
+import rbackupd.restore as restore
+
+FIRST = "task_2013-01-01T00:00:00_daily.snapshot"
+SECOND = "task_2013-01-02T00:00:00_daily.snapshot"
+WEEKLY = "task_2013-01-03T00:00:00_weekly.snapshot"
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, "source")
+        self.destination = os.path.join(self.tmpdir, "destination")
+        for snapshot in (FIRST, SECOND, WEEKLY):
+            os.makedirs(os.path.join(self.destination, snapshot, "source"))
+        self.repo = repository.Repository(
+            [self.source], self.destination, "task",
+            collections.OrderedDict(daily="0 0 * * * *"), {}, {}, None, None,
+            ["-a"], [], None)
+        self.tree = os.path.join(self.tmpdir, "tree")
+        os.makedirs(os.path.join(self.tree, "dir"))
+        with open(os.path.join(self.tree, "dir", "file"), "w") as tree_file:
+            tree_file.write("content")
+        os.link(os.path.join(self.tree, "dir", "file"),
+                os.path.join(self.tree, "link"))
+        os.symlink("dir/file", os.path.join(self.tree, "symlink"))
+        os.chmod(os.path.join(self.tree, "dir"), 0o750)
+        os.utime(os.path.join(self.tree, "dir"), (1000000000, 1000000000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_find_latest(self):
+        self.assertEqual(restore.find_snapshot(self.repo), WEEKLY)
+
+    def test_find_at(self):
+        at = datetime.datetime(2013, 1, 2, 12)
+        self.assertEqual(restore.find_snapshot(self.repo, at), SECOND)
+        at = datetime.datetime(2012, 12, 31)
+        self.assertIsNone(restore.find_snapshot(self.repo, at))
+
+    def test_find_interval(self):
+        self.assertEqual(restore.find_snapshot(self.repo, None, "daily"),
+                         SECOND)
+
+    def test_snapshot_path(self):
+        path = restore.get_snapshot_path(
+            self.repo, FIRST, os.path.join(self.source, "dir", "file"))
+        self.assertEqual(path, os.path.join(self.destination, FIRST,
+                                            "source", "dir", "file"))
+        self.assertIsNone(restore.get_snapshot_path(self.repo, FIRST,
+                                                    "/elsewhere"))
+
+    def test_copy_tree(self):
+        target = os.path.join(self.tmpdir, "copy")
+        result = restore.copy_tree(self.tree, target, workers=2)
+        self.assertEqual(result.files, 3)
+        with open(os.path.join(target, "link")) as copied:
+            self.assertEqual(copied.read(), "content")
+        self.assertTrue(os.path.samefile(os.path.join(target, "link"),
+                                         os.path.join(target, "dir", "file")))
+        self.assertEqual(os.readlink(os.path.join(target, "symlink")),
+                         "dir/file")
+        st = os.stat(os.path.join(target, "dir"))
+        self.assertEqual(st.st_mode & 0o777, 0o750)
+        self.assertEqual(st.st_mtime, 1000000000)
+
+    def test_copy_error(self):
+        tree = os.path.join(self.tmpdir, "many")
+        os.mkdir(tree)
+        for i in range(200):
+            with open(os.path.join(tree, "file%03d" % i), "w") as f:
+                f.write("content")
+        copy_file = restore._copy_file
+        copied = []
+
+        def failing_copy(path, target_path, st):
+            copied.append(path)
+            if len(copied) == 1:
+                raise OSError(errno.ENOSPC, "No space left on device")
+            copy_file(path, target_path, st)
+
+        # the first copy fails long before the last ones are submitted
+        with unittest.mock.patch.object(restore, "_copy_file",
+                                        failing_copy):
+            with self.assertRaises(OSError) as cm:
+                restore.copy_tree(tree, os.path.join(self.tmpdir, "copy"),
+                                  workers=1)
+        self.assertEqual(cm.exception.errno, errno.ENOSPC)
+
+    def test_copy_sparse_file(self):
+        path = os.path.join(self.tree, "sparse")
+        with open(path, "wb") as sparse:
+            sparse.write(b"x")
+            sparse.seek(10 * 1024 * 1024)
+            sparse.write(b"y")
+        target = os.path.join(self.tmpdir, "sparse")
+        restore.copy_tree(path, target)
+        with open(path, "rb") as original, open(target, "rb") as copied:
+            self.assertEqual(original.read(), copied.read())
+        self.assertLessEqual(os.stat(target).st_blocks,
+                             os.stat(path).st_blocks)
+
+    def test_existing_files_are_kept(self):
+        target = os.path.join(self.tmpdir, "copy")
+        restore.copy_tree(self.tree, target)
+        with self.assertRaises(FileExistsError):
+            restore.copy_tree(self.tree, target)
+        restore.copy_tree(self.tree, target, overwrite=True)
+
+    def test_clone_file_data(self):
+        path = os.path.join(self.tree, "dir", "file")
+        target = os.path.join(self.tmpdir, "clone")
+        with open(path, "rb") as original, open(target, "wb") as clone:
+            cloned = files.clone_file_data(original.fileno(), clone.fileno(),
+                                           os.stat(path).st_size)
+        # the file is copied where reflinks are not supported
+        self.assertEqual(cloned, files.supports_reflink(self.tmpdir))
+        with open(target) as clone:
+            self.assertEqual(clone.read(), "content")
@@ -0,0 +1,122 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rbackupd.rsync as rsync
+
+
+class Tests(unittest.TestCase):
+
+    def test_parse_local(self):
+        for source in ["/home/user", "relative/path", "/path/with:colon",
+                       "./file:name"]:
+            location = rsync.parse_location(source)
+            self.assertEqual(location.transport, rsync.Transports.LOCAL)
+            self.assertEqual(location.path, source)
+
+    def test_parse_ssh(self):
+        location = rsync.parse_location("user@host:/home/user")
+        self.assertEqual(location.transport, rsync.Transports.SSH)
+        self.assertEqual(location.host, "user@host")
+        self.assertEqual(location.path, "/home/user")
+
+    def test_group_sources(self):
+        sources = ["host1:/a", "/local/a", "user@host2:/a", "host1:/b",
+                   "/local/b", "user@host2:/b", "host2:/c"]
+        groups = [group for (_, group) in rsync.group_sources(sources)]
+        self.assertEqual(groups, [["host1:/a", "host1:/b"],
+                                  ["/local/a"],
+                                  ["user@host2:/a", "user@host2:/b"],
+                                  ["/local/b"],
+                                  ["host2:/c"]])
+
+    def test_parse_daemon_url(self):
+        location = rsync.parse_location("rsync://user@host:8873/mod/a/b")
+        self.assertEqual(location.transport, rsync.Transports.DAEMON)
+        self.assertEqual(location.host, "user@host")
+        self.assertEqual(location.port, 8873)
+        self.assertEqual(location.module, "mod")
+        self.assertEqual(location.path, "a/b")
+        self.assertEqual(location.get_module_url(),
+                         "rsync://user@host:8873/mod/")
+
+    def test_parse_daemon_double_colon(self):
+        location = rsync.parse_location("host::mod/a")
+        self.assertEqual(location.transport, rsync.Transports.DAEMON)
+        self.assertEqual(location.host, "host")
+        self.assertIsNone(location.port)
+        self.assertEqual(location.module, "mod")
+        self.assertEqual(location.get_module_url(), "rsync://host/mod/")
+
+    def test_group_daemon_sources_by_module(self):
+        sources = ["host::mod1/a", "rsync://host/mod1/b", "host::mod2/a",
+                   "host:/a"]
+        groups = [group for (_, group) in rsync.group_sources(sources)]
+        self.assertEqual(groups, [["host::mod1/a", "rsync://host/mod1/b"],
+                                  ["host::mod2/a"],
+                                  ["host:/a"]])
+
+    def test_destination_name(self):
+        self.assertEqual(rsync.get_destination_name("/srv/a", False), "a")
+        self.assertEqual(rsync.get_destination_name("host:/srv/a", False),
+                         "a")
+        self.assertEqual(rsync.get_destination_name("host::mod/a", False),
+                         "a")
+        self.assertIsNone(rsync.get_destination_name("/srv/a/", False))
+        self.assertIsNone(rsync.get_destination_name("host::mod", False))
+        self.assertEqual(rsync.get_destination_name("/srv/a/", True), "srv")
+        self.assertEqual(rsync.get_destination_name("/srv/./a/b", True),
+                         "a")
+        self.assertIsNone(rsync.get_destination_name("/", True))
+
+    def test_module_exists(self):
+        location = rsync.parse_location("rsync://host/mod/")
+        (exists, _) = rsync.module_exists("true", location, [])
+        self.assertTrue(exists)
+        (exists, _) = rsync.module_exists("false", location, [])
+        self.assertFalse(exists)
+
+    def test_capture_log(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # writes its log like rsync, but transfers nothing
+            cmd = os.path.join(tmpdir, "rsync")
+            with open(cmd, "w") as f:
+                f.write("#!/bin/sh\n"
+                        "for arg; do\n"
+                        "  case \"$arg\" in --log-file=*) log=${arg#*=};; "
+                        "esac\n"
+                        "done\n"
+                        "echo \">f+++++++++ file\" >> \"$log\"\n")
+            os.chmod(cmd, 0o755)
+            destination = os.path.join(tmpdir, "snapshot")
+            data = []
+            (returncode, _, _) = rsync.rsync(
+                cmd, ["/src"], destination, None, (),
+                rsync.Filter([], [], [], [], []),
+                rsync.LogfileOptions("rsync.log", None, "gzip"),
+                log=data.append)
+            self.assertEqual(returncode, 0)
+            self.assertEqual(b"".join(data), b">f+++++++++ file\n")
+            self.assertEqual(os.listdir(destination), [])
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,119 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import rbackupd.rsynclog as rsynclog
+
+NAME = "task_2013-01-01T00:00:00_daily.snapshot"
+PREFIX = b"2013/01/01 00:00:00 [1234] "
+
+
+def _lines():
+    lines = [PREFIX + b"building file list"]
+    for directory in (b"home/a", b"home/b", b"srv"):
+        lines.append(PREFIX + b"cd+++++++++ " + directory + b"/")
+        for i in range(20):
+            lines.append(PREFIX + b">f+++++++++ %s/file%d" % (directory, i))
+    lines.append(PREFIX + b"cL+++++++++ srv/link -> file1")
+    lines.append(PREFIX + b"*deleting   srv/old")
+    lines.append(PREFIX + b"sent 1234 bytes  received 56 bytes")
+    return lines
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.destination = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.destination)
+
+    def _write(self, data, log_format=None):
+        writer = rsynclog.LogWriter(self.destination, NAME, "gzip",
+                                    log_format, block_size=1000)
+        # rsync does not write whole lines at once
+        for i in range(0, len(data), 100):
+            writer.write(data[i:i + 100])
+        self.assertFalse(rsynclog.exists(self.destination, NAME))
+        writer.commit()
+        return rsynclog.LogReader(self.destination, NAME)
+
+    def test_parse_path(self):
+        self.assertEqual(rsynclog.parse_path(PREFIX + b">f..t...... a/b c"),
+                         b"a/b c")
+        self.assertEqual(rsynclog.parse_path(PREFIX + b"cd+++++++++ a/"),
+                         b"a")
+        self.assertEqual(rsynclog.parse_path(PREFIX + b"cL+++++++++ l -> t"),
+                         b"l")
+        self.assertEqual(rsynclog.parse_path(PREFIX + b"hf+++++++++ h => f"),
+                         b"h")
+        self.assertIsNone(rsynclog.parse_path(PREFIX + b"total size is 0"))
+
+    def test_read(self):
+        lines = _lines()
+        reader = self._write(b"\n".join(lines))
+        self.assertTrue(len(reader.blocks) > 3)
+        self.assertEqual(list(reader.read()), lines)
+        # the blocks form a valid gzip file
+        with gzip.open(reader.path) as f:
+            self.assertEqual(f.read(), b"\n".join(lines) + b"\n")
+
+    def test_search(self):
+        lines = _lines()
+        reader = self._write(b"\n".join(lines) + b"\n")
+        self.assertTrue(len(reader.get_blocks("srv")) <
+                        len(reader.blocks))
+        self.assertEqual(list(reader.search("/home/a/file1")),
+                         [PREFIX + b">f+++++++++ home/a/file1"])
+        found = list(reader.search("srv"))
+        self.assertEqual(len(found), 23)
+        self.assertEqual(found[0], PREFIX + b"cd+++++++++ srv/")
+        self.assertEqual(found[-1], PREFIX + b"*deleting   srv/old")
+        self.assertEqual(list(reader.search("home/c")), [])
+
+    def test_custom_format(self):
+        lines = [PREFIX + b"recv home/a/file%d 100" % i for i in range(50)]
+        reader = self._write(b"\n".join(lines) + b"\n", "recv %n %l")
+        self.assertEqual(reader.get_blocks("home/a/file1"), reader.blocks)
+        self.assertEqual(len(list(reader.search("home/a/file1"))), 11)
+
+    def test_retention(self):
+        self._write(b"\n".join(_lines()))
+        other = NAME.replace("daily", "weekly")
+        rsynclog.rename(self.destination, NAME, other)
+        self.assertFalse(rsynclog.exists(self.destination, NAME))
+        self.assertEqual(list(rsynclog.LogReader(self.destination,
+                                                 other).read()), _lines())
+        rsynclog.remove(self.destination, other)
+        self.assertEqual(os.listdir(rsynclog.get_directory(
+            self.destination)), [])
+        with self.assertRaises(rsynclog.LogError):
+            rsynclog.LogReader(self.destination, other)
+
+    def test_incomplete(self):
+        writer = rsynclog.LogWriter(self.destination, NAME, "xz")
+        writer.write(PREFIX + b">f+++++++++ file\n")
+        writer.close()
+        rsynclog.remove_incomplete(self.destination)
+        self.assertEqual(os.listdir(rsynclog.get_directory(
+            self.destination)), [])
@@ -0,0 +1,87 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import rbackupd.repository as repository
+import rbackupd.schedule as schedule
+
+NOW = datetime.datetime(2013, 1, 1, 12, 0, 30)
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _create(self, name, schedule_string, latest, seconds=None):
+        destination = os.path.join(self.tmpdir, name)
+        folder = "%s_%s_interval.snapshot" % (
+            name, latest.strftime("%Y-%m-%dT%H:%M:%S"))
+        os.makedirs(os.path.join(destination, folder))
+        repo = repository.Repository(
+            ["/source"], destination, name,
+            collections.OrderedDict(interval=schedule_string), {}, {},
+            None, None, ["-a"], [], None)
+        if seconds is not None:
+            repo.catalog.add(folder, stats={"bytes": 0, "files": 0,
+                                            "seconds": seconds})
+        return repo
+
+    def test_urgency(self):
+        hourly = self._create("hourly", "0 * * * * *",
+                              datetime.datetime(2013, 1, 1, 11, 0), 600)
+        urgency = schedule.get_urgency(hourly, 1, NOW)
+        self.assertEqual(urgency.due_since, datetime.datetime(2013, 1, 1, 12))
+        self.assertEqual(urgency.deadline, datetime.datetime(2013, 1, 1, 13))
+        self.assertEqual(urgency.get_slack(NOW), 3570 - 600)
+        urgency.priority = 2
+        self.assertEqual(urgency.get_slack(NOW), (3570 - 600) / 2)
+        urgency.expected_seconds = 4000
+        self.assertEqual(urgency.get_slack(NOW), -430 * 2)
+
+        fresh = self._create("fresh", "0 * * * * *",
+                             datetime.datetime(2013, 1, 1, 12, 0))
+        self.assertIsNone(schedule.get_urgency(fresh, 1, NOW))
+        self.assertEqual(schedule.get_urgency(fresh, 1, NOW, due=True)
+                         .due_since, NOW)
+
+    def test_order(self):
+        repos = [
+            self._create("fresh", "* * * * * *",
+                         datetime.datetime(2013, 1, 1, 12, 0)),
+            self._create("daily", "0 0 * * * *",
+                         datetime.datetime(2012, 12, 31, 0, 0)),
+            self._create("hourly", "0 * * * * *",
+                         datetime.datetime(2013, 1, 1, 11, 0)),
+            self._create("slow", "0 * * * * *",
+                         datetime.datetime(2013, 1, 1, 11, 0), 3000),
+            self._create("important", "0 0 * * * *",
+                         datetime.datetime(2012, 12, 31, 0, 0)),
+        ]
+        ordered = schedule.order(repos, {"important": 10}, NOW)
+        self.assertEqual([repo.name for repo in ordered],
+                         ["slow", "hourly", "important", "daily", "fresh"])
@@ -0,0 +1,103 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import rbackupd.constants as const
+import rbackupd.settings as settings
+
+MAIN = """
+[include]
+directory = "{include}"
+[logging]
+logfile = "/var/log/rbackupd/log"
+loglevel = "default"
+[default]
+rsync_args = "-aHAX --relative"
+rsync_args = "--no-implied-dirs"
+one_fs = yes
+ssh_args = "-p 22"
+overlapping = "symlink"
+"""
+
+TASK = """
+[task]
+name = "{name}"
+source = "/src/{name}"
+destination = "/dst/{name}"
+overlapping = "{overlapping}"
+interval["daily"] = "0 0 * * * *"
+keep["daily"] = 7
+keep_age["daily"] = "1M"
+"""
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.include = os.path.join(self.tmpdir, "conf.d")
+        os.mkdir(self.include)
+        self.path = os.path.join(self.tmpdir, "rbackupd.conf")
+        with open(self.path, "w") as conf:
+            conf.write(MAIN.format(include=self.include))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_task(self, filename, name, overlapping="single"):
+        with open(os.path.join(self.include, filename), "w") as conf:
+            conf.write(TASK.format(name=name, overlapping=overlapping))
+
+    def test_tasks_from_include_directory(self):
+        self._write_task("b.conf", "b")
+        self._write_task("a.conf", "a")
+        self._write_task("ignored.txt", "c")
+        conf = settings.load(self.path)
+        self.assertEqual(list(conf.tasks.keys()), ["a", "b"])
+        task = conf.tasks["a"]
+        self.assertEqual(task.rsync_args,
+                         ["-aHAX", "--relative", "--no-implied-dirs", "-x"])
+        self.assertEqual(task.ssh_args, ["-p", "22"])
+        self.assertEqual(task.overlapping, "single")
+        self.assertEqual(task.snapshot_backend, "hardlink")
+        self.assertEqual(task.priority, 1)
+
+    def test_duplicate_task(self):
+        self._write_task("a.conf", "a")
+        self._write_task("b.conf", "a")
+        with self.assertRaises(settings.SettingsError) as context:
+            settings.load(self.path)
+        self.assertEqual(context.exception.exit_code,
+                         const.EXIT_INVALID_CONFIG_FILE)
+
+    def test_invalid_overlapping(self):
+        self._write_task("a.conf", "a", overlapping="invalid")
+        self.assertRaises(settings.SettingsError, settings.load, self.path)
+
+    def test_changed_tasks_differ(self):
+        self._write_task("a.conf", "a")
+        self._write_task("b.conf", "b")
+        old = settings.load(self.path)
+        self._write_task("b.conf", "b", overlapping="hardlink")
+        new = settings.load(self.path)
+        self.assertEqual(old.tasks["a"], new.tasks["a"])
+        self.assertNotEqual(old.tasks["b"], new.tasks["b"])
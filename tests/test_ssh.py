@@ -0,0 +1,156 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+import rbackupd.ssh
+
+# A stand-in for ssh(1) that only understands the ControlMaster operations.
+# The control socket is simulated by a regular file, every invocation is
+# recorded in a logfile. Connecting to the host "slow" blocks while the file
+# "block" exists.
+STUB = """#!/bin/sh
+echo "$@" >> "{log}"
+path=""
+op=""
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -o) case "$2" in ControlPath=*) path="${{2#ControlPath=}}";; esac
+            shift;;
+        -O) op="$2"; shift;;
+        -M) op="master";;
+        *) host="$1";;
+    esac
+    shift
+done
+case "$op" in
+    master) while [ "$host" = slow ] && [ -e "{block}" ]; do sleep 0.05; done
+            touch "$path";;
+    check) [ -e "$path" ];;
+    exit) rm -f "$path";;
+esac
+"""
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmpdir, "log")
+        self.stub = os.path.join(self.tmpdir, "ssh")
+        self.block = os.path.join(self.tmpdir, "block")
+        with open(self.stub, "w") as stub:
+            stub.write(STUB.format(log=self.log, block=self.block))
+        os.chmod(self.stub, stat.S_IRWXU)
+        self.pool = rbackupd.ssh.ConnectionPool(
+            self.stub,
+            control_dir=os.path.join(self.tmpdir, "control"),
+            check_interval=0)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _invocations(self, marker):
+        with open(self.log) as log:
+            return len([line for line in log if marker in line.split()])
+
+    def test_control_dir_is_private(self):
+        mode = os.stat(self.pool.control_dir).st_mode
+        self.assertEqual(stat.S_IMODE(mode), 0o700)
+
+    def test_existing_control_dir_is_checked(self):
+        shared = os.path.join(self.tmpdir, "shared")
+        os.mkdir(shared)
+        os.chmod(shared, 0o1777)
+        with self.assertRaises(rbackupd.ssh.ControlDirError):
+            rbackupd.ssh.ConnectionPool(self.stub, control_dir=shared)
+        # the directory is left as it is
+        self.assertEqual(stat.S_IMODE(os.stat(shared).st_mode), 0o1777)
+        os.chmod(shared, 0o755)
+        pool = rbackupd.ssh.ConnectionPool(self.stub, control_dir=shared)
+        pool.close()
+        self.assertEqual(stat.S_IMODE(os.stat(shared).st_mode), 0o755)
+
+    def test_slow_host_does_not_block_others(self):
+        open(self.block, "w").close()
+        connected = threading.Event()
+
+        def connect_slow():
+            with self.pool.session("slow", []):
+                connected.set()
+
+        thread = threading.Thread(target=connect_slow)
+        thread.start()
+        while not os.path.exists(self.log) or self._invocations("slow") == 0:
+            time.sleep(0.01)
+        # lets the slow host connect eventually if sessions block each other
+        timer = threading.Timer(5, os.remove, [self.block])
+        timer.start()
+        try:
+            with self.pool.session("fast", []) as args:
+                self.assertIn("ControlMaster=no", args)
+            self.assertFalse(connected.is_set())
+        finally:
+            timer.cancel()
+            if os.path.exists(self.block):
+                os.remove(self.block)
+            thread.join()
+        self.assertTrue(connected.is_set())
+
+    def test_master_is_reused(self):
+        for _ in range(3):
+            with self.pool.session("user@host", ["-p", "22"]) as args:
+                self.assertIn("ControlMaster=no", args)
+        self.assertEqual(self._invocations("-M"), 1)
+
+    def test_different_args_use_different_masters(self):
+        with self.pool.session("host", ["-p", "22"]) as args_1:
+            pass
+        with self.pool.session("host", ["-p", "2222"]) as args_2:
+            pass
+        self.assertNotEqual(args_1, args_2)
+        self.assertEqual(self._invocations("-M"), 2)
+
+    def test_dead_master_is_recycled(self):
+        with self.pool.session("host", []) as args:
+            path = args[1].partition("=")[2]
+        os.remove(path)
+        with self.pool.session("host", []):
+            self.assertTrue(os.path.exists(path))
+        self.assertEqual(self._invocations("-M"), 2)
+
+    def test_close_removes_sockets(self):
+        with self.pool.session("host", []) as args:
+            path = args[1].partition("=")[2]
+        self.pool.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_failing_master_falls_back(self):
+        pool = rbackupd.ssh.ConnectionPool("/does/not/exist")
+        try:
+            with pool.session("host", []) as args:
+                self.assertEqual(args, [])
+        finally:
+            pool.close()
@@ -0,0 +1,129 @@
+# -*- encoding: utf-8 -*-
+# Copyright (c) 2013 Hannes Körber <hannes.koerber+rbackupd@gmail.com>
+#
+# This file is part of rbackupd.
+#
+# rbackupd is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rbackupd is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+
+import rbackupd
+import rbackupd.repository as repository
+import rbackupd.verify as verify
+
+FIRST = "task_2013-01-01T00:00:00_daily.snapshot"
+SECOND = "task_2013-01-02T00:00:00_daily.snapshot"
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, "source")
+        self.destination = os.path.join(self.tmpdir, "destination")
+        os.makedirs(os.path.join(self.source, "dir"))
+        for (name, content) in (("a", "a"), ("dir/b", "b")):
+            with open(os.path.join(self.source, name), "w") as source:
+                source.write(content)
+        # without --relative, the source ends up under its basename
+        shutil.copytree(self.source,
+                        os.path.join(self.destination, FIRST, "source"))
+        self.repo = repository.Repository(
+            [self.source], self.destination, "task",
+            collections.OrderedDict(daily="0 0 * * * *"), {}, {}, None, None,
+            ["-a"], [], None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _corrupt(self, snapshot):
+        path = os.path.join(self.destination, snapshot, "source", "a")
+        st = os.stat(path)
+        with open(path, "w") as corrupted:
+            corrupted.write("x")
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def test_verify_ok(self):
+        result = verify.verify_snapshot(self.repo, FIRST)
+        self.assertTrue(result.ok)
+        self.assertEqual(result.files, 2)
+        self.assertEqual(result.hashed_files, 2)
+
+    def test_mismatch(self):
+        self._corrupt(FIRST)
+        result = verify.verify_snapshot(self.repo, FIRST)
+        self.assertEqual(len(result.mismatches), 1)
+
+    def test_hardlinks_inherit_verdict(self):
+        self._corrupt(FIRST)
+        verify.verify_snapshot(self.repo, FIRST)
+        shutil.copytree(os.path.join(self.destination, FIRST),
+                        os.path.join(self.destination, SECOND),
+                        copy_function=os.link)
+        result = verify.verify_snapshot(self.repo, SECOND)
+        self.assertEqual(result.hashed_files, 0)
+        self.assertEqual(result.inherited, 2)
+        self.assertEqual(len(result.mismatches), 1)
+
+    def test_changed_source(self):
+        with open(os.path.join(self.source, "a"), "w") as source:
+            source.write("changed")
+        result = verify.verify_snapshot(self.repo, FIRST)
+        self.assertTrue(result.ok)
+        self.assertEqual(result.changed, 1)
+
+    def _link_copy(self):
+        shutil.copytree(os.path.join(self.destination, FIRST),
+                        os.path.join(self.destination, SECOND),
+                        copy_function=os.link)
+
+    def test_removed_snapshot_is_not_inherited(self):
+        verify.verify_snapshot(self.repo, FIRST)
+        self._link_copy()
+        # the inodes of a removed snapshot may be reused by any file
+        shutil.rmtree(os.path.join(self.destination, FIRST))
+        result = verify.verify_snapshot(self.repo, SECOND)
+        self.assertEqual(result.inherited, 0)
+        self.assertEqual(result.hashed_files, 2)
+        verify.remove_verdicts(self.destination, FIRST)
+        self.assertEqual(os.listdir(verify.get_verdicts_dir(
+            self.destination)), [SECOND])
+
+    def test_changed_inode_is_not_inherited(self):
+        verify.verify_snapshot(self.repo, FIRST)
+        self._link_copy()
+        path = os.path.join(self.destination, SECOND, "source", "a")
+        os.utime(path, (1000000000, 1000000000))
+        result = verify.verify_snapshot(self.repo, SECOND)
+        self.assertEqual(result.inherited, 1)
+        self.assertEqual(result.changed, 1)
+
+    def test_reflink_snapshots_inherit_verdict(self):
+        self.repo.backend = "reflink"
+        self._corrupt(FIRST)
+        verify.verify_snapshot(self.repo, FIRST)
+        rbackupd.clone_snapshot(os.path.join(self.destination, FIRST),
+                                os.path.join(self.destination, SECOND), None)
+        path = os.path.join(self.destination, SECOND, "source", "dir", "b")
+        os.utime(path, (1000000000, 1000000000))
+        result = verify.verify_snapshot(self.repo, SECOND)
+        self.assertEqual(result.inherited, 1)
+        self.assertEqual(result.mismatches,
+                         [os.path.join(self.destination, SECOND, "source",
+                                       "a")])
+        self.assertEqual(result.changed, 1)